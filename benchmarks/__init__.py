@@ -0,0 +1,9 @@
+"""Benchmarks for the AMIE mediator
+
+The modules in this package drive :class:`~mediator.AMIEMediator` against
+in-process stand-ins for the AMIE service and the local Service Provider.
+Like the scripts in ``bin``, they expect the ``src`` directory to be on the
+Python path; e.g. from the top-level directory::
+
+    PYTHONPATH=src python -m benchmarks.throughput --help
+"""
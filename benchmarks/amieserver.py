@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""Local AMIE REST server simulator
+
+Serve a :class:`~benchmarks.fakeamie.SimulatedAMIE` workload over HTTP, so
+``bin/amie`` and ``bin/test-scenario`` can be run end to end (e.g. for soak
+tests) on a machine without network access. The server implements the parts
+of the AMIE REST API that ``amieclient.AMIEClient`` and ``bin/test-scenario``
+use::
+
+    GET  <base>/packets/<site>                          : list packets
+    POST <base>/packets/<site>                          : send a packet
+    PUT  <base>/transactions/<site>/<id>/state/failed   : fail a transaction
+    GET  <base>/transactions/<site>/<id>/packets        : transaction packets
+    POST <base>/test/<site>/reset                       : discard everything
+    POST <base>/test/<site>/scenarios?type=<type>       : start a transaction
+
+plus ``GET <base>/stats``, which returns throughput, latency, and memory
+statistics as JSON. API keys are not checked.
+
+Example, from the top-level directory::
+
+    PYTHONPATH=src python -m benchmarks.amieserver --port=8500 --rate=0.5 \\
+        --mix=request_project_create=3,request_account_create=1
+
+and then set ``amie_url`` in the ``[amieclient]`` section of ``config.ini`` to
+the URL the server prints.
+"""
+import sys
+import json
+import argparse
+import logging
+import resource
+import threading
+from datetime import datetime
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from urllib.parse import (urlsplit, parse_qs, unquote)
+from benchmarks.fakeamie import SimulatedAMIE
+
+
+class AMIEServer(object):
+    def __init__(self, amie, address='localhost:0', base_path='/amie-api'):
+        """Serve a simulated AMIE workload over HTTP
+
+        :param amie: The simulated AMIE server
+        :type amie: SimulatedAMIE
+        :param address: The address to listen on: "[host:]port"; the default
+            host is "localhost", and port 0 picks a free port
+        :type address: str
+        :param base_path: The path prefix of all URLs
+        :type base_path: str
+        """
+
+        self.amie = amie
+        (host, sep, port) = address.rpartition(':')
+        self.host = host if host else 'localhost'
+        self.port = int(port)
+        self.base_path = '/' + base_path.strip('/') if base_path.strip('/') \
+            else ''
+        self.logger = logging.getLogger(__name__)
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        """The value to use for the ``amie_url`` configuration parameter"""
+
+        return 'http://' + self.host + ':' + str(self.port) + \
+            self.base_path + '/'
+
+    def start(self):
+        """Start serving requests in a background thread"""
+
+        if self.httpd is not None:
+            return
+        self.httpd = ThreadingHTTPServer((self.host, self.port),
+                                         _AMIERequestHandler)
+        # report the actual port if port 0 was requested
+        self.port = self.httpd.server_address[1]
+        self.httpd.daemon_threads = True
+        self.httpd.amie_server = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='amieserver', daemon=True)
+        self.thread.start()
+        self.logger.info("Serving simulated AMIE API on " + self.url)
+
+    def stop(self):
+        """Stop serving requests"""
+
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        self.httpd = None
+        self.thread = None
+
+    def get_stats(self):
+        """Return the workload statistics, plus server memory use"""
+
+        with self.amie.lock:
+            stats = self.amie.get_stats()
+        stats['peak_rss_mb'] = _peak_rss_mb()
+        return stats
+
+
+class _AMIERequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def _dispatch(self, method):
+        server = self.server.amie_server
+        amie = server.amie
+        url = urlsplit(self.path)
+        path = url.path
+        if not path.startswith(server.base_path + '/'):
+            self._respond(404, {'message': "Not found"})
+            return
+        parts = [unquote(part) for part in
+                 path[len(server.base_path) + 1:].strip('/').split('/')]
+        params = parse_qs(url.query)
+        body = self._read_body()
+
+        if parts == ['stats'] and method == 'GET':
+            self._respond(200, server.get_stats())
+            return
+        if len(parts) < 2 or parts[1] != amie.site_name:
+            self._respond(404, {'message': "Not found"})
+            return
+        try:
+            with amie.lock:
+                result = self._handle(amie, method, parts, params, body)
+        except (ValueError, KeyError, TypeError) as err:
+            self._respond(400, {'message': "Bad request: " + str(err)})
+            return
+        if result is None:
+            self._respond(404, {'message': "Not found"})
+        else:
+            self._respond(200, result)
+
+    def _handle(self, amie, method, parts, params, body):
+        if parts[0] == 'packets' and len(parts) == 2:
+            if method == 'GET':
+                start = None
+                update_time = params.get('update_time', [''])[0]
+                if update_time.partition(',')[0]:
+                    start = _parse_timestamp(update_time.partition(',')[0])
+                return {'message': '',
+                        'result': amie.list_packets(start)}
+            if method == 'POST':
+                amie.receive_packet(json.loads(body))
+                return {'message': 'OK'}
+        if parts[0] == 'transactions' and len(parts) == 5 and \
+           parts[3:] == ['state', 'failed'] and method == 'PUT':
+            amie.fail_transaction(parts[2])
+            return {'message': 'OK'}
+        if parts[0] == 'transactions' and len(parts) == 4 and \
+           parts[3] == 'packets' and method == 'GET':
+            entry = amie.posted.get(int(parts[2]), None)
+            return {'message': '',
+                    'result': [] if entry is None else [entry[1]]}
+        if parts[0] == 'test' and method == 'POST':
+            if parts[2:] == ['reset']:
+                amie.reset()
+                return {'message': 'OK'}
+            if parts[2:] == ['scenarios']:
+                trid = amie.add_transaction(params['type'][0])
+                return {'message': 'OK', 'transaction_id': trid}
+        return None
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0) or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _respond(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(self.address_string() + " " +
+                                          (format % args))
+
+
+def _parse_timestamp(value):
+    return datetime.fromisoformat(value).timestamp()
+
+def _peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.amieserver",
+        description="Serve a simulated AMIE REST API for load and soak tests",
+        epilog="Delays are distributions: <n>, uniform:<lo>,<hi>, "
+        "exp:<mean>, lognormal:<median>,<sigma>, or choice:<n>,<n>...")
+    parser.add_argument('--host', default='localhost',
+                        help="host name or address to listen on "
+                        "(default localhost)")
+    parser.add_argument('--port', type=int, default=0,
+                        help="port to listen on (default: any free port)")
+    parser.add_argument('--site', default='NCAR',
+                        help="local site name (default NCAR)")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="new transactions per second (default 0: "
+                        "only test scenarios)")
+    parser.add_argument('--mix',
+                        help="transaction mix: <request_type>=<weight>,... "
+                        "(default: request_project_create only)")
+    parser.add_argument('-n', '--transactions', type=int,
+                        help="stop generating after this many transactions")
+    parser.add_argument('--reply-delay', default='0',
+                        help="seconds before AMIE posts the next packet")
+    parser.add_argument('--max-latencies', type=int, default=100000,
+                        help="number of recent latencies kept for "
+                        "statistics (default 100000)")
+    parser.add_argument('--seed', type=int, help="random seed")
+    parser.add_argument('-D', '--debug', action='store_true',
+                        help="log each request")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    amie = SimulatedAMIE(site_name=args.site, reply_delay=args.reply_delay,
+                         seed=args.seed, max_latencies=args.max_latencies)
+    if args.rate:
+        amie.start_arrivals(args.rate, args.mix, args.transactions)
+    server = AMIEServer(amie, args.host + ':' + str(args.port))
+    server.start()
+    print("amie_url = " + server.url, flush=True)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import math
+import random
+
+class Distribution(object):
+    def __init__(self, spec, rng=None):
+        """A random distribution of non-negative values, e.g. delays in seconds
+
+        The distribution is given as a string of the form "<kind>:<args>":
+
+            <n> or const:<n>      : always <n>
+            uniform:<lo>,<hi>     : uniform between <lo> and <hi>
+            exp:<mean>            : exponential with the given mean
+            lognormal:<median>,<sigma>
+                                  : log-normal with the given median and
+                                    shape parameter
+            choice:<n>,<n>,...    : one of the given values
+
+        :param spec: The distribution specification
+        :type spec: str, int, or float
+        :param rng: The random number generator to use
+        :type rng: random.Random, optional
+        :raises ValueError: if the specification cannot be parsed
+        """
+
+        self.spec = str(spec)
+        self.rng = random.Random() if rng is None else rng
+        (kind, sep, args) = self.spec.partition(':')
+        if not sep:
+            (kind, args) = ('const', kind)
+        try:
+            values = [float(arg) for arg in args.split(',')]
+        except ValueError:
+            raise ValueError("bad distribution: " + self.spec)
+        nvalues = {'const': 1, 'uniform': 2, 'exp': 1, 'lognormal': 2}
+        if (kind not in nvalues and kind != 'choice') or \
+           (kind in nvalues and len(values) != nvalues[kind]) or \
+           min(values) < 0:
+            raise ValueError("bad distribution: " + self.spec)
+        self.kind = kind
+        self.values = values
+
+    def sample(self):
+        """Return a random value from the distribution"""
+
+        kind = self.kind
+        values = self.values
+        if kind == 'const':
+            return values[0]
+        if kind == 'uniform':
+            return self.rng.uniform(values[0], values[1])
+        if kind == 'exp':
+            if values[0] == 0:
+                return 0.0
+            return self.rng.expovariate(1.0 / values[0])
+        if kind == 'lognormal':
+            if values[0] == 0:
+                return 0.0
+            return self.rng.lognormvariate(math.log(values[0]), values[1])
+        return self.rng.choice(values)
+
+    def is_zero(self):
+        """Return True if the distribution always returns 0"""
+
+        if self.kind in ('exp', 'lognormal'):
+            return self.values[0] == 0
+        return max(self.values) == 0
+
+    def __str__(self):
+        return self.spec
+
+
+def percentile(sorted_values, pct):
+    """Return a percentile of a sorted list, using linear interpolation
+
+    :param sorted_values: The values, in increasing order
+    :type sorted_values: list
+    :param pct: The percentile (0-100)
+    :type pct: float
+    :return: The value, or None if the list is empty
+    """
+
+    if not sorted_values:
+        return None
+    pos = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(math.floor(pos))
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + \
+        (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
@@ -0,0 +1,569 @@
+import time
+import copy
+import random
+import heapq
+import threading
+from collections import deque
+from requests.exceptions import ConnectionError
+from amieclient.packet.packetlist import PacketList
+from misctypes import TimeUtil
+from benchmarks.distribution import (Distribution, percentile)
+
+#: Body of generated "request_project_create" packets
+RPC_BODY = {
+    "AllocationType": "new",
+    "BoardType": "Startup",
+    "RequestType": "new",
+    "Abstract": "Lorem ipsum dolor est...",
+    "PfosNumber": "21000",
+    "PiBusinessPhoneNumber": "5555555555",
+    "PiCity": "University Park",
+    "PiStreetAddress": "Department of Physics",
+    "PiZip": "16802",
+    "PiState": "PA",
+    "PiCountry": "9US",
+    "PiMiddleName": "",
+    "PiDepartment": "Physics",
+    "PiTitle": "",
+    "PiOrganization": "Pennsylvania State University",
+    "PiOrgCode": "0088138",
+    "NsfStatusCode": "GS",
+    "PiDnList": ["/C=US/O=Example/CN=Benchmark User"],
+    "AcademicDegree": [{"Degree": "BS", "Field": "Engineering"}],
+    "ProjectTitle": "Lorem Ipsum",
+    "Sfos": [{"Number": "0"}],
+    "StartDate": "2023-08-03",
+    "EndDate": "2024-08-03",
+    "ServiceUnitsAllocated": "1",
+    "ResourceList": ["test-resource1.ncar.xsede"],
+    "AllocatedResource": "test-resource1.ncar.xsede",
+}
+
+#: Body of generated "request_account_create" packets
+RAC_BODY = {
+    "AcademicDegree": [{"Degree": "MS", "Field": "Computer Science"}],
+    "UserDnList": ["/C=US/O=Example/CN=Benchmark User"],
+    "NsfStatusCode": "GS",
+    "UserOrgCode": "0032425",
+    "UserOrganization": "Carnegie Mellon University",
+    "UserTitle": "",
+    "UserDepartment": "SCS",
+    "UserMiddleName": "",
+    "UserCountry": "9US",
+    "UserState": "PA",
+    "UserZip": "15213",
+    "UserStreetAddress": "Craig Street",
+    "UserCity": "Pittsburgh",
+    "UserBusinessPhoneNumber": "5555555555",
+    "AllocatedResource": "test-resource1.ncar.xsede",
+    "UserRequestedLoginList": [""],
+    "ResourceList": ["test-resource1.ncar.xsede"],
+    "UserPasswordAccessEnable": "1",
+}
+
+#: Bodies of generated request packets, by packet type
+REQUEST_BODIES = {
+    'request_project_create': RPC_BODY,
+    'request_account_create': RAC_BODY,
+    'request_project_inactivate': {
+        "ResourceList": ["test-resource1.ncar.xsede"],
+    },
+    'request_project_reactivate': {
+        "ResourceList": ["test-resource1.ncar.xsede"],
+    },
+    'request_account_inactivate': {
+        "ResourceList": ["test-resource1.ncar.xsede"],
+    },
+    'request_account_reactivate': {
+        "ResourceList": ["test-resource1.ncar.xsede"],
+    },
+    'request_person_merge': {},
+    'request_user_modify': {
+        "ActionType": "replace",
+        "Email": "new@example.org",
+    },
+}
+
+#: For each reply packet type, the packet AMIE sends next
+NEXT_PACKET_TYPES = {
+    'notify_project_create': 'data_project_create',
+    'notify_account_create': 'data_account_create',
+    'notify_project_inactivate': 'inform_transaction_complete',
+    'notify_project_reactivate': 'inform_transaction_complete',
+    'notify_account_inactivate': 'inform_transaction_complete',
+    'notify_account_reactivate': 'inform_transaction_complete',
+}
+
+def parse_mix(mix):
+    """Parse a transaction mix: "<packet_type>=<weight>,..."
+
+    :param mix: The mix specification; if None or empty, all transactions are
+        "request_project_create"
+    :type mix: str
+    :raises ValueError: if the specification cannot be parsed
+    :return: dict mapping request packet types to weights
+    """
+
+    if not mix:
+        return {'request_project_create': 1.0}
+    weights = dict()
+    for item in mix.split(','):
+        (packet_type, sep, weight) = item.strip().partition('=')
+        if packet_type not in REQUEST_BODIES:
+            raise ValueError("unknown request packet type: " + packet_type)
+        weights[packet_type] = float(weight) if sep else 1.0
+    return weights
+
+
+class WorkloadComplete(Exception):
+    """Exception raised by FakeAMIEClient when all transactions are finished"""
+    pass
+
+
+class SimulatedAMIE(object):
+    def __init__(self, site_name='NCAR', reply_delay=0, seed=None,
+                 timeutil=None, max_latencies=None):
+        """The AMIE server side of a simulated workload
+
+        A SimulatedAMIE object generates transactions and plays the part of
+        the AMIE server in each: it posts a request packet, and when the
+        local site replies it posts the next packet of the transaction after
+        a delay. "request_project_create" transactions go RPC, NPC, DPC, ITC;
+        other types follow the corresponding chain in the AMIE protocol. A
+        transaction is finished when the local site sends an
+        "inform_transaction_complete" packet, or when it is marked failed.
+
+        Packets are plain dicts in the format used by the AMIE REST API. The
+        object is not thread-safe; callers must serialize access (see
+        ``lock``).
+
+        :param site_name: The local site name
+        :type site_name: str
+        :param reply_delay: Seconds before AMIE posts the next packet of a
+            transaction (a distribution; see
+            :class:`~benchmarks.distribution.Distribution`)
+        :type reply_delay: str
+        :param seed: Random seed
+        :type seed: int, optional
+        :param timeutil: Source of the current time
+        :type timeutil: TimeUtil, optional
+        :param max_latencies: If given, only the most recent latencies are
+            kept, so memory use does not grow during long runs
+        :type max_latencies: int, optional
+        """
+
+        self.site_name = site_name
+        self.rng = random.Random(seed)
+        self.reply_delay = Distribution(reply_delay, self.rng)
+        self.timeutil = TimeUtil() if timeutil is None else timeutil
+        self.max_latencies = max_latencies
+        self.lock = threading.Lock()
+        self.next_trid = 100001
+        self.arrival_rate = 0
+        self.arrival_limit = None
+        self.arrival_mix = None
+        self.next_arrival = None
+        self.reset()
+
+    def reset(self):
+        """Discard all transactions and statistics"""
+
+        self.scheduled = list()
+        self.posted = dict()
+        self.transactions = dict()
+        self.next_rec_id = 1
+        self.ntransactions = 0
+        self.nfinished = 0
+        self.nfailed = 0
+        self.latencies = deque(maxlen=self.max_latencies)
+        self.response_times = deque(maxlen=self.max_latencies)
+        self.packets_posted = 0
+        self.packets_listed = 0
+        self.packets_received = 0
+        self.finish_time = None
+
+    def add_transactions(self, count, mix=None, arrival_rate=0, until=None):
+        """Schedule new transactions
+
+        :param count: The number of transactions; if None, ``until`` must be
+            given
+        :type count: int or None
+        :param mix: Relative frequencies of request types; see
+            :func:`parse_mix`
+        :type mix: str or dict, optional
+        :param arrival_rate: Transactions per second; if 0, all transactions
+            arrive at once
+        :type arrival_rate: float
+        :param until: If given, no transactions arrive more than this many
+            seconds from now
+        :type until: float, optional
+        :return: The number of transactions scheduled
+        """
+
+        if count is None and (until is None or not arrival_rate):
+            raise ValueError("a count, or an arrival rate and until, is needed")
+        weights = mix if isinstance(mix, dict) else parse_mix(mix)
+        start = now = self._now()
+        n = 0
+        while count is None or n < count:
+            if arrival_rate:
+                now += self.rng.expovariate(arrival_rate)
+            if until is not None and now - start > until:
+                break
+            self._add_transaction(now, self._choose(weights))
+            n += 1
+        return n
+
+    def start_arrivals(self, rate, mix=None, limit=None):
+        """Generate new transactions continuously
+
+        Transactions are generated as a Poisson process as time passes; no
+        transactions are generated while the object is not being used.
+
+        :param rate: Transactions per second; if 0, stop generating
+        :type rate: float
+        :param mix: Relative frequencies of request types; see
+            :func:`parse_mix`
+        :type mix: str or dict, optional
+        :param limit: Stop after this many transactions
+        :type limit: int, optional
+        """
+
+        self.arrival_rate = float(rate)
+        self.arrival_mix = mix if isinstance(mix, dict) else parse_mix(mix)
+        self.arrival_limit = limit
+        self.next_arrival = None
+        if self.arrival_rate:
+            self.next_arrival = self._now() + \
+                self.rng.expovariate(self.arrival_rate)
+
+    def add_transaction(self, packet_type):
+        """Post a new transaction now
+
+        :param packet_type: The request packet type
+        :type packet_type: str
+        :return: The transaction ID
+        """
+
+        if packet_type not in REQUEST_BODIES:
+            raise ValueError("unknown request packet type: " + packet_type)
+        return self._add_transaction(self._now(), packet_type)
+
+    def is_done(self):
+        """Return True if all scheduled transactions are finished"""
+
+        return self.nfinished == self.ntransactions and \
+            self.next_arrival is None
+
+    def list_packets(self, update_time_start=None):
+        """Return packets awaiting a reply from the local site
+
+        :param update_time_start: If given, only return packets posted at or
+            after this time (seconds since the epoch)
+        :type update_time_start: float, optional
+        :return: list of packet dicts
+        """
+
+        now = self._now()
+        self._generate_arrivals(now)
+        self._post_due_packets(now)
+        result = [pdict for (posted_time, pdict) in self.posted.values()
+                  if update_time_start is None or
+                  posted_time >= update_time_start]
+        self.packets_listed += len(result)
+        return result
+
+    def receive_packet(self, pdict):
+        """Accept a packet from the local site
+
+        :param pdict: The packet, as a dict
+        :type pdict: dict
+        """
+
+        self.packets_received += 1
+        header = pdict['header']
+        body = pdict.get('body', {})
+        (trid, replied_to) = self._find_replied_to(header)
+        if replied_to is not None:
+            self.response_times.append(self._now() - replied_to[0])
+            replied_to = replied_to[1]
+        packet_type = pdict['type']
+        if packet_type == 'inform_transaction_complete':
+            self._finish(trid, str(body.get('StatusCode', '')) == 'Success')
+            return
+        if replied_to is None:
+            # a duplicate reply; the next packet is already scheduled
+            return
+        next_type = NEXT_PACKET_TYPES.get(packet_type, None)
+        if next_type is None:
+            self._finish(trid, False)
+            return
+        if next_type == 'inform_transaction_complete':
+            next_body = {'StatusCode': 'Success', 'DetailCode': 1,
+                         'Message': 'OK'}
+        else:
+            next_body = {
+                'PersonID': _get_first(body, 'PiPersonID', 'UserPersonID',
+                                       'PersonID'),
+                'ProjectID': body.get('ProjectID', None),
+                'DnList': ["/C=US/O=Example/CN=Benchmark User"],
+            }
+        due = self._now() + self.reply_delay.sample()
+        packet_id = int(replied_to['header']['packet_id']) + 1
+        self._schedule(due, trid, next_type, packet_id, next_body)
+
+    def fail_transaction(self, trid):
+        """Mark a transaction failed
+
+        :param trid: The transaction ID
+        :type trid: int
+        """
+
+        trid = int(trid)
+        self.posted.pop(trid, None)
+        self._finish(trid, False)
+
+    def get_stats(self):
+        """Return a dict of statistics"""
+
+        latencies = sorted(self.latencies)
+        response_times = sorted(self.response_times)
+        return {
+            'transactions': self.ntransactions,
+            'finished': self.nfinished,
+            'failed': self.nfailed,
+            'in_progress': len(self.transactions),
+            'packets_posted': self.packets_posted,
+            'packets_listed': self.packets_listed,
+            'packets_received': self.packets_received,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p95': percentile(latencies, 95),
+            'latency_p99': percentile(latencies, 99),
+            'response_p50': percentile(response_times, 50),
+            'response_p95': percentile(response_times, 95),
+            'response_p99': percentile(response_times, 99),
+        }
+
+    def _now(self):
+        return self.timeutil.now().timestamp()
+
+    def _choose(self, weights):
+        (types, values) = zip(*weights.items())
+        return self.rng.choices(types, values)[0]
+
+    def _add_transaction(self, when, packet_type):
+        trid = self.next_trid
+        self.next_trid += 1
+        self.ntransactions += 1
+        self._schedule(when, trid, packet_type, 1, None)
+        return trid
+
+    def _generate_arrivals(self, now):
+        while self.next_arrival is not None and self.next_arrival <= now:
+            self._add_transaction(self.next_arrival,
+                                  self._choose(self.arrival_mix))
+            if self.arrival_limit is not None and \
+               self.ntransactions >= self.arrival_limit:
+                self.next_arrival = None
+            else:
+                self.next_arrival += self.rng.expovariate(self.arrival_rate)
+
+    def _schedule(self, due, trid, packet_type, packet_id, body):
+        heapq.heappush(self.scheduled,
+                       (due, trid, packet_type, packet_id, body))
+
+    def _post_due_packets(self, now):
+        while self.scheduled and self.scheduled[0][0] <= now:
+            (due, trid, packet_type, packet_id, body) = \
+                heapq.heappop(self.scheduled)
+            if trid not in self.transactions:
+                self.transactions[trid] = due
+            self.packets_posted += 1
+            self.posted[trid] = (now, self._make_packet(trid, packet_type,
+                                                        packet_id, body))
+
+    def _make_packet(self, trid, packet_type, packet_id, body):
+        if body is None:
+            body = self._make_request_body(trid, packet_type)
+        rec_id = self.next_rec_id
+        self.next_rec_id += 1
+        return {
+            'DATA_TYPE': 'Packet',
+            'type': packet_type,
+            'header': {
+                'packet_id': packet_id,
+                'trans_rec_id': trid,
+                'transaction_id': trid,
+                'packet_rec_id': rec_id,
+                'remote_site_name': self.site_name,
+                'local_site_name': 'TGCDB',
+                'originating_site_name': 'TGCDB',
+                'outgoing_flag': 1,
+                'packet_state': 'in-progress',
+                'transaction_state': 'in-progress',
+                'client_state': None,
+                'client_json': None,
+                'packet_timestamp': self.timeutil.now().isoformat(),
+            },
+            'body': copy.deepcopy(body),
+        }
+
+    def _make_request_body(self, trid, packet_type):
+        n = str(trid)
+        body = dict(REQUEST_BODIES[packet_type])
+        if packet_type == 'request_project_create':
+            body['GrantNumber'] = 'BMK' + n
+            body['RecordID'] = 'BMK-' + n
+            body['PiGlobalID'] = n
+            body['PiFirstName'] = 'First' + n
+            body['PiLastName'] = 'Last' + n
+            body['PiEmail'] = 'user' + n + '@example.org'
+            body['PiRequestedLoginList'] = ['user' + n]
+        elif packet_type == 'request_account_create':
+            body['GrantNumber'] = 'BMK' + n
+            body['ProjectID'] = 'prj' + n
+            body['UserGlobalID'] = n
+            body['UserPersonID'] = n
+            body['UserFirstName'] = 'First' + n
+            body['UserLastName'] = 'Last' + n
+            body['UserEmail'] = 'user' + n + '@example.org'
+        elif packet_type == 'request_person_merge':
+            body['KeepGlobalID'] = n
+            body['KeepPersonID'] = 'p' + n
+            body['DeleteGlobalID'] = str(trid + 1000000)
+            body['DeletePersonID'] = 'p' + str(trid + 1000000)
+        else:
+            body['ProjectID'] = 'prj' + n
+            body['PersonID'] = 'p' + n
+        return body
+
+    def _find_replied_to(self, header):
+        # Return the transaction ID and the (posted time, posted packet) pair
+        # a reply is for. The reply is matched by transaction ID if it has
+        # one, else by "in_reply_to", which is all that replies built by
+        # amieclient have
+        trid = header.get('transaction_id', None) or \
+            header.get('trans_rec_id', None)
+        if trid is not None:
+            return (int(trid), self.posted.pop(int(trid), None))
+        in_reply_to = header.get('in_reply_to', None)
+        for (trid, entry) in self.posted.items():
+            if entry[1]['header']['packet_rec_id'] == in_reply_to:
+                del self.posted[trid]
+                return (trid, entry)
+        raise ValueError("no packet for reply: " + str(in_reply_to))
+
+    def _finish(self, trid, success):
+        start = self.transactions.pop(trid, None)
+        if start is None:
+            return
+        now = self._now()
+        self.latencies.append(now - start)
+        if not success:
+            self.nfailed += 1
+        self.nfinished += 1
+        if self.is_done():
+            self.finish_time = now
+
+
+class FakeAMIEClient(object):
+    def __init__(self, amie=None, latency=0, error_rate=0, seed=None):
+        """An in-process stand-in for ``amieclient.AMIEClient``
+
+        The client talks directly to a :class:`SimulatedAMIE` object. Packets
+        are parsed and validated like the real client does.
+
+        :param amie: The simulated AMIE server; default is a new SimulatedAMIE
+        :type amie: SimulatedAMIE, optional
+        :param latency: Seconds taken by every call (a distribution; see
+            :class:`~benchmarks.distribution.Distribution`)
+        :type latency: str
+        :param error_rate: Fraction of calls that raise a ConnectionError
+        :type error_rate: float
+        :param seed: Random seed
+        :type seed: int, optional
+        """
+
+        self.amie = SimulatedAMIE() if amie is None else amie
+        self.site_name = self.amie.site_name
+        self.rng = random.Random(seed)
+        self.latency = Distribution(latency, self.rng)
+        self.error_rate = float(error_rate)
+        self.calls = 0
+        self.errors = 0
+        self.packets_sent = 0
+
+    def list_packets(self, update_time_start=None, **kwargs):
+        """Return packets awaiting a reply from the local site
+
+        :param update_time_start: If given, only return packets posted at or
+            after this time
+        :type update_time_start: datetime, optional
+        :raises WorkloadComplete: if all transactions are finished
+        :return: amieclient.packet.packetlist.PacketList
+        """
+
+        self._call()
+        if self.amie.is_done():
+            raise WorkloadComplete()
+        start = None if update_time_start is None else \
+            update_time_start.timestamp()
+        with self.amie.lock:
+            result = self.amie.list_packets(start)
+        return make_packet_list(result)
+
+    def send_packet(self, packet, skip_validation=False):
+        """Send a packet to the simulated AMIE server
+
+        :param packet: The packet
+        :type packet: amieclient.packet.base.Packet
+        """
+
+        self._call()
+        if not skip_validation:
+            packet.validate_data(raise_on_invalid=True)
+        self.packets_sent += 1
+        with self.amie.lock:
+            self.amie.receive_packet(packet.as_dict())
+        return None
+
+    def set_transaction_failed(self, transaction_or_id=None):
+        """Mark a transaction failed"""
+
+        self._call()
+        with self.amie.lock:
+            self.amie.fail_transaction(transaction_or_id)
+
+    def _call(self):
+        self.calls += 1
+        if not self.latency.is_zero():
+            self._delay(self.latency.sample())
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise ConnectionError("simulated connection error")
+
+    def _delay(self, secs):
+        time.sleep(secs)
+
+
+def make_packet_list(result):
+    """Parse packet dicts like ``AMIEClient.list_packets()`` does
+
+    :param result: Packet dicts
+    :type result: list
+    :return: amieclient.packet.packetlist.PacketList
+    """
+
+    packet_list = PacketList.from_dict({'message': '', 'result': result})
+    for (packet, pdict) in zip(packet_list.packets, result):
+        # Older amieclient releases do not keep the packet timestamp
+        if getattr(packet, 'packet_timestamp', None) is None:
+            packet.packet_timestamp = pdict['header']['packet_timestamp']
+    return packet_list
+
+def _get_first(body, *keys):
+    for key in keys:
+        value = body.get(key, None)
+        if value:
+            return value
+    return None
@@ -0,0 +1,311 @@
+import time
+import heapq
+import bisect
+import random
+from collections import Counter
+from serviceprovider import ServiceProviderIF
+from spexception import ServiceProviderTemporaryError
+from misctypes import (DateTime, TimeUtil)
+from taskstatus import TaskStatus
+from organization import AMIEOrg
+from person import AMIEPerson
+from benchmarks.distribution import Distribution
+
+#: Products of each task type; functions of the task arguments and a serial
+#: number that is unique to the task
+TASK_PRODUCTS = {
+    'choose_or_add_org': lambda kw, n: {
+        'OrgCode': kw.get('OrgCode', None) or 'org' + n,
+    },
+    'choose_or_add_person': lambda kw, n: {
+        'PersonID': 'p' + n,
+        'RemoteSiteLogin': 'u' + n,
+        'site_org': 'org' + n,
+        'active': '1',
+    },
+    'update_person_DNs': lambda kw, n: {},
+    'activate_person': lambda kw, n: {
+        'PersonID': kw.get('PersonID', None) or 'p' + n,
+        'active': '1',
+    },
+    'choose_or_add_contract_number': lambda kw, n: {
+        'contract_number': 'c' + n,
+    },
+    'choose_or_add_local_fos': lambda kw, n: {
+        'areaOfInterest': 'fos' + n,
+    },
+    'choose_or_add_project_name_base': lambda kw, n: {
+        'project_name_base': 'pnb' + n,
+    },
+    'create_project': lambda kw, n: {
+        'ProjectID': 'prj' + n,
+        'ServiceUnitsAllocated': str(kw.get('ServiceUnitsAllocated', 1)),
+        'StartDate': str(kw.get('StartDate', '2023-01-01')),
+        'EndDate': str(kw.get('EndDate', '2024-01-01')),
+        'PiRemoteSiteLogin': 'u' + n,
+    },
+    'inactivate_project': lambda kw, n: {},
+    'reactivate_project': lambda kw, n: {},
+    'create_account': lambda kw, n: {
+        'RemoteSiteLogin': 'u' + n,
+        'AccountActivityTime': str(DateTime.now()),
+        'ProjectID': kw.get('ProjectID', None) or 'prj' + n,
+    },
+    'inactivate_account': lambda kw, n: {},
+    'reactivate_account': lambda kw, n: {},
+    'update_allocation': lambda kw, n: {
+        'ServiceUnitsAllocated': str(kw.get('ServiceUnitsAllocated', 1)),
+        'StartDate': str(kw.get('StartDate', '2023-01-01')),
+        'EndDate': str(kw.get('EndDate', '2024-01-01')),
+        'resource_name': str(kw.get('ResourceList', ['resource'])[0]),
+    },
+    'modify_user': lambda kw, n: {},
+    'merge_person': lambda kw, n: {},
+    'notify_user': lambda kw, n: {},
+}
+
+class ServiceProvider(ServiceProviderIF):
+    def __init__(self):
+        """A configurable stand-in for a local Service Provider
+
+        This follows the structure of ``tests/serviceproviderspy.py``, but
+        rather than recording arguments it counts calls (``calls``) and
+        simulated errors (``errors``), and rather than returning fixed results
+        it simulates a back end: every call takes a random amount of time,
+        and every task is queued and later completes (successfully, or with a
+        random failure) after a random delay. Completed tasks are returned by
+        :meth:`get_tasks`.
+
+        Lookups of organizations and people always succeed. Other lookups
+        fail, so every "request_project_create" packet needs several tasks.
+
+        The following "localsite" configuration parameters are supported;
+        the distributions are described in
+        :class:`~benchmarks.distribution.Distribution`:
+
+            latency            : seconds taken by every call (default 0)
+            task_delay         : seconds before a task completes (default 0)
+            task_failure_rate  : fraction of tasks that fail (default 0)
+            error_rate         : fraction of calls that raise a
+                                 ServiceProviderTemporaryError (default 0)
+            seed               : random seed (default None)
+            timeutil           : a TimeUtil object (default TimeUtil())
+        """
+
+        self.calls = Counter()
+        self.errors = 0
+        self.tasks = dict()
+        self.pending = list()
+        self.updates = list()
+        self.serial = 0
+        self.last_timestamp = 0
+        self.apply_config({})
+
+    def apply_config(self, config):
+        self.rng = random.Random(config.get('seed', None))
+        self.latency = Distribution(config.get('latency', 0), self.rng)
+        self.task_delay = Distribution(config.get('task_delay', 0), self.rng)
+        self.task_failure_rate = float(config.get('task_failure_rate', 0))
+        self.error_rate = float(config.get('error_rate', 0))
+        self.timeutil = config.get('timeutil', None) or TimeUtil()
+
+    def _call(self, method_name):
+        self.calls[method_name] += 1
+        if not self.latency.is_zero():
+            self._delay(self.latency.sample())
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            raise ServiceProviderTemporaryError("simulated temporary error")
+
+    def _delay(self, secs):
+        time.sleep(secs)
+
+    def _now(self):
+        return self.timeutil.now().timestamp()
+
+    def _next_timestamp(self):
+        # Task timestamps are msec since the epoch; keep them strictly
+        # increasing so "since" queries never miss an update
+        now_ms = int(self._now() * 1000)
+        self.last_timestamp = max(now_ms, self.last_timestamp + 1)
+        return self.last_timestamp
+
+    def _submit_task(self, method_name, kwargs):
+        self._call(method_name)
+        task_name = kwargs.get('task_name', None) or method_name
+        key = (kwargs['amie_transaction_id'], kwargs['amie_packet_id'],
+               task_name)
+        entry = self.tasks.get(key, None)
+        if entry is not None:
+            return self._make_task_status(entry)
+
+        self.serial += 1
+        serial = str(self.serial)
+        entry = {
+            'amie_packet_type': kwargs['amie_packet_type'],
+            'amie_transaction_id': kwargs['amie_transaction_id'],
+            'amie_packet_id': kwargs['amie_packet_id'],
+            'job_id': kwargs['job_id'],
+            'task_name': task_name,
+            'task_state': 'queued',
+            'timestamp': self._next_timestamp(),
+            'products': [],
+        }
+        if self.task_failure_rate and \
+           self.rng.random() < self.task_failure_rate:
+            final_products = [{'name': 'FAILED',
+                               'value': "simulated failure"}]
+        else:
+            products = TASK_PRODUCTS[method_name](kwargs, serial)
+            final_products = [{'name': name, 'value': value}
+                              for (name, value) in products.items()]
+        self.tasks[key] = entry
+        self.updates.append((entry['timestamp'], key))
+        delay = self.task_delay.sample()
+        if delay == 0:
+            self._complete_task(entry, final_products)
+        else:
+            heapq.heappush(self.pending,
+                           (self._now() + delay, self.serial, key,
+                            final_products))
+        return self._make_task_status(entry)
+
+    def _complete_task(self, entry, products):
+        entry['products'] = products
+        entry['task_state'] = 'successful'
+        entry['timestamp'] = self._next_timestamp()
+        key = (entry['amie_transaction_id'], entry['amie_packet_id'],
+               entry['task_name'])
+        self.updates.append((entry['timestamp'], key))
+
+    def _complete_due_tasks(self):
+        now = self._now()
+        ncompleted = 0
+        while self.pending and self.pending[0][0] <= now:
+            (due, serial, key, products) = heapq.heappop(self.pending)
+            entry = self.tasks.get(key, None)
+            if entry is not None:
+                self._complete_task(entry, products)
+                ncompleted += 1
+        return ncompleted
+
+    def _make_task_status(self, entry):
+        ts_parms = dict(entry)
+        ts_parms['products'] = [dict(pr) for pr in entry['products']]
+        return TaskStatus(ts_parms)
+
+    def get_local_task_name(self, method_name, kwargs) -> str:
+        return method_name
+
+    def get_tasks(self, active=True, wait=None, since=None) -> list:
+        self._call('get_tasks')
+        ncompleted = self._complete_due_tasks()
+        if ncompleted == 0 and wait and self.pending:
+            next_due = self.pending[0][0]
+            self._delay(max(0, min(next_due - self._now(), float(wait))))
+            self._complete_due_tasks()
+        elif ncompleted == 0 and wait:
+            self._delay(float(wait))
+        if since is None:
+            entries = list(self.tasks.values())
+        else:
+            # self.updates is in timestamp order; an entry is stale if the
+            # task was updated again later or has been cleared
+            start = bisect.bisect_right(self.updates, int(since),
+                                        key=lambda update: update[0])
+            entries = list()
+            for (timestamp, key) in self.updates[start:]:
+                entry = self.tasks.get(key, None)
+                if entry is not None and entry['timestamp'] == timestamp:
+                    entries.append(entry)
+        return [self._make_task_status(entry) for entry in entries
+                if not (active and entry['task_state'] == 'cleared')]
+
+    def clear_transaction(self, amie_transaction_id):
+        self._call('clear_transaction')
+        for key in [key for key in self.tasks
+                    if key[0] == amie_transaction_id]:
+            del self.tasks[key]
+
+    def lookup_org(self, *args, **kwargs) -> AMIEOrg:
+        self._call('lookup_org')
+        parms = args[0] if args else kwargs
+        return AMIEOrg(OrgCode=parms.get('OrgCode', None) or '0000000',
+                       Organization=parms.get('Organization', None) or 'Org')
+
+    def choose_or_add_org(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('choose_or_add_org', kwargs)
+
+    def lookup_person(self, *args, **kwargs) -> AMIEPerson:
+        self._call('lookup_person')
+        parms = args[0] if args else kwargs
+        person_id = 'p' + str(parms.get('GlobalID', None) or '0')
+        return AMIEPerson(PersonID=person_id,
+                          FirstName=parms.get('FirstName', None) or 'First',
+                          LastName=parms.get('LastName', None) or 'Last',
+                          RemoteSiteLogin=person_id,
+                          active='0')
+
+    def choose_or_add_person(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('choose_or_add_person', kwargs)
+
+    def update_person_DNs(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('update_person_DNs', kwargs)
+
+    def activate_person(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('activate_person', kwargs)
+
+    def lookup_project_by_grant_number(self, *args, **kwargs) -> str:
+        self._call('lookup_project_by_grant_number')
+        return None
+
+    def lookup_local_fos(self, *args, **kwargs) -> str:
+        self._call('lookup_local_fos')
+        return None
+
+    def choose_or_add_local_fos(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('choose_or_add_local_fos', kwargs)
+
+    def choose_or_add_contract_number(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('choose_or_add_contract_number', kwargs)
+
+    def lookup_project_name_base(self, *args, **kwargs) -> str:
+        self._call('lookup_project_name_base')
+        return None
+
+    def choose_or_add_project_name_base(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('choose_or_add_project_name_base', kwargs)
+
+    def create_project(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('create_project', kwargs)
+
+    def lookup_project_task(self, *args, **kwargs) -> TaskStatus:
+        self._call('lookup_project_task')
+        return None
+
+    def inactivate_project(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('inactivate_project', kwargs)
+
+    def reactivate_project(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('reactivate_project', kwargs)
+
+    def create_account(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('create_account', kwargs)
+
+    def inactivate_account(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('inactivate_account', kwargs)
+
+    def reactivate_account(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('reactivate_account', kwargs)
+
+    def update_allocation(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('update_allocation', kwargs)
+
+    def modify_user(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('modify_user', kwargs)
+
+    def merge_person(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('merge_person', kwargs)
+
+    def notify_user(self, *args, **kwargs) -> TaskStatus:
+        return self._submit_task('notify_user', kwargs)
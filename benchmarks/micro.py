@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""Microbenchmarks for the per-packet costs of the core data types
+
+Every benchmark times one small operation that the mediator repeats for each
+packet or task (validating parameters, building ActionablePackets, taking
+snapshots, ...), and reports the median and minimum time per operation over
+several repeats. Results can be saved as a baseline and compared with later
+runs; operations that got slower than the baseline by more than a threshold
+are reported as regressions, and the exit status is 1.
+
+A baseline for the reference environment is kept in
+``benchmarks/baselines/micro.json``. Times depend on the machine, so compare
+runs made on the same machine: save a baseline before a change, then compare
+after it.
+
+Example, from the top-level directory::
+
+    PYTHONPATH=src python -m benchmarks.micro --save=before.json
+    ... make changes ...
+    PYTHONPATH=src python -m benchmarks.micro --compare=before.json
+"""
+import os
+import sys
+import json
+import copy
+import platform
+import argparse
+import tempfile
+import statistics
+import timeit
+from pathlib import Path
+import pprintpp
+pprintpp.monkeypatch()
+from parmdesc import transform_args
+from taskstatus import (TaskStatus, TaskStatusList)
+from actionablepacket import ActionablePacket
+from amieparms import (get_packet_keys, strip_key_prefix)
+from miscfuncs import to_expanded_string
+from misctypes import DateTime
+from snapshotjournal import open_snapshots
+from benchmarks.fakeamie import make_packet_list
+from tests.fixtures.request_project_create import RPC_PKT_1
+
+#: Version of the results format
+RESULTS_VERSION = 1
+
+#: The baseline kept with the source
+DEFAULT_BASELINE = str(Path(__file__).parent / 'baselines' / 'micro.json')
+
+#: Benchmark setup functions, by name; see :func:`benchmark`
+BENCHMARKS = dict()
+
+TS_PARMS = {
+    'amie_packet_type': 'request_project_create',
+    'amie_transaction_id': 'SDSC:PSC:SDSC:244207',
+    'amie_packet_id': '2',
+    'job_id': '174709746',
+    'task_name': 'create_project',
+    'task_state': 'successful',
+    'timestamp': 1629816472600,
+    'products': [{'name': 'ProjectID', 'value': 'p12345'},
+                 {'name': 'PersonID', 'value': 'u12345'}],
+}
+
+def benchmark(name):
+    """Register a benchmark
+
+    The decorated function is called with the path of an empty temporary
+    directory, and returns a function of no arguments that performs the
+    operation to be timed.
+
+    :param name: The benchmark name
+    :type name: str
+    """
+
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+def _rpc_packet():
+    return make_packet_list([copy.deepcopy(RPC_PKT_1)]).packets[0]
+
+@benchmark('transform_args')
+def _transform_args(tmpdir):
+    func_info = TaskStatus.__init__.func_info
+    (allowed, required) = (func_info['allowed'], func_info['required'])
+    parm2type = TaskStatus.parm2type
+    return lambda: transform_args('TaskStatus', parm2type, allowed, required,
+                                  **TS_PARMS)
+
+@benchmark('TaskStatus')
+def _task_status(tmpdir):
+    return lambda: TaskStatus(**TS_PARMS)
+
+@benchmark('TaskStatusList.put')
+def _task_status_list_put(tmpdir):
+    tslist = TaskStatusList()
+    names = ['task' + str(i) for i in range(8)]
+    tasks = [TaskStatus(TS_PARMS, task_name=name) for name in names]
+    def put():
+        for ts in tasks:
+            tslist.put(ts)
+    return put
+
+@benchmark('ActionablePacket')
+def _actionable_packet(tmpdir):
+    packet = _rpc_packet()
+    return lambda: ActionablePacket(packet)
+
+@benchmark('get_packet_keys')
+def _get_packet_keys(tmpdir):
+    packet = _rpc_packet()
+    return lambda: get_packet_keys(packet)
+
+@benchmark('strip_key_prefix')
+def _strip_key_prefix(tmpdir):
+    apacket = ActionablePacket(_rpc_packet())
+    return lambda: strip_key_prefix('Pi', apacket)
+
+@benchmark('to_expanded_string')
+def _to_expanded_string(tmpdir):
+    apacket = ActionablePacket(_rpc_packet())
+    return lambda: to_expanded_string(apacket)
+
+@benchmark('DateTime')
+def _date_time(tmpdir):
+    return lambda: DateTime('2021-08-24T14:47:52.600Z')
+
+def _snapshot_data(n):
+    apacket = ActionablePacket(_rpc_packet())
+    return json.loads(json.dumps(apacket, default=str)) | {'n': n}
+
+def _snapshots_update(tmpdir, backend):
+    snapshots = open_snapshots(tmpdir, 'w', backend)
+    # alternate between two images so every update writes
+    images = [_snapshot_data(0), _snapshot_data(1)]
+    state = {'i': 0}
+    def update():
+        state['i'] ^= 1
+        snapshots.update('SDSC:PSC:SDSC:244207', images[state['i']])
+    return update
+
+def _snapshots_list(tmpdir, backend):
+    writer = open_snapshots(tmpdir, 'w', backend)
+    for n in range(50):
+        writer.update('key' + str(n), _snapshot_data(n))
+    reader = open_snapshots(tmpdir, 'r', backend)
+    return reader.list
+
+@benchmark('Snapshots.update[files]')
+def _snapshots_update_files(tmpdir):
+    return _snapshots_update(tmpdir, 'files')
+
+@benchmark('Snapshots.update[journal]')
+def _snapshots_update_journal(tmpdir):
+    return _snapshots_update(tmpdir, 'journal')
+
+@benchmark('Snapshots.list[files]')
+def _snapshots_list_files(tmpdir):
+    return _snapshots_list(tmpdir, 'files')
+
+@benchmark('Snapshots.list[journal]')
+def _snapshots_list_journal(tmpdir):
+    return _snapshots_list(tmpdir, 'journal')
+
+
+def measure(func, repeat=5, min_time=0.2):
+    """Time a function
+
+    :param func: The function to time
+    :type func: callable
+    :param repeat: The number of timing runs
+    :type repeat: int
+    :param min_time: Minimum seconds per timing run
+    :type min_time: float
+    :return: dict with "number" (calls per run) and "median_ns" and
+        "min_ns" (nanoseconds per call)
+    """
+
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 2
+    times = [timer.timeit(number) / number * 1e9 for i in range(repeat)]
+    return {
+        'number': number,
+        'median_ns': statistics.median(times),
+        'min_ns': min(times),
+    }
+
+def run_benchmarks(names=None, repeat=5, min_time=0.2):
+    """Run benchmarks
+
+    :param names: Benchmarks to run (see :data:`BENCHMARKS`); default is all
+    :type names: list, optional
+    :return: dict of results, suitable for :func:`compare_results`
+    """
+
+    results = dict()
+    for name in (BENCHMARKS if names is None else names):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            func = BENCHMARKS[name](tmpdir)
+            results[name] = measure(func, repeat, min_time)
+    return {
+        'v': RESULTS_VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+def compare_results(baseline, current, threshold=0.25):
+    """Compare results with a baseline
+
+    :param baseline: Baseline results
+    :type baseline: dict
+    :param current: Current results
+    :type current: dict
+    :param threshold: Fractional slowdown of the median time that counts as
+        a regression
+    :type threshold: float
+    :return: list of (name, baseline_ns, current_ns, ratio, status) tuples,
+        where status is "slower", "faster", "ok", or "new"
+    """
+
+    rows = list()
+    base_results = baseline['results']
+    for (name, result) in current['results'].items():
+        current_ns = result['median_ns']
+        base = base_results.get(name, None)
+        if base is None:
+            rows.append((name, None, current_ns, None, 'new'))
+            continue
+        base_ns = base['median_ns']
+        ratio = current_ns / base_ns if base_ns else None
+        if ratio is None:
+            status = 'ok'
+        elif ratio > 1 + threshold:
+            status = 'slower'
+        elif ratio < 1 / (1 + threshold):
+            status = 'faster'
+        else:
+            status = 'ok'
+        rows.append((name, base_ns, current_ns, ratio, status))
+    return rows
+
+def format_results(results):
+    """Return results as a table"""
+
+    lines = [f"{'benchmark':28} {'median':>12} {'min':>12} {'calls':>8}"]
+    for (name, result) in results['results'].items():
+        lines.append(f"{name:28} {_format_ns(result['median_ns']):>12} "
+                     f"{_format_ns(result['min_ns']):>12} "
+                     f"{result['number']:>8}")
+    return "\n".join(lines)
+
+def format_comparison(rows):
+    """Return the output of :func:`compare_results` as a table"""
+
+    lines = [f"{'benchmark':28} {'baseline':>12} {'current':>12} "
+             f"{'ratio':>7}  status"]
+    for (name, base_ns, current_ns, ratio, status) in rows:
+        base = '-' if base_ns is None else _format_ns(base_ns)
+        ratio = '-' if ratio is None else f"{ratio:.2f}"
+        lines.append(f"{name:28} {base:>12} {_format_ns(current_ns):>12} "
+                     f"{ratio:>7}  {status}")
+    return "\n".join(lines)
+
+def _format_ns(ns):
+    if ns >= 1e6:
+        return f"{ns / 1e6:.2f} ms"
+    if ns >= 1e3:
+        return f"{ns / 1e3:.2f} us"
+    return f"{ns:.0f} ns"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.micro",
+        description="Time per-packet operations of the core data types")
+    parser.add_argument('-k', metavar='SUBSTRING', action='append',
+                        help="only run benchmarks whose names contain "
+                        "SUBSTRING (may be repeated)")
+    parser.add_argument('-l', '--list', action='store_true',
+                        help="list the benchmarks and exit")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="timing runs per benchmark (default 5)")
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help="minimum seconds per timing run (default 0.2)")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the results as a baseline in FILE")
+    parser.add_argument('--compare', metavar='FILE', nargs='?',
+                        const=DEFAULT_BASELINE,
+                        help="compare with the baseline in FILE (default "
+                        "benchmarks/baselines/micro.json)")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="slowdown that counts as a regression "
+                        "(default 0.25, i.e. 25%%)")
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if
+             not args.k or any(k in name for k in args.k)]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    results = run_benchmarks(names, args.repeat, args.min_time)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, results, args.threshold)
+        print(format_comparison(rows))
+        if any(row[4] == 'slower' for row in rows):
+            status = 1
+    else:
+        print(format_results(results))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)),
+                    exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+"""Replay a recorded AMIE packet stream
+
+Feed the packets received in a recording made with the mediator's
+``packet_record_file`` parameter (see :class:`~packetrecorder.PacketRecorder`)
+back into :class:`~mediator.AMIEMediator`, with the original timing preserved
+or compressed. A :class:`~benchmarks.fakesp.ServiceProvider` stands in for
+the local site, or, with ``--sp-replay``, a :class:`spreplay.ServiceProvider`
+serving a recording made with the ``sp_record_file`` parameter. The packets
+the mediator sends are themselves recorded, and compared with a baseline: by
+default the packets sent in the original recording, or the output of an
+earlier replay. The comparison reports, for each transaction, whether the
+same types of reply packets were sent in the same order (and optionally with
+the same bodies; repeated sends of the same packet count once), and compares
+response time percentiles: the seconds from receiving a packet to sending the
+reply.
+
+Example, from the top-level directory; run last month's traffic 100 times
+faster than real time, keep the result as a baseline, and compare a later
+release against it::
+
+    PYTHONPATH=src python -m benchmarks.replay --speed=100 \\
+        --output=baseline.jsonl packets.jsonl
+    PYTHONPATH=src python -m benchmarks.replay --speed=100 \\
+        --baseline=baseline.jsonl packets.jsonl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+import heapq
+import pprintpp
+pprintpp.monkeypatch()
+from datetime import datetime
+from collections import defaultdict
+from misctypes import TimeUtil
+from serviceprovider import ServiceProvider
+from mediator import AMIEMediator
+from packetrecorder import read_recording
+from benchmarks.distribution import percentile
+from benchmarks.fakeamie import (WorkloadComplete, make_packet_list)
+from benchmarks.throughput import (BenchmarkTimeUtil, format_results)
+
+
+class ReplayAMIEClient(object):
+    def __init__(self, records, speed=1.0, timeutil=None):
+        """An ``amieclient.AMIEClient`` stand-in that replays a recording
+
+        The first packet of each transaction in the recording becomes visible
+        to :meth:`list_packets` at its recorded time relative to the start of
+        the recording, divided by ``speed``. Later packets are sent by AMIE in
+        response to the local site, so each is held back until the local site
+        sends the packet it responded to (the last packet sent for the
+        transaction before it in the recording), and then delayed by AMIE's
+        recorded response time divided by ``speed``. A packet stops being
+        listed when the local site sends a packet for the same transaction.
+        The replay is done when every recorded packet has been delivered and
+        the local site has sent every type of packet for each transaction
+        that it sent in the recording.
+
+        :param records: Records from :func:`~packetrecorder.read_recording`
+        :type records: iterable
+        :param speed: Time compression factor
+        :type speed: float
+        :param timeutil: Source of the current time
+        :type timeutil: TimeUtil, optional
+        """
+
+        self.speed = float(speed)
+        if self.speed <= 0:
+            raise ValueError("speed must be positive")
+        self.timeutil = TimeUtil() if timeutil is None else timeutil
+        self.scheduled = list()
+        self.held = defaultdict(list)
+        self.expected = defaultdict(set)
+        self.site_name = None
+        last_sent = dict()
+        t0 = None
+        for record in records:
+            pdict = record['packet']
+            t = datetime.fromisoformat(record['time']).timestamp()
+            t0 = t if t0 is None else t0
+            trid = _get_trid(pdict)
+            if record['direction'] == 'sent':
+                self.expected[trid].add(pdict['type'])
+                last_sent[trid] = (pdict['type'], t)
+                continue
+            if self.site_name is None:
+                self.site_name = pdict['header'].get('remote_site_name', None)
+            if trid in last_sent:
+                (trigger_type, trigger_time) = last_sent[trid]
+                self.held[(trid, trigger_type)].append(
+                    ((t - trigger_time) / self.speed, pdict))
+            else:
+                self.scheduled.append(((t - t0) / self.speed, pdict))
+        self.npackets = len(self.scheduled) + \
+            sum([len(held) for held in self.held.values()])
+        self.scheduled.sort(key=lambda entry: entry[0])
+        self.sent = defaultdict(set)
+        self.visible = dict()
+        self.start_time = None
+        self.packets_delivered = 0
+        self.packets_sent = 0
+        self.calls = 0
+
+    def start(self):
+        """Start the replay clock"""
+
+        self.start_time = self._now()
+        # the sequence numbers keep the heap from comparing packets
+        self.scheduled = [(self.start_time + offset, seq, pdict)
+                          for (seq, (offset, pdict))
+                          in enumerate(self.scheduled)]
+        self.seq = len(self.scheduled)
+        heapq.heapify(self.scheduled)
+
+    def is_done(self):
+        """Return True if the replay is finished"""
+
+        if self.packets_delivered < self.npackets:
+            return False
+        for (trid, packet_types) in self.expected.items():
+            if not packet_types <= self.sent[trid]:
+                return False
+        return True
+
+    def list_packets(self, update_time_start=None, **kwargs):
+        """Return delivered packets still awaiting a reply
+
+        :param update_time_start: If given, only return packets delivered at
+            or after this time
+        :type update_time_start: datetime, optional
+        :raises WorkloadComplete: if the replay is finished
+        :return: amieclient.packet.packetlist.PacketList
+        """
+
+        self.calls += 1
+        if self.is_done():
+            raise WorkloadComplete()
+        if self.start_time is None:
+            self.start()
+        now = self._now()
+        while self.scheduled and self.scheduled[0][0] <= now:
+            (deliver_time, seq, pdict) = heapq.heappop(self.scheduled)
+            self.packets_delivered += 1
+            pdict = json.loads(json.dumps(pdict))
+            pdict['header']['packet_timestamp'] = \
+                datetime.fromtimestamp(deliver_time).isoformat()
+            self.visible[_get_trid(pdict)] = (deliver_time, pdict)
+        start = None if update_time_start is None else \
+            update_time_start.timestamp()
+        result = [pdict for (deliver_time, pdict) in self.visible.values()
+                  if start is None or deliver_time >= start]
+        return make_packet_list(result)
+
+    def send_packet(self, packet, skip_validation=False):
+        """Accept a packet from the local site"""
+
+        self.calls += 1
+        if not skip_validation:
+            packet.validate_data(raise_on_invalid=True)
+        trid = str(packet.transaction_id)
+        packet_type = packet._packet_type
+        self.visible.pop(trid, None)
+        self.sent[trid].add(packet_type)
+        self.packets_sent += 1
+        now = self._now()
+        for (delay, pdict) in self.held.pop((trid, packet_type), []):
+            self.seq += 1
+            heapq.heappush(self.scheduled, (now + delay, self.seq, pdict))
+        return None
+
+    def set_transaction_failed(self, transaction_or_id=None):
+        """Stop listing the packets of a transaction"""
+
+        self.calls += 1
+        trid = str(transaction_or_id)
+        self.visible.pop(trid, None)
+        self.expected.pop(trid, None)
+        return None
+
+    def _now(self):
+        return self.timeutil.now().timestamp()
+
+
+def summarize_recording(records):
+    """Summarize the packets sent in a recording
+
+    :param records: Records from :func:`~packetrecorder.read_recording`
+    :type records: iterable
+    :return: A (sent, response_times) pair: sent maps each transaction ID to
+        the list of packet dicts sent for it, and response_times is a list of
+        seconds from receiving a packet to sending the next packet in the
+        same transaction
+    """
+
+    sent = defaultdict(list)
+    last_received = dict()
+    response_times = list()
+    for record in records:
+        pdict = record['packet']
+        trid = _get_trid(pdict)
+        t = datetime.fromisoformat(record['time']).timestamp()
+        if record['direction'] == 'received':
+            last_received[trid] = t
+            continue
+        sent[trid].append(pdict)
+        if trid in last_received:
+            response_times.append(t - last_received.pop(trid))
+    return (sent, response_times)
+
+def compare_recordings(baseline_records, replay_records, compare_bodies=False,
+                       ignore_keys=()):
+    """Compare the packets sent in a replay with a baseline
+
+    :param baseline_records: Records of the baseline
+    :type baseline_records: iterable
+    :param replay_records: Records of the replay
+    :type replay_records: iterable
+    :param compare_bodies: If True, packet bodies must also match
+    :type compare_bodies: bool
+    :param ignore_keys: Body keys to ignore when comparing bodies
+    :type ignore_keys: collection of str
+    :return: dict of results
+    """
+
+    (base_sent, base_times) = summarize_recording(baseline_records)
+    (replay_sent, replay_times) = summarize_recording(replay_records)
+    matched = list()
+    differing = list()
+    for trid in sorted(set(base_sent) & set(replay_sent)):
+        if _packet_signatures(base_sent[trid], compare_bodies,
+                              ignore_keys) == \
+           _packet_signatures(replay_sent[trid], compare_bodies, ignore_keys):
+            matched.append(trid)
+        else:
+            differing.append(trid)
+    base_times.sort()
+    replay_times.sort()
+    results = {
+        'transactions_matched': len(matched),
+        'transactions_differing': len(differing),
+        'transactions_missing': len(set(base_sent) - set(replay_sent)),
+        'transactions_extra': len(set(replay_sent) - set(base_sent)),
+        'differing_ids': differing[:20],
+        }
+    for pct in (50, 95, 99):
+        base = percentile(base_times, pct)
+        replay = percentile(replay_times, pct)
+        results[f'baseline_response_p{pct}'] = base
+        results[f'replay_response_p{pct}'] = replay
+        results[f'response_p{pct}_ratio'] = replay / base if base else None
+    return results
+
+def run_replay(recording, speed=1.0, baseline=None, output=None,
+               compare_bodies=False, ignore_keys=(), sp_latency=0,
+               sp_task_delay=0, sp_replay=None, latency_scale=None, seed=None,
+               max_seconds=None, mediator_config=None):
+    """Replay a recording and compare the result with a baseline
+
+    :param recording: The recording file
+    :type recording: str
+    :param speed: Time compression factor
+    :type speed: float
+    :param baseline: The baseline recording; default is ``recording``
+    :type baseline: str, optional
+    :param output: Where to record the replay; default is a temporary file
+    :type output: str, optional
+    :param compare_bodies: If True, packet bodies must also match
+    :type compare_bodies: bool
+    :param ignore_keys: Body keys to ignore when comparing bodies
+    :type ignore_keys: collection of str
+    :param sp_replay: A service provider recording to serve, instead of using
+        the fake service provider
+    :type sp_replay: str, optional
+    :param latency_scale: Multiplier for the latencies in ``sp_replay``;
+        default is 1 / speed
+    :type latency_scale: float, optional
+    :param max_seconds: Stop after this many seconds even if the replay is
+        unfinished
+    :type max_seconds: float, optional
+    :param mediator_config: Mediator configuration parameters (see
+        :data:`~configdefaults.DFLT`)
+    :type mediator_config: dict, optional
+    :return: dict of results
+    """
+
+    deadline = None if not max_seconds else time.monotonic() + max_seconds
+    timeutil = BenchmarkTimeUtil(deadline=deadline)
+    amie_client = ReplayAMIEClient(read_recording(recording), speed, timeutil)
+    timeutil.amie = amie_client
+    sp = ServiceProvider()
+    if sp_replay:
+        sp.apply_config({
+            'package': '',
+            'module': 'spreplay',
+            'replay_file': sp_replay,
+            'latency_scale': 1.0 / speed if latency_scale is None
+                else latency_scale,
+            'timeutil': timeutil,
+            })
+    else:
+        sp.apply_config({
+            'package': '',
+            'module': 'benchmarks.fakesp',
+            'latency': sp_latency,
+            'task_delay': sp_task_delay,
+            'seed': seed,
+            'timeutil': timeutil,
+            })
+
+    tmpdir = tempfile.TemporaryDirectory()
+    if output is None:
+        output = os.path.join(tmpdir.name, 'replay.jsonl')
+    elif os.path.exists(output):
+        os.unlink(output)
+    config = {
+        'min_retry_delay': 1,
+        'max_retry_delay': 4,
+        'sp_min_retry_delay': 1,
+        'sp_max_retry_delay': 4,
+        }
+    config.update(mediator_config or {})
+    config['snapshot_dir'] = os.path.join(tmpdir.name, 'snapshots')
+    config['packet_record_file'] = output
+    os.mkdir(config['snapshot_dir'])
+
+    start = time.monotonic()
+    mediator = AMIEMediator(config, amie_client, sp, timeutil)
+    amie_client.start()
+    try:
+        mediator.run_loop_persistently()
+    except WorkloadComplete:
+        pass
+    elapsed = time.monotonic() - start
+    mediator.packet_recorder.close()
+
+    results = {
+        'recording': recording,
+        'speed': speed,
+        'elapsed_seconds': elapsed,
+        'packets_replayed': amie_client.packets_delivered,
+        'packets_sent': amie_client.packets_sent,
+        'complete': amie_client.is_done(),
+        }
+    if sp_replay:
+        results['sp_mismatches'] = sp.implem.mismatches
+    else:
+        results['sp_calls'] = sum(sp.implem.calls.values())
+    results.update(compare_recordings(
+        read_recording(baseline or recording), read_recording(output),
+        compare_bodies, ignore_keys))
+    tmpdir.cleanup()
+    return results
+
+def _get_trid(pdict):
+    header = pdict['header']
+    trid = header.get('transaction_id', None) or \
+        header.get('trans_rec_id', None)
+    return str(trid)
+
+def _packet_signatures(pdicts, compare_bodies, ignore_keys):
+    signatures = list()
+    for pdict in pdicts:
+        if compare_bodies:
+            body = {key: value for (key, value) in pdict['body'].items()
+                    if key not in ignore_keys}
+            signature = (pdict['type'], json.dumps(body, sort_keys=True))
+        else:
+            signature = pdict['type']
+        # the mediator may send a reply again if it has not seen AMIE's
+        # next packet yet; that is not a difference
+        if not signatures or signatures[-1] != signature:
+            signatures.append(signature)
+    return signatures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.replay",
+        description="Replay a recorded AMIE packet stream against the "
+        "mediator and compare the replies with a baseline",
+        epilog="Delays and latencies are distributions: <n>, uniform:<lo>,"
+        "<hi>, exp:<mean>, lognormal:<median>,<sigma>, or choice:<n>,<n>...")
+    parser.add_argument('recording', help="recording file (JSON Lines)")
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help="time compression factor (default 1: real time)")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="baseline recording (default: the recording)")
+    parser.add_argument('--output', metavar='FILE',
+                        help="record the replay in FILE, e.g. to use as a "
+                        "later baseline")
+    parser.add_argument('--compare-bodies', action='store_true',
+                        help="require packet bodies to match too")
+    parser.add_argument('--ignore', action='append', default=[],
+                        metavar='KEY',
+                        help="body key to ignore when comparing bodies "
+                        "(may be repeated)")
+    parser.add_argument('--sp-latency', default='0',
+                        help="seconds per Service Provider call")
+    parser.add_argument('--task-delay', default='0',
+                        help="seconds for a Service Provider task to finish")
+    parser.add_argument('--sp-replay', metavar='FILE',
+                        help="serve this service provider recording instead "
+                        "of using the fake service provider")
+    parser.add_argument('--latency-scale', type=float,
+                        help="multiplier for latencies in the service "
+                        "provider recording (default 1/speed)")
+    parser.add_argument('--pause-max', type=int,
+                        help="mediator pause_max (seconds)")
+    parser.add_argument('--idle-loop-delay', type=int,
+                        help="mediator idle_loop_delay (seconds)")
+    parser.add_argument('--busy-loop-delay', type=int,
+                        help="mediator busy_loop_delay (seconds)")
+    parser.add_argument('--reply-delay', type=int,
+                        help="mediator reply_delay (seconds)")
+    parser.add_argument('--seed', type=int, help="random seed")
+    parser.add_argument('--max-seconds', type=float,
+                        help="stop after this many seconds")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write results to FILE as JSON")
+    parser.add_argument('-D', '--debug', action='store_true',
+                        help="log mediator debug messages")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    mediator_config = dict()
+    for attr in ('pause_max', 'idle_loop_delay', 'busy_loop_delay',
+                 'reply_delay'):
+        value = getattr(args, attr)
+        if value is not None:
+            mediator_config[attr] = value
+
+    results = run_replay(
+        args.recording,
+        speed=args.speed,
+        baseline=args.baseline,
+        output=args.output,
+        compare_bodies=args.compare_bodies,
+        ignore_keys=set(args.ignore),
+        sp_latency=args.sp_latency,
+        sp_task_delay=args.task_delay,
+        sp_replay=args.sp_replay,
+        latency_scale=args.latency_scale,
+        seed=args.seed,
+        max_seconds=args.max_seconds,
+        mediator_config=mediator_config)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    ok = results['complete'] and results['transactions_differing'] == 0 and \
+        results['transactions_missing'] == 0
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+"""Virtual-time simulation of the mediator's loop timing
+
+Run :meth:`~mediator.AMIEMediator.run_loop` against the simulated AMIE
+server and Service Provider of the throughput benchmark, but on a virtual
+clock: sleeps, call latencies, and ServiceProvider waits advance the clock
+instead of taking real time, so days of operation take seconds. Processing
+inside the mediator takes no virtual time. The run stops when the horizon is
+reached (or when a fixed number of transactions is finished).
+
+Every combination of the given ``pause_max``, ``idle_loop_delay``,
+``busy_loop_delay``, and ``reply_delay`` values is simulated with the same
+workload (the same arrival times and request types), and a row is printed
+for each with:
+
+    amie_calls_per_hour  : calls to the AMIE REST API per hour
+    sp_calls_per_hour    : ServiceProvider calls per hour
+    latency p50/p95      : seconds from AMIE posting the first packet of a
+                           transaction to the mediator finishing it
+    response p50/p95     : seconds from AMIE posting a packet to the
+                           mediator replying
+    idle                 : fraction of the time spent sleeping or waiting
+                           in ServiceProvider.get_tasks()
+
+Example, from the top-level directory::
+
+    PYTHONPATH=src python -m benchmarks.simulate --hours=72 --rate=20 \\
+        --idle-loop-delay=600,1800,3600 --busy-loop-delay=30,60 \\
+        --task-delay=exp:1800 --json=grid.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import contextlib
+import itertools
+import logging
+import tempfile
+from collections import Counter
+from datetime import (datetime, timedelta)
+import pprintpp
+pprintpp.monkeypatch()
+from misctypes import TimeUtil
+import serviceprovider
+from mediator import AMIEMediator
+from benchmarks import fakesp
+from benchmarks.distribution import (Distribution, percentile)
+from benchmarks.fakeamie import (SimulatedAMIE, FakeAMIEClient,
+                                 WorkloadComplete)
+from benchmarks.throughput import format_results
+
+#: Mediator parameters that can be given a list of values
+TIMING_PARMS = ('pause_max', 'idle_loop_delay', 'busy_loop_delay',
+                'reply_delay')
+
+class VirtualTimeUtil(TimeUtil):
+    def __init__(self, start=None, horizon=None):
+        """A TimeUtil with a virtual clock
+
+        The clock only moves when :meth:`sleep` or :meth:`advance` is
+        called. Time spent is accumulated in ``spent``, by activity.
+
+        :param start: The initial time; default is midnight, 1 January 2024
+        :type start: datetime, optional
+        :param horizon: Seconds after ``start`` at which to stop; advancing
+            the clock past it raises
+            :class:`~benchmarks.fakeamie.WorkloadComplete`
+        :type horizon: float, optional
+        """
+
+        self.start = datetime(2024, 1, 1) if start is None else start
+        self.horizon = horizon
+        self.elapsed = 0.0
+        self.spent = Counter()
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def sleep(self, secs):
+        self.advance(float(secs) if secs else 0, 'sleep')
+
+    def advance(self, secs, activity):
+        """Move the clock forward
+
+        :param secs: Seconds
+        :type secs: float
+        :param activity: What the time was spent on
+        :type activity: str
+        :raises WorkloadComplete: if the horizon is reached
+        """
+
+        if self.horizon is not None and self.elapsed + secs >= self.horizon:
+            self.spent[activity] += max(0.0, self.horizon - self.elapsed)
+            self.elapsed = self.horizon
+            raise WorkloadComplete()
+        self.elapsed += secs
+        self.spent[activity] += secs
+
+
+class VirtualAMIEClient(FakeAMIEClient):
+    """A FakeAMIEClient whose call latencies advance the virtual clock"""
+
+    def _delay(self, secs):
+        self.amie.timeutil.advance(secs, 'amie')
+
+
+class ServiceProvider(fakesp.ServiceProvider):
+    """A fakesp.ServiceProvider whose delays advance the virtual clock
+
+    Call latencies are counted as "sp" time, and waits in :meth:`get_tasks`
+    as "sp_wait" time.
+    """
+
+    def _call(self, method_name):
+        self.in_call = True
+        try:
+            super()._call(method_name)
+        finally:
+            self.in_call = False
+
+    def _delay(self, secs):
+        activity = 'sp' if getattr(self, 'in_call', False) else 'sp_wait'
+        self.timeutil.advance(secs, activity)
+
+
+def run_simulation(hours=24, arrival_rate=10, transactions=None, mix=None,
+                   amie_latency='0.5', amie_reply_delay='exp:60',
+                   amie_error_rate=0, sp_latency='0.05',
+                   sp_task_delay='exp:900', sp_task_failure_rate=0,
+                   sp_error_rate=0, seed=0, mediator_config=None):
+    """Simulate the mediator on a virtual clock
+
+    Latencies, delays, and rates are described in
+    :class:`~benchmarks.fakeamie.SimulatedAMIE`,
+    :class:`~benchmarks.fakeamie.FakeAMIEClient`, and
+    :class:`~benchmarks.fakesp.ServiceProvider`.
+
+    :param hours: Virtual hours to simulate
+    :type hours: float
+    :param arrival_rate: New transactions per hour
+    :type arrival_rate: float
+    :param transactions: If given, stop after this many transactions have
+        arrived; the simulation ends early if they are all finished
+    :type transactions: int, optional
+    :param mix: Relative frequencies of request types; see
+        :func:`~benchmarks.fakeamie.parse_mix`
+    :type mix: str, optional
+    :param amie_latency: Seconds per AMIE call; must not be 0, or the
+        mediator's busy loop would never advance the clock
+    :type amie_latency: str
+    :param seed: Random seed; the same seed gives the same workload
+    :type seed: int
+    :param mediator_config: Mediator configuration parameters (see
+        :data:`~configdefaults.DFLT`)
+    :type mediator_config: dict, optional
+    :return: dict of results
+    """
+
+    if Distribution(amie_latency).is_zero():
+        raise ValueError("amie_latency must not be 0")
+    horizon = float(hours) * 3600
+    timeutil = VirtualTimeUtil(horizon=horizon)
+    amie = SimulatedAMIE(reply_delay=amie_reply_delay, seed=seed,
+                         timeutil=timeutil, max_latencies=100000)
+    amie_client = VirtualAMIEClient(amie, latency=amie_latency,
+                                    error_rate=amie_error_rate,
+                                    seed=seed + 2)
+    sp = serviceprovider.ServiceProvider()
+    sp.apply_config({
+        'package': '',
+        'module': 'benchmarks.simulate',
+        'latency': sp_latency,
+        'task_delay': sp_task_delay,
+        'task_failure_rate': sp_task_failure_rate,
+        'error_rate': sp_error_rate,
+        'seed': seed + 1,
+        'timeutil': timeutil,
+        })
+
+    config = dict(mediator_config or {})
+    narrived = amie.add_transactions(transactions, mix,
+                                     float(arrival_rate) / 3600,
+                                     until=horizon)
+    wall_start = time.monotonic()
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        config['snapshot_dir'] = snapshot_dir
+        # The mediator prints some debugging output; over days of virtual
+        # time there is a lot of it
+        with open(os.devnull, 'w') as devnull, \
+             contextlib.redirect_stdout(devnull):
+            try:
+                mediator = AMIEMediator(config, amie_client, sp, timeutil)
+                mediator.run_loop_persistently()
+            except WorkloadComplete:
+                pass
+    wall = time.monotonic() - wall_start
+
+    virtual = timeutil.elapsed
+    vhours = virtual / 3600 if virtual else None
+    stats = amie.get_stats()
+    sp_calls = sum(sp.implem.calls.values())
+    idle = timeutil.spent['sleep'] + timeutil.spent['sp_wait']
+    results = {
+        'virtual_hours': vhours,
+        'wall_seconds': wall,
+        'speedup': virtual / wall if wall else None,
+        'transactions': narrived,
+        'arrived': stats['transactions'],
+        'finished': stats['finished'],
+        'failed': stats['failed'],
+        'in_progress': stats['in_progress'],
+        'packets_posted': stats['packets_posted'],
+        'packets_sent': amie_client.packets_sent,
+        'amie_calls': amie_client.calls,
+        'amie_calls_per_hour': amie_client.calls / vhours if vhours else None,
+        'amie_errors': amie_client.errors,
+        'sp_calls': sp_calls,
+        'sp_calls_per_hour': sp_calls / vhours if vhours else None,
+        'sp_calls_by_method': dict(sp.implem.calls),
+        'sp_errors': sp.implem.errors,
+        'idle_seconds': idle,
+        'idle_fraction': idle / virtual if virtual else None,
+        'seconds_by_activity': dict(timeutil.spent),
+        }
+    for name in ('latency', 'response'):
+        for pct in (50, 95, 99):
+            results[f'{name}_p{pct}'] = stats[f'{name}_p{pct}']
+    results['mediator_config'] = {key: value for (key, value) in
+                                  config.items() if key != 'snapshot_dir'}
+    return results
+
+def expand_grid(grid):
+    """Return every combination of parameter values
+
+    :param grid: Lists of values, by parameter name
+    :type grid: dict
+    :return: list of dicts
+    """
+
+    names = [name for name in grid if grid[name]]
+    return [dict(zip(names, values)) for values in
+            itertools.product(*[grid[name] for name in names])]
+
+def format_table(rows):
+    """Return the results of several simulations as a table"""
+
+    columns = [
+        ('pause', 'pause_max', 6, ''),
+        ('idle', 'idle_loop_delay', 6, ''),
+        ('busy', 'busy_loop_delay', 6, ''),
+        ('reply', 'reply_delay', 6, ''),
+        ('amie/h', 'amie_calls_per_hour', 8, '.1f'),
+        ('sp/h', 'sp_calls_per_hour', 8, '.1f'),
+        ('done', 'finished', 6, ''),
+        ('lat_p50', 'latency_p50', 8, '.0f'),
+        ('lat_p95', 'latency_p95', 8, '.0f'),
+        ('resp_p50', 'response_p50', 8, '.0f'),
+        ('resp_p95', 'response_p95', 8, '.0f'),
+        ('idle%', 'idle_fraction', 6, '.1%'),
+        ]
+    lines = [" ".join([f"{title:>{width}}"
+                       for (title, key, width, spec) in columns])]
+    for row in rows:
+        config = row['mediator_config']
+        cells = list()
+        for (title, key, width, spec) in columns:
+            value = config.get(key, row.get(key, None))
+            if value is None:
+                cells.append(f"{'-':>{width}}")
+            else:
+                cells.append(f"{value:>{width}{spec}}")
+        lines.append(" ".join(cells))
+    return "\n".join(lines)
+
+def _int_list(arg):
+    return [int(value) for value in arg.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.simulate",
+        description="Simulate AMIEMediator loop timing on a virtual clock",
+        epilog="Timing parameters take comma-separated lists of seconds; "
+        "every combination is simulated. Delays and latencies are "
+        "distributions: <n>, uniform:<lo>,<hi>, exp:<mean>, "
+        "lognormal:<median>,<sigma>, or choice:<n>,<n>...")
+    parser.add_argument('--hours', type=float, default=24,
+                        help="virtual hours to simulate (default 24)")
+    parser.add_argument('--rate', type=float, default=10,
+                        help="new transactions per hour (default 10)")
+    parser.add_argument('-n', '--transactions', type=int,
+                        help="stop after this many transactions")
+    parser.add_argument('--mix',
+                        help="transaction mix: <request_type>=<weight>,... "
+                        "(default: request_project_create only)")
+    for parm in TIMING_PARMS:
+        parser.add_argument('--' + parm.replace('_', '-'), type=_int_list,
+                            metavar='SECS[,SECS...]',
+                            help=f"mediator {parm} values")
+    parser.add_argument('--amie-latency', default='0.5',
+                        help="seconds per AMIE call (default 0.5)")
+    parser.add_argument('--amie-reply-delay', default='exp:60',
+                        help="seconds before AMIE posts the next packet "
+                        "(default exp:60)")
+    parser.add_argument('--amie-error-rate', type=float, default=0,
+                        help="fraction of AMIE calls that fail")
+    parser.add_argument('--sp-latency', default='0.05',
+                        help="seconds per Service Provider call "
+                        "(default 0.05)")
+    parser.add_argument('--task-delay', default='exp:900',
+                        help="seconds for a Service Provider task to finish "
+                        "(default exp:900)")
+    parser.add_argument('--task-failure-rate', type=float, default=0,
+                        help="fraction of Service Provider tasks that fail")
+    parser.add_argument('--sp-error-rate', type=float, default=0,
+                        help="fraction of Service Provider calls that raise "
+                        "a temporary error")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed (default 0)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write all results to FILE as JSON")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="print all results of every simulation")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(levelname)s %(name)s: %(message)s")
+
+    grid = {parm: getattr(args, parm) for parm in TIMING_PARMS}
+    rows = list()
+    for settings in expand_grid(grid):
+        results = run_simulation(
+            hours=args.hours,
+            arrival_rate=args.rate,
+            transactions=args.transactions,
+            mix=args.mix,
+            amie_latency=args.amie_latency,
+            amie_reply_delay=args.amie_reply_delay,
+            amie_error_rate=args.amie_error_rate,
+            sp_latency=args.sp_latency,
+            sp_task_delay=args.task_delay,
+            sp_task_failure_rate=args.task_failure_rate,
+            sp_error_rate=args.sp_error_rate,
+            seed=args.seed,
+            mediator_config=settings)
+        rows.append(results)
+        if args.verbose:
+            print(format_results(results) + "\n")
+    print(format_table(rows))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(rows, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Startup-time benchmark for the mediator programs
+
+Every run starts fresh Python interpreters, so nothing is cached between
+runs except the operating system's file cache and the ``.pyc`` files. Each
+child process times these phases of startup (in milliseconds):
+
+    import               importing the modules that ``bin/amie`` imports
+    initialize_handlers  PacketHandler.initialize_handlers(), as called by
+                         the mediator
+    load_all_handlers    importing every packet handler module; the mediator
+                         does this lazily, one packet type at a time
+    build_docstrings     supplementing the ``@process_parms`` docstrings; this
+                         is only done under Sphinx or on request
+
+and the parent times the whole child process (``process``), and
+``bin/amie -h`` (``amie_help``), which pays the same import costs as the
+``--list`` and ``--fail`` admin commands without needing an AMIE server.
+
+Results can be saved and compared like those of ``benchmarks.micro``::
+
+    PYTHONPATH=src python -m benchmarks.startup --save=before.json
+    ... make changes ...
+    PYTHONPATH=src python -m benchmarks.startup --compare=before.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+from benchmarks.micro import (RESULTS_VERSION, compare_results,
+                              format_comparison)
+
+TOP_DIR = Path(__file__).parent.parent
+
+#: Phases timed in each child process, in order
+PHASES = ('import', 'initialize_handlers', 'load_all_handlers',
+          'build_docstrings')
+
+CHILD_SCRIPT = """
+import json
+import time
+t0 = time.perf_counter()
+import pprintpp
+pprintpp.monkeypatch()
+import config
+import amieclient
+import serviceprovider
+import mediator
+import profiling
+t1 = time.perf_counter()
+from packethandler import PacketHandler
+PacketHandler.initialize_handlers()
+t2 = time.perf_counter()
+PacketHandler.initialize_handlers(eager=True)
+t3 = time.perf_counter()
+import parmdesc
+parmdesc.build_docstrings()
+t4 = time.perf_counter()
+print(json.dumps([t1 - t0, t2 - t1, t3 - t2, t4 - t3]))
+"""
+
+def _child_env():
+    env = dict(os.environ)
+    src = str(TOP_DIR / 'src')
+    path = env.get('PYTHONPATH', None)
+    env['PYTHONPATH'] = src if not path else src + os.pathsep + path
+    return env
+
+def time_child(env=None):
+    """Start one child interpreter and time its startup phases
+
+    :return: dict mapping each of :data:`PHASES`, and "process", to seconds
+    """
+
+    env = _child_env() if env is None else env
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', CHILD_SCRIPT], env=env,
+                         cwd=str(TOP_DIR), check=True, capture_output=True,
+                         text=True).stdout
+    elapsed = time.perf_counter() - start
+    times = dict(zip(PHASES, json.loads(out.splitlines()[-1])))
+    times['process'] = elapsed
+    return times
+
+def time_amie_help(env=None):
+    """Time ``bin/amie -h`` in a child process
+
+    :return: Elapsed seconds
+    """
+
+    env = _child_env() if env is None else env
+    start = time.perf_counter()
+    subprocess.run([sys.executable, str(TOP_DIR / 'bin' / 'amie'), '-h'],
+                   env=env, cwd=str(TOP_DIR), check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def run_startup(repeat=10):
+    """Run the startup benchmark
+
+    :param repeat: Number of child processes of each kind
+    :type repeat: int
+    :return: dict of results, in the format used by ``benchmarks.micro``
+    """
+
+    env = _child_env()
+    samples = dict()
+    for i in range(repeat):
+        for (name, secs) in time_child(env).items():
+            samples.setdefault(name, []).append(secs)
+        samples.setdefault('amie_help', []).append(time_amie_help(env))
+    results = dict()
+    for (name, times) in samples.items():
+        results[name] = {
+            'number': 1,
+            'median_ns': statistics.median(times) * 1e9,
+            'min_ns': min(times) * 1e9,
+        }
+    return {
+        'v': RESULTS_VERSION,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+def format_results(results):
+    """Return results as a table"""
+
+    lines = [f"{'phase':20} {'median ms':>10} {'min ms':>10}"]
+    for (name, result) in results['results'].items():
+        lines.append(f"{name:20} {result['median_ns'] / 1e6:>10.1f} "
+                     f"{result['min_ns'] / 1e6:>10.1f}")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.startup",
+        description="Time the startup of fresh mediator processes")
+    parser.add_argument('--repeat', type=int, default=10,
+                        help="child processes of each kind (default 10)")
+    parser.add_argument('--save', metavar='FILE',
+                        help="save the results as a baseline in FILE")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="compare with the baseline in FILE")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="slowdown that counts as a regression "
+                        "(default 0.25, i.e. 25%%)")
+    args = parser.parse_args(argv)
+
+    results = run_startup(args.repeat)
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        rows = compare_results(baseline, results, args.threshold)
+        print(format_comparison(rows))
+        if any(row[4] == 'slower' for row in rows):
+            status = 1
+    else:
+        print(format_results(results))
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)),
+                    exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""End-to-end throughput benchmark
+
+Run :class:`~mediator.AMIEMediator` against a
+:class:`~benchmarks.fakeamie.SimulatedAMIE` (through a
+:class:`~benchmarks.fakeamie.FakeAMIEClient`) and a
+:class:`~benchmarks.fakesp.ServiceProvider` until every transaction of the
+workload is finished, and report:
+
+    packets_per_hour         : AMIE packets posted by AMIE and sent by the
+                               mediator per hour
+    transactions_per_hour    : finished transactions per hour
+    latency p50/p95/p99      : seconds from the first packet of a transaction
+                               being posted to the final
+                               "inform_transaction_complete" packet
+    sp_calls_per_packet      : ServiceProvider calls per packet posted by AMIE
+    peak_rss_mb              : peak resident set size of the process
+    peak_traced_mb           : peak memory allocated by Python (only with
+                               --tracemalloc, which slows everything down)
+
+The mediator's timing parameters (``pause_max`` and the loop delays) can be
+set on the command line, so the effect of changing them can be measured by
+running the benchmark before and after. Use ``--json`` to save results.
+
+Example, from the top-level directory::
+
+    PYTHONPATH=src python -m benchmarks.throughput -n 1000 \\
+        --task-delay=exp:2 --pause-max=5 --json=after.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import tempfile
+import resource
+import tracemalloc
+import pprintpp
+pprintpp.monkeypatch()
+from misctypes import TimeUtil
+from serviceprovider import ServiceProvider
+from mediator import AMIEMediator
+from benchmarks.distribution import percentile
+from benchmarks.fakeamie import (SimulatedAMIE, FakeAMIEClient,
+                                 WorkloadComplete)
+
+class BenchmarkTimeUtil(TimeUtil):
+    def __init__(self, amie=None, deadline=None):
+        """A TimeUtil that can sleep for fractions of a second
+
+        The mediator's sleeps are cut short with a
+        :class:`~benchmarks.fakeamie.WorkloadComplete` exception when the
+        workload is finished or the deadline has passed, so idle loop delays
+        do not distort the results.
+
+        :param amie: The simulated AMIE server whose workload is being run
+        :type amie: SimulatedAMIE
+        :param deadline: time.monotonic() value after which the run stops
+        :type deadline: float, optional
+        """
+
+        self.amie = amie
+        self.deadline = deadline
+
+    def sleep(self, secs):
+        end = time.monotonic() + (float(secs) if secs else 0)
+        while True:
+            self.check()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.1))
+
+    def check(self):
+        if self.amie is not None and self.amie.is_done():
+            raise WorkloadComplete()
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise WorkloadComplete()
+
+
+def run_benchmark(transactions=100, mix=None, arrival_rate=0,
+                  amie_latency=0, amie_reply_delay=0, amie_error_rate=0,
+                  sp_latency=0, sp_task_delay=0, sp_task_failure_rate=0,
+                  sp_error_rate=0, seed=None, max_seconds=None,
+                  mediator_config=None, snapshot_dir=None,
+                  trace_memory=False):
+    """Run the mediator against fake AMIE and Service Provider back ends
+
+    Latencies, delays, and rates are described in
+    :class:`~benchmarks.fakeamie.SimulatedAMIE`,
+    :class:`~benchmarks.fakeamie.FakeAMIEClient`, and
+    :class:`~benchmarks.fakesp.ServiceProvider`.
+
+    :param transactions: The number of transactions
+    :type transactions: int
+    :param mix: Relative frequencies of request types; see
+        :func:`~benchmarks.fakeamie.parse_mix`
+    :type mix: str, optional
+    :param max_seconds: Stop after this many seconds even if transactions
+        are unfinished
+    :type max_seconds: float, optional
+    :param mediator_config: Mediator configuration parameters (see
+        :data:`~configdefaults.DFLT`); retry delays default to 1 second
+    :type mediator_config: dict, optional
+    :param snapshot_dir: Snapshot directory; default is a temporary directory
+    :type snapshot_dir: str, optional
+    :param trace_memory: If True, use tracemalloc to track peak memory
+    :type trace_memory: bool
+    :return: dict of results
+    """
+
+    deadline = None if not max_seconds else time.monotonic() + max_seconds
+    timeutil = BenchmarkTimeUtil(deadline=deadline)
+    amie = SimulatedAMIE(reply_delay=amie_reply_delay, seed=seed,
+                         timeutil=timeutil)
+    amie_client = FakeAMIEClient(amie, latency=amie_latency,
+                                 error_rate=amie_error_rate,
+                                 seed=None if seed is None else seed + 2)
+    timeutil.amie = amie
+    sp = ServiceProvider()
+    sp.apply_config({
+        'package': '',
+        'module': 'benchmarks.fakesp',
+        'latency': sp_latency,
+        'task_delay': sp_task_delay,
+        'task_failure_rate': sp_task_failure_rate,
+        'error_rate': sp_error_rate,
+        'seed': None if seed is None else seed + 1,
+        'timeutil': timeutil,
+        })
+
+    tmpdir = None
+    if snapshot_dir is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        snapshot_dir = tmpdir.name
+    config = {
+        'min_retry_delay': 1,
+        'max_retry_delay': 4,
+        'sp_min_retry_delay': 1,
+        'sp_max_retry_delay': 4,
+        }
+    config.update(mediator_config or {})
+    config['snapshot_dir'] = snapshot_dir
+
+    if trace_memory:
+        tracemalloc.start()
+    amie.add_transactions(transactions, mix, arrival_rate)
+    start = time.monotonic()
+    wall_start = timeutil.now().timestamp()
+    try:
+        mediator = AMIEMediator(config, amie_client, sp, timeutil)
+        mediator.run_loop_persistently()
+    except WorkloadComplete:
+        pass
+    elapsed = time.monotonic() - start
+    if amie.finish_time is not None:
+        elapsed = amie.finish_time - wall_start
+    peak_traced = None
+    if trace_memory:
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+    latencies = sorted(amie.latencies)
+    nposted = amie.packets_posted
+    npackets = nposted + amie_client.packets_sent
+    sp_calls = sum(sp.implem.calls.values())
+    hours = elapsed / 3600.0 if elapsed > 0 else None
+    return {
+        'transactions': transactions,
+        'finished': amie.nfinished,
+        'failed': amie.nfailed,
+        'elapsed_seconds': elapsed,
+        'packets_posted': nposted,
+        'packets_listed': amie.packets_listed,
+        'packets_sent': amie_client.packets_sent,
+        'packets_per_hour': npackets / hours if hours else None,
+        'transactions_per_hour':
+            amie.nfinished / hours if hours else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'latency_p99': percentile(latencies, 99),
+        'sp_calls': sp_calls,
+        'sp_calls_per_packet': sp_calls / nposted if nposted else None,
+        'sp_calls_by_method': dict(sp.implem.calls),
+        'sp_errors': sp.implem.errors,
+        'amie_calls': amie_client.calls,
+        'amie_errors': amie_client.errors,
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_traced_mb': None if peak_traced is None else
+            peak_traced / (1024 * 1024),
+        'mediator_config': {key: value for (key, value) in config.items()
+                            if key != 'snapshot_dir'},
+        }
+
+def format_results(results):
+    """Return benchmark results as human-readable text"""
+
+    lines = list()
+    for (key, value) in results.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        elif isinstance(value, dict):
+            value = ", ".join([k + "=" + str(v) for (k, v) in
+                               sorted(value.items())])
+        lines.append(f"{key:24} {value}")
+    return "\n".join(lines)
+
+def _peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return maxrss / (1024 * 1024)
+    return maxrss / 1024
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="benchmarks.throughput",
+        description="Measure AMIEMediator throughput against fake AMIE and "
+        "Service Provider back ends",
+        epilog="Delays and latencies are distributions: <n>, uniform:<lo>,"
+        "<hi>, exp:<mean>, lognormal:<median>,<sigma>, or choice:<n>,<n>...")
+    parser.add_argument('-n', '--transactions', type=int, default=100,
+                        help="number of transactions (default 100)")
+    parser.add_argument('--mix',
+                        help="transaction mix: <request_type>=<weight>,... "
+                        "(default: request_project_create only)")
+    parser.add_argument('--arrival-rate', type=float, default=0,
+                        help="transactions per second (default: all at once)")
+    parser.add_argument('--amie-latency', default='0',
+                        help="seconds per AMIE call")
+    parser.add_argument('--amie-reply-delay', default='0',
+                        help="seconds before AMIE posts the next packet")
+    parser.add_argument('--amie-error-rate', type=float, default=0,
+                        help="fraction of AMIE calls that fail")
+    parser.add_argument('--sp-latency', default='0',
+                        help="seconds per Service Provider call")
+    parser.add_argument('--task-delay', default='0',
+                        help="seconds for a Service Provider task to finish")
+    parser.add_argument('--task-failure-rate', type=float, default=0,
+                        help="fraction of Service Provider tasks that fail")
+    parser.add_argument('--sp-error-rate', type=float, default=0,
+                        help="fraction of Service Provider calls that raise "
+                        "a temporary error")
+    parser.add_argument('--pause-max', type=int,
+                        help="mediator pause_max (seconds)")
+    parser.add_argument('--idle-loop-delay', type=int,
+                        help="mediator idle_loop_delay (seconds)")
+    parser.add_argument('--busy-loop-delay', type=int,
+                        help="mediator busy_loop_delay (seconds)")
+    parser.add_argument('--reply-delay', type=int,
+                        help="mediator reply_delay (seconds)")
+    parser.add_argument('--snapshot-backend',
+                        help="mediator snapshot_backend")
+    parser.add_argument('--seed', type=int, help="random seed")
+    parser.add_argument('--max-seconds', type=float,
+                        help="stop after this many seconds")
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="track peak Python memory (slow)")
+    parser.add_argument('--json', metavar='FILE',
+                        help="also write results to FILE as JSON")
+    parser.add_argument('-D', '--debug', action='store_true',
+                        help="log mediator debug messages")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARNING,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    mediator_config = dict()
+    for attr in ('pause_max', 'idle_loop_delay', 'busy_loop_delay',
+                 'reply_delay', 'snapshot_backend'):
+        value = getattr(args, attr)
+        if value is not None:
+            mediator_config[attr] = value
+
+    results = run_benchmark(
+        transactions=args.transactions,
+        mix=args.mix,
+        arrival_rate=args.arrival_rate,
+        amie_latency=args.amie_latency,
+        amie_reply_delay=args.amie_reply_delay,
+        amie_error_rate=args.amie_error_rate,
+        sp_latency=args.sp_latency,
+        sp_task_delay=args.task_delay,
+        sp_task_failure_rate=args.task_failure_rate,
+        sp_error_rate=args.sp_error_rate,
+        seed=args.seed,
+        max_seconds=args.max_seconds,
+        mediator_config=mediator_config,
+        trace_memory=args.tracemalloc)
+    print(format_results(results))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0 if results['finished'] == results['transactions'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
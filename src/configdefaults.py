@@ -3,11 +3,47 @@ DFLT = {
     "min_retry_delay": 60,
     "max_retry_delay": 3600,
     "retry_time_max": 14400,
+    "amie_rate_limits": "",
+    "amie_concurrency_max": 0,
+    "amie_latency_target": 0,
+    "amie_call_timeout": 0,
+    "loop_deadline": 0,
+    "packet_deadline": 0,
     "idle_loop_delay": 3600,
     "busy_loop_delay": 60,
     "reply_delay": 10,
     "snapshot_dir": "/tmp/amiemediator",
+    "snapshot_backend": "files",
+    "snapshot_journal_max_size": 4194304,
+    "snapshot_journal_keep": 2,
+    "snapshot_server_address": "",
+    "metrics_textfile": "",
+    "metrics_address": "",
+    "control_address": "",
+    "trace_file": "",
+    "packet_record_file": "",
+    "sp_record_file": "",
+    "profile": "",
+    "profile_dir": "",
+    "profile_iterations": 100,
+    "profile_seconds": 0,
+    "profile_signal": "",
+    "memory_report_interval": 0,
+    "memory_report_top": 20,
+    "memory_report_frames": 1,
+    "memory_report_keep": 10,
+    "memory_rss_max": 0,
+    "task_page_size": 0,
+    "task_push_dir": "",
+    "shards": 1,
+    "lease_dir": "",
+    "lease_mode": "standby",
+    "lease_ttl": 15,
+    "instance_id": "",
     "sp_min_retry_delay": 60,
     "sp_max_retry_delay": 3600,
     "sp_retry_time_max": 14400,
+    "sp_rate_limits": "",
+    "sp_concurrency_max": 0,
+    "sp_latency_target": 0,
     }
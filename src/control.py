@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import socket
+import socketserver
+import threading
+import logging
+from snapshotserver import parse_address
+
+#: Commands accepted by the control server
+COMMANDS = ('kick', 'pause', 'resume', 'drain', 'dump-state')
+
+#: While the control server is running, the longest (secs) the main loop
+#: waits in a ServiceProvider call before checking for commands
+SLICE_SECS = 1
+
+class LoopControl(object):
+    def __init__(self):
+        """Commands and state shared between the main loop and the
+        :class:`ControlServer`
+
+        Commands are recorded here and take effect in the main loop: "kick"
+        ends the current sleep so AMIE is polled at once, "pause" holds the
+        loop before its next iteration until "resume", and "drain" stops the
+        mediator from taking on new transactions, so the loop exits when all
+        current transactions are done. Every command ends the current sleep;
+        so does :meth:`kick` when it is called for other events (e.g. a
+        pushed task update; see :mod:`taskpush`).
+        """
+
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.paused = False
+        self.draining = False
+        self.state = dict()
+
+    def kick(self):
+        self._notify()
+
+    def pause(self):
+        self._notify(paused=True)
+
+    def resume(self):
+        self._notify(paused=False)
+
+    def drain(self):
+        self._notify(draining=True)
+
+    def _notify(self, **flags):
+        with self.condition:
+            for (name, value) in flags.items():
+                setattr(self, name, value)
+            self.generation += 1
+            self.condition.notify_all()
+
+    def mark(self) -> int:
+        """Return the current event number, for :meth:`sleep`"""
+
+        with self.condition:
+            return self.generation
+
+    def sleep(self, secs, since=None) -> bool:
+        """Sleep until ``secs`` seconds pass or a command arrives
+
+        :param secs: The longest time to sleep, in seconds
+        :type secs: float
+        :param since: A value returned by :meth:`mark`; if a command has
+            arrived since then, return immediately
+        :type since: int, optional
+        :return: True if a command ended the sleep early
+        """
+
+        end = time.monotonic() + float(secs)
+        with self.condition:
+            generation = self.generation if since is None else since
+            while self.generation == generation:
+                left = end - time.monotonic()
+                if left <= 0:
+                    return False
+                self.condition.wait(left)
+            return True
+
+    def wait_while_paused(self) -> bool:
+        """Block while the loop is paused
+
+        :return: True if the loop was paused
+        """
+
+        with self.condition:
+            if not self.paused:
+                return False
+            while self.paused:
+                self.condition.wait()
+            return True
+
+    def set_state(self, state):
+        """Record the mediator state reported by "dump-state"
+
+        The main loop calls this after every iteration, so the control server
+        never reads mediator data structures while the loop is changing them.
+
+        :param state: JSON-serializable state
+        :type state: dict
+        """
+
+        with self.condition:
+            self.state = state
+
+    def handle(self, command) -> dict:
+        """Carry out a command and return the reply
+
+        :param command: One of :data:`COMMANDS`
+        :type command: str
+        :return: dict with "ok", "paused", "draining", and, for "dump-state",
+            "state"; or "ok" and "error" if the command is unknown
+        """
+
+        if command not in COMMANDS:
+            return {'ok': False, 'error': "Unknown command: " + command}
+        if command != 'dump-state':
+            getattr(self, command)()
+        with self.condition:
+            reply = {
+                'ok': True,
+                'paused': self.paused,
+                'draining': self.draining,
+            }
+            if command == 'dump-state':
+                reply['state'] = self.state
+        return reply
+
+
+class ControlServer(object):
+    def __init__(self, control, address):
+        """Accept commands for the main loop on a local socket
+
+        Clients send one command per line (see :data:`COMMANDS`), and get a
+        one-line JSON reply for each (see :meth:`LoopControl.handle`).
+
+        :param control: The main loop's LoopControl
+        :type control: LoopControl
+        :param address: The address to listen on; see
+            :func:`~snapshotserver.parse_address`. A TCP address must be on
+            a loopback host.
+        :type address: str
+        """
+
+        self.control = control
+        self.address = address
+        self.logger = logging.getLogger(__name__)
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Start accepting commands in a background thread
+
+        :raises ValueError: if the address is a TCP address whose host is not
+            a loopback host
+        """
+
+        if self.server is not None:
+            return
+        (family, address) = parse_address(self.address, loopback_only=True)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            # make the socket owner-only before listening on it, so there is
+            # no moment when others can connect
+            server = _UnixControlServer(address, _ControlRequestHandler,
+                                        bind_and_activate=False)
+            try:
+                server.server_bind()
+                os.chmod(address, 0o600)
+                server.server_activate()
+            except BaseException:
+                server.server_close()
+                raise
+            self.server = server
+        else:
+            self.server = _TCPControlServer(address, _ControlRequestHandler)
+            # report the actual port if port 0 was requested
+            self.address = address[0] + ':' + \
+                str(self.server.server_address[1])
+        self.server.daemon_threads = True
+        self.server.control_server = self
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='controlserver', daemon=True)
+        self.thread.start()
+        self.logger.info("Accepting control commands on " + self.address)
+
+    def stop(self):
+        """Stop accepting commands"""
+
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        (family, address) = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        self.server = None
+        self.thread = None
+
+
+class _UnixControlServer(socketserver.ThreadingUnixStreamServer):
+    pass
+
+
+class _TCPControlServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class _ControlRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.control_server
+        for line in self.rfile:
+            command = line.decode('utf-8', 'replace').strip()
+            if not command:
+                continue
+            reply = server.control.handle(command)
+            server.logger.info("Control command: " + command)
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+
+def send_command(address, command, timeout=10) -> dict:
+    """Send a command to a ControlServer and return its reply
+
+    :param address: The server's address; see
+        :func:`~snapshotserver.parse_address`
+    :type address: str
+    :param command: One of :data:`COMMANDS`
+    :type command: str
+    :param timeout: Seconds to wait for the server
+    :type timeout: float
+    :return: The decoded reply
+    """
+
+    (family, address) = parse_address(address)
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        sock.sendall(command.encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as reader:
+            return json.loads(reader.readline())
@@ -0,0 +1,192 @@
+import time
+import threading
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (ConnectionError, Timeout)
+import metrics
+
+DEADLINES_EXCEEDED = metrics.counter(
+    'amie_deadlines_exceeded_total',
+    'Work handed back because a deadline passed, by deadline scope',
+    ('scope',))
+
+_local = threading.local()
+
+class DeadlineExceeded(Exception):
+    """Raised when work cannot be finished before the current deadline
+
+    This is not an error: the work is expected to be tried again later.
+    """
+    pass
+
+
+class Deadline(object):
+    def __init__(self, scope, expires, clock=time.monotonic):
+        """A point in time by which work must be done
+
+        :param scope: What the deadline is for, e.g. "loop" or "packet"
+        :type scope: str
+        :param expires: The clock value of the deadline
+        :type expires: float
+        :param clock: Function returning the current time in seconds
+        :type clock: callable
+        """
+
+        self.scope = scope
+        self.expires = expires
+        self.clock = clock
+
+    def remaining(self) -> float:
+        return self.expires - self.clock()
+
+
+def current():
+    """Return the innermost Deadline of this thread, or None"""
+
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+def remaining():
+    """Return the seconds left before this thread's deadline, or None
+
+    The value is negative if the deadline has passed.
+    """
+
+    deadline = current()
+    return None if deadline is None else deadline.remaining()
+
+def expired() -> bool:
+    """Return True if this thread's deadline has passed"""
+
+    left = remaining()
+    return left is not None and left <= 0
+
+def check(what, needed=0):
+    """Raise DeadlineExceeded unless there is time left for some work
+
+    :param what: Description of the work, for the exception message
+    :type what: str
+    :param needed: Seconds the work needs before it can start (e.g. a retry
+        delay)
+    :type needed: float
+    :raises DeadlineExceeded: if less than ``needed`` seconds are left, or
+        the deadline has passed
+    """
+
+    deadline = current()
+    if deadline is None:
+        return
+    left = deadline.remaining()
+    if left <= 0 or left < needed:
+        raise exceeded(what)
+
+def exceeded(what) -> DeadlineExceeded:
+    """Return (and count) a DeadlineExceeded for this thread's deadline"""
+
+    deadline = current()
+    scope = deadline.scope if deadline is not None else ''
+    DEADLINES_EXCEEDED.inc(scope=scope)
+    return DeadlineExceeded(what + ": " + scope + " deadline exceeded")
+
+@contextmanager
+def budget(seconds, scope, clock=None):
+    """Run a block of work under a deadline
+
+    The deadline is ``seconds`` from now, or the enclosing deadline if that
+    is sooner. Calls made through
+    :class:`~retryingproxy.RetryingServiceProxy` sessions in the block raise
+    :class:`DeadlineExceeded` instead of starting (or sleeping before a
+    retry) once there is no time left, and HTTP requests made by the AMIE
+    client time out at the deadline (see :func:`install_http_timeouts`).
+
+    :param seconds: The budget; 0 or None means no deadline of its own
+    :type seconds: float
+    :param scope: What the deadline is for, e.g. "loop" or "packet"
+    :type scope: str
+    :param clock: Function returning the current time in seconds; the
+        default is the enclosing deadline's clock, or time.monotonic
+    :type clock: callable, optional
+    """
+
+    if not seconds:
+        yield current()
+        return
+    outer = current()
+    if clock is None:
+        clock = time.monotonic if outer is None else outer.clock
+    if outer is not None and outer.remaining() <= float(seconds):
+        deadline = outer
+    else:
+        deadline = Deadline(scope, clock() + float(seconds), clock)
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = list()
+    stack.append(deadline)
+    try:
+        yield deadline
+    finally:
+        stack.pop()
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, call_timeout=0, **kwargs):
+        """A requests transport adapter that gives every request a timeout
+
+        The timeout is the time left before the deadline of the calling
+        thread (see :func:`budget`), or ``call_timeout``, whichever is
+        shorter. A request that times out because of the deadline raises
+        :class:`DeadlineExceeded`; one that times out because of
+        ``call_timeout`` raises a requests ConnectionError, which the
+        mediator treats as a temporary error.
+
+        :param call_timeout: Seconds; 0 means no timeout but the deadline
+        :type call_timeout: float
+        """
+
+        super().__init__(**kwargs)
+        self.call_timeout = float(call_timeout)
+
+    def send(self, request, timeout=None, **kwargs):
+        left = remaining()
+        if left is not None and left <= 0:
+            raise exceeded("HTTP " + str(request.method))
+        limit = self.call_timeout or None
+        by_deadline = left is not None and (limit is None or left < limit)
+        if by_deadline:
+            limit = left
+        if limit is not None and (timeout is None or
+                                  not isinstance(timeout, (int, float)) or
+                                  limit < timeout):
+            timeout = limit
+        else:
+            by_deadline = False
+        try:
+            return super().send(request, timeout=timeout, **kwargs)
+        except Timeout as err:
+            if by_deadline:
+                raise exceeded("HTTP " + str(request.method)) from err
+            if isinstance(err, ConnectionError):
+                raise
+            raise ConnectionError(err, request=request) from err
+
+
+def install_http_timeouts(client, call_timeout=0) -> bool:
+    """Give the HTTP requests made by a client timeouts
+
+    Mount a :class:`TimeoutHTTPAdapter` on the requests session of a client
+    (e.g. an AMIEClient) that has one in its ``_session`` attribute.
+
+    :param client: The client
+    :type client: object
+    :param call_timeout: See :class:`TimeoutHTTPAdapter`
+    :type call_timeout: float
+    :return: True if the client has a requests session
+    """
+
+    session = getattr(client, '_session', None)
+    if session is None or not hasattr(session, 'mount'):
+        return False
+    adapter = TimeoutHTTPAdapter(call_timeout)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return True
@@ -1,7 +1,11 @@
 from abc import (ABC, abstractmethod)
 import stat
-import signal, os, sys, errno
+import os, sys, errno
+import select
+import struct
+import threading
 import time
+import ctypes, ctypes.util
 
 class FileWaiterFileType(Exception):
     """Exception raised when wait file exists and is wrong type"""
@@ -9,112 +13,378 @@ class FileWaiterFileType(Exception):
 
 
 class FileWaiter(object):
-    implem = None
-    
+
     def __init__(self, path):
         """Use a file to wait for another process to release us
 
+        The file's directory is watched by a :class:`DirectoryWatcher` that is
+        shared by all FileWaiters for the same directory in this process. A
+        waiter is released when the file is written by :meth:`release` (in
+        any process); it can also wait for changes to other files in the
+        directory by passing their names as ``keys`` to :meth:`wait`.
+
+        No watching is done until :meth:`mark` or :meth:`wait` is first called,
+        so a process that only calls :meth:`release` costs nothing.
+
         :param path: the path of the file to use for synchronization
         :type path: str
         """
-        if not FileWaiter.implem:
-            if os.name == "posix":
-                FileWaiter.implem = FIFOFileWaiter(path)
-            else:
-                FileWaiter.implem = PollingFileWaiter(path)
-        
-    def wait(self, max_secs=600):
+        self.path = path
+        (dir, self.name) = os.path.split(os.path.abspath(path))
+        if os.path.lexists(self.path):
+            mode = os.lstat(self.path).st_mode
+            if stat.S_ISFIFO(mode):
+                # left by an older version that forked to wait on a FIFO
+                os.unlink(self.path)
+            elif not stat.S_ISREG(mode):
+                raise FileWaiterFileType(self.path)
+        self.watcher = DirectoryWatcher.for_directory(dir)
+        self.watcher.add_broadcast_name(self.name)
+
+    def mark(self):
+        """Start watching if necessary and return the current change number
+
+        The value can be passed as the ``since`` argument of :meth:`wait` so
+        that changes made between calling ``mark()`` and ``wait()`` are not
+        missed.
+
+        :return: An opaque change number
+        """
+        return self.watcher.mark()
+
+    def wait(self, max_secs=600, keys=None, since=None):
         """Wait for another process to release us
 
         :param max_secs: Maximum time to wait, in seconds
         :type max_secs: int
+        :param keys: Names of files in the directory; if given, only changes
+            to these files (or a release) end the wait
+        :type keys: list, optional
+        :param since: A value returned by :meth:`mark`; if a relevant change
+            has happened since then, return immediately
+        :type since: int, optional
         :return: True if we were released, False if we timed out
         """
-        FileWaiter.implem.wait(max_secs)
+        return self.watcher.wait(max_secs, keys, since)
 
     def release(self):
-        """Release another process that might be waiting"""
-        FileWaiter.implem.release()
+        """Release all processes that might be waiting"""
+        with open(self.path, 'w') as fp:
+            # the content only matters when the directory is being polled
+            fp.write(str(time.time_ns()))
+
+
+class DirectoryWatcher(ABC):
+    """Track changes to files in a directory and wake up waiting threads
+
+    Every change seen by the watcher is given a new change number. The
+    watcher remembers the change number of the latest change to each file, so
+    a thread that waits on specific files is only woken when one of those
+    files (or a "broadcast" file) changes.
+    """
+
+    #: Maximum number of file names to remember change numbers for
+    max_names = 10000
+
+    _watchers = dict()
+    _watchers_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, dir):
+        """Return the watcher for a directory, creating it if necessary
+
+        Inotify is used if available; otherwise the directory is polled.
+
+        :param dir: The directory to watch
+        :type dir: str
+        :return: DirectoryWatcher
+        """
+        dir = os.path.realpath(dir)
+        with DirectoryWatcher._watchers_lock:
+            watcher = DirectoryWatcher._watchers.get(dir, None)
+            if watcher is None or watcher.pid != os.getpid():
+                if InotifyWatcher.available():
+                    watcher = InotifyWatcher(dir)
+                else:
+                    watcher = PollingWatcher(dir)
+                DirectoryWatcher._watchers[dir] = watcher
+            return watcher
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = False
+        self.seq = 0
+        self.broadcast_seq = 0
+        self.name_seqs = dict()
+        self.broadcast_names = set()
+        self.waiters = list()
+
+    def add_broadcast_name(self, name):
+        """Treat changes to the named file as changes to every file
+
+        :param name: The file name
+        :type name: str
+        """
+        with self.lock:
+            self.broadcast_names.add(name)
+
+    def mark(self):
+        """Start watching if necessary and return the current change number"""
+        with self.lock:
+            if self.thread is None:
+                self._open()
+                self.stopping = False
+                self.thread = threading.Thread(target=self._run,
+                                               name='watch:' + self.dir,
+                                               daemon=True)
+                self.thread.start()
+            return self.seq
+
+    def wait(self, max_secs, keys=None, since=None):
+        """Wait for a change in the directory
+
+        :param max_secs: Maximum time to wait, in seconds
+        :type max_secs: int
+        :param keys: If given, only wait for changes to these files
+        :type keys: list, optional
+        :param since: Return immediately if there was a relevant change after
+            this change number
+        :type since: int, optional
+        :return: True if a change was seen, False if we timed out
+        """
+        curr_seq = self.mark()
+        if since is None:
+            since = curr_seq
+        names = None if keys is None else frozenset(keys)
+        event = threading.Event()
+        waiter = (names, event)
+        with self.lock:
+            if self._changed_since(names, since):
+                return True
+            self.waiters.append(waiter)
+        try:
+            return event.wait(max(max_secs, 0))
+        finally:
+            with self.lock:
+                self.waiters.remove(waiter)
+
+    def close(self):
+        """Stop watching the directory"""
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.stopping = True
+            self._interrupt()
+        thread.join()
+        with self.lock:
+            self._close()
+            self.thread = None
+
+    def _changed_since(self, names, since):
+        if names is None or self.broadcast_seq > since:
+            return self.seq > since
+        for name in names:
+            if self.name_seqs.get(name, 0) > since:
+                return True
+        return False
+
+    def _notify(self, names):
+        # names is a set of changed file names, or None if anything may have
+        # changed
+        with self.lock:
+            self.seq += 1
+            if names is None or not self.broadcast_names.isdisjoint(names):
+                self.broadcast_seq = self.seq
+                names = None
+            else:
+                if len(self.name_seqs) + len(names) > self.max_names:
+                    # forget old changes; waiters see a spurious broadcast
+                    self.name_seqs = dict()
+                    self.broadcast_seq = self.seq
+                for name in names:
+                    self.name_seqs[name] = self.seq
+            for (waiter_names, event) in self.waiters:
+                if names is None or waiter_names is None or \
+                   not waiter_names.isdisjoint(names):
+                    event.set()
 
-class FileWaiterImplABC(ABC):
+    def _run(self):
+        while not self.stopping:
+            names = self._read_changes()
+            if self.stopping:
+                break
+            if names is None or names:
+                self._notify(names)
 
     @abstractmethod
-    def wait(self, max_secs):
+    def _open(self):
+        """Start collecting changes; called with the lock held"""
         pass
 
     @abstractmethod
-    def release(self):
+    def _read_changes(self):
+        """Block until something changes and return the changed names
+
+        :return: A set of file names, or None if anything may have changed
+        """
         pass
 
-class FIFOFileWaiter(FileWaiterImplABC):
+    @abstractmethod
+    def _interrupt(self):
+        """Make :meth:`_read_changes` return promptly"""
+        pass
 
-    def __init__(self, path):
-        self.path = path
-        if os.path.exists(self.path):
-            if stat.S_ISFIFO(os.stat(self.path).st_mode):
-                return
-            self.implem = PollingFileWaiter()
-        else:
-            os.mkfifo(self.path)
+    @abstractmethod
+    def _close(self):
+        pass
 
-    def wait(self, max_secs):
-        pid = os.fork()
-        if pid == 0:
-            signal.alarm(max_secs)
-            fd = os.open(self.path, os.O_RDONLY)
-            os._exit(0)
-        (wpid, status) = os.waitpid(pid, 0)
-        signo = status & 255
-        if signo:
-            return False
 
-        return True
+class InotifyWatcher(DirectoryWatcher):
+    """Watch a directory using Linux inotify"""
 
-    def release(self):
-        try:
-            fd = os.open(self.path, os.O_RDWR | os.O_NONBLOCK)
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+        IN_DELETE
+
+    _libc = None
+
+    @classmethod
+    def available(cls):
+        """Return True if inotify can be used on this system"""
+        if cls._libc is None:
+            cls._libc = False
+            if sys.platform.startswith('linux'):
+                try:
+                    libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                       use_errno=True)
+                    libc.inotify_init1
+                    libc.inotify_add_watch
+                    cls._libc = libc
+                except (OSError, AttributeError):
+                    pass
+        return cls._libc is not False
+
+    def __init__(self, dir):
+        DirectoryWatcher.__init__(self, dir)
+        self.fd = None
+        self.pipe = None
+        self.fallback = None
+
+    def _open(self):
+        libc = InotifyWatcher._libc
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            self._use_fallback()
+            return
+        wd = libc.inotify_add_watch(fd, os.fsencode(self.dir),
+                                    self.WATCH_MASK)
+        if wd < 0:
+            # probably out of watches (fs.inotify.max_user_watches)
             os.close(fd)
-        except OSError as e:
-            if e.errno != errno.ENXIO:
-                raise e
+            self._use_fallback()
+            return
+        self.fd = fd
+        self.pipe = os.pipe()
 
-class PollingFileWaiter(FileWaiterImplABC):
+    def _use_fallback(self):
+        self.fallback = PollingWatcher(self.dir)
+        self.fallback._open()
 
-    def __init__(self, path):
-        self.path = path
-        if os.path.exists(self.path):
-            if stat.S_ISREG(os.stat(self.path).st_mode):
-                return
-            raise FileWaiterFileType()
-        with open(self.path, 'w') as fp:
-            # truncate file; zero size implies no process is waiting
-            pass
-
-    def _get_file_size(self):
-        statinfo = os.stat(self.path)
-        return statinfo.ST_SIZE
-
-    def wait(self, max_secs):
-        with open(self.path, 'a') as fp:
-            print('', file=fp)
-            # add a char; non-zero size implies process is waiting
-        initial_size = self._get_file_size()
-        size = initial_size
+    def _read_changes(self):
+        if self.fallback:
+            return self.fallback._read_changes()
+        (rlist, wlist, xlist) = select.select([self.fd, self.pipe[0]], [], [])
+        if self.pipe[0] in rlist:
+            return set()
+        names = set()
         while True:
-            if size < initial_size:
-                return True
-            if max_secs <= 0:
-                return False
-            time.sleep(1)
-            size = self._get_file_size()
-            max_secs = max_secs - 1
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                (wd, mask, cookie, length) = struct.unpack_from('iIII', buf,
+                                                                offset)
+                offset += 16
+                if mask & self.IN_Q_OVERFLOW:
+                    names = None
+                elif length and names is not None:
+                    name = buf[offset:offset + length].rstrip(b'\0')
+                    names.add(os.fsdecode(name))
+                offset += length
+        return names
 
-    def release(self):
-        size = self._get_file_size()
-        if size == 0:
+    def _interrupt(self):
+        if self.fallback:
+            self.fallback._interrupt()
+        else:
+            os.write(self.pipe[1], b'x')
+
+    def _close(self):
+        if self.fallback:
+            self.fallback._close()
+            self.fallback = None
             return
-        with open(self.path, 'w') as fp:
-            # truncate file
-            pass
+        os.close(self.fd)
+        os.close(self.pipe[0])
+        os.close(self.pipe[1])
+        self.fd = None
+        self.pipe = None
+
+
+class PollingWatcher(DirectoryWatcher):
+    """Watch a directory by periodically comparing file status"""
+
+    #: Seconds between polls
+    poll_interval = 0.5
+
+    def __init__(self, dir):
+        DirectoryWatcher.__init__(self, dir)
+        self.stop_event = threading.Event()
+        self.stats = None
+
+    def _scan(self):
+        stats = dict()
+        with os.scandir(self.dir) as entry_gen:
+            for dir_entry in entry_gen:
+                try:
+                    st = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                stats[dir_entry.name] = (st.st_ino, st.st_mtime_ns,
+                                         st.st_size)
+        return stats
+
+    def _open(self):
+        self.stop_event.clear()
+        self.stats = self._scan()
+
+    def _read_changes(self):
+        if self.stop_event.wait(self.poll_interval):
+            return set()
+        stats = self._scan()
+        names = set()
+        for name, info in stats.items():
+            if self.stats.get(name, None) != info:
+                names.add(name)
+        names.update(self.stats.keys() - stats.keys())
+        self.stats = stats
+        return names
+
+    def _interrupt(self):
+        self.stop_event.set()
 
-    
+    def _close(self):
+        self.stats = None
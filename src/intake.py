@@ -0,0 +1,129 @@
+import time
+import logging
+import metrics
+
+#: Names of the stages of the mediator's AMIE packet intake, in order
+INTAKE_STAGES = ('fetch', 'site_filter', 'dedupe', 'validate', 'buffer')
+
+INTAKE_PACKETS = metrics.counter(
+    'amie_intake_packets_total',
+    'AMIE packets leaving each intake stage, by result (passed or dropped)',
+    ('stage', 'result'))
+INTAKE_STAGE_SECONDS = metrics.histogram(
+    'amie_intake_stage_seconds',
+    'Time spent in each intake stage per load of AMIE packets',
+    ('stage',))
+
+def packet_fingerprint(packet) -> tuple:
+    """Return the fields that identify an AMIE packet
+
+    Two packets with the same fingerprint are the same packet as far as the
+    mediator is concerned, whatever their other contents.
+
+    :param packet: An AMIE packet
+    :type packet: amieclient.packet.base.Packet
+    :return: tuple
+    """
+
+    return (packet.__class__._packet_type,
+            packet.transaction_id,
+            packet.packet_rec_id,
+            packet.originating_site_name,
+            packet.local_site_name,
+            packet.remote_site_name)
+
+def get_invalid_packet_error(packet):
+    """Validate an incoming AMIE packet
+
+    :param packet: An AMIE packet
+    :type packet: amieclient.packet.base.Packet
+    :return: An error message, or None if the packet is valid
+    """
+
+    err = None
+    if packet.validate_data():
+        missing = packet.missing_attributes()
+        if missing:
+            err = "Required attributes are missing from incoming packet: " \
+                + ",".join(missing)
+    else:
+        err = "packet.validate_data() failed for incoming packet"
+    return err
+
+
+class IntakePipeline(object):
+    def __init__(self, stages):
+        """Pass packets through a sequence of stages, one packet at a time
+
+        The first stage is a function of no arguments that returns an
+        iterable of packets (e.g. a list_packets() call); each of the others
+        is a function of one argument that returns what the next stage should
+        get, or None to drop the packet. Each packet goes through every stage
+        before the next packet is fetched, so no stage builds a list.
+
+        For every run, the number of packets that each stage passed on and
+        dropped, and the time spent in it, are kept in :attr:`stats` and
+        added to the ``amie_intake_packets_total`` and
+        ``amie_intake_stage_seconds`` metrics.
+
+        :param stages: (name, function) pairs
+        :type stages: sequence of tuple
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.stages = list(stages)
+        self.stats = dict()
+
+    def run(self) -> int:
+        """Run all packets from the first stage through the others
+
+        :return: The number of packets that got through the last stage
+        """
+
+        clock = time.perf_counter
+        ((fetch_name, fetch), *stages) = self.stages
+        stats = {name: {'passed': 0, 'dropped': 0, 'seconds': 0.0}
+                 for (name, func) in self.stages}
+        self.stats = stats
+
+        fetch_stats = stats[fetch_name]
+        start = clock()
+        try:
+            items = iter(fetch())
+            while True:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                finally:
+                    end = clock()
+                    fetch_stats['seconds'] += end - start
+                fetch_stats['passed'] += 1
+                for (name, func) in stages:
+                    item = func(item)
+                    start = clock()
+                    stage_stats = stats[name]
+                    stage_stats['seconds'] += start - end
+                    end = start
+                    if item is None:
+                        stage_stats['dropped'] += 1
+                        break
+                    stage_stats['passed'] += 1
+                start = clock()
+        finally:
+            self._report(stats)
+        return stats[self.stages[-1][0]]['passed']
+
+    def _report(self, stats):
+        parts = list()
+        for (name, stage_stats) in stats.items():
+            INTAKE_STAGE_SECONDS.observe(stage_stats['seconds'], stage=name)
+            for result in ('passed', 'dropped'):
+                if stage_stats[result]:
+                    INTAKE_PACKETS.inc(stage_stats[result], stage=name,
+                                       result=result)
+            parts.append(f"{name} {stage_stats['passed']}/"
+                         f"{stage_stats['dropped']}/"
+                         f"{stage_stats['seconds']:.3f}s")
+        self.logger.debug("Packet intake (passed/dropped/time): " +
+                          ", ".join(parts))
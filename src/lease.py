@@ -0,0 +1,465 @@
+import os
+import json
+import time
+import fcntl
+import socket
+import logging
+import threading
+from pathlib import Path
+from mediator import AMIEMediator
+from amieparms import get_packet_keys
+from spexception import ServiceProviderError
+import metrics
+
+#: Name of the lease held by the active instance in "standby" mode
+POLLER_LEASE = 'poller'
+
+#: Prefix of transaction lease names in "shared" mode
+TRANSACTION_LEASE_PREFIX = 'transaction.'
+
+#: Supported values of the "lease_mode" configuration parameter
+LEASE_MODES = ('standby', 'shared')
+
+LEASES_HELD = metrics.gauge(
+    'amie_leases_held',
+    'Number of leases held by this instance')
+LEASE_TAKEOVERS = metrics.counter(
+    'amie_lease_takeovers_total',
+    'Leases taken over from instances that died or stopped heartbeating')
+
+
+class LeaseLost(Exception):
+    """Raised when this instance finds it no longer holds a lease it needs"""
+    pass
+
+
+def _lease_file_name(name):
+    return name.replace(os.sep, '_') + '.lease'
+
+def _is_linked(f, path):
+    # True if the open file f is still the file at path
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return False
+    fst = os.fstat(f.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+class LeaseManager(object):
+    def __init__(self, lease_dir, instance_id=None, ttl=15):
+        """Hold named leases in a directory shared by mediator instances
+
+        Each instance has an instance file, ``<instance_id>.instance``, with a
+        heartbeat time that is rewritten every ``ttl``/3 seconds by a
+        background thread; the instance also holds an exclusive ``flock`` on
+        the file for as long as it runs. A lease is a ``<name>.lease`` file
+        containing the ID of the instance that holds it (it is removed when
+        the lease is released), and it is valid for as long as its holder is
+        alive. A holder is considered dead, and its leases can be taken over,
+        as soon as its lock is released (i.e. when the process exits, however
+        that happens), or when its heartbeat is more than ``ttl`` seconds old
+        (e.g. when the process hangs).
+
+        An instance whose own heartbeat fell more than ``ttl`` seconds behind
+        assumes that other instances may have taken over its leases, and
+        checks each of them before renewing.
+
+        :param lease_dir: The shared directory
+        :type lease_dir: str
+        :param instance_id: A name for this instance, unique among the
+            instances sharing ``lease_dir``; default is "<host>-<pid>"
+        :type instance_id: str, optional
+        :param ttl: Seconds a heartbeat stays valid
+        :type ttl: float
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.lease_dir = lease_dir
+        self.instance_id = instance_id or \
+            socket.gethostname() + '-' + str(os.getpid())
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self.held = set()
+        self.instance_file = None
+        self.last_heartbeat = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Create and lock the instance file, and start heartbeating"""
+
+        os.makedirs(self.lease_dir, exist_ok=True)
+        path = self._instance_path(self.instance_id)
+        f = open(path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise ServiceProviderError("instance " + self.instance_id +
+                                       " is already running in " +
+                                       self.lease_dir)
+        self.instance_file = f
+        self.heartbeat()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._heartbeat_loop,
+                                       name='lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Release all leases, stop heartbeating, and remove the instance file
+        """
+
+        if self.thread:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+        for name in self.held_names():
+            self.release(name)
+        if self.instance_file:
+            try:
+                os.unlink(self._instance_path(self.instance_id))
+            except FileNotFoundError:
+                pass
+            self.instance_file.close()
+            self.instance_file = None
+
+    def valid(self) -> bool:
+        """Return True if this instance's heartbeat is current"""
+
+        return self.last_heartbeat is not None and \
+            time.time() - self.last_heartbeat < self.ttl
+
+    def held_names(self) -> list:
+        """Return the names of the leases this instance holds"""
+
+        with self.lock:
+            return list(self.held)
+
+    def holds(self, name) -> bool:
+        """Return True if this instance holds the named lease
+
+        No files are read; the lease is held if it was acquired and not lost,
+        and this instance's heartbeat is current.
+        """
+
+        return name in self.held and self.valid()
+
+    def owner(self, name):
+        """Return the ID of the instance named in a lease file, or None"""
+
+        try:
+            with open(self._lease_path(name)) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def acquire(self, name):
+        """Try to acquire the named lease
+
+        :param name: The lease name
+        :type name: str
+        :return: None if the lease is held by another live instance; else the
+            ID of the previous holder if the lease was taken over from a dead
+            one, or "" if it was free (or already held by this instance)
+        """
+
+        if self.holds(name):
+            return ''
+        path = self._lease_path(name)
+        while True:
+            f = open(path, 'a+')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if _is_linked(f, path):
+                break
+            # the holder released the lease and removed the file while we
+            # waited for the lock; lock the new file instead
+            f.close()
+        with f:
+            f.seek(0)
+            owner = f.read().strip()
+            if owner and owner != self.instance_id:
+                if self.instance_alive(owner):
+                    return None
+                self.logger.warning("Taking over lease " + name +
+                                    " from " + owner)
+                LEASE_TAKEOVERS.inc()
+            else:
+                owner = ''
+            f.seek(0)
+            f.truncate()
+            f.write(self.instance_id + "\n")
+            f.flush()
+        with self.lock:
+            self.held.add(name)
+            LEASES_HELD.set(len(self.held))
+        return owner
+
+    def release(self, name):
+        """Release the named lease, if this instance holds it
+
+        The lease file is removed, so lease_dir does not fill up with the
+        files of finished transactions.
+        """
+
+        with self.lock:
+            self.held.discard(name)
+            LEASES_HELD.set(len(self.held))
+        path = self._lease_path(name)
+        try:
+            with open(path, 'r+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if f.read().strip() == self.instance_id and \
+                   _is_linked(f, path):
+                    f.seek(0)
+                    f.truncate()
+                    os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def instance_alive(self, instance_id) -> bool:
+        """Return True if the identified instance is running and heartbeating
+        """
+
+        if instance_id == self.instance_id:
+            return self.valid()
+        try:
+            f = open(self._instance_path(instance_id))
+        except FileNotFoundError:
+            return False
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                # Nobody holds the lock, so the instance has exited
+                return False
+            except OSError:
+                pass
+            try:
+                heartbeat = json.loads(f.read())['heartbeat']
+            except (ValueError, KeyError):
+                return True
+        return time.time() - heartbeat < self.ttl
+
+    def heartbeat(self):
+        """Update the heartbeat time in the instance file
+
+        If the previous heartbeat had expired, leases that other instances
+        have taken over are forgotten.
+        """
+
+        if self.last_heartbeat is not None and not self.valid():
+            self.logger.warning("Heartbeat expired; checking leases")
+            for name in self.held_names():
+                if self.owner(name) != self.instance_id:
+                    self.logger.warning("Lost lease " + name)
+                    with self.lock:
+                        self.held.discard(name)
+            LEASES_HELD.set(len(self.held))
+        now = time.time()
+        data = json.dumps({
+            'instance': self.instance_id,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'heartbeat': now,
+            'ttl': self.ttl,
+        })
+        f = self.instance_file
+        f.seek(0)
+        f.truncate()
+        f.write(data + "\n")
+        f.flush()
+        self.last_heartbeat = now
+
+    def _heartbeat_loop(self):
+        while not self.stop_event.wait(self.ttl / 3):
+            try:
+                self.heartbeat()
+            except OSError:
+                self.logger.exception("Heartbeat failed")
+
+    def _instance_path(self, instance_id):
+        return str(Path(self.lease_dir,
+                        instance_id.replace(os.sep, '_') + '.instance'))
+
+    def _lease_path(self, name):
+        return str(Path(self.lease_dir, _lease_file_name(name)))
+
+
+class LeasedMediator(AMIEMediator):
+    def __init__(self, config, amie_client, service_provider, timeutil=None,
+                 lease_manager=None):
+        """A mediator that coordinates with other instances through leases
+
+        In "standby" ``lease_mode``, only the instance holding the
+        :data:`POLLER_LEASE` runs; the others wait, fully initialized, and one
+        of them takes over within about ``lease_ttl``/3 seconds of the active
+        instance exiting (or ``lease_ttl`` seconds of it hanging).
+
+        In "shared" ``lease_mode``, every instance polls AMIE and the
+        ServiceProvider, but each transaction is handled only by the
+        instance that holds its lease; the first instance to see a packet for
+        a new transaction claims it. When an instance dies, the others claim
+        its transactions on their next full query of AMIE.
+
+        An instance that finds it has lost a lease it needs (because its own
+        heartbeat expired) raises :class:`LeaseLost` before doing any more
+        work; :meth:`run_loop` then drops all its transactions and starts
+        over, in standby mode by waiting to become active again.
+
+        :param config: Mediator configuration; see :data:`~configdefaults.DFLT`
+        :type config: dict
+        :param amie_client: An AMIEClient instance
+        :type amie_client: AMIEClient
+        :param service_provider: A ServiceProvider instance
+        :type service_provider: ServiceProvider
+        :param timeutil: If non None, an instance of TimeUtil
+        :type timeutil: TimeUtil or None
+        :param lease_manager: If not None, a started LeaseManager to use
+            instead of one created from the configuration
+        :type lease_manager: LeaseManager, optional
+        """
+
+        AMIEMediator.__init__(self, config, amie_client, service_provider,
+                              timeutil)
+        if self.lease_mode not in LEASE_MODES:
+            raise ValueError("lease_mode must be one of: " +
+                             ", ".join(LEASE_MODES))
+        if lease_manager is None:
+            lease_manager = LeaseManager(self.lease_dir,
+                                         self.instance_id or None,
+                                         self.lease_ttl)
+            lease_manager.start()
+        self.leases = lease_manager
+        self.foreign_owners = dict()
+
+    def close(self):
+        """Release all leases"""
+
+        self.leases.stop()
+
+    def run(self) -> list:
+        if self.lease_mode == 'standby':
+            self._wait_for_lease(POLLER_LEASE)
+        return AMIEMediator.run(self)
+
+    def run_loop(self):
+        while True:
+            try:
+                AMIEMediator.run_loop(self)
+                return
+            except LeaseLost as err:
+                self.logger.warning(str(err) + "; dropping all transactions")
+                self._reset()
+                self.timeutil.sleep(max(1, self.leases.ttl / 3))
+
+    def _wait_for_lease(self, name):
+        interval = max(1, self.leases.ttl / 3)
+        announced = False
+        while self.leases.acquire(name) is None:
+            if not announced:
+                self.logger.info("Waiting for lease " + name + " (held by " +
+                                 str(self.leases.owner(name)) + ")")
+                announced = True
+            self.timeutil.sleep(interval)
+        self.logger.info("Acquired lease " + name)
+
+    def _reset(self):
+        tm = self.transaction_manager
+        for atrid in tm.get_transaction_ids():
+            apackets = tm.get_actionable_packets(atrid)
+            self.packet_manager.purge_actionable_packets(apackets)
+            tm.purge(atrid)
+        self.foreign_owners = dict()
+        self.amie_packet_update_time = None
+        self.task_query_time = None
+
+    def _check_leases(self):
+        if not self.leases.valid():
+            raise LeaseLost("Lease heartbeat expired")
+        if self.lease_mode == 'standby' and \
+           not self.leases.holds(POLLER_LEASE):
+            raise LeaseLost("Lost lease " + POLLER_LEASE)
+
+    def _load_amie_packets(self) -> list:
+        self._check_leases()
+        if self.lease_mode == 'shared':
+            self._check_foreign_owners()
+        apackets = AMIEMediator._load_amie_packets(self)
+        if self.lease_mode == 'shared':
+            self._release_finished_transactions()
+        return apackets
+
+    def _flush_amie_packets(self):
+        self._check_leases()
+        AMIEMediator._flush_amie_packets(self)
+
+    def _service_actionable_packets(self, apackets):
+        self._check_leases()
+        if self.lease_mode == 'shared':
+            apackets = [ap for ap in apackets if self.leases.holds(
+                TRANSACTION_LEASE_PREFIX + ap['amie_transaction_id'])]
+        return AMIEMediator._service_actionable_packets(self, apackets)
+
+    def _accept_packet(self, packet) -> bool:
+        if not AMIEMediator._accept_packet(self, packet):
+            return False
+        if self.lease_mode != 'shared':
+            return True
+        jid, atrid, pid = get_packet_keys(packet)
+        return self._claim_transaction(atrid)
+
+    def _get_tasks(self, active=True, wait=None) -> list:
+        tasks = AMIEMediator._get_tasks(self, active=active, wait=wait)
+        if self.lease_mode != 'shared':
+            return tasks
+        return [task for task in tasks
+                if task['amie_transaction_id'] not in self.foreign_owners]
+
+    def _take_pushed_tasks(self) -> list:
+        tasks = AMIEMediator._take_pushed_tasks(self)
+        if self.lease_mode != 'shared':
+            return tasks
+        return [task for task in tasks
+                if task['amie_transaction_id'] not in self.foreign_owners]
+
+    def _purge_obsolete_transaction(self, atrid):
+        name = TRANSACTION_LEASE_PREFIX + atrid
+        if self.lease_mode == 'shared' and not self.leases.holds(name):
+            # Another instance owns the transaction now, so leave its
+            # ServiceProvider state alone
+            apackets = self.transaction_manager.get_actionable_packets(atrid)
+            self.packet_manager.purge_actionable_packets(apackets)
+            self.transaction_manager.purge(atrid)
+            return
+        AMIEMediator._purge_obsolete_transaction(self, atrid)
+
+    def _claim_transaction(self, atrid) -> bool:
+        previous = self.leases.acquire(TRANSACTION_LEASE_PREFIX + atrid)
+        if previous is None:
+            self.foreign_owners[atrid] = \
+                self.leases.owner(TRANSACTION_LEASE_PREFIX + atrid)
+            return False
+        self.foreign_owners.pop(atrid, None)
+        if previous:
+            # Task updates for the transaction were skipped while the other
+            # instance owned it
+            self.task_query_time = None
+        return True
+
+    def _check_foreign_owners(self):
+        owners = set(self.foreign_owners.values())
+        dead = [owner for owner in owners
+                if not self.leases.instance_alive(owner)]
+        if dead:
+            self.logger.warning("Instances " + ", ".join(dead) +
+                                " are gone; reloading all packets")
+            self.foreign_owners = dict()
+            self.amie_packet_update_time = None
+
+    def _release_finished_transactions(self):
+        trids = self.transaction_manager.get_transaction_ids()
+        for name in self.leases.held_names():
+            if name.startswith(TRANSACTION_LEASE_PREFIX) and \
+               name[len(TRANSACTION_LEASE_PREFIX):] not in trids:
+                self.leases.release(name)
@@ -1,5 +1,9 @@
 import sys
+import math
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from pathlib import Path
 import requests
 from requests.exceptions import JSONDecodeError
 import logging
@@ -9,6 +13,7 @@ from amieclient.packet.base import Packet as AMIEPacket
 from misctypes import (DateTime, TimeUtil)
 from miscfuncs import to_expanded_string
 from retryingproxy import RetryingServiceProxy
+from ratelimit import make_call_limiter
 from configdefaults import DFLT
 from amieparms import get_packet_keys
 from taskstatus import (State, TaskStatus)
@@ -19,6 +24,35 @@ from loopdelay import (WaitParms, LoopDelay)
 from transactionmanager import TransactionManager
 from packetmanager import (ActionablePacket, PacketManager)
 from packethandler import (PacketHandlerError, PacketHandler)
+from snapshotserver import SnapshotServer
+from control import (LoopControl, ControlServer, SLICE_SECS)
+from taskpush import TaskDropDirectory
+import metrics
+from metrics import (MetricsServer, timed)
+import tracing
+from tracing import (ChromeTraceExporter, traced)
+import profiling
+from memtrack import MemoryTracker
+from packetrecorder import PacketRecorder
+from intake import (IntakePipeline, get_invalid_packet_error)
+from sprecorder import RecordingServiceProvider
+import deadline
+
+LOOP_PHASE_SECONDS = metrics.histogram(
+    'amie_loop_phase_seconds',
+    'Time spent in each phase of the mediator loop',
+    ('phase',))
+LOOP_ITERATION_SECONDS = metrics.histogram(
+    'amie_loop_iteration_seconds',
+    'Duration of each iteration of the mediator loop')
+QUEUE_DEPTH = metrics.gauge(
+    'amie_queue_depth',
+    'Number of buffered transactions, packets, and tasks',
+    ('queue',))
+PACKET_LATENCY_SECONDS = metrics.histogram(
+    'amie_packet_latency_seconds',
+    'Time from accepting an AMIE packet to sending the reply, by packet type',
+    ('packet_type',))
 
 
 class AMIESession(RetryingServiceProxy):
@@ -63,17 +97,30 @@ class AMIEMediator(object):
         self.logdumper = LogDumper(self.logger)
         self.amie_client = amie_client
         self.site_name = self.amie_client.site_name
+        self.timeutil = TimeUtil() if timeutil is None else timeutil
+        deadline.install_http_timeouts(self.amie_client,
+                                       float(self.amie_call_timeout))
         AMIESession.configure(self.amie_client,
                               self.min_retry_delay,
                               self.max_retry_delay,
-                              self.retry_time_max)
+                              self.retry_time_max,
+                              self.timeutil)
+        AMIESession.set_call_limiter(make_call_limiter(
+            'AMIESession', self.amie_rate_limits, self.amie_concurrency_max,
+            self.amie_latency_target, self.timeutil))
         self.sp = service_provider
-        self.timeutil = TimeUtil() if timeutil is None else timeutil
         if service_provider:
             SPSession.configure(service_provider,
                                 self.sp_min_retry_delay,
                                 self.sp_max_retry_delay,
-                                self.sp_retry_time_max)
+                                self.sp_retry_time_max,
+                                self.timeutil)
+            SPSession.set_call_limiter(make_call_limiter(
+                'SPSession', self.sp_rate_limits, self.sp_concurrency_max,
+                self.sp_latency_target, self.timeutil))
+            if self.sp_record_file:
+                service_provider.implem = RecordingServiceProvider(
+                    service_provider.implem, self.sp_record_file)
 
         self.amie_wait = WaitParms(
             auto_update_delay=self.reply_delay,
@@ -82,12 +129,39 @@ class AMIEMediator(object):
             timeutil=self.timeutil)
 
         self.transaction_manager = TransactionManager(self.amie_wait)
-        self.packet_manager = PacketManager(self.snapshot_dir)
+        self.packet_manager = self._create_packet_manager()
         self.packet_logger = self.packet_manager.packet_logger
-        PacketHandler.initialize_handlers()
+        self.snapshot_server = None
+        self.metrics_server = None
+        self.loop_control = LoopControl()
+        self.control_server = None
+        self.task_drop = None
+        self.push_mark = None
+        if self.task_push_dir:
+            self.task_drop = TaskDropDirectory(self.task_push_dir,
+                                               self.loop_control.kick)
+        if self.trace_file:
+            tracing.configure(ChromeTraceExporter(self.trace_file))
+        self.packet_recorder = None
+        if self.packet_record_file:
+            self.packet_recorder = PacketRecorder(self.packet_record_file)
+        profiling.PROFILER.configure(self.profile_dir,
+                                     self.profile or 'cprofile',
+                                     self.profile_iterations,
+                                     self.profile_seconds)
+        if self.profile_signal:
+            profiling.PROFILER.install_signal_handler(self.profile_signal)
+        if self.profile:
+            profiling.PROFILER.start()
+        self.memory_tracker = None
+        if float(self.memory_report_interval) or int(self.memory_rss_max):
+            self._start_memory_tracker()
         
         self.amie_packet_update_time = None
         self.task_query_time = None
+        # transactions found to be obsolete by a full load that are not
+        # purged yet
+        self.obsolete_trids = set()
 
 
     def list_packets(self):
@@ -141,24 +215,32 @@ class AMIEMediator(object):
         :return: list of ActionablePacket
         """
 
+        self._start_servers()
+
         self.logger.debug("!!!run: _loadTasks")
         self._load_tasks()
+        self._load_pushed_tasks()
 
-        self.logger.debug("!!!run: _load_amie_packets")
-        apackets = self._load_amie_packets()
-        self.logger.debug("!!!run: _flush_amie_packets")
-        self._flush_amie_packets()
+        apackets = list()
+        with self._iteration_deadline():
+            self.logger.debug("!!!run: _load_amie_packets")
+            apackets = self._load_amie_packets()
+            self.logger.debug("!!!run: _flush_amie_packets")
+            self._flush_amie_packets()
 
-        self.logger.debug("!!!run: _service_actional_packets")
-        apackets = self._service_actionable_packets(apackets)
-        self._flush_amie_packets()
+            self.logger.debug("!!!run: _service_actional_packets")
+            apackets = self._service_actionable_packets(apackets)
+            self._flush_amie_packets()
+        self._report_metrics()
 
         return apackets
 
     def run_loop(self):
         """Process all active packets in a loop
 
-        Process packets until an exception is raised.
+        Process packets until an exception is raised, or until the loop is
+        told to drain (see :class:`~control.LoopControl`) and no transactions
+        are left.
         
         :raises ServiceProviderError: if an internal error was encountered
         :raises ServiceProviderRequestFailed: if the request is internally
@@ -182,6 +264,11 @@ class AMIEMediator(object):
         previous_wait_secs = 0
         
         while True:
+            # commands that arrive from here on end this iteration's wait
+            mark = self.loop_control.mark()
+            if self._check_control():
+                return
+            iteration_start = time.perf_counter()
 
             # How long we wait before querying AMIE again depends on whether
             # we just sent AMIE a packet, and whether any packets are being
@@ -194,47 +281,189 @@ class AMIEMediator(object):
                               str(loop_delay.get_base_time()) +\
                               " target=" + str(loop_delay.get_target_time()) +\
                               " wait_secs=" + str(wait_secs))
-            if wait_secs:
-                if wait_secs > pause_max:
-                    wait_secs = pause_max
-                # Whenever we increase the time we are waiting, ramp up to
-                # the calculated wait time; e.g. if we had a short wait because
-                # we were expecting a reply from AMIE, but we are no longer
-                # expecting anything from AMIE, there is still a chance that
-                # there is a cluster of requests, so we don't want to wait too
-                # long for them
-                if wait_secs > previous_wait_secs:
-                    ramped_wait_secs = max(previous_wait_secs * 2, 4)
-                    if ramped_wait_secs < wait_secs:
-                        wait_secs = ramped_wait_secs
+            wait_secs = self._limit_wait_secs(wait_secs, previous_wait_secs,
+                                              pause_max)
             
-            if self.transaction_manager.have_actionable_packets():
+            if self.task_drop is not None:
+                # Task updates are pushed, so wait for one (or a control
+                # command) instead of long-polling the ServiceProvider, which
+                # is still polled without waiting in case some are not
+                if wait_secs:
+                    self.logger.debug("Waiting " + str(wait_secs) +
+                                      " sec for pushed task updates")
+                    if self._sleep(wait_secs, self.push_mark):
+                        wait_secs = 0
+                self._load_pushed_tasks()
+                if self.transaction_manager.have_actionable_packets():
+                    self.logger.debug("!!!run_loop _load_tasks")
+                    self._load_tasks()
+            elif self.transaction_manager.have_actionable_packets():
                 self.logger.debug("!!!run_loop _load_tasks")
-                self._load_tasks(wait=wait_secs)
+                if self._wait_for_tasks(
+                        lambda wait: self._load_tasks(wait=wait), wait_secs,
+                        mark):
+                    wait_secs = 0
             elif wait_secs:
                 self.logger.debug("Sleeping " + str(wait_secs) + " sec")
-                self.timeutil.sleep(wait_secs)
+                if self._sleep(wait_secs, mark):
+                    # woken by a control command; start ramping up again
+                    wait_secs = 0
                 
             previous_wait_secs = wait_secs if wait_secs else 0
 
-            self.logger.debug("!!!run_loop _load_amie_packets")
-            try:
-                apackets = self._load_amie_packets()
-            except JSONDecodeError as ex:
-                if "Expecting value: line 1 column 1 (char 0)" in str(ex):
-                    pass
-                else:
-                    raise
-                
-            self.logger.debug("!!!run_loop _flush_amie_packets")
-            self._flush_amie_packets()
+            with self._iteration_deadline():
+                self.logger.debug("!!!run_loop _load_amie_packets")
+                try:
+                    apackets = self._load_amie_packets()
+                except JSONDecodeError as ex:
+                    if "Expecting value: line 1 column 1 (char 0)" in str(ex):
+                        pass
+                    else:
+                        raise
 
-            if apackets:
-                self.logger.debug("!!!run_loop _service_actionable_packets")
-                apackets = self._service_actionable_packets(apackets)
                 self.logger.debug("!!!run_loop _flush_amie_packets")
                 self._flush_amie_packets()
-                
+
+                if apackets:
+                    self.logger.debug(
+                        "!!!run_loop _service_actionable_packets")
+                    apackets = self._service_actionable_packets(apackets)
+                    self.logger.debug("!!!run_loop _flush_amie_packets")
+                    self._flush_amie_packets()
+
+            LOOP_ITERATION_SECONDS.observe(time.perf_counter() -
+                                           iteration_start)
+            self._report_metrics()
+            profiling.PROFILER.iteration()
+            if self.memory_tracker:
+                self.memory_tracker.check()
+
+    @contextmanager
+    def _iteration_deadline(self):
+        """Run the work of one loop iteration under ``loop_deadline``
+
+        The deadline starts after the iteration's wait and task update, and
+        bounds fetching, servicing, and sending packets (see
+        :mod:`deadline`). Work still outstanding when it passes is handed
+        back: unsent replies stay buffered, unfetched packets are fetched
+        again, and unserviced packets stay actionable, so all of it is picked
+        up by the next iteration.
+        """
+
+        try:
+            with deadline.budget(float(self.loop_deadline), 'loop',
+                                 self._clock):
+                yield
+        except deadline.DeadlineExceeded as err:
+            self.logger.info("Iteration deadline exceeded, deferring the " +
+                             "rest of the work: " + str(err))
+
+    def _clock(self) -> float:
+        """Return the current time in seconds, as ``timeutil`` sees it"""
+
+        return self.timeutil.now().timestamp()
+
+    def _limit_wait_secs(self, wait_secs, previous_wait_secs, pause_max):
+        if wait_secs:
+            if wait_secs > pause_max:
+                wait_secs = pause_max
+            # Whenever we increase the time we are waiting, ramp up to
+            # the calculated wait time; e.g. if we had a short wait because
+            # we were expecting a reply from AMIE, but we are no longer
+            # expecting anything from AMIE, there is still a chance that
+            # there is a cluster of requests, so we don't want to wait too
+            # long for them
+            if wait_secs > previous_wait_secs:
+                ramped_wait_secs = max(previous_wait_secs * 2, 4)
+                if ramped_wait_secs < wait_secs:
+                    wait_secs = ramped_wait_secs
+        return wait_secs
+
+    def _start_servers(self):
+        if self.snapshot_server_address and not self.snapshot_server:
+            self.snapshot_server = SnapshotServer(
+                self.packet_manager.snapshots, self.snapshot_server_address)
+            self.snapshot_server.start()
+        if self.metrics_address and not self.metrics_server:
+            self.metrics_server = MetricsServer(self.metrics_address)
+            self.metrics_server.start()
+        if self.control_address and not self.control_server:
+            self.control_server = ControlServer(self.loop_control,
+                                                self.control_address)
+            self.control_server.start()
+        if self.task_drop is not None:
+            self.task_drop.start()
+
+    def _sleep(self, secs, since=None) -> bool:
+        """Sleep between iterations of the main loop
+
+        If the control server is running, a control command ends the sleep
+        early; so does a pushed task update, if ``task_push_dir`` is set.
+
+        :param since: See :meth:`~control.LoopControl.sleep`
+        :type since: int, optional
+        :return: True if the sleep was ended early
+        """
+
+        if self.control_server is None and self.task_drop is None:
+            self.timeutil.sleep(secs)
+            return False
+        return self.loop_control.sleep(secs, since)
+
+    def _wait_for_tasks(self, load, wait_secs, since=None) -> bool:
+        """Long-poll the ServiceProvider for task updates
+
+        If the control server is running, the wait is split into calls of at
+        most :data:`~control.SLICE_SECS` seconds, and a control command ends
+        it after the current call. The ServiceProvider is still only called
+        from the main loop.
+
+        :param load: Function that gets task updates, given a ``wait`` value
+            (see :meth:`ServiceProvider.get_tasks`), and returns the number
+            of updates it got
+        :type load: callable
+        :param wait_secs: The longest time to wait, in seconds
+        :type wait_secs: int
+        :param since: See :meth:`~control.LoopControl.sleep`
+        :type since: int, optional
+        :return: True if a control command ended the wait early
+        """
+
+        if self.control_server is None or not wait_secs:
+            load(wait_secs)
+            return False
+        if since is None:
+            since = self.loop_control.mark()
+        end = self._clock() + float(wait_secs)
+        while True:
+            if self.loop_control.mark() != since:
+                load(None)
+                return True
+            left = math.ceil(end - self._clock())
+            if left <= SLICE_SECS:
+                load(left if left > 0 else None)
+                return False
+            if load(SLICE_SECS):
+                return False
+
+    def _check_control(self) -> bool:
+        """Apply control commands at the top of a main loop iteration
+
+        Block while the loop is paused.
+
+        :return: True if the loop is draining and no transactions are left
+        """
+
+        control = self.loop_control
+        if control.paused:
+            self.logger.info("Main loop paused")
+            control.wait_while_paused()
+            self.logger.info("Main loop resumed")
+        if control.draining and \
+           not self._get_queue_depths().get('transactions', 0):
+            self.logger.info("All transactions drained")
+            return True
+        return False
 
     def run_loop_persistently(self):
         """Process all active packets in a loop, persistently
@@ -249,6 +478,7 @@ class AMIEMediator(object):
         while True:
             try:
                 self.run_loop()
+                return
         
             except ServiceProviderTemporaryError:
                 pass
@@ -257,7 +487,40 @@ class AMIEMediator(object):
             except Exception as err:
                 raise err
         
+    @timed(LOOP_PHASE_SECONDS, phase='load_tasks')
+    @traced('load_tasks', 'loop')
     def _load_tasks(self, active=True, wait=None) -> int:
+        tasks = self._get_tasks(active=active, wait=wait)
+        if int(self.task_page_size):
+            return self.transaction_manager.stream_task_updates(tasks)
+        self.transaction_manager.buffer_task_updates(tasks)
+        return len(tasks)
+
+    @timed(LOOP_PHASE_SECONDS, phase='load_pushed_tasks')
+    @traced('load_pushed_tasks', 'loop')
+    def _load_pushed_tasks(self) -> int:
+        tasks = self._take_pushed_tasks()
+        if int(self.task_page_size):
+            return self.transaction_manager.stream_task_updates(tasks)
+        self.transaction_manager.buffer_task_updates(tasks)
+        return len(tasks)
+
+    def _take_pushed_tasks(self) -> list:
+        """Return task updates pushed to ``task_push_dir``
+
+        Updates pushed after this is called end the next :meth:`_sleep`.
+        """
+
+        if self.task_drop is None:
+            return []
+        self.push_mark = self.loop_control.mark()
+        return self.task_drop.take_updates()
+
+    def _get_tasks(self, active=True, wait=None) -> list:
+        page_size = int(self.task_page_size)
+        if page_size:
+            return self._iter_tasks(active, wait, page_size)
+
         m = "Calling ServiceProvider.get_tasks(active=" + str(active) +\
             ", wait=" + str(wait) + ", since=" + str(self.task_query_time) + ")"
         self.logger.debug(m)
@@ -281,12 +544,38 @@ class AMIEMediator(object):
             self.logger.debug(m)
         else:
             self.logger.info(m)
+        return tasks
+
+    def _iter_tasks(self, active, wait, page_size):
+        # The "since" watermark is only advanced when the whole stream has
+        # been read, because tasks need not arrive in timestamp order
+        m = "Calling ServiceProvider.iter_tasks(active=" + str(active) +\
+            ", wait=" + str(wait) + ", since=" + str(self.task_query_time) +\
+            ", page_size=" + str(page_size) + ")"
+        self.logger.debug(m)
 
-        self.transaction_manager.buffer_task_updates(tasks)
-        return ntasks
+        latest = 0.0 if not self.task_query_time else self.task_query_time
+        ntasks = 0
+        with SPSession() as sp:
+            for task in sp.iter_tasks(active=active, wait=wait,
+                                      since=self.task_query_time,
+                                      page_size=page_size):
+                ntasks += 1
+                timestamp = float(task['timestamp'])
+                if timestamp > latest:
+                    latest = timestamp
+                yield task
+        self.task_query_time = None if latest == 0.0 else int(latest)
+
+        m = f"Got {ntasks} tasks from Service Provider"
+        if ntasks == 0:
+            self.logger.debug(m)
+        else:
+            self.logger.info(m)
 
+    @timed(LOOP_PHASE_SECONDS, phase='load_amie_packets')
+    @traced('load_amie_packets', 'loop')
     def _load_amie_packets(self) -> list:
-        packets = None
         currtime = self.timeutil.now();
         all_packets = self.amie_packet_update_time is None
         list_packets_parms = {
@@ -295,59 +584,116 @@ class AMIEMediator(object):
         m = "Calling amieclient.list_packets() with update_start_time=" +\
             str(self.amie_packet_update_time)
         self.logger.debug(m)
-        with AMIESession() as amieclient:
-            packets = amieclient.list_packets(**list_packets_parms).packets
-            self.amie_packet_update_time = currtime
 
-        npackets = len(packets)
-        msg = f"Got {npackets} (unvalidated) packets from AMIE server"
+        if all_packets:
+            self.obsolete_trids = self.transaction_manager.get_transaction_ids()
+        # an incremental load drops transactions whose packets it lists
+        inactive_trids = self.obsolete_trids
+
+        pipeline = self._create_intake_pipeline(currtime, list_packets_parms,
+                                                inactive_trids)
+        nbuffered = pipeline.run()
+        self.amie_packet_update_time = currtime
+
+        stats = pipeline.stats
+        msg = f"Got {stats['fetch']['passed']} (unvalidated) packets from " +\
+            f"AMIE server, buffered {nbuffered}"
         self.logger.debug(msg)
 
-        packets = self._filter_packets(packets)
+        if inactive_trids:
+            self._purge_obsolete_transactions(inactive_trids)
 
-        if all_packets:
-            inactive_trids = self.transaction_manager.get_transaction_ids()
-        else:
-            inactive_trids = set()
-            
-        for packet in packets:
-            itc_info = self._get_itc_info(packet)
-            log_tag = self._get_packet_log_tag(packet, itc_info)
+        return self.transaction_manager.get_actionable_packets()
 
-            jid, atrid, pid = get_packet_keys(packet)
+    def _create_intake_pipeline(self, currtime, list_packets_parms,
+                                inactive_trids):
+        """Return the IntakePipeline for one load of AMIE packets
+
+        Packets are fetched, filtered by site (see :meth:`_accept_packet`),
+        dropped if they have been seen before, validated, and buffered in the
+        TransactionManager, one at a time. Seen packets are dropped before
+        any validation or logging work is done for them.
+        """
+
+        tm = self.transaction_manager
 
+        def fetch():
+            return self._list_amie_packets(list_packets_parms)
+
+        def site_filter(packet):
+            if self.loop_control.draining:
+                jid, atrid, pid = get_packet_keys(packet)
+                if atrid not in tm.transactions:
+                    # take on no new transactions while draining
+                    return None
+            return packet if self._accept_packet(packet) else None
+
+        def dedupe(packet):
+            jid, atrid, pid = get_packet_keys(packet)
             inactive_trids.discard(atrid)
-            msg = self.transaction_manager.buffer_incoming_amie_packet(currtime,
-                                                                       packet)
+            if tm.is_amie_packet_seen(currtime, packet):
+                return None
+            return packet
+
+        def validate(packet):
+            if packet.__class__._packet_type == 'inform_transaction_complete':
+                return (packet, None)
+            return (packet, get_invalid_packet_error(packet))
+
+        def buffer(validated_packet):
+            (packet, err) = validated_packet
+            msg = tm.buffer_incoming_amie_packet(currtime, packet,
+                                                 validated=True, err=err)
             if msg is None:
                 # saw this packet already
-                continue
-            
+                return None
+            itc_info = self._get_itc_info(packet)
+            log_tag = self._get_packet_log_tag(packet, itc_info)
             self.packet_logger.debug(msg + " " + log_tag + ":\n" + \
                                      packet.json(indent=2,sort_keys=True))
             self.logger.debug(msg + ": " + log_tag)
+            if self.packet_recorder:
+                self.packet_recorder.record('received', packet, currtime)
+            return packet
 
-        if inactive_trids:
-            self._purge_obsolete_transactions(inactive_trids)
+        return IntakePipeline((('fetch', fetch),
+                               ('site_filter', site_filter),
+                               ('dedupe', dedupe),
+                               ('validate', validate),
+                               ('buffer', buffer)))
 
-        return self.transaction_manager.get_actionable_packets()
+    def _list_amie_packets(self, list_packets_parms):
+        with AMIESession() as amieclient:
+            return amieclient.list_packets(**list_packets_parms).packets
+
+    def _create_packet_manager(self):
+        return PacketManager(
+            self.snapshot_dir,
+            snapshot_backend=self.snapshot_backend,
+            packet_deadline=float(self.packet_deadline),
+            max_journal_size=int(self.snapshot_journal_max_size),
+            keep_journals=int(self.snapshot_journal_keep))
 
     def _filter_packets(self, packets):
-        packets_for_us = list()
-        for packet in packets:
-            if packet.remote_site_name == self.site_name:
-                packets_for_us.append(packet)
-            else:
-                disposition = "Ignoring incoming packet from AMIE " +\
-                    "with remote_site_name=" + packet.remote_site_name
-                self.packet_logger.debug(disposition + ":\n" + \
-                                         packet.json(indent=2,sort_keys=True))
-        return packets_for_us
-            
+        return [packet for packet in packets if self._accept_packet(packet)]
+
+    def _accept_packet(self, packet) -> bool:
+        if packet.remote_site_name == self.site_name:
+            return True
+        if self.packet_logger.isEnabledFor(logging.DEBUG):
+            disposition = "Ignoring incoming packet from AMIE " +\
+                "with remote_site_name=" + packet.remote_site_name
+            self.packet_logger.debug(disposition + ":\n" + \
+                                     packet.json(indent=2,sort_keys=True))
+        return False
+
 
     def _purge_obsolete_transactions(self, trids):
-        for atrid in trids:
+        # trids are removed as they are purged, so if this is cut off (e.g.
+        # by a deadline), the next load purges the rest
+        for atrid in sorted(trids):
             self._purge_obsolete_transaction(atrid)
+            trids.discard(atrid)
 
     def _purge_obsolete_transaction(self, atrid):
         with SPSession() as sp:
@@ -357,11 +703,22 @@ class AMIEMediator(object):
             self.packet_manager.purge_actionable_packets(apackets)
             self.transaction_manager.purge(atrid)
         
+    @timed(LOOP_PHASE_SECONDS, phase='flush_amie_packets')
+    @traced('flush_amie_packets', 'loop')
     def _flush_amie_packets(self):
         packets = self.transaction_manager.get_outgoing_amie_packets()
-        for packet in packets:
-            self._send_amie_packet(packet)
-
+        for (i, packet) in enumerate(packets):
+            try:
+                self._send_amie_packet(packet)
+            except deadline.DeadlineExceeded:
+                # send the rest on the next iteration, not after reply_delay
+                for unsent in packets[i:]:
+                    self.transaction_manager.requeue_outgoing_amie_packet(
+                        unsent)
+                raise
+
+    @timed(LOOP_PHASE_SECONDS, phase='service_actionable_packets')
+    @traced('service_actionable_packets', 'loop')
     def _service_actionable_packets(self, apackets):
         if self.logger.isEnabledFor(logging.DEBUG):
             self.logger.debug("Servicing ActionablePackets:")
@@ -389,13 +746,66 @@ class AMIEMediator(object):
                                  packet.json(indent=2,sort_keys=True))
         self.logger.debug("Sending Reply Packet "+log_tag)
 
-        with AMIESession() as amieclient:
-            self.amie_client.send_packet(packet)
+        jid, atrid, pid = get_packet_keys(packet)
+        with tracing.TRACER.transaction(atrid), AMIESession() as amieclient:
+            amieclient.send_packet(packet)
+        if self.packet_recorder:
+            self.packet_recorder.record('sent', packet, self.timeutil.now())
+
+        accept_info = self.transaction_manager.take_accept_info(atrid)
+        if accept_info is not None:
+            (packet_type, accept_time) = accept_info
+            latency = (self.timeutil.now() - accept_time).total_seconds()
+            PACKET_LATENCY_SECONDS.observe(latency, packet_type=packet_type)
 
         if itc_info:
             jid, atrid, pid = get_packet_keys(packet)
             self._purge_obsolete_transaction(atrid)
 
+    def _report_metrics(self):
+        depths = self._get_queue_depths()
+        for queue, depth in depths.items():
+            QUEUE_DEPTH.set(depth, queue=queue)
+        if self.metrics_textfile:
+            metrics.REGISTRY.write_textfile(self.metrics_textfile)
+        tracing.TRACER.flush()
+        if self.control_server is not None:
+            self.loop_control.set_state(self._get_control_state(depths))
+
+    def _get_control_state(self, depths) -> dict:
+        return {
+            'time': self.timeutil.now().isoformat(),
+            'depths': depths,
+            'transactions': sorted(self.transaction_manager.transactions),
+            'actionable': self.transaction_manager.have_actionable_packets(),
+            'amie_packet_update_time': str(self.amie_packet_update_time),
+            'task_query_time': self.task_query_time,
+        }
+
+    def _start_memory_tracker(self):
+        # Reports go in a dot-directory so the snapshot readers ignore them
+        self.memory_tracker = MemoryTracker(
+            str(Path(self.snapshot_dir, '.memory')),
+            interval=float(self.memory_report_interval),
+            top=int(self.memory_report_top),
+            frames=int(self.memory_report_frames),
+            rss_max=int(self.memory_rss_max),
+            keep=int(self.memory_report_keep))
+        tm = self.transaction_manager
+        pm = self.packet_manager
+        self.memory_tracker.add_container(
+            'transactions', lambda: len(tm.transactions))
+        self.memory_tracker.add_container(
+            'initial_snapshot_data', lambda: len(pm.initial_snapshot_data))
+        self.memory_tracker.add_container(
+            'snapshot_images', lambda: len(pm.snapshots.images))
+        self.memory_tracker.add_container(
+            'snapshot_image_bytes',
+            lambda: sum(len(image) for image in pm.snapshots.images.values()))
+
+    def _get_queue_depths(self):
+        return self.transaction_manager.get_queue_depths()
+
     def _get_itc_info(self, packet):
         packet_type = packet.__class__._packet_type
         if packet_type == 'inform_transaction_complete':
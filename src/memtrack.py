@@ -0,0 +1,262 @@
+import os
+import gc
+import sys
+import time
+import logging
+import tracemalloc
+from pathlib import Path
+from datetime import datetime
+import metrics
+
+#: Names of the mediator classes whose live instances are counted
+TRACKED_TYPES = ('Transaction', 'ActionablePacket', 'TaskStatus',
+                 'TaskStatusList')
+
+#: Prefix of report file names
+REPORT_PREFIX = 'memory-report-'
+
+RSS_BYTES = metrics.gauge(
+    'amie_memory_rss_bytes',
+    'Resident set size of the mediator process')
+TRACKED_OBJECTS = metrics.gauge(
+    'amie_tracked_objects',
+    'Number of live instances of the main mediator types',
+    ('type',))
+CONTAINER_SIZE = metrics.gauge(
+    'amie_container_size',
+    'Number of entries in the long-lived mediator containers',
+    ('container',))
+
+def get_rss() -> int:
+    """Return the resident set size of this process in bytes
+
+    On systems without ``/proc``, the peak resident set size is returned.
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def count_objects(type_names=TRACKED_TYPES) -> dict:
+    """Count live objects whose class has one of the given names
+
+    :param type_names: Class names
+    :type type_names: sequence of str
+    :return: dict mapping each name to a count
+    """
+
+    counts = dict.fromkeys(type_names, 0)
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        if name in counts:
+            counts[name] += 1
+    return counts
+
+
+class MemoryTracker(object):
+    def __init__(self, report_dir, interval=0, top=20, frames=1, rss_max=0,
+                 keep=10):
+        """Track the memory use of a long-running mediator
+
+        Every ``interval`` seconds (checked whenever :meth:`check` is called,
+        i.e. once per loop iteration), and whenever the resident set size
+        first exceeds ``rss_max`` or grows another 10% past it, a report is
+        written to ``report_dir`` with the resident set size, the sizes of
+        the registered containers (see :meth:`add_container`), live object
+        counts for the :data:`TRACKED_TYPES`, and the ``top`` source lines
+        whose allocations grew most since the previous report and since
+        tracking started, according to tracemalloc. Reports triggered by the
+        RSS ceiling also list the largest allocations by traceback. Only the
+        newest ``keep`` reports are kept.
+
+        tracemalloc is started (if it is not running already) when the
+        tracker is created; it slows allocation down and costs memory of its
+        own, roughly in proportion to ``frames``.
+
+        :param report_dir: Directory for reports
+        :type report_dir: str
+        :param interval: Seconds between periodic reports; 0 means only write
+            reports when the RSS ceiling is exceeded
+        :type interval: float
+        :param top: Number of entries in each allocation list
+        :type top: int
+        :param frames: Number of stack frames tracemalloc records per
+            allocation
+        :type frames: int
+        :param rss_max: RSS ceiling in bytes; 0 means no ceiling
+        :type rss_max: int
+        :param keep: Number of reports to keep; 0 means keep them all
+        :type keep: int
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.report_dir = report_dir
+        self.interval = float(interval)
+        self.top = int(top)
+        self.frames = int(frames)
+        self.rss_max = int(rss_max)
+        self.keep = int(keep)
+        self.containers = dict()
+        self.started_tracemalloc = False
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.started_tracemalloc = True
+        self.first_snapshot = self._take_snapshot()
+        self.prev_snapshot = self.first_snapshot
+        self.prev_counts = dict()
+        self.last_report_clock = time.monotonic()
+        self.rss_dump_level = 0
+
+    def add_container(self, name, size_func):
+        """Register a container whose size should be reported
+
+        :param name: The name to report
+        :type name: str
+        :param size_func: Function of no arguments that returns the size
+        :type size_func: callable
+        """
+
+        self.containers[name] = size_func
+
+    def check(self):
+        """Write a report if one is due
+
+        :return: The path of the report written, or None
+        """
+
+        rss = get_rss()
+        RSS_BYTES.set(rss)
+        if self.rss_max and rss > self.rss_max and \
+           rss > self.rss_dump_level:
+            self.rss_dump_level = int(rss * 1.1)
+            self.logger.warning("RSS of " + str(rss) +
+                                " bytes exceeds memory_rss_max")
+            return self.report("RSS " + str(rss) + " exceeds ceiling " +
+                               str(self.rss_max), rss, dump=True)
+        if self.interval and \
+           time.monotonic() - self.last_report_clock >= self.interval:
+            return self.report("periodic", rss)
+        return None
+
+    def report(self, reason, rss=None, dump=False):
+        """Write a report now
+
+        :param reason: Why the report is being written
+        :type reason: str
+        :param rss: The resident set size, if already known
+        :type rss: int, optional
+        :param dump: If True, also list the largest allocations by traceback
+        :type dump: bool
+        :return: The path of the report
+        """
+
+        now = datetime.now()
+        if rss is None:
+            rss = get_rss()
+        snapshot = self._take_snapshot()
+        counts = count_objects()
+        for (name, count) in counts.items():
+            TRACKED_OBJECTS.set(count, type=name)
+        sizes = dict()
+        for (name, size_func) in self.containers.items():
+            sizes[name] = size_func()
+            CONTAINER_SIZE.set(sizes[name], container=name)
+        (traced, peak) = tracemalloc.get_traced_memory()
+
+        lines = ["Memory report " + now.isoformat(timespec='seconds'),
+                 "reason: " + reason,
+                 "rss: " + _format_bytes(rss),
+                 "tracemalloc: current " + _format_bytes(traced) +
+                 ", peak " + _format_bytes(peak),
+                 ""]
+        if sizes:
+            lines.append("Containers:")
+            for (name, size) in sizes.items():
+                lines.append(f"  {name:32} {size:>10}")
+            lines.append("")
+        lines.append("Live objects (change since previous report):")
+        for (name, count) in counts.items():
+            delta = count - self.prev_counts.get(name, count)
+            lines.append(f"  {name:32} {count:>10} {delta:>+8}")
+        lines.append("")
+        lines.extend(self._format_growth(
+            "Top allocation growth since previous report:",
+            snapshot.compare_to(self.prev_snapshot, 'lineno')))
+        lines.extend(self._format_growth(
+            "Top allocation growth since tracking started:",
+            snapshot.compare_to(self.first_snapshot, 'lineno')))
+        if dump:
+            lines.append("Largest allocations by traceback:")
+            for stat in snapshot.statistics('traceback')[:self.top]:
+                lines.append(f"  {_format_bytes(stat.size)} in "
+                             f"{stat.count} blocks")
+                lines.extend(["    " + line for line in
+                              stat.traceback.format(most_recent_first=True)])
+            lines.append("")
+
+        self.prev_snapshot = snapshot
+        self.prev_counts = counts
+
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = str(Path(self.report_dir, REPORT_PREFIX +
+                        now.strftime("%Y%m%d-%H%M%S-%f") + ".txt"))
+        with open(path, 'w') as f:
+            f.write("\n".join(lines))
+        self._prune()
+        self.logger.info("Wrote memory report " + path)
+        # Measure the interval from the end of the report, so a slow report
+        # is not followed immediately by another
+        self.last_report_clock = time.monotonic()
+        return path
+
+    def stop(self):
+        """Stop tracemalloc if this tracker started it"""
+
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+
+    def _take_snapshot(self):
+        # Leave tracemalloc's own allocations and the import machinery out
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+            ))
+
+    def _format_growth(self, title, stats):
+        lines = [title]
+        growing = [stat for stat in stats if stat.size_diff > 0]
+        for stat in growing[:self.top]:
+            frame = stat.traceback[0]
+            lines.append(f"  {_format_bytes(stat.size_diff, True):>12} "
+                         f"{stat.count_diff:>+8} blocks  "
+                         f"{frame.filename}:{frame.lineno}")
+        if not growing:
+            lines.append("  (none)")
+        lines.append("")
+        return lines
+
+    def _prune(self):
+        if not self.keep:
+            return
+        names = sorted(name for name in os.listdir(self.report_dir)
+                       if name.startswith(REPORT_PREFIX))
+        for name in names[:-self.keep]:
+            Path(self.report_dir, name).unlink(missing_ok=True)
+
+
+def _format_bytes(n, signed=False):
+    sign = ('+' if n >= 0 else '-') if signed else ''
+    n = abs(n) if signed else n
+    for unit in ('B', 'KiB', 'MiB'):
+        if n < 1024:
+            return f"{sign}{n:.0f} {unit}" if unit == 'B' else \
+                f"{sign}{n:.1f} {unit}"
+        n /= 1024
+    return f"{sign}{n:.1f} GiB"
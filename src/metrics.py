@@ -0,0 +1,388 @@
+import os
+import math
+import time
+import functools
+import threading
+import logging
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+
+#: Default histogram buckets (seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 14400.0, 86400.0)
+
+class MetricsError(Exception):
+    """Exception raised when a metric is defined or used inconsistently"""
+    pass
+
+
+class Metric(object):
+    type_name = None
+
+    def __init__(self, name, help, labelnames=()):
+        """A named metric with optional labels
+
+        :param name: The metric name
+        :type name: str
+        :param help: A one-line description of the metric
+        :type help: str
+        :param labelnames: Label names; every update must provide a value for
+            each label as a keyword argument
+        :type labelnames: tuple of str
+        """
+
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise MetricsError(self.name + ": labels must be " +
+                               str(self.labelnames))
+        try:
+            return tuple(str(labels[name]) for name in self.labelnames)
+        except KeyError:
+            raise MetricsError(self.name + ": labels must be " +
+                               str(self.labelnames))
+
+    def _format_labels(self, key, extra=None, const_labels=()):
+        pairs = list(const_labels) + list(zip(self.labelnames, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join([name + '="' + _escape(value) + '"'
+                               for (name, value) in pairs]) + '}'
+
+    def expose(self, const_labels=()):
+        """Return the metric in Prometheus text exposition format
+
+        :param const_labels: (name, value) pairs of labels to add to every
+            sample
+        :type const_labels: tuple
+        """
+
+        lines = ['# HELP ' + self.name + ' ' + self.help,
+                 '# TYPE ' + self.name + ' ' + self.type_name]
+        with self.lock:
+            items = sorted(self.values.items())
+            lines.extend(self._expose_values(items, const_labels))
+        return '\n'.join(lines) + '\n'
+
+    def _expose_values(self, items, const_labels=()):
+        return [self.name + self._format_labels(key, None, const_labels) +
+                ' ' + _num(value)
+                for (key, value) in items]
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increment the counter
+
+        :param amount: The (non-negative) amount to add
+        :type amount: float
+        """
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the current value"""
+
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge to the given value"""
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """Increment (or, if amount is negative, decrement) the gauge"""
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        """Return the current value"""
+
+        with self.lock:
+            return self.values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """A histogram of observed values
+
+        :param name: The metric name
+        :type name: str
+        :param help: A one-line description of the metric
+        :type help: str
+        :param labelnames: Label names
+        :type labelnames: tuple of str
+        :param buckets: Upper bounds of the buckets, in increasing order
+        :type buckets: tuple of float
+        """
+
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Record an observed value"""
+
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key, None)
+            if entry is None:
+                # [bucket counts..., count, sum]
+                entry = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[key] = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+                    break
+            entry[-2] += 1
+            entry[-1] += value
+
+    def time(self, **labels):
+        """Return a context manager that observes the duration of its body"""
+
+        return _Timer(self, labels)
+
+    def get(self, **labels):
+        """Return a (count, sum) pair"""
+
+        with self.lock:
+            entry = self.values.get(self._key(labels), None)
+            if entry is None:
+                return (0, 0.0)
+            return (entry[-2], entry[-1])
+
+    def _expose_values(self, items, const_labels=()):
+        lines = list()
+        for (key, entry) in items:
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += entry[i]
+                lines.append(self.name + '_bucket' +
+                             self._format_labels(key, ('le', _num(bound)),
+                                                 const_labels) +
+                             ' ' + str(cumulative))
+            lines.append(self.name + '_bucket' +
+                         self._format_labels(key, ('le', '+Inf'),
+                                             const_labels) +
+                         ' ' + str(entry[-2]))
+            lines.append(self.name + '_count' +
+                         self._format_labels(key, None, const_labels) +
+                         ' ' + str(entry[-2]))
+            lines.append(self.name + '_sum' +
+                         self._format_labels(key, None, const_labels) +
+                         ' ' + _num(entry[-1]))
+        return lines
+
+
+class _Timer(object):
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+def timed(histogram, **labels):
+    """Decorator that observes the duration of each call in a histogram
+
+    :param histogram: The histogram
+    :type histogram: Histogram
+    :param labels: Label values for the observations
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Registry(object):
+    def __init__(self):
+        """A collection of metrics that can be exposed together"""
+
+        self.lock = threading.Lock()
+        self.metrics = dict()
+        self.const_labels = ()
+
+    def set_const_labels(self, **labels):
+        """Add the given labels to every exposed sample
+
+        This is used to tell apart metrics from processes that share metric
+        names, such as the workers of a sharded mediator.
+        """
+
+        self.const_labels = tuple(sorted(labels.items()))
+
+    def counter(self, name, help, labelnames=()):
+        """Return the named Counter, creating it if necessary"""
+
+        return self._get_or_create(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        """Return the named Gauge, creating it if necessary"""
+
+        return self._get_or_create(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Return the named Histogram, creating it if necessary"""
+
+        return self._get_or_create(Histogram, name, help, labelnames,
+                                   buckets=buckets)
+
+    def _get_or_create(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = cls(name, help, labelnames, **kwargs)
+                self.metrics[name] = metric
+            elif (metric.__class__ is not cls) or \
+                 (metric.labelnames != tuple(labelnames)):
+                raise MetricsError(name + " already defined differently")
+            return metric
+
+    def expose(self):
+        """Return all metrics in Prometheus text exposition format"""
+
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        return ''.join([metric.expose(self.const_labels)
+                        for metric in metrics])
+
+    def write_textfile(self, path):
+        """Write all metrics to a file, atomically
+
+        The file can be collected by the node_exporter "textfile" collector.
+
+        :param path: The file path
+        :type path: str
+        """
+
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.expose())
+        os.replace(tmp_path, path)
+
+
+#: The registry used by the mediator
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()):
+    """Return the named Counter from :data:`REGISTRY`"""
+
+    return REGISTRY.counter(name, help, labelnames)
+
+def gauge(name, help, labelnames=()):
+    """Return the named Gauge from :data:`REGISTRY`"""
+
+    return REGISTRY.gauge(name, help, labelnames)
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Return the named Histogram from :data:`REGISTRY`"""
+
+    return REGISTRY.histogram(name, help, labelnames, buckets)
+
+
+class MetricsServer(object):
+    def __init__(self, address, registry=None):
+        """Serve metrics over HTTP for Prometheus to scrape
+
+        ``GET /metrics`` returns all metrics in the Prometheus text format.
+
+        :param address: "[host:]port" to listen on; the default host is
+            localhost
+        :type address: str
+        :param registry: The metrics to serve; default is :data:`REGISTRY`
+        :type registry: Registry, optional
+        """
+
+        (host, sep, port) = address.rpartition(':')
+        self.address = (host if host else 'localhost', int(port))
+        self.registry = REGISTRY if registry is None else registry
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """Start serving requests in a background thread"""
+
+        if self.httpd is not None:
+            return
+        self.httpd = ThreadingHTTPServer(self.address, _MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = self.registry
+        self.address = self.httpd.server_address[:2]
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='metricsserver', daemon=True)
+        self.thread.start()
+        logging.getLogger(__name__).info("Serving metrics on " +
+                                         self.address[0] + ':' +
+                                         str(self.address[1]))
+
+    def stop(self):
+        """Stop serving requests"""
+
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        self.httpd = None
+        self.thread = None
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(self.address_string() + " " +
+                                          (format % args))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _num(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
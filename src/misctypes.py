@@ -43,9 +43,8 @@ class TimeUtil(object):
     def sleep(self, secs):
         """sleep() proxy - reimplement in subclass for testing"""
 
-        isecs = int(secs) if secs else 0
-        if isecs > 0:
-            sleep(isecs)
+        if secs and secs > 0:
+            sleep(secs)
 
     def now(self):
         """datetime.now() proxy - reimplement in subclass for testing"""
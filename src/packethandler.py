@@ -8,10 +8,13 @@ from miscfuncs import to_expanded_string
 from amieparms import (get_packet_keys, strip_key_prefix)
 from spexception import (ServiceProviderRequestFailed, ServiceProviderError)
 from serviceprovider import (ServiceProvider, SPSession)
-from organization import AMIEOrg
-from person import AMIEPerson
+from organization import (AMIEOrg, LookupOrg)
+from person import (AMIEPerson, LookupPerson)
+from project import (LookupProjectByGrantNumber, LookupLocalFos)
 from taskstatus import (TaskStatus, TaskStatusList)
 from actionablepacket import ActionablePacket
+from tracing import trace_methods
+from singleflight import (SP_CALLS, make_key)
 import handler
 
     
@@ -78,8 +81,11 @@ class ServiceProviderAdapter(object):
 
         transaction_id = apacket.get('amie_transaction_id',None)
 
-        with SPSession() as sp:
-            sp.clear_transaction(transaction_id)
+        try:
+            with SPSession() as sp:
+                sp.clear_transaction(transaction_id)
+        finally:
+            SP_CALLS.invalidate()
         return
 
     def lookup_org(self, apacket, prefix) -> AMIEOrg:
@@ -94,10 +100,7 @@ class ServiceProviderAdapter(object):
 
         request_data = strip_key_prefix(prefix,apacket)
 
-        amie_org = None
-        with SPSession() as sp:
-            amie_org = sp.lookup_org(request_data)
-        return amie_org
+        return self._lookup('lookup_org', LookupOrg, request_data)
         
     def choose_or_add_org(self, apacket, prefix) -> TaskStatus:
         """Get the TaskStatus object from ServiceProvider.choose_or_add_org()
@@ -114,8 +117,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket, prefix)
 
-            with SPSession() as sp:
-                ts = sp.choose_or_add_org(**request_data)
+            ts = self._call_sp('choose_or_add_org', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -132,10 +134,7 @@ class ServiceProviderAdapter(object):
         """
 
         request_data = strip_key_prefix(prefix,apacket)
-        amie_person = None
-        with SPSession() as sp:
-            amie_person = sp.lookup_person(request_data)
-        return amie_person
+        return self._lookup('lookup_person', LookupPerson, request_data)
 
     def choose_or_add_person(self, apacket, prefix) -> TaskStatus:
         """Get the TaskStatus object from ServiceProvider.choose_or_add_person()
@@ -153,8 +152,7 @@ class ServiceProviderAdapter(object):
             request_data = self._init_task_data(ts, apacket, prefix)
             request_data['person_role'] = prefix
 
-            with SPSession() as sp:
-                ts = sp.choose_or_add_person(**request_data)
+            ts = self._call_sp('choose_or_add_person', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -180,8 +178,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket, prefix)
 
-            with SPSession() as sp:
-                ts = sp.update_person_DNs(**request_data)
+            ts = self._call_sp('update_person_DNs', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -203,8 +200,7 @@ class ServiceProviderAdapter(object):
             request_data = self._init_task_data(ts, apacket, prefix)
             request_data['person_role'] = prefix
 
-            with SPSession() as sp:
-                ts = sp.activate_person(**request_data)
+            ts = self._call_sp('activate_person', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -222,10 +218,8 @@ class ServiceProviderAdapter(object):
         :return: ProjectID string
         """
 
-        project_id = None
-        with SPSession() as sp:
-            project_id = sp.lookup_project_by_grant_number(apacket)
-        return project_id
+        return self._lookup('lookup_project_by_grant_number',
+                            LookupProjectByGrantNumber, apacket)
         
     def choose_or_add_contract_number(self, apacket) -> TaskStatus:
         """Get the TaskStatus object from
@@ -243,8 +237,7 @@ class ServiceProviderAdapter(object):
             request_data = self._init_task_data(ts, apacket)
             request_data['PiPersonID'] = apacket['pi_person_id']
 
-            with SPSession() as sp:
-                ts = sp.choose_or_add_contract_number(**request_data)
+            ts = self._call_sp('choose_or_add_contract_number', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -258,10 +251,7 @@ class ServiceProviderAdapter(object):
         :return: local_fos string
         """
 
-        local_fos = None
-        with SPSession() as sp:
-            local_fos = sp.lookup_local_fos(apacket)
-        return local_fos
+        return self._lookup('lookup_local_fos', LookupLocalFos, apacket)
 
     def choose_or_add_local_fos(self, apacket) -> str:
         """Get the TaskStatus object from SP.choose_or_add_local_fos
@@ -276,8 +266,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.choose_or_add_local_fos(**request_data)
+            ts = self._call_sp('choose_or_add_local_fos', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -310,8 +299,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.choose_or_add_project_name_base(**request_data)
+            ts = self._call_sp('choose_or_add_project_name_base', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -335,8 +323,7 @@ class ServiceProviderAdapter(object):
             request_data = self._init_task_data(ts, apacket)
             request_data['PiPersonID'] = apacket['pi_person_id']
 
-            with SPSession() as sp:
-                ts = sp.create_project(**request_data)
+            ts = self._call_sp('create_project', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -370,8 +357,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.inactivate_project(**request_data)
+            ts = self._call_sp('inactivate_project', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -392,8 +378,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.reactivate_project(**request_data)
+            ts = self._call_sp('reactivate_project', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -420,8 +405,7 @@ class ServiceProviderAdapter(object):
             if project_id is None:
                 request_data['ProjectID'] = apacket['project_id']
 
-            with SPSession() as sp:
-                ts = sp.create_account(**request_data)
+            ts = self._call_sp('create_account', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -442,8 +426,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.inactivate_account(**request_data)
+            ts = self._call_sp('inactivate_account', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -468,8 +451,7 @@ class ServiceProviderAdapter(object):
             request_data = self._init_task_data(ts, apacket, prefix)
             request_data['task_name'] = task_name
 
-            with SPSession() as sp:
-                ts = sp.reactivate_account(**request_data)
+            ts = self._call_sp('reactivate_account', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -495,8 +477,7 @@ class ServiceProviderAdapter(object):
                 project_id = apacket.get('project_id',None)
                 request_data['ProjectID'] = project_id
 
-            with SPSession() as sp:
-                ts = sp.update_allocation(**request_data)
+            ts = self._call_sp('update_allocation', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -517,8 +498,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.modify_user(**request_data)
+            ts = self._call_sp('modify_user', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -539,8 +519,7 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.merge_person(**request_data)
+            ts = self._call_sp('merge_person', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
@@ -561,13 +540,39 @@ class ServiceProviderAdapter(object):
         if ts['task_state'] == 'nascent':
             request_data = self._init_task_data(ts, apacket)
 
-            with SPSession() as sp:
-                ts = sp.notify_user(**request_data)
+            ts = self._call_sp('notify_user', request_data)
             apacket.add_or_update_task(ts)
 
         self._check_task_status_for_errors(ts)
         return ts
 
+    def _lookup(self, method_name, parm_class, request_data):
+        # Identical lookups (by their validated parameters) that are running
+        # at the same time, or that ran since the last change made through
+        # _call_sp(), share one ServiceProvider call
+        try:
+            key = make_key(method_name, parm_class(request_data))
+        except Exception:
+            # let the ServiceProvider report the bad parameters
+            key = None
+
+        def call():
+            with SPSession() as sp:
+                return getattr(sp, method_name)(request_data)
+
+        if key is None:
+            return call()
+        return SP_CALLS.do(key, call)
+
+    def _call_sp(self, method_name, request_data) -> TaskStatus:
+        # Make a change through the ServiceProvider; earlier lookup results
+        # may be out of date afterwards
+        try:
+            with SPSession() as sp:
+                return getattr(sp, method_name)(**request_data)
+        finally:
+            SP_CALLS.invalidate()
+
     def _check_task_status_for_errors(self, ts):
         state = ts['task_state']
         if state == "failed":
@@ -579,8 +584,14 @@ class ServiceProviderAdapter(object):
         return
 
 
+# Record a tracing span for every ServiceProviderAdapter operation
+trace_methods(ServiceProviderAdapter, 'sp_adapter')
+
 _handler_map = {}
 
+# Handler modules that have been imported (see PacketHandler._load_handler)
+_imported_handlers = set()
+
 class PacketHandler(ABC):
     
     def __init_subclass__(cls, packet_type, **kwargs):
@@ -590,18 +601,44 @@ class PacketHandler(ABC):
         _handler_map[packet_type] = handler
 
     @classmethod
-    def initialize_handlers(cls):
-        for pkg in handler.__all__:
-            mod = importlib.import_module('.'+pkg,'handler')
-        DefaultHandler()
+    def initialize_handlers(cls, eager=False):
+        """Prepare to look up packet handlers
+
+        Handler modules in the ``handler`` package are named after the packet
+        types they handle, and are normally imported by :meth:`get_handler`
+        the first time a packet of their type is seen, so programs that never
+        handle a given packet type do not pay for importing its handler. This
+        method can be called any number of times.
+
+        :param eager: If True, import all handler modules now (e.g. to find
+            errors in them at startup)
+        :type eager: bool
+        """
+
+        if eager:
+            for packet_type in handler.__all__:
+                cls._load_handler(packet_type)
 
     @classmethod
     def get_handler(cls, packet_type):
         handler = _handler_map.get(packet_type,None)
+        if handler is None:
+            handler = cls._load_handler(packet_type)
         if handler is None:
             handler = DefaultHandler.singleton
         return handler
 
+    @classmethod
+    def _load_handler(cls, packet_type):
+        if packet_type in handler.__all__ and \
+           packet_type not in _imported_handlers:
+            # a module that fails to import is tried again (and fails
+            # loudly) for every packet, rather than leaving its packets to
+            # DefaultHandler
+            importlib.import_module('.' + packet_type, 'handler')
+            _imported_handlers.add(packet_type)
+        return _handler_map.get(packet_type, None)
+
     def __init__(self):
         """Object that handles ServiceProvider interactions for an Packet"""
 
@@ -1,12 +1,16 @@
 import logging
 from miscfuncs import (Prettifiable, pformat, to_expanded_string)
 from logdumper import LogDumper
-from snapshot import Snapshots
+from snapshotjournal import open_snapshots
 from amieclient.packet.base import Packet as AMIEPacket
 from taskstatus import (State, TaskStatus)
 from actionablepacket import ActionablePacket
 from packethandler import (PacketHandlerError, PacketHandler)
 from spexception import (ServiceProviderTimeout, ServiceProviderRequestFailed)
+import tracing
+import profiling
+import singleflight
+import deadline
 
 SNAPSHOT_DFLT_KEYS = [
     'job_id',
@@ -30,7 +34,8 @@ SNAPSHOT_DFLT_TASK_KEYS = [
         
 class PacketManager(object):
 
-    def __init__(self, snapshot_dir):
+    def __init__(self, snapshot_dir, snapshot_backend='files',
+                 snapshots=None, packet_deadline=0, **snapshot_opts):
         """Coordinate the running of tasks to service ActionablePackets
 
         In addition to passing ActionablePacket objects to individual handlers
@@ -57,10 +62,28 @@ class PacketManager(object):
         :type site_name: TransactionManager
         :param snapshot_dir: the name of the directory for apacket snapshots
         :type site_name: str
+        :param snapshot_backend: the snapshot implementation: "files" (one file
+            per ActionablePacket) or "journal" (an append-only journal; see
+            :class:`~snapshotjournal.SnapshotJournal`)
+        :type snapshot_backend: str
+        :param snapshots: If not None, a 'w' mode Snapshots-like object to use
+            instead of opening ``snapshot_dir``
+        :type snapshots: Snapshots, optional
+        :param packet_deadline: Seconds a packet's handler may spend before
+            its work is handed back to be resumed on a later pass; 0 means no
+            limit
+        :type packet_deadline: float
+        :param snapshot_opts: additional options for the "journal" backend
         
         """
 
-        self.snapshots = Snapshots(snapshot_dir, 'w')
+        if snapshot_backend == 'files':
+            snapshot_opts = {}
+        if snapshots is None:
+            snapshots = open_snapshots(snapshot_dir, 'w', snapshot_backend,
+                                       **snapshot_opts)
+        self.snapshots = snapshots
+        self.packet_deadline = float(packet_deadline)
         
         self.packet_logger = logging.getLogger("amiepackets")
         self.logger = logging.getLogger(__name__)
@@ -94,6 +117,17 @@ class PacketManager(object):
         or not). If all tasks are done, a reply packet will be returned to be
         sent to AMIE. In normal operation, this is called in a loop.
 
+        Identical ServiceProvider lookups made while handling the packets
+        share one call until a ServiceProvider task changes something (see
+        :mod:`singleflight`); tasks may finish between calls, so nothing is
+        shared from one call to the next.
+
+        Each packet is handled under its own ``packet_deadline``, within any
+        enclosing deadline (see :mod:`deadline`). A packet whose deadline
+        passes is left as it is, and packets not yet reached when the
+        enclosing deadline passes are deferred; all are picked up again on
+        the next call.
+
         :param apackets: Actionable packets
         :type apackets: collection of ActionablePacket
         :return: List of amieclient.packet.base.Packet
@@ -103,19 +137,38 @@ class PacketManager(object):
         actionable_packets = list(apackets)
         actionable_packets.sort(key=lambda ap: ap['timestamp'])
         amie_packet_expected = False
-        for apacket in actionable_packets:
-            self._update_snapshot(apacket)
-            reply_packet = self._service_actionable_packet(apacket)
-            if reply_packet:
-                reply_packets.append(reply_packet)
-                self.logger.debug("ServiceManager processed apacket "+\
-                                  "(job_id=" + apacket['job_id'] +\
-                                  "), got reply AMIEPacket from handler," +\
-                                  "type=" + reply_packet.__class__._packet_type)
-            else:
-                self._update_snapshot(apacket)
+        singleflight.SP_CALLS.invalidate()
+        try:
+            self._service_packets(actionable_packets, reply_packets)
+        finally:
+            singleflight.SP_CALLS.invalidate()
         return reply_packets
 
+    def _service_packets(self, actionable_packets, reply_packets):
+        for (i, apacket) in enumerate(actionable_packets):
+            if deadline.expired():
+                self._defer_packets(actionable_packets[i:])
+                break
+            with profiling.packet_type(apacket['amie_packet_type']), \
+                 deadline.budget(self.packet_deadline, 'packet'):
+                self._update_snapshot(apacket)
+                reply_packet = self._service_actionable_packet(apacket)
+                if reply_packet:
+                    reply_packets.append(reply_packet)
+                    self.logger.debug("ServiceManager processed apacket "+\
+                                      "(job_id=" + apacket['job_id'] +\
+                                      "), got reply AMIEPacket from handler,"+\
+                                      "type=" +\
+                                      reply_packet.__class__._packet_type)
+                else:
+                    self._update_snapshot(apacket)
+
+    def _defer_packets(self, apackets):
+        self.logger.info("Deadline exceeded, deferring " +
+                         str(len(apackets)) + " packet(s) to the next pass")
+        for apacket in apackets:
+            self.logger.debug("Deferred apacket: " + apacket.mk_name())
+
     def _service_actionable_packet(self, apacket):
         try:
             self.logger.debug("Processing apacket: "+apacket.mk_name()+" ts="+\
@@ -131,6 +184,10 @@ class PacketManager(object):
             raise spto
         except ServiceProviderRequestFailed as sprf:
             return apacket.create_failure_reply_packet(message=str(sprf))
+        except deadline.DeadlineExceeded as de:
+            self.logger.info("Handing back apacket " + apacket.mk_name() +
+                             ": " + str(de))
+            return None
         except Exception as err:
             msg = self._build_log_message(apacket,err)
             self.logger.info(msg)
@@ -140,9 +197,13 @@ class PacketManager(object):
 
     def _handle_packet(self, apacket):
         # Return reply Packet, or None if the apacket still has an active task
-        handler = PacketHandler.get_handler(apacket['amie_packet_type'])
+        packet_type = apacket['amie_packet_type']
+        handler = PacketHandler.get_handler(packet_type)
         before_timestamp = apacket['timestamp']
-        ts_or_reply_packet = handler.work(apacket)
+        tracer = tracing.TRACER
+        with tracer.transaction(apacket['amie_transaction_id']), \
+             tracer.span(packet_type + '.work', 'handler'):
+            ts_or_reply_packet = handler.work(apacket)
         after_timestamp = apacket['timestamp']
         if isinstance(ts_or_reply_packet,TaskStatus):
             if after_timestamp > before_timestamp:
@@ -0,0 +1,88 @@
+import json
+import threading
+
+#: Version of the recording format; written in every record
+RECORD_VERSION = 1
+
+class PacketRecorder(object):
+    def __init__(self, path):
+        """Record AMIE packets in a JSON Lines file
+
+        Every packet received from or sent to the AMIE server is written as
+        one line, a JSON object with these members::
+
+            v          : the format version (RECORD_VERSION)
+            time       : ISO time the mediator received or sent the packet
+            direction  : "received" or "sent"
+            packet     : the packet, in the format used by the AMIE REST API
+
+        Records are appended, and each is flushed as it is written, so a
+        recording can span several runs of the mediator and survives crashes.
+        Recordings can be replayed with ``benchmarks.replay``.
+
+        :param path: The recording file
+        :type path: str
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, direction, packet, time):
+        """Write a record for a packet
+
+        :param direction: "received" or "sent"
+        :type direction: str
+        :param packet: The packet
+        :type packet: amieclient.packet.base.Packet
+        :param time: When the packet was received or sent
+        :type time: datetime
+        """
+
+        pdict = packet.as_dict()
+        timestamp = getattr(packet, 'packet_timestamp', None)
+        if timestamp is not None and 'packet_timestamp' not in pdict['header']:
+            pdict['header']['packet_timestamp'] = str(timestamp)
+        record = {
+            'v': RECORD_VERSION,
+            'time': time.isoformat(),
+            'direction': direction,
+            'packet': pdict,
+            }
+        line = json.dumps(record, sort_keys=True, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+
+    def close(self):
+        """Close the recording file"""
+
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+def read_recording(path):
+    """Read the records in a recording file, in order
+
+    :param path: The recording file
+    :type path: str
+    :raises ValueError: if a record is not valid
+    :return: An iterator of record dicts; see :class:`PacketRecorder`
+    """
+
+    with open(path, encoding='utf-8') as f:
+        for (lineno, line) in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as err:
+                raise ValueError(f"{path}:{lineno}: {err}")
+            if not isinstance(record, dict) or \
+               record.get('v', None) != RECORD_VERSION or \
+               record.get('direction', None) not in ('received', 'sent') or \
+               'time' not in record or 'packet' not in record:
+                raise ValueError(f"{path}:{lineno}: not a packet record")
+            yield record
@@ -1,3 +1,4 @@
+import sys
 import threading
 import inspect
 import json
@@ -43,6 +44,26 @@ def transform_value(target_type, inval):
 class ParmDescException(Exception):
     pass
 
+# (class, function_info, function) tuples for process_parms() methods whose
+# docstrings have not been supplemented yet; see build_docstrings()
+_pending_docstrings = []
+
+def build_docstrings():
+    """Supplement the docstrings of all ``@process_parms`` methods
+
+    Building the ``:param`` and ``:type`` entries for every decorated method
+    takes a noticeable part of the time needed to import the mediator, and
+    the docstrings are only needed for documentation, so they are not built
+    when classes are defined unless Sphinx has been imported. Call this
+    function before using ``help()`` or ``pydoc`` on ``ParmDescAware``
+    subclasses. It is safe to call more than once.
+    """
+
+    with ParmDescAware._lock:
+        while _pending_docstrings:
+            (cls, func_info, func) = _pending_docstrings.pop(0)
+            cls._build_function_docstring(func_info, func)
+
 class ParmDescAware():
     """Base class for classes that use pre-defined parameter descriptions
     
@@ -95,9 +116,11 @@ class ParmDescAware():
 
         If a subclass defines some set of methods using the `@process_parms`
         decorator (which takes ``allowed`` and ``required`` parameters lists),
-        ``ParmDescAware`` supplements the docstrings of these methods using
-        ``parm2doc`` data, and adds a ``class`` entry to the ``function_info``
-        map that is initialized by ``process_parms()``.
+        ``ParmDescAware`` adds a ``class`` entry to the ``function_info``
+        map that is initialized by ``process_parms()``, and arranges for the
+        docstrings of these methods to be supplemented using ``parm2doc``
+        data; this is done immediately when Sphinx is running, and otherwise
+        when :func:`build_docstrings` is called.
         """
         
         super().__init_subclass__(**kwargs)
@@ -134,8 +157,10 @@ class ParmDescAware():
 
     @classmethod
     def _update_function_info(cls):
-        members = inspect.getmembers(cls)
-        for k, v in members:
+        # Only functions defined in cls itself can have function_info keys
+        # naming cls, so there is no need to look at inherited members
+        build_now = 'sphinx' in sys.modules
+        for k, v in vars(cls).items():
             if v.__class__.__name__ == 'function':
                 info_key = cls.__module__ + '.' + cls.__name__ + '.' + k
                 if info_key in ParmDescAware.function_info:
@@ -143,7 +168,10 @@ class ParmDescAware():
                     func_info['class'] = cls
                     cls._validate_function_parms(func_info)
                     cls._add_function_attributes(func_info,v)
-                    cls._build_function_docstring(func_info,v)
+                    if build_now:
+                        cls._build_function_docstring(func_info,v)
+                    elif func_info['allowed']:
+                        _pending_docstrings.append((cls, func_info, v))
         return
 
     @classmethod
@@ -157,6 +185,10 @@ class ParmDescAware():
         if invalid:
             msg = "process_parms() given undefined parms: " + ", ".join(invalid)
             raise ParmDescException(msg)
+        # Docstrings may be built later, so check now that they can be
+        for parm in allowed:
+            if parm not in cls.parm2doc:
+                raise ParmDescException("'" + parm + "' unknown")
         for parm in func_info['required']:
             if isinstance(parm,list):
                 for subparm in parm:
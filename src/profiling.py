@@ -0,0 +1,284 @@
+import os
+import sys
+import time
+import signal
+import logging
+import cProfile
+import threading
+from collections import Counter
+from datetime import datetime
+
+#: Profiling modes
+MODES = ('cprofile', 'sample')
+
+#: Label of work not done for a particular packet type
+LOOP_LABEL = 'loop'
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+_NULL_CONTEXT = _NullContext()
+
+
+class LoopProfiler(object):
+    def __init__(self):
+        """Profile iterations of the mediator loop
+
+        A LoopProfiler is started with :meth:`start` (or :meth:`toggle`, e.g.
+        from a signal handler), and stops itself after a given number of
+        loop iterations or seconds, or when :meth:`stop` is called. When it
+        stops it writes its results to files in the output directory, named
+        ``amie-profile-<start time>-<label>.<ext>``.
+
+        Work done inside a :meth:`packet_type` context is attributed to that
+        packet type; everything else is labelled "loop". There are two
+        modes:
+
+            cprofile  : deterministic profiling with cProfile; a ``.pstats``
+                        file is written for each label (load it with the
+                        pstats module or snakeviz)
+            sample    : a background thread samples the stack of the
+                        profiled thread every ``interval`` seconds; one
+                        ``.collapsed`` file is written with a line per
+                        distinct stack, "<label>;<frame>;<frame>... <count>",
+                        the input format of flamegraph.pl and speedscope
+
+        Starting, stopping, and toggling only take effect at iteration
+        boundaries (see :meth:`iteration`), so profiles never contain part of
+        an iteration and signal handlers do no real work.
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.output_dir = '.'
+        self.mode = 'cprofile'
+        self.iterations = 0
+        self.seconds = 0
+        self.interval = 0.005
+        self.running = False
+        self.pending = None
+        self.label = LOOP_LABEL
+        self.profiles = dict()
+        self.samples = Counter()
+        self.sampler = None
+
+    def configure(self, output_dir='.', mode='cprofile', iterations=0,
+                  seconds=0, interval=0.005):
+        """Set profiling parameters
+
+        :param output_dir: Where to write results
+        :type output_dir: str
+        :param mode: "cprofile" or "sample"
+        :type mode: str
+        :param iterations: Stop after this many loop iterations; 0 means no
+            limit
+        :type iterations: int
+        :param seconds: Stop at the end of the first iteration that ends this
+            many seconds after starting; 0 means no limit
+        :type seconds: float
+        :param interval: Seconds between samples in "sample" mode
+        :type interval: float
+        :raises ValueError: if the mode is unknown
+        """
+
+        if mode not in MODES:
+            raise ValueError("unknown profiling mode: " + str(mode))
+        self.output_dir = output_dir or '.'
+        self.mode = mode
+        self.iterations = int(iterations or 0)
+        self.seconds = float(seconds or 0)
+        self.interval = float(interval)
+
+    def start(self):
+        """Start profiling now"""
+
+        if self.running:
+            return
+        self.running = True
+        self.start_time = datetime.now()
+        self.start_clock = time.monotonic()
+        self.iteration_count = 0
+        self.label = LOOP_LABEL
+        self.profiles = dict()
+        self.samples = Counter()
+        if self.mode == 'cprofile':
+            self._get_profile(LOOP_LABEL).enable()
+        else:
+            self.sampler = _Sampler(self, threading.get_ident(),
+                                    self.interval)
+            self.sampler.start()
+        self.logger.info("Profiling started (" + self.mode + ")")
+
+    def stop(self) -> list:
+        """Stop profiling and write the results
+
+        :return: The names of the files written
+        """
+
+        if not self.running:
+            return []
+        self.running = False
+        if self.mode == 'cprofile':
+            self.profiles[self.label].disable()
+        else:
+            self.sampler.stop()
+            self.sampler = None
+        paths = self._write()
+        self.logger.info("Profiling stopped; wrote " + ", ".join(paths))
+        return paths
+
+    def toggle(self):
+        """Request that profiling start or stop at the next iteration
+
+        This is safe to call from a signal handler.
+        """
+
+        self.pending = 'toggle'
+
+    def iteration(self):
+        """Note the end of a loop iteration
+
+        Pending toggles are applied, and profiling is stopped if the limits
+        have been reached.
+        """
+
+        if self.pending is not None:
+            self.pending = None
+            if self.running:
+                self.stop()
+            else:
+                self.start()
+            return
+        if not self.running:
+            return
+        self.iteration_count += 1
+        if (self.iterations and self.iteration_count >= self.iterations) or \
+           (self.seconds and
+            time.monotonic() - self.start_clock >= self.seconds):
+            self.stop()
+
+    def packet_type(self, packet_type):
+        """Return a context manager that attributes work to a packet type
+
+        :param packet_type: The AMIE packet type
+        :type packet_type: str
+        """
+
+        if not self.running:
+            return _NULL_CONTEXT
+        return _PacketTypeContext(self, packet_type)
+
+    def install_signal_handler(self, signame):
+        """Toggle profiling when the process receives the named signal
+
+        Nothing is done unless this is called from the main thread.
+
+        :param signame: A signal name, e.g. "SIGUSR2" or "USR2"
+        :type signame: str
+        :raises ValueError: if the signal name is unknown
+        """
+
+        if not signame.startswith('SIG'):
+            signame = 'SIG' + signame
+        signum = getattr(signal, signame.upper(), None)
+        if signum is None:
+            raise ValueError("unknown signal: " + signame)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signum, lambda signum, frame: self.toggle())
+
+    def _switch(self, label):
+        # Attribute work from now on to the given label; return the old label
+        prev = self.label
+        if self.mode == 'cprofile':
+            self.profiles[prev].disable()
+            self._get_profile(label).enable()
+        self.label = label
+        return prev
+
+    def _get_profile(self, label):
+        profile = self.profiles.get(label, None)
+        if profile is None:
+            profile = self.profiles[label] = cProfile.Profile()
+        return profile
+
+    def _write(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.output_dir,
+            "amie-profile-" + self.start_time.strftime("%Y%m%d-%H%M%S") + "-")
+        paths = list()
+        if self.mode == 'cprofile':
+            for (label, profile) in sorted(self.profiles.items()):
+                path = prefix + label + ".pstats"
+                profile.dump_stats(path)
+                paths.append(path)
+        else:
+            path = prefix + "samples.collapsed"
+            with self.lock:
+                samples = sorted(self.samples.items())
+            with open(path, 'w') as f:
+                for (stack, count) in samples:
+                    f.write(stack + " " + str(count) + "\n")
+            paths.append(path)
+        return paths
+
+
+class _PacketTypeContext(object):
+    def __init__(self, profiler, packet_type):
+        self.profiler = profiler
+        self.packet_type = packet_type
+        self.prev = None
+
+    def __enter__(self):
+        self.prev = self.profiler._switch(self.packet_type)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if self.profiler.running:
+            self.profiler._switch(self.prev)
+        return False
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, profiler, thread_id, interval):
+        super().__init__(name="amie-profiler", daemon=True)
+        self.profiler = profiler
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        profiler = self.profiler
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id, None)
+            if frame is None:
+                continue
+            label = profiler.label
+            frames = list()
+            while frame is not None:
+                code = frame.f_code
+                frames.append(code.co_name + " (" +
+                              os.path.basename(code.co_filename) + ":" +
+                              str(code.co_firstlineno) + ")")
+                frame = frame.f_back
+            frames.append(label)
+            stack = ";".join(reversed(frames))
+            with profiler.lock:
+                profiler.samples[stack] += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+
+#: The profiler used by the mediator
+PROFILER = LoopProfiler()
+
+def packet_type(name):
+    """Return a :data:`PROFILER` context; see :meth:`LoopProfiler.packet_type`"""
+
+    return PROFILER.packet_type(name)
@@ -0,0 +1,305 @@
+import time
+import logging
+import threading
+import metrics
+import deadline
+
+#: Key for the rate limit of methods not named in a rate limit spec
+DEFAULT_METHOD = '*'
+
+#: Factor applied to an adaptive concurrency limit when the backend is
+#: struggling
+BACKOFF_FACTOR = 0.5
+
+RATE_LIMIT_WAIT_SECONDS = metrics.counter(
+    'amie_rate_limit_wait_seconds_total',
+    'Time calls waited for a rate limit token, by session class and method',
+    ('session', 'method'))
+CONCURRENCY_WAIT_SECONDS = metrics.counter(
+    'amie_concurrency_wait_seconds_total',
+    'Time calls waited for the adaptive concurrency limit, by session class '
+    'and method',
+    ('session', 'method'))
+CONCURRENCY_LIMIT = metrics.gauge(
+    'amie_concurrency_limit',
+    'Current adaptive concurrency limit, by session class and method',
+    ('session', 'method'))
+
+def parse_rate_limits(spec) -> dict:
+    """Parse a rate limit specification
+
+    A specification is a comma-separated list of ``method=rate`` or
+    ``method=rate:burst`` items, where ``rate`` is calls per second and
+    ``burst`` is the number of calls that can be made at once after an idle
+    period (default is the rate, or 1). A method of ``*`` applies to all
+    methods not listed; each method still gets its own limit. For example::
+
+        lookup_person=5:10, send_packet=1, *=20
+
+    :param spec: The specification
+    :type spec: str
+    :return: dict mapping method names to (rate, burst) tuples
+    :raises ValueError: if the specification is malformed
+    """
+
+    limits = dict()
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        (method, sep, value) = item.partition('=')
+        (rate, sep2, burst) = value.partition(':')
+        try:
+            rate = float(rate)
+            burst = float(burst) if sep2 else max(rate, 1.0)
+        except ValueError:
+            raise ValueError("Bad rate limit: " + item)
+        if not sep or not method.strip() or rate <= 0 or burst < 1:
+            raise ValueError("Bad rate limit: " + item)
+        limits[method.strip()] = (rate, burst)
+    return limits
+
+def make_call_limiter(session, rate_limits='', concurrency_max=0,
+                      latency_target=0, time_util=None):
+    """Build a CallLimiter from configuration values
+
+    :param session: Session class name, for metrics
+    :type session: str
+    :param rate_limits: Rate limit spec; see :func:`parse_rate_limits`
+    :type rate_limits: str
+    :param concurrency_max: The highest adaptive concurrency limit; 0 means
+        no concurrency limit
+    :type concurrency_max: int or str
+    :param latency_target: See :class:`AdaptiveLimit`
+    :type latency_target: float or str
+    :param time_util: If given, the limiter reads the time and sleeps through
+        this, so it follows the same clock as the rest of the mediator
+    :type time_util: misctypes.TimeUtil, optional
+    :return: A CallLimiter, or None if no limits are configured
+    :raises ValueError: if rate_limits is malformed
+    """
+
+    rates = parse_rate_limits(rate_limits or '')
+    if not rates and not int(concurrency_max):
+        return None
+    if time_util is None:
+        return CallLimiter(session, rates, int(concurrency_max),
+                           float(latency_target))
+
+    def clock():
+        return time_util.now().timestamp()
+
+    return CallLimiter(session, rates, int(concurrency_max),
+                       float(latency_target), clock, time_util.sleep)
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """A token bucket rate limit
+
+        :param rate: Tokens added per second
+        :type rate: float
+        :param burst: Bucket capacity
+        :type burst: float
+        :param clock: Function returning the current time in seconds
+        :type clock: callable
+        """
+
+        self.rate = float(rate)
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, and return how long to wait before using it
+
+        Tokens may be taken before they are available, so concurrent callers
+        are served in order and each knows its wait at once.
+
+        :return: Seconds to wait
+        """
+
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class AdaptiveLimit(object):
+    def __init__(self, limit_max, latency_target=0, clock=time.monotonic):
+        """An AIMD (additive increase, multiplicative decrease) limit on
+        concurrent calls
+
+        The limit starts at 1. Each call that succeeds within
+        ``latency_target`` seconds raises it by 1/limit (i.e. by about one
+        per limit's worth of calls), up to ``limit_max``; a call that fails
+        with a temporary error or takes longer than ``latency_target`` cuts it
+        by :data:`BACKOFF_FACTOR`, down to 1. Only calls started after the
+        last cut can cut it again, so one slow period counts once.
+
+        :param limit_max: The highest limit
+        :type limit_max: int
+        :param latency_target: Latency (secs) above which calls count as
+            slow; 0 means only temporary errors count
+        :type latency_target: float
+        :param clock: Function returning the current time in seconds
+        :type clock: callable
+        """
+
+        self.limit_max = int(limit_max)
+        self.latency_target = float(latency_target)
+        self.clock = clock
+        self.limit = 1.0
+        self.in_flight = 0
+        self.last_backoff = None
+        self.condition = threading.Condition()
+
+    def acquire(self, what='call') -> float:
+        """Wait until a call may start, and return its start time
+
+        The wait ends at this thread's deadline (see :mod:`deadline`), if it
+        has one.
+
+        :param what: Description of the call, for the exception message
+        :type what: str
+        :raises deadline.DeadlineExceeded: if the deadline passes first
+        """
+
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                timeout = deadline.remaining()
+                if timeout is not None and timeout <= 0:
+                    raise deadline.exceeded(what)
+                self.condition.wait(timeout)
+            self.in_flight += 1
+            return self.clock()
+
+    def release(self, start, latency, failed=False):
+        """Record the outcome of a call started by :meth:`acquire`
+
+        :param start: The value returned by acquire()
+        :type start: float
+        :param latency: Duration of the call in seconds
+        :type latency: float
+        :param failed: True if the call failed with a temporary error
+        :type failed: bool
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            slow = self.latency_target and latency > self.latency_target
+            if failed or slow:
+                if self.last_backoff is None or start >= self.last_backoff:
+                    self.limit = max(1.0, self.limit * BACKOFF_FACTOR)
+                    self.last_backoff = self.clock()
+            elif self.limit < self.limit_max:
+                self.limit = min(float(self.limit_max),
+                                 self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+
+class CallLimiter(object):
+    def __init__(self, session, rates=None, concurrency_max=0,
+                 latency_target=0, clock=time.monotonic, sleep=time.sleep):
+        """Per-method rate and concurrency limits for a proxied service
+
+        A ``CallLimiter`` is attached to a
+        :class:`~retryingproxy.RetryingServiceProxy` subclass (see
+        :meth:`~retryingproxy.RetryingServiceProxy.set_call_limiter`), and
+        every call made through the session waits for it. Each method gets
+        its own :class:`TokenBucket`, from its entry in ``rates`` or the
+        :data:`DEFAULT_METHOD` entry, and, if ``concurrency_max`` is set, its
+        own :class:`AdaptiveLimit`.
+
+        :param session: Session class name, for metrics
+        :type session: str
+        :param rates: dict mapping method names to (rate, burst); see
+            :func:`parse_rate_limits`
+        :type rates: dict
+        :param concurrency_max: The highest adaptive concurrency limit; 0
+            means no concurrency limit
+        :type concurrency_max: int
+        :param latency_target: See :class:`AdaptiveLimit`
+        :type latency_target: float
+        :param clock: Function returning the current time in seconds
+        :type clock: callable
+        :param sleep: Function that sleeps for fractional seconds
+        :type sleep: callable
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.session = session
+        self.rates = dict(rates or {})
+        self.concurrency_max = int(concurrency_max)
+        self.latency_target = float(latency_target)
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.buckets = dict()
+        self.limits = dict()
+
+    def acquire(self, method):
+        """Wait until a call to a method may start
+
+        :param method: The method name
+        :type method: str
+        :return: A token to pass to :meth:`release`
+        """
+
+        (bucket, limit) = self._get_limits(method)
+        if bucket is not None:
+            wait = bucket.reserve()
+            if wait > 0:
+                deadline.check(self.session + "." + method, wait)
+                self.logger.debug(self.session + "." + method +
+                                  ": rate limited for " + f"{wait:.3f}" +
+                                  " sec")
+                self.sleep(wait)
+                RATE_LIMIT_WAIT_SECONDS.inc(wait, session=self.session,
+                                            method=method)
+        if limit is None:
+            return None
+        before = self.clock()
+        start = limit.acquire(self.session + "." + method)
+        if start > before:
+            CONCURRENCY_WAIT_SECONDS.inc(start - before, session=self.session,
+                                         method=method)
+        return start
+
+    def release(self, method, token, latency, failed=False):
+        """Record the outcome of a call
+
+        :param method: The method name
+        :type method: str
+        :param token: The value returned by :meth:`acquire`
+        :param latency: Duration of the call in seconds
+        :type latency: float
+        :param failed: True if the call failed with a temporary error
+        :type failed: bool
+        """
+
+        limit = self.limits.get(method, None)
+        if limit is None:
+            return
+        limit.release(token, latency, failed)
+        CONCURRENCY_LIMIT.set(int(limit.limit), session=self.session,
+                              method=method)
+
+    def _get_limits(self, method):
+        with self.lock:
+            if method not in self.buckets:
+                rate = self.rates.get(method,
+                                      self.rates.get(DEFAULT_METHOD, None))
+                self.buckets[method] = None if rate is None else \
+                    TokenBucket(rate[0], rate[1], self.clock)
+                if self.concurrency_max:
+                    self.limits[method] = AdaptiveLimit(
+                        self.concurrency_max, self.latency_target, self.clock)
+            return (self.buckets[method], self.limits.get(method, None))
@@ -1,6 +1,27 @@
 import logging
+import time
 from requests.exceptions import ConnectionError
 from misctypes import TimeUtil
+import metrics
+import tracing
+import deadline
+
+CALL_SECONDS = metrics.histogram(
+    'amie_session_call_seconds',
+    'Time spent in calls to a proxied service, by session class and method',
+    ('session', 'method'))
+RETRIES = metrics.counter(
+    'amie_session_retries_total',
+    'Temporary errors that caused a retry, by session class',
+    ('session',))
+BACKOFF_SECONDS = metrics.counter(
+    'amie_session_backoff_seconds_total',
+    'Time spent sleeping before retries, by session class',
+    ('session',))
+MAX_RETRIES = metrics.counter(
+    'amie_session_max_retries_total',
+    'Calls that gave up after retry_time_max, by session class',
+    ('session',))
 
 class RetryingServiceProxyError(Exception):
     """Exception raised when RetryingServiceProxy hits an internal error"""
@@ -13,6 +34,9 @@ class MaxRetryError(Exception):
 class RetryingServiceProxy:
     """Context Manager class for contacting an external service"""
 
+    #: A :class:`~ratelimit.CallLimiter` that every call waits for, or None
+    call_limiter = None
+
     @classmethod
     def configure(cls, svc,
                   min_retry_delay, max_retry_delay, retry_time_max,
@@ -53,6 +77,7 @@ class RetryingServiceProxy:
         cls.max_retry_exception = max_retry_exception
         cls.retry_delay = None
         cls.retry_deadline = None
+        cls.retry_failed_time = None
         tec = list(temporary_exception_classes)
         cls.temp_exception_classes = tec
         if ConnectionError not in tec:
@@ -61,14 +86,41 @@ class RetryingServiceProxy:
             cls.temp_exception_classes[0]
         cls.logger = logging.getLogger(__name__)
         
+    @classmethod
+    def set_call_limiter(cls, limiter):
+        """Set or clear the rate and concurrency limits for this class's calls
+
+        :param limiter: Limits for calls made through this class, or None
+        :type limiter: ratelimit.CallLimiter or None
+        """
+
+        cls.call_limiter = limiter
+
     def __enter__(self):
         cls = self.__class__
         if cls.svc is None:
             raise RetryingServiceProxyError("not configured")
+        deadline.check(cls.__name__)
         if cls.retry_delay is not None:
-            cls.logger.debug("Sleeping " + str(self.retry_delay) + " sec")
-            cls.time_util.sleep(self.retry_delay)
-        return cls.svc
+            delay = cls.retry_delay
+            if deadline.current() is not None:
+                # Under a deadline, time spent elsewhere since the failure
+                # counts toward the delay, and work that cannot wait out the
+                # rest is handed back rather than sleeping past the deadline
+                elapsed = (cls.time_util.now() -
+                           cls.retry_failed_time).total_seconds()
+                delay = max(0, int(delay - elapsed))
+                deadline.check(cls.__name__, delay)
+            cls.logger.debug("Sleeping " + str(delay) + " sec")
+            cls.time_util.sleep(delay)
+            BACKOFF_SECONDS.inc(delay, session=cls.__name__)
+        # Subclasses may be configured through this class's configure(), so
+        # each class keeps its own proxy, rebuilt if svc changes
+        proxy = cls.__dict__.get('call_proxy', None)
+        if (proxy is None) or (proxy._svc is not cls.svc):
+            proxy = ServiceCallProxy(cls, cls.svc)
+            cls.call_proxy = proxy
+        return proxy
 
     def __exit__(self, exc_type, exc_value, exc_tb):
         cls = self.__class__
@@ -87,6 +139,8 @@ class RetryingServiceProxy:
 
     def _update_retry(self, exc):
         cls = self.__class__
+        RETRIES.inc(session=cls.__name__)
+        cls.retry_failed_time = cls.time_util.now()
         if cls.retry_delay is None:
             cls.retry_delay = int(self.min_retry_delay)
             cls.retry_deadline = \
@@ -95,9 +149,73 @@ class RetryingServiceProxy:
             if cls.time_util.now() > cls.retry_deadline:
                 cls.retry_delay = None
                 cls.retry_deadline = None
+                MAX_RETRIES.inc(session=cls.__name__)
                 raise cls.max_retry_exception() from exc
             cls.retry_delay *= 2
             if cls.retry_delay > cls.max_retry_delay:
                 cls.retry_delay = cls.max_retry_delay
 
 
+class ServiceCallProxy(object):
+    def __init__(self, session_cls, svc):
+        """Stand-in for a proxied service that measures every method call
+
+        Attribute lookups are passed through to the service; methods are
+        wrapped so that each call waits for the session class's
+        ``call_limiter``, if any, calls are not started after the caller's
+        deadline (see :mod:`deadline`), and the duration of each call is
+        recorded in the ``amie_session_call_seconds`` histogram and, if
+        tracing is enabled, as a span.
+
+        :param session_cls: The RetryingServiceProxy subclass
+        :type session_cls: class
+        :param svc: The service being proxied
+        :type svc: object
+        """
+
+        self._session_cls = session_cls
+        self._session = session_cls.__name__
+        self._svc = svc
+
+    def __getattr__(self, name):
+        attr = getattr(self._svc, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        wrapper = self._wrap(name, attr)
+        # cache the wrapper; __getattr__ is not called for it again
+        setattr(self, name, wrapper)
+        return wrapper
+
+    def _wrap(self, name, method):
+        session_cls = self._session_cls
+        session = self._session
+        span_name = session + '.' + name
+        tracer = tracing.TRACER
+
+        def call(*args, **kwargs):
+            deadline.check(span_name)
+            limiter = session_cls.call_limiter
+            token = None
+            if limiter is not None:
+                token = limiter.acquire(name)
+            failed = False
+            start = time.perf_counter()
+            try:
+                with tracer.span(span_name, 'session'):
+                    return method(*args, **kwargs)
+            except tuple(session_cls.temp_exception_classes):
+                failed = True
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                CALL_SECONDS.observe(elapsed, session=session, method=name)
+                if limiter is not None:
+                    # Time a long poll (e.g. get_tasks(wait=...)) is asked to
+                    # wait for is not latency
+                    wait = kwargs.get('wait', None)
+                    if isinstance(wait, (int, float)):
+                        elapsed = max(0.0, elapsed - wait)
+                    limiter.release(name, token, elapsed, failed)
+        call.__name__ = name
+        call.__doc__ = method.__doc__
+        return call
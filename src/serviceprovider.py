@@ -98,6 +98,32 @@ class ServiceProviderIF(ABC):
 
         pass
 
+    def iter_tasks(self, active=True, wait=None, since=None,
+                   page_size=None):
+        """Iterate over the tasks that get_tasks() would return
+
+        This is optional; the mediator uses it instead of get_tasks() when
+        its ``task_page_size`` parameter is set, so that it never holds the
+        whole task table in memory at once. A Service Provider with many
+        tasks can implement it as a generator that fetches ``page_size``
+        tasks at a time. It may yield plain dicts with the TaskStatus keys
+        instead of TaskStatus objects; the mediator only makes TaskStatus
+        objects of the tasks it needs. The default implementation calls
+        get_tasks().
+
+        :param active: See get_tasks()
+        :type active: bool, optional
+        :param wait: See get_tasks()
+        :type wait: int, optional
+        :param since: See get_tasks()
+        :param since: DateTime, optional
+        :param page_size: Suggested number of tasks to fetch at a time
+        :type page_size: int, optional
+        :return: An iterator of TaskStatus objects or dicts
+        """
+
+        return iter(self.get_tasks(active=active, wait=wait, since=since))
+
     @abstractmethod
     def clear_transaction(self, amie_transaction_id):
         """Clean up task data associated with a packet
@@ -480,6 +506,9 @@ class ServiceProvider(AMIEParmDescAware, ServiceProviderIF):
         the :class:``ServiceProviderIF`` interface. It then passes the
         configuration on to that implementation, and remembers the object so
         that the rest of the methods in the class can delegate to it.
+
+        If ``sp_pool_size`` is set, the implementation is instead loaded in
+        that many worker processes; see :class:`~sppool.ServiceProviderPool`.
         """
 
         localsite_package = config['package']
@@ -487,6 +516,15 @@ class ServiceProvider(AMIEParmDescAware, ServiceProviderIF):
         self.logger.debug("(localsite_module,localsite_package)=(" + \
                           localsite_module + ',' + localsite_package + ")")
 
+        pool_size = int(config.get('sp_pool_size', 0) or 0)
+        if pool_size > 0:
+            from sppool import (ServiceProviderPool, DEFAULT_TIMEOUT)
+            timeout = config.get('sp_pool_timeout', None) or DEFAULT_TIMEOUT
+            self.implem = ServiceProviderPool(config, pool_size, timeout)
+            self.logger.debug("ServiceProvider=" + localsite_module +
+                              " in " + str(pool_size) + " worker processes")
+            return
+
         localsite = importlib.import_module(localsite_module,localsite_package)
         self.implem = localsite.ServiceProvider()
         self.logger.debug("ServiceProvider="+str(self.implem.__class__))
@@ -509,7 +547,22 @@ class ServiceProvider(AMIEParmDescAware, ServiceProviderIF):
         except Timeout as to:
             raise ServiceProviderTimeout() from to
         return local_packets
-        
+
+    def iter_tasks(self, active=True, wait=None, since=None,
+                   page_size=None):
+        self._check_implem()
+        iter_tasks = getattr(self.implem, 'iter_tasks', None)
+        if iter_tasks is None:
+            return iter(self.get_tasks(active=active, wait=wait, since=since))
+        return self._map_timeouts(iter_tasks(active=active, wait=wait,
+                                             since=since,
+                                             page_size=page_size))
+
+    def _map_timeouts(self, tasks):
+        try:
+            yield from tasks
+        except Timeout as to:
+            raise ServiceProviderTimeout() from to
 
     def clear_transaction(self, amie_transaction_id):
         self._check_implem()
@@ -0,0 +1,613 @@
+import json
+import time
+import atexit
+import zlib
+import logging
+import multiprocessing
+from pathlib import Path
+from collections import Counter
+from requests.exceptions import JSONDecodeError
+from amieclient.packet.base import Packet as AMIEPacket
+from configdefaults import DFLT
+from amieparms import get_packet_keys
+from taskstatus import (TASK_FIELDS, encode_task, decode_task)
+from serviceprovider import ServiceProvider
+from spexception import *
+from packetmanager import PacketManager
+from mediator import (AMIEMediator, LOOP_PHASE_SECONDS,
+                      LOOP_ITERATION_SECONDS)
+import metrics
+from metrics import timed
+from tracing import traced
+import profiling
+
+#: Configuration parameters naming files that each worker writes separately;
+#: see :func:`shard_path`
+SHARD_FILE_PARMS = ('trace_file', 'packet_record_file', 'sp_record_file',
+                    'metrics_textfile')
+
+#: Configuration parameters for servers that only the coordinator runs
+COORDINATOR_ONLY_PARMS = ('snapshot_server_address', 'metrics_address',
+                          'control_address', 'task_push_dir')
+
+#: Exceptions raised in workers that the coordinator re-raises as
+#: ServiceProviderTemporaryError, so run_loop_persistently() continues
+TEMPORARY_ERRORS = ('ServiceProviderTemporaryError', 'ServiceProviderTimeout',
+                    'ConnectionError', 'Timeout')
+
+def shard_for(atrid, nshards) -> int:
+    """Return the shard that owns a transaction
+
+    The hash is stable across processes and releases (unlike ``hash()``).
+
+    :param atrid: AMIE transaction ID
+    :type atrid: str
+    :param nshards: Number of shards
+    :type nshards: int
+    """
+
+    return zlib.crc32(atrid.encode('utf-8')) % nshards
+
+def shard_path(path, shard) -> str:
+    """Return a per-shard version of a file path
+
+    ".shard<N>" is inserted before the first suffix of the file name, so
+    e.g. "/tmp/amie-sp.jsonl.gz" becomes "/tmp/amie-sp.shard1.jsonl.gz".
+    """
+
+    p = Path(path)
+    (stem, dot, suffixes) = p.name.partition('.')
+    return str(p.with_name(stem + '.shard' + str(shard) + dot + suffixes))
+
+def encode_packet(packet) -> dict:
+    """Encode an AMIE packet, for :func:`decode_packet`
+
+    Workers build their own ActionablePackets from the packets they are
+    sent, so only the AMIE packet crosses the process boundary.
+    """
+
+    pdict = packet.as_dict()
+    timestamp = getattr(packet, 'packet_timestamp', None)
+    if timestamp is not None and 'packet_timestamp' not in pdict['header']:
+        pdict['header']['packet_timestamp'] = str(timestamp)
+    return pdict
+
+def decode_packet(pdict) -> AMIEPacket:
+    """Rebuild an AMIE packet encoded by :func:`encode_packet`"""
+
+    packet = AMIEPacket.from_dict(pdict)
+    # Older amieclient releases do not keep the packet timestamp
+    if getattr(packet, 'packet_timestamp', None) is None:
+        packet.packet_timestamp = pdict['header'].get('packet_timestamp', None)
+    return packet
+
+def encode_message(message) -> bytes:
+    """Encode a message between the coordinator and a worker"""
+
+    return json.dumps(message, separators=(',', ':'),
+                      default=str).encode('utf-8')
+
+def decode_message(data) -> dict:
+    """Decode a message encoded by :func:`encode_message`"""
+
+    return json.loads(data)
+
+def worker_config(config, shard) -> dict:
+    """Return the mediator configuration for a worker
+
+    Files named in :data:`SHARD_FILE_PARMS` get per-shard names (see
+    :func:`shard_path`), the servers in :data:`COORDINATOR_ONLY_PARMS` are
+    left to the coordinator, and memory reports and profiles go to a
+    ".shard<N>" or "shard<N>" subdirectory.
+
+    :param config: The mediator configuration
+    :type config: dict
+    :param shard: The shard number
+    :type shard: int
+    """
+
+    wconfig = dict(config)
+    for parm in SHARD_FILE_PARMS:
+        if wconfig.get(parm, None):
+            wconfig[parm] = shard_path(wconfig[parm], shard)
+    for parm in COORDINATOR_ONLY_PARMS:
+        wconfig[parm] = ''
+    snapshot_dir = wconfig.get('snapshot_dir', DFLT['snapshot_dir'])
+    wconfig['snapshot_dir'] = str(Path(snapshot_dir, '.shard' + str(shard)))
+    profile_dir = wconfig.get('profile_dir', None) or '.'
+    wconfig['profile_dir'] = str(Path(profile_dir, 'shard' + str(shard)))
+    return wconfig
+
+def make_service_provider(localsite_config) -> ServiceProvider:
+    """Create and configure a ServiceProvider (for use as a worker factory)"""
+
+    service_provider = ServiceProvider()
+    service_provider.apply_config(localsite_config)
+    return service_provider
+
+
+class ForwardingSnapshots(object):
+    def __init__(self):
+        """A 'w' mode Snapshots stand-in that collects changes
+
+        A worker's PacketManager writes its snapshots here; the changes are
+        sent to the coordinator with each step's status and applied to the
+        one real snapshot directory, so readers see the snapshots of all
+        shards together.
+        """
+
+        self.images = dict()
+        self.changes = dict()
+
+    def mode(self):
+        return 'w'
+
+    def update(self, key, data):
+        jdata = json.dumps(data)
+        if jdata != self.images.get(key, None):
+            self.images[key] = jdata
+            self.changes[key] = data
+
+    def delete(self, key):
+        if self.images.pop(key, None) is not None or key in self.changes:
+            self.changes[key] = None
+
+    def release(self):
+        pass
+
+    def take_changes(self) -> list:
+        """Return and forget [key, data] pairs changed since the last call
+
+        data is None if the snapshot was deleted.
+        """
+
+        changes = [[key, data] for (key, data) in self.changes.items()]
+        self.changes = dict()
+        return changes
+
+
+class ShardWorker(AMIEMediator):
+    def __init__(self, config, amie_client, service_provider, shard,
+                 timeutil=None):
+        """Mediate the transactions of one shard
+
+        A ``ShardWorker`` owns its own TransactionManager, PacketManager, and
+        ServiceProvider session, and sends its own replies to AMIE, but it
+        does not poll AMIE or the ServiceProvider; the
+        :class:`ShardCoordinator` does that and sends each worker the packets
+        and task updates for its transactions with every :meth:`step`.
+
+        :param config: Mediator configuration (see :func:`worker_config`)
+        :type config: dict
+        :param amie_client: An AMIEClient instance, used to send replies
+        :type amie_client: AMIEClient
+        :param service_provider: A ServiceProvider instance
+        :type service_provider: ServiceProvider
+        :param shard: The shard number
+        :type shard: int
+        :param timeutil: If non None, an instance of TimeUtil
+        :type timeutil: TimeUtil or None
+        """
+
+        self.shard = shard
+        self.routed_packets = list()
+        self.routed_tasks = list()
+        AMIEMediator.__init__(self, config, amie_client, service_provider,
+                              timeutil)
+
+    def step(self, message) -> dict:
+        """Process one batch of packets and task updates from the coordinator
+
+        This does what one iteration of :meth:`AMIEMediator.run_loop` does
+        after its wait.
+
+        :param message: dict with "packets" (see :func:`encode_packet`),
+            "tasks" (see :func:`encode_task`), "full" (True if the
+            packets are all the active packets for the shard, so transactions
+            with no packets are obsolete), and "drain" (True if the worker
+            should take on no new transactions)
+        :type message: dict
+        :return: Status dict with "wait" (seconds before this worker wants
+            the next step), "actionable" (True if packets are waiting on the
+            ServiceProvider), "depths" (queue depths), and "snapshots"
+            (see :meth:`ForwardingSnapshots.take_changes`)
+        """
+
+        self.routed_packets = [decode_packet(p) for p in message['packets']]
+        self.routed_tasks = [decode_task(t) for t in message['tasks']]
+        if message.get('full', False):
+            self.amie_packet_update_time = None
+        if message.get('drain', False) and not self.loop_control.draining:
+            self.loop_control.drain()
+
+        self._load_tasks()
+        with self._iteration_deadline():
+            apackets = self._load_amie_packets()
+            self._flush_amie_packets()
+            if apackets:
+                self._service_actionable_packets(apackets)
+                self._flush_amie_packets()
+        self._report_metrics()
+        profiling.PROFILER.iteration()
+        if self.memory_tracker:
+            self.memory_tracker.check()
+
+        tm = self.transaction_manager
+        return {
+            'wait': tm.get_loop_delay().wait_secs() or 0,
+            'actionable': tm.have_actionable_packets(),
+            'depths': tm.get_queue_depths(),
+            'snapshots': self.packet_manager.snapshots.take_changes(),
+        }
+
+    def serve(self, conn):
+        """Process messages from the coordinator until told to stop
+
+        :param conn: The worker's end of a multiprocessing Pipe
+        :type conn: multiprocessing.connection.Connection
+        """
+
+        while True:
+            try:
+                message = decode_message(conn.recv_bytes())
+            except EOFError:
+                break
+            if message['op'] == 'stop':
+                break
+            try:
+                status = self.step(message)
+            except Exception as err:
+                self.logger.exception("Shard " + str(self.shard) +
+                                      " step failed")
+                status = {
+                    'error': err.__class__.__name__,
+                    'message': str(err),
+                    'snapshots': self.packet_manager.snapshots.take_changes(),
+                }
+            conn.send_bytes(encode_message(status))
+
+    def _create_packet_manager(self):
+        return PacketManager(self.snapshot_dir,
+                             snapshots=ForwardingSnapshots(),
+                             packet_deadline=float(self.packet_deadline))
+
+    def _get_tasks(self, active=True, wait=None) -> list:
+        tasks = self.routed_tasks
+        self.routed_tasks = list()
+        return tasks
+
+    def _list_amie_packets(self, list_packets_parms):
+        packets = self.routed_packets
+        self.routed_packets = list()
+        return packets
+
+
+def _worker_main(conn, shard, config, make_amie_client,
+                 make_service_provider):
+    service_provider = None
+    try:
+        service_provider = make_service_provider()
+        worker = ShardWorker(config, make_amie_client(), service_provider,
+                             shard)
+        metrics.REGISTRY.set_const_labels(shard=str(shard))
+        worker.serve(conn)
+    finally:
+        profiling.PROFILER.stop()
+        # e.g. a ServiceProviderPool or RecordingServiceProvider
+        implem = getattr(service_provider, 'implem', None)
+        if hasattr(implem, 'close'):
+            implem.close()
+        conn.close()
+
+
+class ProcessWorker(object):
+    def __init__(self, shard, config, make_amie_client,
+                 make_service_provider, start_method=None):
+        """A ShardWorker running in a child process
+
+        :param shard: The shard number
+        :type shard: int
+        :param config: Mediator configuration for the worker (see
+            :func:`worker_config`)
+        :type config: dict
+        :param make_amie_client: Function of no arguments that returns an
+            AMIEClient; it must be picklable unless the "fork" start method
+            is used
+        :type make_amie_client: callable
+        :param make_service_provider: Function of no arguments that returns
+            a configured ServiceProvider (see :func:`make_service_provider`)
+        :type make_service_provider: callable
+        :param start_method: multiprocessing start method; default is the
+            platform default
+        :type start_method: str, optional
+        """
+
+        self.shard = shard
+        context = multiprocessing.get_context(start_method)
+        (self.conn, child_conn) = context.Pipe()
+        # Not a daemon, so the worker can start service provider pool
+        # processes; it exits when its end of the pipe is closed
+        self.process = context.Process(
+            target=_worker_main, name='amie-shard' + str(shard),
+            args=(child_conn, shard, config, make_amie_client,
+                  make_service_provider))
+        self.process.start()
+        child_conn.close()
+        atexit.register(self.stop)
+
+    def send(self, message):
+        """Send a message to the worker"""
+
+        self.conn.send_bytes(encode_message(message))
+
+    def receive(self) -> dict:
+        """Wait for the worker's reply to the last message
+
+        :raises ServiceProviderError: if the worker has exited
+        """
+
+        try:
+            return decode_message(self.conn.recv_bytes())
+        except (EOFError, OSError):
+            raise ServiceProviderError("shard " + str(self.shard) +
+                                       " worker exited")
+
+    def stop(self, timeout=30):
+        """Tell the worker to stop, and wait for it"""
+
+        if self.conn.closed:
+            return
+        try:
+            self.send({'op': 'stop'})
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+
+class LocalWorker(object):
+    def __init__(self, worker):
+        """A ShardWorker in this process, with the ProcessWorker interface
+
+        Messages are still encoded and decoded, but steps run one at a time.
+
+        :param worker: The worker
+        :type worker: ShardWorker
+        """
+
+        self.worker = worker
+        self.message = None
+
+    def send(self, message):
+        self.message = encode_message(message)
+
+    def receive(self) -> dict:
+        message = decode_message(self.message)
+        self.message = None
+        try:
+            status = self.worker.step(message)
+        except Exception as err:
+            status = {'error': err.__class__.__name__, 'message': str(err),
+                      'snapshots':
+                      self.worker.packet_manager.snapshots.take_changes()}
+        return decode_message(encode_message(status))
+
+    def stop(self):
+        pass
+
+
+def start_workers(nshards, config, make_amie_client, make_service_provider,
+                  start_method=None) -> list:
+    """Start a ProcessWorker for each shard
+
+    Start workers before creating the :class:`ShardCoordinator`, so they do
+    not inherit its threads and open files.
+
+    :param nshards: Number of shards
+    :type nshards: int
+    :param config: The mediator configuration; see :func:`worker_config`
+    :type config: dict
+    :return: list of ProcessWorker
+    """
+
+    return [ProcessWorker(shard, worker_config(config, shard),
+                          make_amie_client, make_service_provider,
+                          start_method)
+            for shard in range(nshards)]
+
+
+class ShardCoordinator(AMIEMediator):
+    def __init__(self, config, amie_client, service_provider, workers,
+                 timeutil=None):
+        """Poll AMIE and the ServiceProvider for a set of shard workers
+
+        The coordinator runs the mediator loop, but instead of handling
+        packets itself it sends each packet and task update to the worker
+        that owns its transaction (see :func:`shard_for`), and waits for all
+        workers to finish their steps. Workers run their ServiceProvider
+        operations in parallel. Loop timing is based on the earliest time
+        any worker wants to run again.
+
+        The coordinator owns the snapshot directory, the snapshot server,
+        and the metrics server; workers send it their snapshot changes.
+
+        :param config: Mediator configuration
+        :type config: dict
+        :param amie_client: An AMIEClient instance, used to poll AMIE
+        :type amie_client: AMIEClient
+        :param service_provider: A ServiceProvider instance, used to poll
+            for task updates
+        :type service_provider: ServiceProvider
+        :param workers: ProcessWorker or LocalWorker for each shard
+        :type workers: list
+        :param timeutil: If non None, an instance of TimeUtil
+        :type timeutil: TimeUtil or None
+        """
+
+        AMIEMediator.__init__(self, config, amie_client, service_provider,
+                              timeutil)
+        self.workers = workers
+        self.statuses = [dict() for worker in workers]
+
+    def close(self):
+        """Stop all workers"""
+
+        for worker in self.workers:
+            worker.stop()
+
+    def run(self) -> list:
+        """Send all active packets and tasks to the workers once
+
+        The first call sends all active packets; later calls (e.g. when
+        run_loop_persistently() restarts the loop) send only updates.
+
+        :return: An empty list (ActionablePackets stay in the workers)
+        """
+
+        self._start_servers()
+        full = self.amie_packet_update_time is None
+        tasks = list(self._collect_tasks())
+        tasks.extend(self._take_pushed_tasks())
+        packets = self._collect_amie_packets()
+        self._dispatch(packets, tasks, full=full)
+        self._report_metrics()
+        return []
+
+    def run_loop(self):
+        """Poll AMIE and the ServiceProvider for the workers in a loop
+
+        Process packets until an exception is raised, or the workers are
+        drained; see :meth:`AMIEMediator.run_loop`.
+        """
+
+        self.run()
+
+        pause_max = int(self.pause_max)
+        previous_wait_secs = 0
+        while True:
+            mark = self.loop_control.mark()
+            if self._check_control():
+                return
+            iteration_start = time.perf_counter()
+
+            wait_secs = min([status.get('wait', 0)
+                             for status in self.statuses]) or None
+            wait_secs = self._limit_wait_secs(wait_secs, previous_wait_secs,
+                                              pause_max)
+            tasks = list()
+            actionable = any([status.get('actionable', False)
+                              for status in self.statuses])
+            if self.task_drop is not None:
+                # see AMIEMediator.run_loop()
+                if wait_secs and self._sleep(wait_secs, self.push_mark):
+                    wait_secs = 0
+                tasks = self._take_pushed_tasks()
+                if actionable:
+                    tasks.extend(self._collect_tasks())
+            elif actionable:
+                def load(wait):
+                    collected = self._collect_tasks(wait=wait)
+                    tasks.extend(collected)
+                    return len(collected)
+                if self._wait_for_tasks(load, wait_secs, mark):
+                    wait_secs = 0
+            elif wait_secs:
+                self.logger.debug("Sleeping " + str(wait_secs) + " sec")
+                if self._sleep(wait_secs, mark):
+                    wait_secs = 0
+            previous_wait_secs = wait_secs if wait_secs else 0
+
+            packets = list()
+            try:
+                packets = self._collect_amie_packets()
+            except JSONDecodeError as ex:
+                if "Expecting value: line 1 column 1 (char 0)" not in str(ex):
+                    raise
+
+            self._dispatch(packets, tasks)
+
+            LOOP_ITERATION_SECONDS.observe(time.perf_counter() -
+                                           iteration_start)
+            self._report_metrics()
+            profiling.PROFILER.iteration()
+            if self.memory_tracker:
+                self.memory_tracker.check()
+
+    @timed(LOOP_PHASE_SECONDS, phase='load_tasks')
+    @traced('load_tasks', 'loop')
+    def _collect_tasks(self, active=True, wait=None) -> list:
+        return self._get_tasks(active=active, wait=wait)
+
+    @timed(LOOP_PHASE_SECONDS, phase='load_amie_packets')
+    @traced('load_amie_packets', 'loop')
+    def _collect_amie_packets(self) -> list:
+        currtime = self.timeutil.now()
+        packets = self._list_amie_packets({
+            'update_time_start': self.amie_packet_update_time,
+            })
+        self.amie_packet_update_time = currtime
+        return self._filter_packets(packets)
+
+    @timed(LOOP_PHASE_SECONDS, phase='dispatch')
+    @traced('dispatch', 'loop')
+    def _dispatch(self, packets, tasks, full=False):
+        nshards = len(self.workers)
+        drain = self.loop_control.draining
+        messages = [{'op': 'step', 'full': full, 'drain': drain,
+                     'packets': [], 'tasks': []}
+                    for worker in self.workers]
+        for packet in packets:
+            jid, atrid, pid = get_packet_keys(packet)
+            messages[shard_for(atrid, nshards)]['packets'].append(
+                encode_packet(packet))
+        for task in tasks:
+            messages[shard_for(task['amie_transaction_id'], nshards)][
+                'tasks'].append(encode_task(task))
+
+        for (worker, message) in zip(self.workers, messages):
+            worker.send(message)
+        errors = list()
+        snapshots = self.packet_manager.snapshots
+        for (shard, worker) in enumerate(self.workers):
+            try:
+                status = worker.receive()
+            except ServiceProviderError as err:
+                errors.append(err)
+                continue
+            for (key, data) in status.pop('snapshots', []):
+                if data is None:
+                    snapshots.delete(key)
+                else:
+                    snapshots.update(key, data)
+            if 'error' in status:
+                errors.append(self._worker_error(shard, status))
+            else:
+                self.statuses[shard] = status
+        if errors:
+            raise errors[0]
+
+    def _worker_error(self, shard, status):
+        msg = "shard " + str(shard) + ": " + status['error'] + ": " + \
+            status['message']
+        if status['error'] in TEMPORARY_ERRORS:
+            return ServiceProviderTemporaryError(msg)
+        if status['error'] == 'ServiceProviderRequestFailed':
+            return ServiceProviderRequestFailed(msg)
+        return ServiceProviderError(msg)
+
+    def _get_control_state(self, depths) -> dict:
+        return {
+            'time': self.timeutil.now().isoformat(),
+            'depths': depths,
+            'shards': [status.get('depths', {}) for status in self.statuses],
+            'amie_packet_update_time': str(self.amie_packet_update_time),
+        }
+
+    def _get_queue_depths(self):
+        depths = Counter()
+        for status in self.statuses:
+            depths.update(status.get('depths', {}))
+        return dict(depths)
@@ -0,0 +1,114 @@
+import threading
+import metrics
+
+COALESCED_CALLS = metrics.counter(
+    'amie_sp_coalesced_calls_total',
+    'Calls answered by sharing an identical in-flight or earlier call, '
+    'by method',
+    ('method',))
+
+def make_key(name, kwargs) -> tuple:
+    """Return a hashable key for a call
+
+    :param name: The method name
+    :type name: str
+    :param kwargs: The call's (validated) keyword arguments
+    :type kwargs: dict
+    :return: tuple
+    """
+
+    return (name, _freeze(kwargs))
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((str(k), _freeze(v)) for (k, v) in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(repr(v) for v in value))
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return repr(value)
+
+
+class _Call(object):
+    def __init__(self, generation):
+        self.generation = generation
+        self.event = threading.Event()
+        self.ok = None
+        self.value = None
+
+
+class SingleFlight(object):
+    def __init__(self):
+        """Coalesce identical calls
+
+        :meth:`do` runs a function for a key unless a call for the same key
+        is already running, in which case it waits for that call and shares
+        its result (or exception), or has finished since the last
+        :meth:`invalidate`, in which case its result is returned again.
+        Results of failed calls are not kept.
+
+        This is safe to use from several threads; callers that must not see
+        results from before some change (e.g. an update to the data being
+        looked up) call :meth:`invalidate` after making it. A call that was
+        running when :meth:`invalidate` was called is shared with callers
+        that were already waiting for it, but not with later ones.
+        """
+
+        self.lock = threading.Lock()
+        self.calls = dict()
+        self.generation = 0
+
+    def do(self, key, func):
+        """Return func(), sharing the result with identical calls
+
+        :param key: A hashable key identifying the call (see
+            :func:`make_key`)
+        :type key: tuple
+        :param func: Function of no arguments that makes the call
+        :type func: callable
+        :return: The value returned by func
+        :raises Exception: whatever func raised
+        """
+
+        with self.lock:
+            call = self.calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = _Call(self.generation)
+                self.calls[key] = call
+        if not leader:
+            COALESCED_CALLS.inc(method=key[0])
+            call.event.wait()
+            if not call.ok:
+                raise call.value
+            return call.value
+
+        try:
+            call.value = func()
+            call.ok = True
+        except BaseException as err:
+            call.value = err
+            call.ok = False
+            raise
+        finally:
+            with self.lock:
+                if not call.ok or call.generation != self.generation:
+                    if self.calls.get(key, None) is call:
+                        del self.calls[key]
+            call.event.set()
+        return call.value
+
+    def invalidate(self):
+        """Forget the results of finished calls, and of calls still running"""
+
+        with self.lock:
+            self.generation += 1
+            self.calls = dict()
+
+
+#: Coalesces lookups by :class:`~packethandler.ServiceProviderAdapter`
+SP_CALLS = SingleFlight()
@@ -3,6 +3,7 @@ import os
 import json
 from stat import *
 import time
+import threading
 from filewait import FileWaiter
 
 class Snapshots(object):
@@ -31,8 +32,16 @@ class Snapshots(object):
         self.filewaiter = FileWaiter(waitfile)
         if mode == 'r':
             self.images = None
+            # cache maps keys to (token, data) pairs, where the token is the
+            # file's (st_mtime_ns, st_size) when it was read
+            self.cache = dict()
         else:
             self.images = dict()
+            # Every change to images gets a new version number; this lets
+            # a SnapshotServer tell clients when something has changed
+            self.version = 0
+            self.key_versions = dict()
+            self.changed = threading.Condition()
             entry_gen = os.scandir(self.dir)
             for dir_entry in entry_gen:
                 if not dir_entry.name.startswith('.') and dir_entry.is_file():
@@ -67,9 +76,17 @@ class Snapshots(object):
             fpath = Path(self.dir,key)
             with open(fpath,'w') as f:
                 f.write(jdata)
-                self.images[key] = jdata
-                self.filewaiter.release()
+            self._set_image(key, jdata)
         
+    def close(self):
+        """Release resources held by this object
+
+        The file backend holds none; see
+        :meth:`~snapshotjournal.SnapshotJournal.close`.
+        """
+
+        pass
+
     def release(self):
         """Release any process waiting on the snapshots
 
@@ -97,26 +114,101 @@ class Snapshots(object):
         fpath = Path(self.dir, key)
         if os.path.exists(fpath):
             Path(fpath).unlink(missing_ok=True)
-            self.filewaiter.release()
-        self.images.pop(key, None)
+        self._set_image(key, None)
+
+    def get_image(self, key=None, max_wait=0, version=None):
+        """Get the serialized snapshot for a key, or for all keys
+
+        The Snapshot object must be in 'w' mode. This can be called from any
+        thread.
+
+        :param key: The target key; if None, get all snapshots
+        :type key: str, optional
+        :param max_wait: The maximum seconds to wait if version is current
+        :type max_wait: float
+        :param version: A version returned by a previous call; if None, the
+            function returns immediately
+        :type version: int, optional
+        :return: A (jdata, version) pair; jdata is a JSON string (a list of
+            all snapshots if key is None), the version is None if the key does
+            not exist, and jdata is None if the operation times out
+        """
+
+        if self.mode() == 'r':
+            raise TypeError("Snapshots.get_image() not supported in 'r' mode")
+        with self.changed:
+            curr_version = self._get_version(key)
+            if (version is not None) and (version == curr_version) and \
+               (max_wait > 0):
+                self.changed.wait_for(
+                    lambda: self._get_version(key) != version, max_wait)
+                curr_version = self._get_version(key)
+            if curr_version is None:
+                return (None, None)
+            if (version is not None) and (version == curr_version):
+                return (None, curr_version)
+            if key is not None:
+                return (self.images[key], curr_version)
+            keys = list(self.images.keys())
+            keys.sort()
+            jdata = '[' + ','.join([self.images[k] for k in keys]) + ']'
+            return (jdata, curr_version)
+
+    def _get_version(self, key):
+        if key is None:
+            return self.version
+        if key not in self.images:
+            return None
+        return self.key_versions.get(key, 0)
+
+    def _set_image(self, key, jdata):
+        # Set (or, if jdata is None, remove) an image and wake get_image()
+        with self.changed:
+            if jdata is None:
+                if self.images.pop(key, None) is None:
+                    return
+                self.key_versions.pop(key, None)
+            else:
+                self.images[key] = jdata
+            self.version += 1
+            if jdata is not None:
+                self.key_versions[key] = self.version
+            self.changed.notify_all()
     
     def list(self):
         """Return all snapshots
 
-        The Snapshot object can be in either 'r' or 'w' mode.
+        The Snapshot object can be in either 'r' or 'w' mode. In 'r' mode,
+        a snapshot file is only re-read if its modification time or size has
+        changed since the last call, so the returned objects may be shared
+        with earlier calls and should not be modified.
 
         :return: A list of unserialized data objects
         """
         
         if self.mode() == 'r':
-            images = dict()
-            entry_gen = os.scandir(self.dir)
-            for dir_entry in entry_gen:
-                if not dir_entry.name.startswith('.') and dir_entry.is_file():
+            cache = dict()
+            with os.scandir(self.dir) as entry_gen:
+                for dir_entry in entry_gen:
+                    if dir_entry.name.startswith('.') or \
+                       not dir_entry.is_file():
+                        continue
                     key = dir_entry.name
-                    with open(dir_entry.path,'r') as f:
-                        jdata = f.read()
-                        images[key] = jdata
+                    try:
+                        statinfo = dir_entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    token = (statinfo.st_mtime_ns, statinfo.st_size)
+                    entry = self.cache.get(key, None)
+                    if (entry is None) or (entry[0] != token):
+                        entry = self._read_file(key, entry)
+                        if entry is None:
+                            continue
+                    cache[key] = entry
+            self.cache = cache
+            keys = list(cache.keys())
+            keys.sort()
+            return [cache[key][1] for key in keys]
         else:
             images = self.images
 
@@ -145,7 +237,7 @@ class Snapshots(object):
             raise TypeError("Snapshots.list_when_updated() " +\
                             "not supported in 'w' mode")
         if max_wait > 0:
-            self.filewaiter.wait(max_wait)
+            self.filewaiter.wait(max_wait, since=self.filewaiter.mark())
             
         return self.list()
 
@@ -160,7 +252,8 @@ class Snapshots(object):
         """
 
         if self.mode() == 'r':
-            (jdata, token) = self._get_from_file(key)
+            (data, token) = self._get_from_file(key)
+            return data
         else:
             jdata = self.images.get(key,None)
             if jdata is None:
@@ -185,29 +278,47 @@ class Snapshots(object):
         if self.mode() == 'w':
             raise TypeError("Snapshots.get_when_updated() " +\
                             "not supported in 'w' mode")
-        (jdata, curr_token) = self._get_from_file(key)
-        if (token is None) or (token != curr_token):
-            return (jdata, curr_token)
-        
-        curr_time = int(time.time())
-        expire_time = curr_time + max_wait
-        if curr_time < expire_time:
-            remaining_time = expire_time - curr_time
-            self.filewaiter.wait(remaining_time)
-        (jdata, curr_token) = self._get_from_file(key)
-        if (token is None) or (token != curr_token):
-            return (jdata, curr_token)
-        return (None, curr_token)
+        expire_time = time.monotonic() + max_wait
+        while True:
+            since = self.filewaiter.mark() if max_wait > 0 else None
+            (jdata, curr_token) = self._get_from_file(key)
+            if (token is None) or (token != curr_token):
+                return (jdata, curr_token)
+            remaining_time = expire_time - time.monotonic()
+            if remaining_time <= 0:
+                return (None, curr_token)
+            # Only wake up when this key's file changes (or on release())
+            self.filewaiter.wait(remaining_time, [key], since)
             
 
     def _get_from_file(self, key):
-        fpath = Path(self.dir, key)
-        if not os.path.exists(fpath):
+        try:
+            statinfo = os.stat(Path(self.dir, key))
+        except FileNotFoundError:
+            self.cache.pop(key, None)
             return (None, None)
-        with open(fpath,'r') as f:
-            jdata = f.read()
-            fd = f.fileno()
-            statinfo = os.fstat(fd)
-            token = (statinfo.st_mtime, statinfo.st_size)
+        token = (statinfo.st_mtime_ns, statinfo.st_size)
+        entry = self.cache.get(key, None)
+        if (entry is None) or (entry[0] != token):
+            entry = self._read_file(key, entry)
+            if entry is None:
+                self.cache.pop(key, None)
+                return (None, None)
+            self.cache[key] = entry
+        (token, data) = entry
+        return (data, token)
+
+    def _read_file(self, key, prev_entry):
+        # Return a (token, data) pair for the key's file. If the file is being
+        # rewritten and cannot be parsed, return the previous entry
+        try:
+            with open(Path(self.dir, key),'r') as f:
+                jdata = f.read()
+                statinfo = os.fstat(f.fileno())
+        except FileNotFoundError:
+            return None
+        try:
             data = json.loads(jdata)
-        return (data, token);
+        except json.JSONDecodeError:
+            return prev_entry
+        return ((statinfo.st_mtime_ns, statinfo.st_size), data)
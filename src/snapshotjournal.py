@@ -0,0 +1,380 @@
+from pathlib import Path
+import os
+import json
+import time
+from snapshot import Snapshots
+
+CHECKPOINT_NAME = ".checkpoint"
+JOURNAL_PREFIX = ".journal."
+
+class SnapshotJournal(Snapshots):
+    def __init__(self, dir, mode='r', purge_writeable=True,
+                 max_journal_size=4194304, keep_journals=2):
+        """Set up a directory as a journaled "snapshot" directory
+
+        A SnapshotJournal has the same interface as :class:`~snapshot.Snapshots`
+        but, instead of rewriting one file per key, a writer appends a change
+        record to a journal file for every update or delete. When the journal
+        grows beyond ``max_journal_size`` bytes, the writer compacts it: it
+        writes all current images to a checkpoint file and starts a new
+        journal "generation". The most recent ``keep_journals`` old journals
+        are retained so that readers can review the history of each key.
+
+        The checkpoint is named ``.checkpoint`` and journals are named
+        ``.journal.<generation>``; since the names start with '.', they are
+        invisible to :class:`~snapshot.Snapshots` readers.
+
+        Each journal record is a single line of JSON with the following
+        entries::
+            seq   : sequence number of the change; this never decreases
+            time  : time of the change (msec since start of epoch)
+            op    : "update" or "delete"
+            key   : the snapshot key
+            data  : the snapshot data (not present for "delete")
+
+        A reader keeps its own copy of all images and only reads journal
+        records appended since its last refresh.
+
+        :param dir: The directory containing snapshot files.
+        :type dir: str
+        :param mode: The mode: either 'r' or 'w'
+        :type mode: str
+        :param purge_writeable: In 'w' mode, discard any existing checkpoint
+            and journals (default=True)
+        :type purge_writeable: bool
+        :param max_journal_size: The journal size (bytes) that triggers a
+            compaction (default=4194304)
+        :type max_journal_size: int
+        :param keep_journals: The number of compacted journals to retain
+            (default=2)
+        :type keep_journals: int
+        """
+
+        Snapshots.__init__(self, dir, mode, purge_writeable)
+        self.max_journal_size = int(max_journal_size)
+        self.keep_journals = int(keep_journals)
+        self.checkpoint_path = Path(dir, CHECKPOINT_NAME)
+        self.generation = 0
+        self.seq = 0
+        self.journal = None
+
+        # key_seqs holds the seq of the last record for each key. In 'r'
+        # mode, objs holds unserialized images
+        self.objs = dict()
+        self.key_seqs = dict()
+        self.checkpoint_id = None
+        self.offset = 0
+
+        if mode == 'w':
+            if purge_writeable:
+                for generation in self._list_generations():
+                    self._journal_path(generation).unlink(missing_ok=True)
+                self.checkpoint_path.unlink(missing_ok=True)
+            else:
+                self._catch_up()
+                if self.checkpoint_id is not None:
+                    self.generation += 1
+                for key, obj in self.objs.items():
+                    self.images[key] = json.dumps(obj)
+                self.objs = dict()
+            self.compact()
+
+    def update(self, key, data):
+        """Update the data associated with the given key
+
+        The SnapshotJournal object must be in 'w' mode.
+
+        :param key: The key
+        :type key: str
+        :param data: The object data
+        :type data: Any JSON-serializeable value or object
+        """
+
+        if self.mode() == 'r':
+            raise TypeError("Snapshots.update() not supported in 'r' mode")
+        jdata = json.dumps(data)
+        image = self.images.get(key, None)
+        if jdata != image:
+            # Update images before appending, since appending can compact
+            self._set_image(key, jdata)
+            self.key_seqs[key] = self.seq + 1
+            self._append('update', key, jdata)
+            self.filewaiter.release()
+
+    def delete(self, key):
+        """Delete the data associated with the given key
+
+        The SnapshotJournal object must be in 'w' mode. The change is
+        recorded in the journal, so the key's history is not lost.
+
+        :param key: The key
+        :type key: str
+        """
+
+        if self.mode() == 'r':
+            raise TypeError("Snapshots.delete() not supported in 'r' mode")
+        if key in self.images:
+            self._set_image(key, None)
+            self.key_seqs.pop(key, None)
+            self._append('delete', key)
+            self.filewaiter.release()
+
+    def list(self):
+        """Return all snapshots
+
+        The SnapshotJournal object can be in either 'r' or 'w' mode.
+
+        :return: A list of unserialized data objects
+        """
+
+        if self.mode() == 'w':
+            return Snapshots.list(self)
+        self._catch_up()
+        keys = list(self.objs.keys())
+        keys.sort()
+        return [self.objs[key] for key in keys]
+
+    def get(self, key):
+        """Get the snapshot data for the given key
+
+        The SnapshotJournal object can be in either 'r' or 'w' mode.
+
+        :param key: The target key
+        :type key: str
+        :return: The unserialized data object from the snapshot
+        """
+
+        if self.mode() == 'w':
+            return Snapshots.get(self, key)
+        self._catch_up()
+        return self.objs.get(key, None)
+
+    def history(self, key=None):
+        """Return all retained journal records, oldest first
+
+        The SnapshotJournal object can be in either 'r' or 'w' mode.
+
+        :param key: If given, only return records for this key
+        :type key: str, optional
+        :return: A list of record dicts (see class description)
+        """
+
+        (records, position) = self.tail()
+        if key is None:
+            return records
+        return [record for record in records if record['key'] == key]
+
+    def tail(self, position=None):
+        """Return journal records written after a given position
+
+        The SnapshotJournal object can be in either 'r' or 'w' mode.
+
+        :param position: A position returned by a previous call; if None,
+            start with the oldest retained journal
+        :type position: tuple, optional
+        :return: A (records, position) pair; records is a list of record
+            dicts, and position can be passed to the next call
+        """
+
+        generations = self._list_generations()
+        if not generations:
+            return ([], position)
+        if position is None or position[0] < generations[0]:
+            position = (generations[0], 0)
+        (generation, offset) = position
+        records = list()
+        for gen in generations:
+            if gen < generation:
+                continue
+            if gen > generation:
+                (generation, offset) = (gen, 0)
+            (lines, offset) = self._read_journal(gen, offset)
+            records.extend([json.loads(line) for line in lines])
+        return (records, (generation, offset))
+
+    def compact(self):
+        """Write all images to a checkpoint and start a new journal
+
+        The SnapshotJournal object must be in 'w' mode. This is called
+        automatically when the journal reaches ``max_journal_size`` bytes.
+        """
+
+        if self.mode() == 'r':
+            raise TypeError("Snapshots.compact() not supported in 'r' mode")
+        if self.journal is not None:
+            self.journal.close()
+            self.generation += 1
+
+        keys = sorted(self.images.keys())
+        images = [json.dumps(key) + ':' + self.images[key] for key in keys]
+        seqs = dict()
+        for key in keys:
+            seqs[key] = self.key_seqs.get(key, self.seq)
+        checkpoint = '{"generation":' + str(self.generation) + \
+            ',"seq":' + str(self.seq) + \
+            ',"seqs":' + json.dumps(seqs) + \
+            ',"images":{' + ','.join(images) + '}}'
+        tmp_path = Path(self.dir, CHECKPOINT_NAME + ".tmp")
+        with open(tmp_path, 'w') as f:
+            f.write(checkpoint)
+        os.replace(tmp_path, self.checkpoint_path)
+
+        self.journal = open(self._journal_path(self.generation), 'a')
+        oldest = self.generation - self.keep_journals
+        for generation in self._list_generations():
+            if generation < oldest:
+                self._journal_path(generation).unlink(missing_ok=True)
+        self.filewaiter.release()
+
+    def close(self):
+        """Close the journal file
+
+        In 'w' mode, the object must not be changed after this is called.
+        """
+
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _append(self, op, key, jdata=None):
+        self.seq += 1
+        record = '{"seq":' + str(self.seq) + \
+            ',"time":' + str(int(time.time() * 1000)) + \
+            ',"op":"' + op + '","key":' + json.dumps(key)
+        if jdata is not None:
+            record += ',"data":' + jdata
+        self.journal.write(record + "}\n")
+        self.journal.flush()
+        if self.journal.tell() >= self.max_journal_size:
+            self.compact()
+
+    def get_when_updated(self, key, max_wait=0, token=None):
+        """Get the snapshot data for the given key when it is updated
+
+        The SnapshotJournal object must be in 'r' mode.
+
+        :param key: The target key
+        :type key: str
+        :param max_wait: The maximum seconds to wait
+        :type max_wait: int
+        :param token: A token used to track when the key has changed; if None,
+            the function returns immediately
+        :type token: int
+        :return: A (data, token) pair; the token is None if the key does not
+            exist, and data is None if the operation times out
+        """
+
+        if self.mode() == 'w':
+            raise TypeError("Snapshots.get_when_updated() " +\
+                            "not supported in 'w' mode")
+        expire_time = time.monotonic() + max_wait
+        while True:
+            since = self.filewaiter.mark() if max_wait > 0 else None
+            (data, curr_token) = self._get_from_journal(key)
+            if (token is None) or (token != curr_token):
+                return (data, curr_token)
+            remaining_time = expire_time - time.monotonic()
+            if remaining_time <= 0:
+                return (None, curr_token)
+            # Journal writers release() after every change
+            self.filewaiter.wait(remaining_time, since=since)
+
+    def _get_from_journal(self, key):
+        self._catch_up()
+        if key not in self.objs:
+            return (None, None)
+        return (self.objs[key], self.key_seqs.get(key, 0))
+
+    def _catch_up(self):
+        # Bring self.objs up to date: reload the checkpoint if a new one has
+        # been written, then apply journal records appended since last time.
+        # A new checkpoint is assumed if the checkpoint file itself has
+        # changed, if the next journal exists, or if the current journal has
+        # disappeared
+        try:
+            st = os.stat(self.checkpoint_path)
+        except FileNotFoundError:
+            return
+        checkpoint_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if checkpoint_id == self.checkpoint_id:
+            if self._journal_path(self.generation + 1).exists() or \
+               not self._journal_path(self.generation).exists():
+                checkpoint_id = None
+        if checkpoint_id != self.checkpoint_id:
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            self.generation = checkpoint['generation']
+            self.seq = checkpoint['seq']
+            self.objs = checkpoint['images']
+            self.key_seqs = checkpoint['seqs']
+            self.offset = 0
+            if checkpoint_id is None:
+                st = os.stat(self.checkpoint_path)
+                checkpoint_id = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.checkpoint_id = checkpoint_id
+
+        (lines, self.offset) = self._read_journal(self.generation, self.offset)
+        for line in lines:
+            record = json.loads(line)
+            key = record['key']
+            self.seq = record['seq']
+            if record['op'] == 'delete':
+                self.objs.pop(key, None)
+                self.key_seqs.pop(key, None)
+            else:
+                self.objs[key] = record['data']
+                self.key_seqs[key] = self.seq
+
+    def _read_journal(self, generation, offset):
+        # Return complete lines starting at offset and the offset following
+        # the last complete line; a partially-written line is left for later
+        try:
+            with open(self._journal_path(generation), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return ([], offset)
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return ([], offset)
+        lines = data[:end].decode('utf-8').splitlines()
+        return (lines, offset + end)
+
+    def _journal_path(self, generation):
+        return Path(self.dir, JOURNAL_PREFIX + "{:06d}".format(generation))
+
+    def _list_generations(self):
+        generations = list()
+        for name in os.listdir(self.dir):
+            if name.startswith(JOURNAL_PREFIX):
+                suffix = name[len(JOURNAL_PREFIX):]
+                if suffix.isdigit():
+                    generations.append(int(suffix))
+        generations.sort()
+        return generations
+
+
+#: Map of ``snapshot_backend`` configuration values to implementation classes
+BACKENDS = {
+    'files': Snapshots,
+    'journal': SnapshotJournal,
+}
+
+def open_snapshots(dir, mode='r', backend='files', **kwargs):
+    """Create a Snapshots object using the named backend
+
+    :param dir: The directory containing snapshot files.
+    :type dir: str
+    :param mode: The mode: either 'r' or 'w'
+    :type mode: str
+    :param backend: The backend name; see :data:`BACKENDS`
+    :type backend: str
+    :param kwargs: Additional arguments for the backend class
+    :raises ValueError: if the backend name is unknown
+    :return: Snapshots or SnapshotJournal
+    """
+
+    cls = BACKENDS.get(backend, None)
+    if cls is None:
+        raise ValueError("unknown snapshot backend: " + str(backend))
+    return cls(dir, mode, **kwargs)
@@ -0,0 +1,338 @@
+import os
+import json
+import socket
+import socketserver
+import threading
+import logging
+import uuid
+import ipaddress
+import http.client
+from http.server import (BaseHTTPRequestHandler, ThreadingHTTPServer)
+from urllib.parse import (urlsplit, parse_qs, quote, unquote)
+
+#: The longest a client can make the server wait for a change (seconds)
+MAX_WAIT = 600
+
+def parse_address(address, loopback_only=False):
+    """Parse a snapshot server address
+
+    An address containing '/' is the path of a Unix-domain socket. Otherwise
+    the address is "[host:]port"; the default host is "localhost".
+
+    :param address: The address
+    :type address: str
+    :param loopback_only: If True, only accept a host that is "localhost" or
+        a loopback IP address
+    :type loopback_only: bool
+    :return: A (family, address) pair, where family is socket.AF_UNIX or
+        socket.AF_INET
+    :raises ValueError: if the address is malformed, or loopback_only is
+        set and the host is not a loopback host
+    """
+
+    if '/' in address:
+        return (socket.AF_UNIX, address)
+    (host, sep, port) = address.rpartition(':')
+    host = host if host else 'localhost'
+    if loopback_only and host != 'localhost':
+        try:
+            loopback = ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback:
+            raise ValueError("Not a loopback address: " + address)
+    return (socket.AF_INET, (host, int(port)))
+
+
+class SnapshotServer(object):
+    def __init__(self, snapshots, address):
+        """Serve snapshot images held in memory over HTTP
+
+        The server runs in background threads and reads the images of a
+        :class:`~snapshot.Snapshots` object in 'w' mode, so clients do not
+        need access to the snapshot directory. The following requests are
+        supported::
+
+            GET /snapshots          : a JSON list of all snapshots
+            GET /snapshots/<key>    : the snapshot for <key>
+
+        Every response includes an ``ETag`` header. If a request includes an
+        ``If-None-Match`` header with the current ETag, the server responds
+        with "304 Not Modified"; if the request also includes a ``wait=<sec>``
+        query parameter, the server first waits up to <sec> seconds for the
+        snapshot(s) to change. A request for a key that does not exist gets
+        "404 Not Found".
+
+        :param snapshots: The snapshots to serve
+        :type snapshots: Snapshots or SnapshotJournal
+        :param address: The address to listen on; see :func:`parse_address`.
+            A Unix-domain socket can only be used by the owner, and a TCP
+            address must be on a loopback host.
+        :type address: str
+        """
+
+        self.snapshots = snapshots
+        self.address = address
+        self.logger = logging.getLogger(__name__)
+        # ETags include an id unique to this server so a restarted server
+        # does not match stale ETags
+        self.instance = uuid.uuid4().hex[:12]
+        self.httpd = None
+        self.thread = None
+
+    def start(self):
+        """Start serving requests in a background thread
+
+        :raises ValueError: if the address is a TCP address whose host is not
+            a loopback host
+        """
+
+        if self.httpd is not None:
+            return
+        (family, address) = parse_address(self.address, loopback_only=True)
+        if family == socket.AF_UNIX:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.httpd = _UnixHTTPServer(address, _SnapshotRequestHandler)
+            os.chmod(address, 0o600)
+        else:
+            self.httpd = ThreadingHTTPServer(address, _SnapshotRequestHandler)
+            # report the actual port if port 0 was requested
+            self.address = address[0] + ':' + \
+                str(self.httpd.server_address[1])
+        self.httpd.daemon_threads = True
+        self.httpd.snapshot_server = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='snapshotserver', daemon=True)
+        self.thread.start()
+        self.logger.info("Serving snapshots on " + self.address)
+
+    def stop(self):
+        """Stop serving requests"""
+
+        if self.httpd is None:
+            return
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+        (family, address) = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            try:
+                os.unlink(address)
+            except FileNotFoundError:
+                pass
+        self.httpd = None
+        self.thread = None
+
+    def make_etag(self, version):
+        return '"' + self.instance + '-' + str(version) + '"'
+
+    def parse_etag(self, etag):
+        if not etag:
+            return None
+        (instance, sep, version) = etag.strip().strip('"').partition('-')
+        if (instance != self.instance) or not version.isdigit():
+            return None
+        return int(version)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    pass
+
+
+class _SnapshotRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server.snapshot_server
+        url = urlsplit(self.path)
+        path = url.path.rstrip('/')
+        if path == '/snapshots':
+            key = None
+        elif path.startswith('/snapshots/'):
+            key = unquote(path[len('/snapshots/'):])
+        else:
+            self._respond(404)
+            return
+        try:
+            params = parse_qs(url.query)
+            max_wait = min(float(params.get('wait', ['0'])[0]), MAX_WAIT)
+        except ValueError:
+            self._respond(400)
+            return
+        version = server.parse_etag(self.headers.get('If-None-Match', None))
+        (jdata, curr_version) = server.snapshots.get_image(key, max_wait,
+                                                            version)
+        if curr_version is None:
+            self._respond(404)
+        elif jdata is None:
+            self._respond(304, server.make_etag(curr_version))
+        else:
+            self._respond(200, server.make_etag(curr_version), jdata)
+
+    def _respond(self, code, etag=None, jdata=None):
+        body = jdata.encode('utf-8') if jdata is not None else b''
+        self.send_response(code)
+        if etag:
+            self.send_header('ETag', etag)
+        if jdata is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # client_address is not a (host, port) pair for Unix sockets
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(self.address_string() + " " +
+                                          (format % args))
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class SnapshotClient(object):
+    def __init__(self, address, timeout=30):
+        """Read snapshots from a :class:`SnapshotServer`
+
+        A SnapshotClient has the same interface as a
+        :class:`~snapshot.Snapshots` object in 'r' mode.
+
+        :param address: The server address; see :func:`parse_address`
+        :type address: str
+        :param timeout: Socket timeout in seconds, in addition to any time
+            spent waiting for updates
+        :type timeout: float
+        """
+
+        (self.family, self.address) = parse_address(address,
+                                                     loopback_only=True)
+        self.timeout = timeout
+        self.conn = None
+        self.list_etag = None
+        self.list_cache = None
+
+    def mode(self):
+        """Return the mode (always 'r')"""
+
+        return 'r'
+
+    def close(self):
+        """Close the connection to the server"""
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def list(self):
+        """Return all snapshots
+
+        :return: A list of unserialized data objects
+        """
+
+        (status, etag, data) = self._get('/snapshots')
+        return data
+
+    def list_when_updated(self, max_wait=0):
+        """Return all snapshots when something is updated or after max_wait sec
+
+        :param max_wait: The maximum seconds to wait; if nothing is updated in
+            this number of seconds, all snapshots are returned (default=0)
+        :type max_wait: int
+        :return: A list of unserialized data objects
+        """
+
+        if self.list_etag is None:
+            max_wait = 0
+        (status, etag, data) = self._get('/snapshots', max_wait,
+                                         self.list_etag)
+        if status == 200:
+            self.list_etag = etag
+            self.list_cache = data
+        return self.list_cache
+
+    def get(self, key):
+        """Get the snapshot data for the given key
+
+        :param key: The target key
+        :type key: str
+        :return: The unserialized data object from the snapshot
+        """
+
+        (status, etag, data) = self._get('/snapshots/' + quote(key, safe=''))
+        return data
+
+    def get_when_updated(self, key, max_wait=0, token=None):
+        """Get the snapshot data for the given key when it is updated
+
+        :param key: The target key
+        :type key: str
+        :param max_wait: The maximum seconds to wait
+        :type max_wait: int
+        :param token: A token used to track when the key has changed; if None,
+            the function returns immediately
+        :type token: str
+        :return: A (data, token) pair; the token is None if the key does not
+            exist, and data is None if the operation times out
+        """
+
+        path = '/snapshots/' + quote(key, safe='')
+        (status, etag, data) = self._get(path, max_wait if token else 0, token)
+        if status == 404:
+            return (None, None)
+        if status == 304:
+            return (None, token)
+        return (data, etag)
+
+    def _get(self, path, max_wait=0, etag=None):
+        # Return (status, etag, data); data is None unless status is 200
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if max_wait > 0:
+            path += '?wait=' + str(max_wait)
+        for attempt in (1, 2):
+            conn = self._connect(max_wait)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # the server may have closed an idle connection
+                self.conn = None
+                conn.close()
+                if attempt == 2:
+                    raise
+        status = response.status
+        data = json.loads(body) if status == 200 else None
+        if status not in (200, 304, 404):
+            raise http.client.HTTPException("snapshot server returned " +
+                                            str(status) + " for " + path)
+        return (status, response.getheader('ETag', None), data)
+
+    def _connect(self, max_wait):
+        timeout = self.timeout + max_wait
+        if self.conn is None:
+            if self.family == socket.AF_UNIX:
+                self.conn = _UnixHTTPConnection(self.address, timeout)
+            else:
+                self.conn = http.client.HTTPConnection(*self.address,
+                                                       timeout=timeout)
+        else:
+            self.conn.timeout = timeout
+            if self.conn.sock is not None:
+                self.conn.sock.settimeout(timeout)
+        return self.conn
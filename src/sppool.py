@@ -0,0 +1,348 @@
+import os
+import pickle
+import socket
+import struct
+import logging
+import tempfile
+import importlib
+import threading
+import multiprocessing
+from pathlib import Path
+from spexception import (ServiceProviderError, ServiceProviderTemporaryError)
+from sprecorder import SP_METHODS
+import metrics
+import deadline
+
+#: Frame header: the length of the pickled payload that follows
+FRAME_HEADER = struct.Struct('!I')
+
+#: Default seconds to wait for a call's result (plus the "wait" argument of
+#: get_tasks()) before the worker is restarted
+DEFAULT_TIMEOUT = 300
+
+#: Seconds to wait for a new worker to load the plugin and report ready
+START_TIMEOUT = 120
+
+SP_POOL_IN_FLIGHT = metrics.gauge(
+    'amie_sp_pool_in_flight',
+    'Service provider calls sent to pool workers and not yet answered')
+SP_POOL_RESTARTS = metrics.counter(
+    'amie_sp_pool_restarts_total',
+    'Service provider pool workers restarted after a timeout or crash',
+    ('reason',))
+
+def send_frame(sock, obj):
+    """Send a pickled object as a length-prefixed frame"""
+
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+def recv_frame(sock):
+    """Receive an object sent by :func:`send_frame`
+
+    :raises EOFError: if the connection was closed
+    """
+
+    (length,) = FRAME_HEADER.unpack(_recv_exactly(sock, FRAME_HEADER.size))
+    return pickle.loads(_recv_exactly(sock, length))
+
+def _recv_exactly(sock, n):
+    chunks = list()
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise EOFError("connection closed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+def _portable_error(err):
+    # Errors are re-raised in the mediator, so they must survive pickling;
+    # others are reported as a ServiceProviderError
+    try:
+        pickle.loads(pickle.dumps(err))
+        return err
+    except Exception:
+        return ServiceProviderError(err.__class__.__name__ + ": " + str(err))
+
+def _worker_main(path, config):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        localsite = importlib.import_module(config['module'],
+                                            config['package'])
+        implem = localsite.ServiceProvider()
+        implem.apply_config(config)
+        send_frame(sock, (0, True, None))
+    except Exception as err:
+        send_frame(sock, (0, False, _portable_error(err)))
+        sock.close()
+        return
+    while True:
+        try:
+            (call_id, name, args, kwargs) = recv_frame(sock)
+        except EOFError:
+            break
+        try:
+            reply = (call_id, True, getattr(implem, name)(*args, **kwargs))
+        except Exception as err:
+            reply = (call_id, False, _portable_error(err))
+        try:
+            send_frame(sock, reply)
+        except (pickle.PicklingError, TypeError, AttributeError) as err:
+            send_frame(sock, (call_id, False, _portable_error(err)))
+    sock.close()
+
+
+class PendingCall(object):
+    def __init__(self, name):
+        """The eventual result of a call sent to a pool worker"""
+
+        self.name = name
+        self.event = threading.Event()
+        self.ok = None
+        self.value = None
+
+    def set(self, ok, value):
+        self.ok = ok
+        self.value = value
+        self.event.set()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish, and return its result
+
+        :param timeout: Seconds to wait; None means wait forever
+        :type timeout: float, optional
+        :return: The result, or None if the call timed out
+        :raises Exception: whatever the call raised in the worker
+        """
+
+        if not self.event.wait(timeout):
+            return None
+        if not self.ok:
+            raise self.value
+        return self.value
+
+
+class _PoolWorker(object):
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.lock = threading.Lock()
+        self.pending = dict()
+        self.next_id = 1
+        self.process = None
+        self.sock = None
+
+    def start(self):
+        with self.pool.start_lock:
+            self._start()
+
+    def _start(self):
+        pool = self.pool
+        self.process = pool.context.Process(
+            target=_worker_main, name='amie-sp' + str(self.index),
+            args=(pool.socket_path, pool.config), daemon=True)
+        self.process.start()
+        pool.listener.settimeout(START_TIMEOUT)
+        try:
+            (sock, addr) = pool.listener.accept()
+            sock.settimeout(START_TIMEOUT)
+            (call_id, ok, value) = recv_frame(sock)
+        except (OSError, EOFError) as err:
+            self.process.kill()
+            raise ServiceProviderError("SP pool worker " + str(self.index) +
+                                       " did not start: " + str(err))
+        if not ok:
+            sock.close()
+            raise value
+        sock.settimeout(None)
+        self.sock = sock
+        threading.Thread(target=self._read_replies, args=(sock,),
+                         name='sp-pool-reader' + str(self.index),
+                         daemon=True).start()
+
+    def submit(self, name, args, kwargs) -> PendingCall:
+        call = PendingCall(name)
+        with self.lock:
+            if self.sock is None:
+                self.start()
+            call_id = self.next_id
+            self.next_id += 1
+            self.pending[call_id] = call
+            SP_POOL_IN_FLIGHT.inc()
+            try:
+                send_frame(self.sock, (call_id, name, args, kwargs))
+            except OSError as err:
+                self._stop_locked("send failed: " + str(err))
+                raise ServiceProviderTemporaryError(
+                    "SP pool worker " + str(self.index) + ": " + str(err))
+        return call
+
+    def load(self) -> int:
+        return len(self.pending)
+
+    def restart(self, reason):
+        """Kill the worker and fail its pending calls; a new worker is started
+        by the next call"""
+
+        with self.lock:
+            self._stop_locked(reason)
+        SP_POOL_RESTARTS.inc(reason=reason.split(':')[0])
+
+    def stop(self):
+        with self.lock:
+            self._stop_locked("pool closed")
+
+    def _stop_locked(self, reason):
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+            self.process = None
+        self._fail_pending(reason)
+
+    def _fail_pending(self, reason):
+        pending = self.pending
+        self.pending = dict()
+        for call in pending.values():
+            call.set(False, ServiceProviderTemporaryError(
+                "SP pool worker " + str(self.index) + ": " + reason))
+            SP_POOL_IN_FLIGHT.inc(-1)
+
+    def _read_replies(self, sock):
+        while True:
+            try:
+                (call_id, ok, value) = recv_frame(sock)
+            except (EOFError, OSError, pickle.UnpicklingError):
+                break
+            call = self.pending.pop(call_id, None)
+            if call is not None:
+                call.set(ok, value)
+                SP_POOL_IN_FLIGHT.inc(-1)
+        with self.lock:
+            if self.sock is sock:
+                self.pool.logger.warning("SP pool worker " +
+                                         str(self.index) + " exited")
+                self._stop_locked("worker exited")
+                SP_POOL_RESTARTS.inc(reason="worker exited")
+
+
+class ServiceProviderPool(object):
+    def __init__(self, config, size, timeout=DEFAULT_TIMEOUT,
+                 start_method=None):
+        """Run the local site ServiceProvider in a pool of worker processes
+
+        A ``ServiceProviderPool`` stands in for the local site implementation
+        behind the :class:`~serviceprovider.ServiceProvider` facade. Each
+        worker process imports the plugin and applies the ``[localsite]``
+        configuration itself, then serves calls over a Unix socket: every
+        request and reply is a length-prefixed pickle frame, and a caller
+        does not wait for earlier calls to finish before sending the next,
+        so calls from several threads are pipelined to the least busy worker
+        and run in parallel.
+
+        Exceptions raised by the plugin are re-raised in the caller, so
+        :class:`~serviceprovider.SPSession` still tells temporary errors from
+        permanent ones. A call that takes longer than ``timeout`` seconds
+        (plus its ``wait`` argument, for get_tasks()) fails with
+        ServiceProviderTemporaryError, and its worker, which may be stuck, is
+        killed; a worker that dies also fails its calls that way. Workers are
+        replaced on the next call.
+
+        :param config: The ``[localsite]`` configuration
+        :type config: dict
+        :param size: Number of worker processes
+        :type size: int
+        :param timeout: Seconds to wait for a call
+        :type timeout: float
+        :param start_method: multiprocessing start method; default is the
+            platform default
+        :type start_method: str, optional
+        """
+
+        self.logger = logging.getLogger("sp")
+        self.config = config
+        self.timeout = float(timeout)
+        self.context = multiprocessing.get_context(start_method)
+        self.socket_dir = tempfile.TemporaryDirectory(prefix='amie-sp-')
+        self.socket_path = str(Path(self.socket_dir.name, 'sp.sock'))
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        self.listener.listen(int(size))
+        self.start_lock = threading.Lock()
+        self.workers = [_PoolWorker(self, i) for i in range(int(size))]
+        for worker in self.workers:
+            worker.start()
+
+    def __getattr__(self, name):
+        if name not in SP_METHODS:
+            raise AttributeError(name)
+        pool = self
+
+        def call(*args, **kwargs):
+            return pool.call(name, args, kwargs)
+        call.__name__ = name
+        return call
+
+    def submit(self, name, args=(), kwargs=None) -> PendingCall:
+        """Send a call to the least busy worker without waiting for it
+
+        :param name: A ServiceProviderIF method name
+        :type name: str
+        :param args: Positional arguments
+        :type args: tuple
+        :param kwargs: Keyword arguments
+        :type kwargs: dict
+        :return: PendingCall
+        """
+
+        worker = min(self.workers, key=_PoolWorker.load)
+        call = worker.submit(name, tuple(args), kwargs or {})
+        call.worker = worker
+        return call
+
+    def call(self, name, args=(), kwargs=None):
+        """Call a ServiceProviderIF method in a worker, and wait for it
+
+        A call still running at the caller's deadline (see :mod:`deadline`)
+        is abandoned: its worker is left to finish it, and the result is
+        discarded.
+
+        :raises ServiceProviderTemporaryError: if the call timed out or the
+            worker died
+        :raises DeadlineExceeded: if the caller's deadline passed first
+        """
+
+        kwargs = kwargs or {}
+        deadline.check("SP pool " + name)
+        call = self.submit(name, args, kwargs)
+        timeout = self.timeout
+        if name == 'get_tasks' and kwargs.get('wait', None):
+            timeout += float(kwargs['wait'])
+        left = deadline.remaining()
+        if left is not None and left < timeout:
+            if not call.event.wait(max(left, 0)):
+                raise deadline.exceeded("SP pool " + name)
+        elif not call.event.wait(timeout):
+            self.logger.warning("SP pool call " + name + " timed out after " +
+                                str(timeout) + " secs; restarting worker " +
+                                str(call.worker.index))
+            call.worker.restart("timeout: " + name)
+        return call.result()
+
+    def close(self):
+        """Stop all workers"""
+
+        for worker in self.workers:
+            worker.stop()
+        self.listener.close()
+        self.socket_dir.cleanup()
@@ -0,0 +1,165 @@
+import gzip
+import json
+import time
+import threading
+from serviceprovider import ServiceProviderIF
+
+#: Version of the recording format; written in the first record
+RECORD_VERSION = 1
+
+#: Names of the ServiceProviderIF methods that are recorded; iter_tasks() is
+#: recorded as get_tasks() (see :meth:`RecordingServiceProvider.iter_tasks`)
+SP_METHODS = frozenset(ServiceProviderIF.__abstractmethods__) - \
+    {'apply_config'}
+
+#: Arguments that differ between runs; they are ignored when matching calls
+VOLATILE_KEYS = frozenset(['timestamp', 'job_id'])
+
+def open_recording(path, mode):
+    """Open a recording file; files with names ending in ".gz" are compressed
+
+    :param path: The file name
+    :type path: str
+    :param mode: 'r', 'w', or 'a'
+    :type mode: str
+    :return: A text file object
+    """
+
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+def recorded_args(args):
+    """Return the positional arguments of a call that are recorded
+
+    The facade passes whole ActionablePackets (dicts) as positional
+    arguments to some methods, along with the validated keyword arguments;
+    those are not recorded.
+
+    :param args: Positional arguments
+    :type args: tuple
+    :return: list
+    """
+
+    return [arg for arg in args if not isinstance(arg, dict)]
+
+def call_key(method_name, args, kwargs):
+    """Return a key for matching a call with a recorded call
+
+    :param method_name: The method name
+    :type method_name: str
+    :param args: The recorded positional arguments (see :func:`recorded_args`)
+    :type args: list
+    :param kwargs: Keyword arguments
+    :type kwargs: dict
+    :return: str
+    """
+
+    kwargs = {key: value for (key, value) in kwargs.items()
+              if key not in VOLATILE_KEYS}
+    return method_name + json.dumps([args, kwargs], sort_keys=True,
+                                    default=str)
+
+def encode_result(result):
+    """Return a (type name, JSON-compatible value) pair for a result
+
+    :param result: A ServiceProviderIF method result
+    :type result: TaskStatus, AMIEOrg, AMIEPerson, str, list, or None
+    """
+
+    if result is None:
+        return (None, None)
+    if isinstance(result, list):
+        return ('list', [encode_result(item) for item in result])
+    if isinstance(result, dict):
+        return (result.__class__.__name__, dict(result))
+    return (result.__class__.__name__, str(result))
+
+
+class RecordingServiceProvider(object):
+    def __init__(self, implem, path):
+        """Record the calls made to a ServiceProvider implementation
+
+        A RecordingServiceProvider stands between the
+        :class:`~serviceprovider.ServiceProvider` facade and the local site
+        implementation, so it sees the validated arguments of each call. Every
+        call of a :class:`~serviceprovider.ServiceProviderIF` method is
+        written to a JSON Lines file (compressed if the name ends in ".gz"),
+        one compact record per call::
+
+            m   : the method name
+            a   : positional arguments, except ActionablePackets
+            k   : keyword arguments
+            r   : the result: a [type name, value] pair; see
+                  :func:`encode_result`
+            e   : if the call raised an exception, its class name
+            t   : seconds from the start of the recording to the call
+            d   : seconds the call took
+
+        The first record is a header, ``{"v": RECORD_VERSION}``. Recordings
+        are served back by :class:`spreplay.ServiceProvider`.
+
+        :param implem: The local site implementation
+        :type implem: ServiceProviderIF
+        :param path: The recording file; it is overwritten
+        :type path: str
+        """
+
+        self._implem = implem
+        self._path = path
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._file = open_recording(path, 'w')
+        self._write({'v': RECORD_VERSION, 'start': self._start})
+
+    def __getattr__(self, name):
+        attr = getattr(self._implem, name)
+        if name not in SP_METHODS:
+            return attr
+        recorder = self
+
+        def call(*args, **kwargs):
+            record = {'m': name, 'a': recorded_args(args), 'k': kwargs}
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+                record['r'] = encode_result(result)
+                return result
+            except Exception as err:
+                record['e'] = err.__class__.__name__
+                raise
+            finally:
+                end = time.time()
+                record['t'] = round(start - recorder._start, 6)
+                record['d'] = round(end - start, 6)
+                recorder._write(record)
+        call.__name__ = name
+        return call
+
+    def iter_tasks(self, active=True, wait=None, since=None,
+                   page_size=None):
+        """Iterate over the tasks of a recorded get_tasks() call
+
+        :meth:`~serviceprovider.ServiceProviderIF.iter_tasks` is not one of
+        :data:`SP_METHODS`, and a stream the mediator stops reading part way
+        through could not be recorded completely, so while recording, task
+        streams are read with one get_tasks() call instead. That call is
+        recorded and timed like any other, and
+        :class:`spreplay.ServiceProvider` serves it back. ``page_size`` is
+        ignored.
+        """
+
+        yield from self.get_tasks(active=active, wait=wait, since=since)
+
+    def close(self):
+        """Close the recording file"""
+
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def _write(self, record):
+        line = json.dumps(record, separators=(',', ':'), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
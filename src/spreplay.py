@@ -0,0 +1,319 @@
+import json
+import time
+from collections import deque
+import spexception
+from spexception import ServiceProviderError
+from serviceprovider import ServiceProviderIF
+from miscfuncs import truthy
+from misctypes import TimeUtil
+from taskstatus import TaskStatus
+from organization import AMIEOrg
+from person import AMIEPerson
+from sprecorder import (RECORD_VERSION, open_recording, recorded_args,
+                        call_key)
+
+#: Task attributes taken from the arguments of a replayed call
+TASK_ID_KEYS = ('amie_transaction_id', 'amie_packet_id', 'amie_packet_type',
+                'job_id', 'task_name')
+
+#: Classes of recorded results, by type name
+RESULT_CLASSES = {
+    'TaskStatus': TaskStatus,
+    'AMIEOrg': AMIEOrg,
+    'AMIEPerson': AMIEPerson,
+}
+
+def decode_result(encoded):
+    """Rebuild a result encoded by :func:`sprecorder.encode_result`
+
+    :param encoded: A (type name, value) pair
+    :type encoded: list
+    """
+
+    (type_name, value) = encoded
+    if type_name is None:
+        return None
+    if type_name == 'list':
+        return [decode_result(item) for item in value]
+    cls = RESULT_CLASSES.get(type_name, None)
+    if cls is not None:
+        return cls(value)
+    return value
+
+
+class ServiceProvider(ServiceProviderIF):
+    def __init__(self):
+        """A ServiceProvider that replays a recording
+
+        This serves back the results of a recording made by
+        :class:`sprecorder.RecordingServiceProvider` (see the
+        ``sp_record_file`` configuration parameter), so the mediator can be
+        run repeatably without the local site's back end. Each call is
+        matched with a recorded call of the same method with the same
+        arguments, and recorded calls are used in order. If there is no
+        match, the next unused recorded call of the same method is used
+        (unless ``strict`` is set) and the mismatch is counted in
+        ``mismatches``. Recorded exceptions are raised again.
+
+        Every call takes its recorded time multiplied by ``latency_scale``.
+        Tasks evolve on the same schedule: a task state that was reported
+        N seconds after the task was submitted in the recording is reported
+        N * ``latency_scale`` seconds after it is submitted in the replay.
+        Tasks that existed before the recording started are reported
+        relative to the start of the replay.
+
+        To use it, set the following in the "localsite" configuration:
+
+            module         : spreplay
+            replay_file    : the recording
+            latency_scale  : multiplier for recorded latencies (default 1;
+                             0 means no delays at all)
+            strict         : if true, calls that do not match the recording
+                             raise a ServiceProviderError (default false)
+        """
+
+        self.calls = dict()
+        self.method_calls = dict()
+        self.get_tasks_calls = deque()
+        self.timelines = dict()
+        self.preexisting = set()
+        self.submitted = dict()
+        self.cleared = set()
+        self.mismatches = 0
+        self.start_time = None
+        self.latency_scale = 1.0
+        self.strict = False
+        self.timeutil = TimeUtil()
+
+    def apply_config(self, config):
+        replay_file = config.get('replay_file', None)
+        if not replay_file:
+            raise ServiceProviderError("replay_file is not configured")
+        self.latency_scale = float(config.get('latency_scale', 1))
+        self.strict = truthy(config.get('strict', False))
+        self.timeutil = config.get('timeutil', None) or TimeUtil()
+        self.load(replay_file)
+
+    def load(self, path):
+        """Load a recording
+
+        :param path: The recording file
+        :type path: str
+        :raises ServiceProviderError: if the file is not a valid recording
+        """
+
+        with open_recording(path, 'r') as f:
+            header = json.loads(f.readline() or '{}')
+            if header.get('v', None) != RECORD_VERSION:
+                raise ServiceProviderError(path + ": not a recording")
+            for line in f:
+                if line.strip():
+                    self._add_record(json.loads(line))
+        for timeline in self.timelines.values():
+            timeline.sort(key=lambda entry: entry[0])
+
+    def _add_record(self, record):
+        method_name = record['m']
+        record['used'] = False
+        if method_name == 'get_tasks':
+            self.get_tasks_calls.append(record)
+            if 'r' in record:
+                for item in record['r'][1] or []:
+                    self._add_task_state(record, item, True)
+            return
+        key = call_key(method_name, record['a'], record['k'])
+        self.calls.setdefault(key, deque()).append(record)
+        self.method_calls.setdefault(method_name, deque()).append(record)
+        if 'r' in record and record['r'][0] == 'TaskStatus':
+            self._add_task_state(record, record['r'], False)
+
+    def _add_task_state(self, record, encoded, from_get_tasks):
+        task_key = _task_key(encoded[1])
+        timeline = self.timelines.get(task_key, None)
+        if timeline is None:
+            timeline = self.timelines[task_key] = list()
+            if from_get_tasks:
+                self.preexisting.add(task_key)
+        timeline.append((record['t'] + record['d'], encoded))
+
+    def _now(self):
+        return self.timeutil.now().timestamp()
+
+    def _delay(self, secs):
+        if secs > 0:
+            time.sleep(secs)
+
+    def _next_record(self, method_name, args, kwargs):
+        key = call_key(method_name, recorded_args(args), kwargs)
+        for record in self.calls.get(key, ()):
+            if not record['used']:
+                record['used'] = True
+                return record
+        if self.strict:
+            raise ServiceProviderError("no recorded call matches " + key)
+        # prefer a call for the same transaction
+        atrid = kwargs.get('amie_transaction_id', None)
+        candidates = [record for record in
+                      self.method_calls.get(method_name, ())
+                      if not record['used']]
+        for record in candidates:
+            if record['k'].get('amie_transaction_id', None) == atrid:
+                break
+        else:
+            record = candidates[0] if candidates else None
+        if record is None:
+            raise ServiceProviderError("no more recorded " + method_name +
+                                       " calls")
+        record['used'] = True
+        self.mismatches += 1
+        return record
+
+    def _replay(self, method_name, args, kwargs):
+        if self.start_time is None:
+            self.start_time = self._now()
+        record = self._next_record(method_name, args, kwargs)
+        self._delay(record['d'] * self.latency_scale)
+        if 'e' in record:
+            exc_class = getattr(spexception, record['e'], ServiceProviderError)
+            raise exc_class("replayed " + record['e'])
+        result = decode_result(record['r'])
+        if isinstance(result, TaskStatus):
+            # Job IDs are assigned by the mediator and may differ from the
+            # recording, and the task of a mismatched call belongs to
+            # another transaction; report the task as the caller's
+            recorded_key = _task_key(result)
+            overrides = {key: kwargs[key] for key in TASK_ID_KEYS
+                         if key in kwargs}
+            result.update(overrides)
+            task_key = _task_key(result)
+            self.cleared.discard(task_key)
+            if task_key not in self.submitted:
+                self.submitted[task_key] = (self._now(),
+                                            record['t'] + record['d'],
+                                            recorded_key, overrides)
+        return result
+
+    def get_local_task_name(self, method_name, kwargs) -> str:
+        return self._replay('get_local_task_name', (method_name, kwargs), {})
+
+    def get_tasks(self, active=True, wait=None, since=None) -> list:
+        if self.start_time is None:
+            self.start_time = self._now()
+        if self.get_tasks_calls:
+            record = self.get_tasks_calls.popleft()
+            delay = record['d'] * self.latency_scale
+            if wait is not None:
+                delay = min(delay, float(wait))
+            self._delay(delay)
+            if 'e' in record:
+                exc_class = getattr(spexception, record['e'],
+                                    ServiceProviderError)
+                raise exc_class("replayed " + record['e'])
+        now = self._now()
+        result = list()
+        tasks = dict((task_key, (self.start_time, 0.0, task_key, {}))
+                     for task_key in self.preexisting)
+        tasks.update(self.submitted)
+        for (task_key, task) in tasks.items():
+            if task_key in self.cleared:
+                continue
+            (replay_time, base, recorded_key, overrides) = task
+            state = None
+            for (offset, encoded) in self.timelines[recorded_key]:
+                when = replay_time + \
+                    max(0.0, offset - base) * self.latency_scale
+                if when > now:
+                    break
+                state = (when, encoded)
+            if state is None:
+                continue
+            ts = decode_result(state[1])
+            ts.update(overrides)
+            ts['timestamp'] = int(state[0] * 1000)
+            if since is not None and ts['timestamp'] <= int(since):
+                continue
+            if active and ts['task_state'] == 'cleared':
+                continue
+            result.append(ts)
+        return result
+
+    def clear_transaction(self, amie_transaction_id):
+        self._replay('clear_transaction', (amie_transaction_id,), {})
+        atrid = str(amie_transaction_id)
+        for task_key in self.preexisting.union(self.submitted):
+            if task_key[0] == atrid:
+                self.cleared.add(task_key)
+
+    def lookup_org(self, *args, **kwargs) -> AMIEOrg:
+        return self._replay('lookup_org', args, kwargs)
+
+    def choose_or_add_org(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('choose_or_add_org', args, kwargs)
+
+    def lookup_person(self, *args, **kwargs) -> AMIEPerson:
+        return self._replay('lookup_person', args, kwargs)
+
+    def choose_or_add_person(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('choose_or_add_person', args, kwargs)
+
+    def update_person_DNs(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('update_person_DNs', args, kwargs)
+
+    def activate_person(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('activate_person', args, kwargs)
+
+    def lookup_project_by_grant_number(self, *args, **kwargs) -> str:
+        return self._replay('lookup_project_by_grant_number', args, kwargs)
+
+    def lookup_local_fos(self, *args, **kwargs) -> str:
+        return self._replay('lookup_local_fos', args, kwargs)
+
+    def choose_or_add_local_fos(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('choose_or_add_local_fos', args, kwargs)
+
+    def choose_or_add_contract_number(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('choose_or_add_contract_number', args, kwargs)
+
+    def lookup_project_name_base(self, *args, **kwargs) -> str:
+        return self._replay('lookup_project_name_base', args, kwargs)
+
+    def choose_or_add_project_name_base(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('choose_or_add_project_name_base', args, kwargs)
+
+    def create_project(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('create_project', args, kwargs)
+
+    def lookup_project_task(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('lookup_project_task', args, kwargs)
+
+    def inactivate_project(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('inactivate_project', args, kwargs)
+
+    def reactivate_project(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('reactivate_project', args, kwargs)
+
+    def create_account(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('create_account', args, kwargs)
+
+    def inactivate_account(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('inactivate_account', args, kwargs)
+
+    def reactivate_account(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('reactivate_account', args, kwargs)
+
+    def update_allocation(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('update_allocation', args, kwargs)
+
+    def modify_user(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('modify_user', args, kwargs)
+
+    def merge_person(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('merge_person', args, kwargs)
+
+    def notify_user(self, *args, **kwargs) -> TaskStatus:
+        return self._replay('notify_user', args, kwargs)
+
+
+def _task_key(ts):
+    return (str(ts['amie_transaction_id']), str(ts['amie_packet_id']),
+            str(ts['task_name']))
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from filewait import DirectoryWatcher
+from taskstatus import TaskStatus
+import metrics
+
+#: Suffix of task update files that are ready to be read
+SUFFIX = '.json'
+
+#: Subdirectory of the drop directory for files that could not be read
+REJECTED_DIR = '.rejected'
+
+#: How often (secs) the watcher thread checks whether it should stop
+WATCH_SECS = 1
+
+PUSHED_TASKS = metrics.counter(
+    'amie_pushed_task_files_total',
+    'Files read from the task push directory, by result (accepted or '
+    'rejected)',
+    ('result',))
+
+def post_task_updates(drop_dir, tasks) -> str:
+    """Post task updates to a drop directory
+
+    This can be called by a ServiceProvider implementation, or by any
+    process that can write to the directory. The file is written under a
+    hidden name and then renamed, so it is never read half-written.
+
+    :param drop_dir: The drop directory (the ``task_push_dir`` parameter)
+    :type drop_dir: str
+    :param tasks: Task updates
+    :type tasks: TaskStatus, dict, or list of TaskStatus or dict
+    :return: The path of the new file
+    """
+
+    if isinstance(tasks, dict):
+        tasks = [tasks]
+    name = str(time.time_ns()) + '-' + str(os.getpid()) + '-' + \
+        str(threading.get_ident())
+    tmp_path = Path(drop_dir, '.' + name)
+    path = Path(drop_dir, name + SUFFIX)
+    with open(tmp_path, 'w') as fp:
+        json.dump([dict(task) for task in tasks], fp)
+    os.replace(tmp_path, path)
+    return str(path)
+
+
+class TaskDropDirectory(object):
+    def __init__(self, path, on_change=None):
+        """A directory where task updates are pushed to the mediator
+
+        Each file in the directory whose name ends in ".json" and does not
+        start with "." holds a JSON object with :class:`~taskstatus.TaskStatus`
+        keys, or a JSON list of such objects (see
+        :func:`post_task_updates`). Files are read in name order and deleted;
+        files that cannot be read are moved to the ".rejected" subdirectory.
+
+        :param path: The directory; it is created if necessary
+        :type path: str
+        :param on_change: Function called (with no arguments) from a
+            background thread when files arrive, once :meth:`start` is called
+        :type on_change: callable, optional
+        """
+
+        self.path = path
+        self.on_change = on_change
+        self.logger = logging.getLogger(__name__)
+        Path(path, REJECTED_DIR).mkdir(parents=True, exist_ok=True)
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        """Start watching the directory for new files"""
+
+        if self.thread is not None or self.on_change is None:
+            return
+        self.stopping = False
+        self.thread = threading.Thread(target=self._watch, name='taskpush',
+                                       daemon=True)
+        self.thread.start()
+        self.logger.info("Accepting task updates in " + self.path)
+
+    def stop(self):
+        """Stop watching the directory"""
+
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.thread.join()
+        self.thread = None
+
+    def _watch(self):
+        watcher = DirectoryWatcher.for_directory(self.path)
+        since = watcher.mark()
+        if self.pending():
+            self.on_change()
+        while not self.stopping:
+            if not watcher.wait(WATCH_SECS, since=since):
+                continue
+            # mark before notifying, so files that arrive after the reader
+            # has looked are seen by the next wait
+            since = watcher.mark()
+            if self.pending():
+                self.on_change()
+
+    def pending(self) -> bool:
+        """Return True if there are files waiting to be read"""
+
+        return len(self._list_files()) > 0
+
+    def _list_files(self) -> list:
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return sorted([name for name in names
+                       if name.endswith(SUFFIX) and not name.startswith('.')])
+
+    def take_updates(self) -> list:
+        """Read and delete all waiting files
+
+        :return: list of TaskStatus
+        """
+
+        tasks = list()
+        for name in self._list_files():
+            path = Path(self.path, name)
+            try:
+                with open(path, 'r') as fp:
+                    data = json.load(fp)
+                if isinstance(data, dict):
+                    data = [data]
+                tasks.extend([TaskStatus(task) for task in data])
+            except FileNotFoundError:
+                continue
+            except Exception as err:
+                self.logger.warning("Rejecting task update file " + name +
+                                    ": " + str(err))
+                os.replace(path, Path(self.path, REJECTED_DIR, name))
+                PUSHED_TASKS.inc(result='rejected')
+                continue
+            os.unlink(path)
+            PUSHED_TASKS.inc(result='accepted')
+        if tasks:
+            self.logger.debug("Got " + str(len(tasks)) +
+                              " pushed task updates")
+        return tasks
@@ -336,3 +336,30 @@ class TaskStatusList(Prettifiable):
         """Return lastest task timestamp"""
         return self.timestamp
             
+
+#: TaskStatus keys, in the order used by :func:`encode_task`
+TASK_FIELDS = ('amie_transaction_id', 'amie_packet_id', 'amie_packet_type',
+               'job_id', 'task_name', 'task_state', 'timestamp')
+
+def encode_task(task) -> list:
+    """Encode a TaskStatus as a compact list, for :func:`decode_task`
+
+    ``task`` can also be a plain dict with the TaskStatus keys. The keys in
+    :data:`TASK_FIELDS` are not repeated for every task; products are encoded
+    as [name, value] pairs.
+    """
+
+    data = [task[key] for key in TASK_FIELDS]
+    products = task.get('products', None)
+    if products:
+        data.append([[p['name'], p.get('value', None)] for p in products])
+    return data
+
+def decode_task(data) -> TaskStatus:
+    """Rebuild a TaskStatus encoded by :func:`encode_task`"""
+
+    parms = dict(zip(TASK_FIELDS, data))
+    if len(data) > len(TASK_FIELDS):
+        parms['products'] = [{'name': name, 'value': value}
+                             for (name, value) in data[len(TASK_FIELDS)]]
+    return TaskStatus(parms)
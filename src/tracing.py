@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import inspect
+import functools
+import threading
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    def __init__(self, tracer, name, category, args):
+        """A timed operation; use as a context manager
+
+        :param tracer: The tracer that will export the span
+        :type tracer: Tracer
+        :param name: The span name
+        :type name: str
+        :param category: The span category
+        :type category: str
+        :param args: Extra data to record with the span
+        :type args: dict
+        """
+
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.lane = None
+        self.start = None
+
+    def set(self, **args):
+        """Add data to record with the span"""
+
+        self.args.update(args)
+
+    def __enter__(self):
+        self.lane = self.tracer.current_lane()
+        self.start = _now_us()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.emit(self.name, self.category, self.start,
+                         _now_us() - self.start, self.lane, self.args)
+        return False
+
+
+class Tracer(object):
+    def __init__(self, exporter=None):
+        """Record spans for AMIE transactions and the calls made for them
+
+        Every AMIE transaction gets a "lane" (a thread ID in Chrome trace
+        terms) and a root span that lasts from when the transaction is first
+        seen until it is purged. Spans opened inside a :meth:`transaction`
+        context are placed in that transaction's lane, so they appear nested
+        under the root span even when work on the transaction is spread over
+        many loop iterations. Other spans are placed in lane 0.
+
+        If there is no exporter, tracing is disabled and spans cost almost
+        nothing.
+
+        :param exporter: Where to send finished spans
+        :type exporter: ChromeTraceExporter, MemoryExporter, or any object with
+            export(), flush(), and close() methods
+        """
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.exporter = None
+        self.configure(exporter)
+
+    def configure(self, exporter):
+        """Replace the exporter; if None, disable tracing
+
+        :param exporter: The new exporter
+        """
+
+        if self.exporter is not None:
+            self.exporter.close()
+        self.exporter = exporter
+        self.enabled = exporter is not None
+        self.lanes = dict()
+        self.next_lane = 1
+        self.transactions = dict()
+
+    def span(self, name, category='', **args):
+        """Return a context manager that records a span
+
+        :param name: The span name
+        :type name: str
+        :param category: The span category
+        :type category: str
+        :param args: Extra data to record with the span
+        :return: Span
+        """
+
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, category, args)
+
+    def transaction(self, atrid):
+        """Return a context manager that places spans in a transaction's lane
+
+        :param atrid: AMIE transaction ID
+        :type atrid: str
+        """
+
+        if not self.enabled:
+            return _NULL_SPAN
+        return _TransactionContext(self, self._get_lane(atrid))
+
+    def begin_transaction(self, atrid, **args):
+        """Start the root span for a transaction
+
+        :param atrid: AMIE transaction ID
+        :type atrid: str
+        :param args: Extra data to record with the root span
+        """
+
+        if not self.enabled:
+            return
+        self._get_lane(atrid)
+        with self.lock:
+            if atrid not in self.transactions:
+                self.transactions[atrid] = (_now_us(), args)
+
+    def annotate_transaction(self, atrid, **args):
+        """Add data to record with a transaction's root span"""
+
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.transactions.get(atrid, None)
+            if entry is not None:
+                entry[1].update(args)
+
+    def end_transaction(self, atrid):
+        """Finish and export the root span for a transaction
+
+        :param atrid: AMIE transaction ID
+        :type atrid: str
+        """
+
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.transactions.pop(atrid, None)
+            lane = self.lanes.pop(atrid, None)
+        if entry is not None:
+            (start, args) = entry
+            self.emit(atrid, 'transaction', start, _now_us() - start, lane,
+                      args)
+
+    def current_lane(self):
+        return getattr(self.local, 'lane', 0)
+
+    def emit(self, name, category, start, duration, lane, args):
+        """Export a finished span
+
+        :param name: The span name
+        :param category: The span category
+        :param start: Start time (microseconds since the epoch)
+        :param duration: Duration (microseconds)
+        :param lane: Lane number
+        :param args: Extra data
+        """
+
+        exporter = self.exporter
+        if exporter is None:
+            return
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': duration,
+            'pid': os.getpid(),
+            'tid': lane,
+        }
+        if args:
+            event['args'] = args
+        exporter.export(event)
+
+    def flush(self):
+        """Flush exported spans"""
+
+        if self.exporter is not None:
+            self.exporter.flush()
+
+    def _get_lane(self, atrid):
+        with self.lock:
+            lane = self.lanes.get(atrid, None)
+            if lane is not None:
+                return lane
+            lane = self.next_lane
+            self.next_lane += 1
+            self.lanes[atrid] = lane
+        # name the lane after the transaction
+        self.exporter.export({'name': 'thread_name', 'ph': 'M',
+                              'pid': os.getpid(), 'tid': lane,
+                              'args': {'name': atrid}})
+        return lane
+
+
+class _TransactionContext(object):
+    def __init__(self, tracer, lane):
+        self.tracer = tracer
+        self.lane = lane
+
+    def __enter__(self):
+        self.prev_lane = self.tracer.current_lane()
+        self.tracer.local.lane = self.lane
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.tracer.local.lane = self.prev_lane
+        return False
+
+
+class ChromeTraceExporter(object):
+    def __init__(self, path):
+        """Write spans to a file in the Chrome trace event (JSON array) format
+
+        The file can be loaded into chrome://tracing or https://ui.perfetto.dev.
+        Events are appended as they finish; the closing "]" is optional in
+        this format, so the file is usable while the mediator is running.
+
+        :param path: The file to write
+        :type path: str
+        """
+
+        self.lock = threading.Lock()
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+
+    def export(self, event):
+        line = json.dumps(event, separators=(',', ':'), default=str)
+        with self.lock:
+            self.file.write(line + ',\n')
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.write('{}]\n')
+            self.file.close()
+
+
+class MemoryExporter(object):
+    def __init__(self):
+        """Keep exported spans in a list (``events``)"""
+
+        self.events = list()
+
+    def export(self, event):
+        self.events.append(event)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+#: The tracer used by the mediator; disabled unless configured
+TRACER = Tracer()
+
+def configure(exporter):
+    """Set the exporter of :data:`TRACER`; if None, disable tracing"""
+
+    TRACER.configure(exporter)
+
+def span(name, category='', **args):
+    """Return a span from :data:`TRACER`; see :meth:`Tracer.span`"""
+
+    return TRACER.span(name, category, **args)
+
+def traced(name=None, category=''):
+    """Decorator that records a span for each call
+
+    :param name: The span name; default is the function's qualified name
+    :type name: str, optional
+    :param category: The span category
+    :type category: str
+    """
+
+    def decorator(func):
+        span_name = func.__qualname__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return func(*args, **kwargs)
+            with TRACER.span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def trace_methods(cls, category=''):
+    """Record a span for each call to a public method of a class
+
+    :param cls: The class whose methods will be wrapped, in place
+    :type cls: class
+    :param category: The span category
+    :type category: str
+    :return: The class
+    """
+
+    for (attr, value) in list(vars(cls).items()):
+        if attr.startswith('_') or not inspect.isfunction(value):
+            continue
+        setattr(cls, attr, traced(cls.__name__ + '.' + attr, category)(value))
+    return cls
+
+def _now_us():
+    return time.time_ns() // 1000
@@ -6,9 +6,11 @@ from amieclient import AMIEClient
 from amieclient.packet.base import Packet as AMIEPacket
 from misctypes import DateTime
 from amieparms import (get_packet_keys, parse_atrid)
-from taskstatus import (TaskStatus, TaskStatusList)
+from taskstatus import (TaskStatus, TaskStatusList, encode_task, decode_task)
 from loopdelay import (WaitParms, LoopDelay)
 from actionablepacket import ActionablePacket
+from intake import (packet_fingerprint, get_invalid_packet_error)
+import tracing
 
 class Transaction(object):
     def __init__(self, amie_wait_parms, atrid):
@@ -24,12 +26,17 @@ class Transaction(object):
 
         self.atrid = atrid
         self.amie_packet = None
+        self.amie_packet_fingerprint = None
         self.amie_packet_incoming = True
         self.actionable_packet = None
 
         # keys for actionable_packets and dangling_tasks are packet_ids
         self.dangling_tasks = dict()
 
+        # (packet_type, querytime) of the last accepted incoming packet, until
+        # a reply is sent
+        self.accept_info = None
+
     def transaction_id(self):
         return self.atrid
     
@@ -58,12 +65,13 @@ class Transaction(object):
             
         tslist.put(task_status)
         
-    def buffer_incoming_amie_packet(self, querytime, packet) \
-        -> (ActionablePacket, str):
+    def buffer_incoming_amie_packet(self, querytime, packet, validated=False,
+                                    err=None) -> (ActionablePacket, str):
         """Adjust transaction state for incoming AMIE packet and save it
 
-        If the packet has not been seen before, the packet is validated and
-        a new ActionablePacket is created. If validation fails, the
+        If the packet has not been seen before, the packet is validated (unless
+        the caller has done so already) and a new ActionablePacket is
+        created. If validation fails, the
         method returns (None, errmsg). If validation succeeds, the method
         returns (apacker, None).
 
@@ -78,22 +86,28 @@ class Transaction(object):
         :type querytime: datetime
         :param packet: Incoming packet
         :type packet: amieclient.packet.base.Packet
+        :param validated: If True, the packet has already been validated
+        :type validated: bool
+        :param err: If validated is True, the validation error or None
+        :type err: str or None
         :return: (ActionablePacket, None) or (None, None) or (None, errmsg)
         """
 
         actionable_packet = None
         calculate_new_target_time = False
         if self._is_amie_packet_new(packet):
-            err = self._get_invalid_packet_error(packet)
+            if not validated:
+                err = get_invalid_packet_error(packet)
             if err:
                 return (None, err)
             jid, atrid, pid = get_packet_keys(packet)
             ptype = packet.__class__._packet_type
-            self.amie_packet = packet
+            self._set_amie_packet(packet)
             tasks = self.dangling_tasks.get(pid, None)
             actionable_packet = ActionablePacket(packet, tasks)
             self.actionable_packet = actionable_packet
             self.amie_packet_incoming = True
+            self.accept_info = (ptype, querytime)
             calculate_new_target_time = True
         elif self.loop_delay.get_target_time() < querytime:
             calculate_new_target_time = True
@@ -102,6 +116,27 @@ class Transaction(object):
             self.loop_delay.calculate_target_time(querytime,
                                                   expect_human_action=True)
         return (actionable_packet, None)
+
+    def check_seen_amie_packet(self, querytime, packet) -> bool:
+        """Check whether an incoming AMIE packet is the current packet
+
+        If it is, the transaction state is adjusted as
+        :meth:`buffer_incoming_amie_packet` would adjust it for a packet seen
+        before, and True is returned.
+
+        :param querytime: Time AMIE server was queried for packets
+        :type querytime: datetime
+        :param packet: Incoming packet
+        :type packet: amieclient.packet.base.Packet
+        :return: True if the packet has been seen before
+        """
+
+        if self._is_amie_packet_new(packet):
+            return False
+        if self.loop_delay.get_target_time() < querytime:
+            self.loop_delay.calculate_target_time(querytime,
+                                                  expect_human_action=True)
+        return True
     
     def get_actionable_packet(self) -> ActionablePacket:
         """Return the current ActionablePacket for the transaction
@@ -123,7 +158,7 @@ class Transaction(object):
         if not self._is_amie_packet_new(packet):
             return
         jid, atrid, pid = get_packet_keys(packet)
-        self.amie_packet = packet
+        self._set_amie_packet(packet)
         self.actionable_packet = None
         self.amie_packet_incoming = False
 
@@ -173,28 +208,23 @@ class Transaction(object):
     def have_outgoing_packet(self):
         return not self.amie_packet_incoming
 
+    def take_accept_info(self):
+        """Return and clear information about the last accepted packet
+
+        :return: (packet_type, querytime) or None
+        """
+
+        accept_info = self.accept_info
+        self.accept_info = None
+        return accept_info
+
+    def _set_amie_packet(self, packet):
+        self.amie_packet = packet
+        self.amie_packet_fingerprint = packet_fingerprint(packet)
+
     def _is_amie_packet_new(self, packet) -> bool:
-        tpacket = self.amie_packet
-        if not tpacket or \
-           tpacket.originating_site_name != packet.originating_site_name or \
-           tpacket.local_site_name != packet.local_site_name or \
-           tpacket.remote_site_name != packet.remote_site_name or \
-           tpacket.transaction_id != packet.transaction_id or \
-           tpacket.packet_rec_id != packet.packet_rec_id or \
-           tpacket.__class__._packet_type != packet.__class__._packet_type:
-            return True
-        return False
-
-    def _get_invalid_packet_error(self, packet):
-        err = None
-        if packet.validate_data():
-            missing = packet.missing_attributes()
-            if missing:
-                err = "Required attributes are missing from incoming packet: " \
-                    + ",".join(missing)
-        else:
-            err = "packet.validate_data() failed for incoming packet"
-        return err
+        return self.amie_packet_fingerprint is None or \
+            self.amie_packet_fingerprint != packet_fingerprint(packet)
 
 
 class TransactionManager(object):
@@ -223,9 +253,19 @@ class TransactionManager(object):
         self.transactions = dict()
         self.actionable_packets = dict()
 
+        # Tasks streamed from the ServiceProvider for transactions that have
+        # no Transaction object yet, in compact form (see
+        # taskstatus.encode_task()); keys are AMIE transaction IDs, values
+        # map (packet_id, task_name) to the latest task
+        self.stashed_tasks = dict()
+
     def get_transaction_ids(self) -> set:
-        """Return all known transaction IDs as a set"""
-        return set(self.transactions.keys())
+        """Return all known transaction IDs as a set
+
+        This includes transactions that so far only have stashed tasks (see
+        :meth:`stream_task_updates`).
+        """
+        return set(self.transactions.keys()).union(self.stashed_tasks.keys())
     
     def add_or_update_task(self, task):
         """Buffer the given task with its associated transaction
@@ -249,6 +289,37 @@ class TransactionManager(object):
         for task in tasks:
             self.add_or_update_task(task)
 
+    def stream_task_updates(self, tasks) -> int:
+        """Buffer task updates from an iterable, with bounded memory
+
+        Tasks of known transactions are buffered as by
+        :meth:`buffer_task_updates`. Tasks of other transactions are stashed
+        in a compact form, keeping only the latest task for each packet and
+        task name, and are made into TaskStatus objects only when their
+        transaction becomes known (e.g. when its AMIE packet arrives). Tasks
+        may be TaskStatus objects or plain dicts with the same keys.
+
+        :param tasks: Task updates
+        :type tasks: iterable of TaskStatus or dict
+        :return: The number of tasks consumed
+        """
+
+        ntasks = 0
+        for task in tasks:
+            ntasks += 1
+            atrid = task['amie_transaction_id']
+            if atrid in self.transactions:
+                if not isinstance(task, TaskStatus):
+                    task = TaskStatus(task)
+                self.add_or_update_task(task)
+                continue
+            stash = self.stashed_tasks.setdefault(atrid, dict())
+            key = (task['amie_packet_id'], task['task_name'])
+            stashed = stash.get(key, None)
+            if stashed is None or stashed[6] <= task['timestamp']:
+                stash[key] = encode_task(task)
+        return ntasks
+
     def get_tasks(self, atrid, pid) -> TaskStatusList:
         """Get all tasks associated with a Packet
 
@@ -262,7 +333,32 @@ class TransactionManager(object):
         transaction = self._get_transaction_by_id(atrid)
         return transaction.get_tasks(pid)
 
-    def buffer_incoming_amie_packet(self, querytime, packet) -> str:
+    def is_amie_packet_seen(self, querytime, packet) -> bool:
+        """Check whether a packet from an AMIE query has been seen before
+
+        A packet is seen before if it is the current packet of a known
+        transaction; the transaction state is then adjusted as
+        :meth:`buffer_incoming_amie_packet` would adjust it, so the caller can
+        drop the packet without validating or buffering it. Incoming
+        "inform_transaction_complete" packets are never reported as seen.
+
+        :param querytime: The time the query was made to AMIE
+        :type querytime: datetime
+        :param packet: AMIE packet just received
+        :type packet: amieclient.packet.base.Packet
+        :return: True if the packet has been seen before
+        """
+
+        if packet.__class__._packet_type == "inform_transaction_complete":
+            return False
+        jid, atrid, pid = get_packet_keys(packet)
+        transaction = self.transactions.get(atrid, None)
+        if transaction is None:
+            return False
+        return transaction.check_seen_amie_packet(querytime, packet)
+
+    def buffer_incoming_amie_packet(self, querytime, packet, validated=False,
+                                    err=None) -> str:
         """Buffer packet from an AMIE query and adjust transaction state
 
         Pass a packet to its transaction object to update the
@@ -275,7 +371,13 @@ class TransactionManager(object):
         :type querytime: datetime
         :param packet: AMIE packet just received
         :type packet: amieclient.packet.base.Packet
-        :return: Message describing disposition of packet
+        :param validated: If True, the packet has already been validated (see
+            :func:`~intake.get_invalid_packet_error`)
+        :type validated: bool
+        :param err: If validated is True, the validation error or None
+        :type err: str or None
+        :return: Message describing disposition of packet, or None if the
+            packet has been seen before
         """
         
         transaction = self._get_transaction(packet)
@@ -302,7 +404,8 @@ class TransactionManager(object):
 
         else:
             (apacket, err) = \
-                transaction.buffer_incoming_amie_packet(querytime, packet)
+                transaction.buffer_incoming_amie_packet(querytime, packet,
+                                                        validated, err)
 
             if err is not None:
                 reply_packet = \
@@ -317,9 +420,50 @@ class TransactionManager(object):
             else:
                 disposition = "Accepted/buffered incoming packet from AMIE"
                 self.actionable_packets[atrid] = apacket
+                tracing.TRACER.annotate_transaction(atrid,
+                                                    packet_type=packet_type)
 
         return disposition
 
+    def get_queue_depths(self) -> dict:
+        """Return the number of buffered items of each kind
+
+        :return: dict with "transactions", "actionable", "outgoing",
+            "dangling_tasks", and "stashed_tasks" counts
+        """
+
+        outgoing = 0
+        dangling_tasks = 0
+        for transaction in self.transactions.values():
+            if transaction.have_outgoing_packet():
+                outgoing += 1
+            for tslist in transaction.dangling_tasks.values():
+                dangling_tasks += len(tslist.tasks_by_name)
+        return {
+            'transactions': len(self.transactions),
+            'actionable': len(self.actionable_packets),
+            'outgoing': outgoing,
+            'dangling_tasks': dangling_tasks,
+            'stashed_tasks': sum([len(stash) for stash in
+                                  self.stashed_tasks.values()]),
+        }
+
+    def take_accept_info(self, atrid):
+        """Return and clear information about a transaction's accepted packet
+
+        This is used to measure the time from accepting an incoming packet to
+        sending the reply.
+
+        :param atrid: AMIE transaction ID
+        :type atrid: str
+        :return: (packet_type, querytime) or None
+        """
+
+        transaction = self.transactions.get(atrid, None)
+        if transaction is None:
+            return None
+        return transaction.take_accept_info()
+
     def have_actionable_packets(self) -> bool:
         """Return True if there are ActionablePacket objects, False otherwise
         """
@@ -375,6 +519,22 @@ class TransactionManager(object):
 
         return sendable_packets
 
+    def requeue_outgoing_amie_packet(self, packet):
+        """Make an outgoing packet that was not sent ready to send again
+
+        :meth:`get_outgoing_amie_packets` moves the resend time of every
+        packet it returns. If a packet is not sent after all, call this so it
+        is returned by the next call instead of after ``reply_delay``.
+
+        :param packet: A packet returned by :meth:`get_outgoing_amie_packets`
+        :type packet: amieclient.packet.base.Packet
+        """
+
+        jid, atrid, pid = get_packet_keys(packet)
+        transaction = self.transactions.get(atrid, None)
+        if transaction is not None and not transaction.amie_packet_incoming:
+            transaction.loop_delay.calculate_target_time(immediate=True)
+
     def purge(self, atrid):
         """Purge all state for the indicated transaction
 
@@ -384,9 +544,16 @@ class TransactionManager(object):
 
         self._purge_actionable_packets(atrid)
         self.transactions.pop(atrid,None)
+        self.stashed_tasks.pop(atrid, None)
+        tracing.TRACER.end_transaction(atrid)
 
     def get_loop_delay(self) -> LoopDelay:
-        """Return LoopDelay that shows how long to wait before querying AMIE"""
+        """Return LoopDelay that shows how long to wait before querying AMIE
+
+        The target time of a transaction with an incoming packet that has
+        passed is moved ``busy_loop_delay`` seconds ahead, so the loop keeps
+        pausing while the ServiceProvider works on the packet.
+        """
 
         loop_delay = LoopDelay(self.amie_wait_parms)
         now = self.timeutil.now()
@@ -408,6 +575,16 @@ class TransactionManager(object):
             #  tasks we want to delay by calling ServiceProvider.get_tasks()
             #  with the "wait" parameter, but otherwise we just want to sleep.
             transaction_target_time = transaction.loop_delay.get_target_time()
+            if transaction.amie_packet_incoming and \
+               transaction_target_time <= now:
+                # AMIE only lists packets that have changed, so the target
+                # time of a transaction waiting on the ServiceProvider is not
+                # advanced by buffer_incoming_amie_packet(); advance it here,
+                # or we would poll without pausing until the tasks finish
+                transaction.loop_delay.calculate_target_time(
+                    now, expect_human_action=True)
+                transaction_target_time = \
+                    transaction.loop_delay.get_target_time()
             if earliest_target_time > transaction_target_time:
                 earliest_target_time = transaction_target_time
 
@@ -424,6 +601,11 @@ class TransactionManager(object):
         if not transaction:
             transaction = Transaction(self.amie_wait_parms, atrid)
             self.transactions[atrid] = transaction
+            tracing.TRACER.begin_transaction(atrid)
+            stash = self.stashed_tasks.pop(atrid, None)
+            if stash:
+                for ((pid, task_name), data) in stash.items():
+                    transaction.buffer_task(pid, decode_task(data))
         return transaction
 
     def _purge_actionable_packets(self, atrid):
@@ -0,0 +1,24 @@
+from mediator import AMIEMediator
+
+class MockAMIEClient(object):
+    site_name = 'NCAR'
+
+class IdleMediator(AMIEMediator):
+    """A mediator whose ServiceProvider and AMIE server have nothing new
+
+    ``polls`` counts the calls to list AMIE packets, and ``waits`` records the
+    ``wait`` value of every ServiceProvider task query.
+    """
+
+    def __init__(self, config):
+        AMIEMediator.__init__(self, config, MockAMIEClient(), None)
+        self.polls = 0
+        self.waits = list()
+
+    def _get_tasks(self, active=True, wait=None) -> list:
+        self.waits.append(wait)
+        return []
+
+    def _list_amie_packets(self, list_packets_parms):
+        self.polls += 1
+        return []
@@ -0,0 +1,33 @@
+import os
+import time
+from spexception import (ServiceProviderTemporaryError,
+                         ServiceProviderRequestFailed)
+from organization import AMIEOrg
+
+class ServiceProvider(object):
+    """A minimal ServiceProvider whose lookup_org() can be told to misbehave
+    """
+
+    def apply_config(self, config):
+        self.config = config
+
+    def get_tasks(self, active=True, wait=None, since=None) -> list:
+        return []
+
+    def clear_transaction(self, amie_transaction_id):
+        pass
+
+    def lookup_org(self, *args, **kwargs):
+        behavior = kwargs.get('behavior', None)
+        if behavior == 'sleep':
+            time.sleep(float(kwargs['secs']))
+        elif behavior == 'temporary':
+            raise ServiceProviderTemporaryError("try again")
+        elif behavior == 'failed':
+            raise ServiceProviderRequestFailed("no such org")
+        elif behavior == 'crash':
+            os._exit(1)
+        elif behavior == 'pid':
+            return os.getpid()
+        return AMIEOrg(OrgCode=kwargs.get('OrgCode', '0032425'),
+                       Organization="Carnegie Mellon University")
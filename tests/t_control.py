@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+import os
+import unittest
+import tempfile
+import threading
+import time
+from pathlib import Path
+from control import (LoopControl, ControlServer, send_command)
+from mediatorstubs import IdleMediator
+
+tempdir = tempfile.TemporaryDirectory()
+
+class BusyMediator(IdleMediator):
+    """A mediator whose ServiceProvider is always working on a packet"""
+
+    def __init__(self, config):
+        IdleMediator.__init__(self, config)
+        self.transaction_manager.have_actionable_packets = lambda: True
+
+    def _get_tasks(self, active=True, wait=None) -> list:
+        # a long-poll with no task updates
+        self.waits.append(wait)
+        time.sleep(wait or 0)
+        return []
+
+class TestControl(unittest.TestCase):
+    def test_sleep(self):
+        control = LoopControl()
+        start = time.monotonic()
+        self.assertFalse(control.sleep(0.05))
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+        timer = threading.Timer(0.1, control.kick)
+        timer.start()
+        start = time.monotonic()
+        self.assertTrue(control.sleep(30))
+        self.assertLess(time.monotonic() - start, 5)
+        timer.join()
+
+    def test_pause(self):
+        control = LoopControl()
+        self.assertFalse(control.wait_while_paused())
+        self.assertEqual(control.handle('pause'),
+                         {'ok': True, 'paused': True, 'draining': False})
+        timer = threading.Timer(0.1, control.resume)
+        timer.start()
+        self.assertTrue(control.wait_while_paused())
+        self.assertFalse(control.paused)
+        timer.join()
+        self.assertFalse(control.handle('bogus')['ok'])
+
+    def test_server(self):
+        address = str(Path(tempdir.name, 'server.sock'))
+        control = LoopControl()
+        control.set_state({'depths': {'transactions': 2}})
+        server = ControlServer(control, address)
+        umask = os.umask(0o022)
+        try:
+            server.start()
+            # the process umask is left alone
+            self.assertEqual(os.umask(0o022), 0o022)
+        finally:
+            os.umask(umask)
+        self.addCleanup(server.stop)
+        self.assertEqual(os.stat(address).st_mode & 0o777, 0o600)
+        reply = send_command(address, 'dump-state')
+        self.assertEqual(reply['state'], {'depths': {'transactions': 2}})
+        reply = send_command(address, 'drain')
+        self.assertEqual(reply, {'ok': True, 'paused': False,
+                                 'draining': True})
+        self.assertTrue(control.draining)
+
+        with self.assertRaises(ValueError):
+            ControlServer(control, '0.0.0.0:0').start()
+
+    def test_mediator(self):
+        address = str(Path(tempdir.name, 'mediator.sock'))
+        config = {
+            'snapshot_dir': str(Path(tempdir.name, 'snapshots')),
+            'control_address': address,
+            'idle_loop_delay': 3600,
+            'pause_max': 3600,
+            }
+        mediator = IdleMediator(config)
+        thread = threading.Thread(target=mediator.run_loop, daemon=True)
+        thread.start()
+        self.addCleanup(mediator.control_server.stop)
+
+        # the first sleep is ramped up to 4 secs; a kick ends it
+        while mediator.polls < 1:
+            time.sleep(0.01)
+        send_command(address, 'kick')
+        while mediator.polls < 2:
+            time.sleep(0.01)
+        state = send_command(address, 'dump-state')['state']
+        self.assertEqual(state['transactions'], [])
+
+        # with no transactions, draining ends the loop at once
+        send_command(address, 'drain')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_long_poll(self):
+        address = str(Path(tempdir.name, 'busy.sock'))
+        config = {
+            'snapshot_dir': str(Path(tempdir.name, 'busy-snapshots')),
+            'control_address': address,
+            'idle_loop_delay': 3600,
+            'busy_loop_delay': 3600,
+            'pause_max': 3600,
+            }
+        mediator = BusyMediator(config)
+        thread = threading.Thread(target=mediator.run_loop, daemon=True)
+        thread.start()
+        self.addCleanup(mediator.control_server.stop)
+        # leave the loop blocked when the test is done
+        self.addCleanup(mediator.loop_control.pause)
+
+        while mediator.polls < 1:
+            time.sleep(0.01)
+        # the 4 sec long-poll is made in 1 sec calls, so a kick ends it early
+        time.sleep(0.5)
+        start = time.monotonic()
+        send_command(address, 'kick')
+        while mediator.polls < 2:
+            time.sleep(0.01)
+        self.assertLess(time.monotonic() - start, 2.5)
+        self.assertLessEqual(max([wait or 0 for wait in mediator.waits]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
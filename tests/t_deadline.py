@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+import time
+import socket
+import tempfile
+import unittest
+from datetime import (datetime, timedelta)
+from pathlib import Path
+import requests
+from requests.exceptions import ConnectionError
+from amieclient.packet.base import Packet
+from fixtures.request_project_create import RPC_PKT_1
+from retryingproxy import RetryingServiceProxy
+from mediatorstubs import IdleMediator
+import deadline
+from deadline import (DeadlineExceeded, DEADLINES_EXCEEDED, budget,
+                      install_http_timeouts)
+
+tempdir = tempfile.TemporaryDirectory()
+
+class MockTimeUtil(object):
+    def __init__(self):
+        self.time = datetime(2024, 1, 1)
+        self.sleeps = list()
+
+    def now(self):
+        return self.time
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.time += timedelta(seconds=secs)
+
+    def future_time(self, seconds, basetime=None):
+        return (basetime or self.time) + timedelta(seconds=seconds)
+
+class MockService(object):
+    def __init__(self):
+        self.calls = 0
+
+    def lookup(self, exc=None):
+        self.calls += 1
+        if exc is not None:
+            raise exc()
+        return self.calls
+
+class DeadlineSession(RetryingServiceProxy):
+    pass
+
+class SendingMediator(IdleMediator):
+    """A mediator whose second AMIE send runs out of time"""
+
+    def __init__(self, config):
+        IdleMediator.__init__(self, config)
+        self.sent = list()
+
+    def _send_amie_packet(self, packet):
+        if len(self.sent) == 1:
+            self.sent.append(None)
+            raise DeadlineExceeded("send_packet")
+        self.sent.append(packet.transaction_id)
+
+class PurgingMediator(IdleMediator):
+    """A mediator that runs out of time purging its second transaction"""
+
+    def __init__(self, config):
+        IdleMediator.__init__(self, config)
+        self.purged = list()
+
+    def _purge_obsolete_transaction(self, atrid):
+        if len(self.purged) == 1:
+            self.purged.append(None)
+            raise DeadlineExceeded("clear_transaction")
+        self.purged.append(atrid)
+        self.transaction_manager.purge(atrid)
+
+def _packet(transaction_id, packet_id):
+    packet = Packet.from_dict(RPC_PKT_1)
+    packet.transaction_id = transaction_id
+    packet.packet_id = packet_id
+    packet.packet_rec_id = transaction_id * 10 + packet_id
+    packet.packet_timestamp = '2024-01-01 00:00:00'
+    return packet
+
+class TestDeadline(unittest.TestCase):
+    def test_budget(self):
+        self.assertIsNone(deadline.current())
+        self.assertIsNone(deadline.remaining())
+        with budget(0, 'loop') as outer:
+            self.assertIsNone(outer)
+        with budget(10, 'loop') as outer:
+            self.assertEqual(outer.scope, 'loop')
+            # an inner budget cannot extend the outer deadline
+            with budget(60, 'packet') as inner:
+                self.assertIs(inner, outer)
+            with budget(1, 'packet') as inner:
+                self.assertEqual(inner.scope, 'packet')
+                self.assertLessEqual(deadline.remaining(), 1)
+            self.assertIs(deadline.current(), outer)
+            self.assertGreater(deadline.remaining(), 1)
+        self.assertIsNone(deadline.current())
+
+    def test_clock(self):
+        time_util = MockTimeUtil()
+        clock = lambda: time_util.now().timestamp()
+        with budget(10, 'loop', clock) as outer:
+            self.assertEqual(deadline.remaining(), 10)
+            time_util.sleep(4)
+            # an inner budget follows the same clock
+            with budget(5, 'packet') as inner:
+                self.assertIs(inner.clock, clock)
+                self.assertEqual(deadline.remaining(), 5)
+            with budget(8, 'packet') as inner:
+                self.assertIs(inner, outer)
+            time_util.sleep(6)
+            self.assertTrue(deadline.expired())
+
+        mediator = IdleMediator({
+            'snapshot_dir': str(Path(tempdir.name, 'clock')),
+            'loop_deadline': 10,
+            })
+        mediator.timeutil = time_util
+        with mediator._iteration_deadline():
+            self.assertFalse(deadline.expired())
+            time_util.sleep(11)
+            self.assertTrue(deadline.expired())
+
+    def test_check(self):
+        deadline.check('lookup', 1000)
+        before = DEADLINES_EXCEEDED.get(scope='packet')
+        with budget(5, 'packet'):
+            deadline.check('lookup')
+            with self.assertRaises(DeadlineExceeded):
+                deadline.check('lookup', 10)
+        with budget(0.01, 'packet'):
+            time.sleep(0.02)
+            self.assertTrue(deadline.expired())
+            with self.assertRaises(DeadlineExceeded):
+                deadline.check('lookup')
+        self.assertEqual(DEADLINES_EXCEEDED.get(scope='packet'), before + 2)
+
+    def test_session(self):
+        svc = MockService()
+        time_util = MockTimeUtil()
+        DeadlineSession.configure(svc, 30, 60, 3600, time_util)
+        with budget(0.01, 'loop'):
+            time.sleep(0.02)
+            with self.assertRaises(DeadlineExceeded):
+                with DeadlineSession() as session:
+                    session.lookup()
+        self.assertEqual(svc.calls, 0)
+
+        with self.assertRaises(ConnectionError):
+            with DeadlineSession() as session:
+                session.lookup(ConnectionError)
+        # the retry delay does not fit in the deadline, so the work is handed
+        # back without sleeping
+        with budget(10, 'loop'):
+            with self.assertRaises(DeadlineExceeded):
+                with DeadlineSession() as session:
+                    session.lookup()
+        self.assertEqual(time_util.sleeps, [])
+        # time spent elsewhere counts toward the delay
+        time_util.time += timedelta(seconds=25)
+        with budget(10, 'loop'):
+            with DeadlineSession() as session:
+                session.lookup()
+        self.assertEqual(time_util.sleeps, [5])
+        self.assertEqual(svc.calls, 2)
+
+    def test_http_timeouts(self):
+        # a server that accepts connections but never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+        url = 'http://127.0.0.1:' + str(server.getsockname()[1]) + '/'
+
+        class Client(object):
+            pass
+
+        client = Client()
+        self.assertFalse(install_http_timeouts(client, 0.2))
+        client._session = requests.Session()
+        self.addCleanup(client._session.close)
+        self.assertTrue(install_http_timeouts(client, 0.2))
+
+        start = time.monotonic()
+        with self.assertRaises(ConnectionError):
+            client._session.get(url)
+        self.assertLess(time.monotonic() - start, 5)
+
+        with budget(0.1, 'loop'):
+            with self.assertRaises(DeadlineExceeded):
+                client._session.get(url)
+            with self.assertRaises(DeadlineExceeded):
+                client._session.get(url)
+
+    def test_flush(self):
+        mediator = SendingMediator({
+            'snapshot_dir': str(Path(tempdir.name, 'flush')),
+            })
+        tm = mediator.transaction_manager
+        for transaction_id in (100, 101, 102):
+            tm.buffer_incoming_amie_packet(mediator.timeutil.now(),
+                                           _packet(transaction_id, 2))
+            tm.buffer_outgoing_amie_packet(_packet(transaction_id, 3))
+        with self.assertRaises(DeadlineExceeded):
+            mediator._flush_amie_packets()
+        # the packets that were not sent go out with the next flush
+        mediator._flush_amie_packets()
+        self.assertEqual(mediator.sent[:2], [100, None])
+        self.assertEqual(sorted(mediator.sent[2:]), [101, 102])
+
+    def test_purge(self):
+        mediator = PurgingMediator({
+            'snapshot_dir': str(Path(tempdir.name, 'purge')),
+            })
+        tm = mediator.transaction_manager
+        for transaction_id in (100, 101, 102):
+            tm.buffer_incoming_amie_packet(mediator.timeutil.now(),
+                                           _packet(transaction_id, 2))
+        # AMIE lists none of the transactions, so all are obsolete
+        with self.assertRaises(DeadlineExceeded):
+            mediator._load_amie_packets()
+        self.assertEqual(len(tm.get_transaction_ids()), 2)
+        # the next load only asks for updates, but still purges the rest
+        self.assertIsNotNone(mediator.amie_packet_update_time)
+        mediator._load_amie_packets()
+        self.assertEqual(tm.get_transaction_ids(), set())
+        self.assertEqual(len(mediator.purged), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
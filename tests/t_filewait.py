@@ -5,7 +5,8 @@ from pathlib import Path
 import os, sys
 import time
 import subprocess
-from filewait import FileWaiter
+import threading
+from filewait import (FileWaiter, DirectoryWatcher, PollingWatcher)
 
 tempdir = tempfile.TemporaryDirectory()
 
@@ -31,11 +32,63 @@ class TestFileWaiter(unittest.TestCase):
         released = fw.wait(3)
         endtime = time.time()
         elapsed = endtime - starttime
-        self.assertFalse(released,
-                         msg="wait() did not return True")
+        self.assertTrue(released,
+                        msg="wait() did not return True")
         self.assertTrue((elapsed > 0.0) and (elapsed < 2.5),
                         msg=str(elapsed) +" seconds elapsed on release")
 
+    def test_wait_keys(self):
+        dir = Path(tempdir.name,"keys")
+        dir.mkdir()
+        fw = FileWaiter(str(Path(dir,".WAITFILE")))
+        since = fw.mark()
+        Path(dir,"other").write_text("x")
+        starttime = time.time()
+        released = fw.wait(1, keys=["mine"], since=since)
+        self.assertFalse(released,
+                         msg="wait() woke for a change to another key")
+        self.assertTrue(time.time() - starttime > 0.5)
+
+        since = fw.mark()
+        threading.Timer(0.2, Path(dir,"mine").write_text, ["x"]).start()
+        released = fw.wait(3, keys=["mine"], since=since)
+        self.assertTrue(released, msg="wait() missed a change to its key")
+
+        since = fw.mark()
+        threading.Timer(0.2, fw.release).start()
+        released = fw.wait(3, keys=["mine"], since=since)
+        self.assertTrue(released, msg="wait() missed a release")
+
+    def test_separate_directories(self):
+        dir1 = Path(tempdir.name,"dir1")
+        dir2 = Path(tempdir.name,"dir2")
+        dir1.mkdir()
+        dir2.mkdir()
+        fw1 = FileWaiter(str(Path(dir1,".WAITFILE")))
+        fw2 = FileWaiter(str(Path(dir2,".WAITFILE")))
+        self.assertIsNot(fw1.watcher, fw2.watcher)
+        since = fw1.mark()
+        fw2.release()
+        self.assertFalse(fw1.wait(1, since=since),
+                         msg="release() in one directory woke another")
+
+    def test_polling_watcher(self):
+        dir = Path(tempdir.name,"polling")
+        dir.mkdir()
+        watcher = PollingWatcher(str(dir))
+        since = watcher.mark()
+        threading.Timer(0.2, Path(dir,"key").write_text, ["x"]).start()
+        self.assertTrue(watcher.wait(3, keys=["key"], since=since))
+        self.assertFalse(watcher.wait(1, keys=["key"]))
+        watcher.close()
+
+    def test_replace_fifo(self):
+        waitfile = str(Path(tempdir.name,"fifowaitfile"))
+        os.mkfifo(waitfile)
+        fw = FileWaiter(waitfile)
+        fw.release()
+        self.assertTrue(Path(waitfile).is_file())
+
         
 if __name__ == '__main__':
     if len(sys.argv) > 1:
@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+import unittest
+import handler
+from packethandler import (PacketHandler, DefaultHandler)
+
+class TestHandlerLoading(unittest.TestCase):
+    def test_lazy_load(self):
+        packet_type = 'request_project_create'
+        found = PacketHandler.get_handler(packet_type)
+        self.assertIsNot(found, DefaultHandler.singleton)
+        self.assertIs(PacketHandler.get_handler(packet_type), found)
+
+    def test_failed_import(self):
+        # a handler module whose import fails (e.g. a missing dependency)
+        packet_type = 'no_such_packet_type'
+        handler.__all__.append(packet_type)
+        self.addCleanup(handler.__all__.remove, packet_type)
+        for attempt in range(2):
+            with self.assertRaises(ImportError):
+                PacketHandler.get_handler(packet_type)
+
+
+if __name__ == '__main__':
+    unittest.main()
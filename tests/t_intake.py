@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import unittest
+import copy
+from datetime import datetime, timedelta
+from amieclient.packet.base import Packet
+from loopdelay import WaitParms
+from transactionmanager import TransactionManager
+from intake import (IntakePipeline, packet_fingerprint,
+                    get_invalid_packet_error, INTAKE_PACKETS)
+
+RAI_DICT = {
+    'type': 'request_account_inactivate',
+    'header': {
+        'packet_rec_id': 8,
+        'packet_id': 2,
+        'transaction_id': 6,
+        'trans_rec_id': 6,
+        'remote_site_name': 'NCAR',
+        'local_site_name': 'TGCDB',
+        'originating_site_name': 'TGCDB',
+        'outgoing_flag': 1,
+        'transaction_state': 'in-progress',
+        'packet_state': 'in-progress',
+        },
+    'body': {
+        'ProjectID': 'p1',
+        'ResourceList': ['r1'],
+        'PersonID': 'u1',
+        },
+    }
+
+def _packet(pdict):
+    packet = Packet.from_dict(pdict)
+    packet.packet_timestamp = '2024-01-02 03:04:05'
+    return packet
+
+class TestIntake(unittest.TestCase):
+    def test_pipeline(self):
+        calls = list()
+
+        def fetch():
+            for i in range(6):
+                calls.append(('fetch', i))
+                yield i
+
+        def odd(i):
+            calls.append(('odd', i))
+            return i if i % 2 else None
+
+        def double(i):
+            calls.append(('double', i))
+            return 2 * i
+
+        before = INTAKE_PACKETS.get(stage='odd', result='dropped')
+        pipeline = IntakePipeline((('fetch', fetch), ('odd', odd),
+                                   ('double', double)))
+        self.assertEqual(pipeline.run(), 3)
+        # each item goes through every stage before the next is fetched
+        self.assertEqual(calls[:4], [('fetch', 0), ('odd', 0),
+                                     ('fetch', 1), ('odd', 1)])
+        self.assertEqual(calls[4], ('double', 1))
+        stats = pipeline.stats
+        self.assertEqual(stats['fetch']['passed'], 6)
+        self.assertEqual(stats['odd']['passed'], 3)
+        self.assertEqual(stats['odd']['dropped'], 3)
+        self.assertEqual(stats['double']['passed'], 3)
+        self.assertGreaterEqual(stats['double']['seconds'], 0)
+        self.assertEqual(INTAKE_PACKETS.get(stage='odd', result='dropped'),
+                         before + 3)
+
+    def test_fingerprint(self):
+        packet = Packet.from_dict(RAI_DICT)
+        other = copy.deepcopy(RAI_DICT)
+        other['body']['PersonID'] = 'u2'
+        self.assertEqual(packet_fingerprint(packet),
+                         packet_fingerprint(Packet.from_dict(other)))
+        other['header']['packet_rec_id'] = 9
+        self.assertNotEqual(packet_fingerprint(packet),
+                            packet_fingerprint(Packet.from_dict(other)))
+        self.assertIsNone(get_invalid_packet_error(packet))
+
+    def test_seen(self):
+        tm = TransactionManager(WaitParms(10, 60, 3600))
+        now = datetime.now()
+        packet = _packet(RAI_DICT)
+        self.assertFalse(tm.is_amie_packet_seen(now, packet))
+        msg = tm.buffer_incoming_amie_packet(now, packet, validated=True)
+        self.assertIsNotNone(msg)
+        self.assertEqual(len(tm.get_actionable_packets()), 1)
+
+        again = _packet(RAI_DICT)
+        self.assertTrue(tm.is_amie_packet_seen(now, again))
+        self.assertIsNone(tm.buffer_incoming_amie_packet(now, again))
+
+        # a new packet in the transaction is validated and buffered
+        new = copy.deepcopy(RAI_DICT)
+        new['header']['packet_rec_id'] = 9
+        new['header']['packet_id'] = 3
+        later = now + timedelta(seconds=1)
+        self.assertFalse(tm.is_amie_packet_seen(later, _packet(new)))
+        msg = tm.buffer_incoming_amie_packet(later, _packet(new))
+        self.assertIsNotNone(msg)
+        (apacket,) = tm.get_actionable_packets()
+        self.assertEqual(apacket['amie_packet_id'], '3')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import json
+import time
+import fcntl
+import threading
+from pathlib import Path
+from spexception import ServiceProviderError
+from lease import (LeaseManager, LeasedMediator, LeaseLost, POLLER_LEASE)
+from mediatorstubs import MockAMIEClient
+
+tempdir = tempfile.TemporaryDirectory()
+
+class TestLease(unittest.TestCase):
+    def _manager(self, name, instance_id):
+        manager = LeaseManager(str(Path(tempdir.name, name)), instance_id,
+                               ttl=60)
+        manager.start()
+        self.addCleanup(manager.stop)
+        return manager
+
+    def test_acquire_release(self):
+        a = self._manager('basic', 'a')
+        b = self._manager('basic', 'b')
+        self.assertEqual(a.acquire('x'), '')
+        self.assertEqual(a.acquire('x'), '')
+        self.assertIsNone(b.acquire('x'))
+        self.assertEqual(b.owner('x'), 'a')
+        self.assertTrue(a.holds('x'))
+        self.assertFalse(b.holds('x'))
+        a.release('x')
+        self.assertIsNone(a.owner('x'))
+        self.assertFalse(Path(tempdir.name, 'basic', 'x.lease').exists())
+        self.assertEqual(b.acquire('x'), '')
+        self.assertTrue(b.holds('x'))
+
+    def test_release_while_waiting(self):
+        b = self._manager('waiting', 'b')
+        path = Path(tempdir.name, 'waiting', 'x.lease')
+        # lock the file as a releasing holder would, so b has to wait
+        f = open(path, 'a+')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        thread = threading.Thread(target=b.acquire, args=('x',))
+        thread.start()
+        time.sleep(0.2)
+        path.unlink()
+        f.close()
+        thread.join()
+        # b did not take the lease in the removed file
+        self.assertTrue(b.holds('x'))
+        self.assertEqual(path.read_text(), 'b\n')
+
+    def test_duplicate_instance(self):
+        self._manager('dup', 'a')
+        with self.assertRaises(ServiceProviderError):
+            LeaseManager(str(Path(tempdir.name, 'dup')), 'a').start()
+
+    def test_takeover_on_exit(self):
+        a = LeaseManager(str(Path(tempdir.name, 'exit')), 'a', ttl=60)
+        a.start()
+        b = self._manager('exit', 'b')
+        a.acquire('x')
+        self.assertIsNone(b.acquire('x'))
+        # Simulate a crash: the lock goes away but the files stay
+        a.stop_event.set()
+        a.thread.join()
+        a.instance_file.close()
+        self.assertFalse(b.instance_alive('a'))
+        self.assertEqual(b.acquire('x'), 'a')
+        self.assertEqual(b.owner('x'), 'b')
+
+    def test_takeover_on_stale_heartbeat(self):
+        a = self._manager('stale', 'a')
+        b = self._manager('stale', 'b')
+        a.acquire('x')
+        # a hangs: its lock is held but its heartbeat gets old
+        a.stop_event.set()
+        a.thread.join()
+        old = time.time() - 120
+        path = Path(tempdir.name, 'stale', 'a.instance')
+        path.write_text(json.dumps({'instance': 'a', 'heartbeat': old}))
+        a.last_heartbeat = old
+        self.assertFalse(a.holds('x'))
+        self.assertEqual(b.acquire('x'), 'a')
+
+        # When a wakes up, it finds that the lease is gone
+        a.heartbeat()
+        self.assertTrue(a.valid())
+        self.assertFalse(a.holds('x'))
+        self.assertEqual(a.held_names(), [])
+
+    def test_standby_fencing(self):
+        a = self._manager('standby', 'a')
+        b = self._manager('standby', 'b')
+        config = {
+            'snapshot_dir': str(Path(tempdir.name, 'standby-snapshots')),
+            'lease_dir': str(Path(tempdir.name, 'standby')),
+            }
+        mediator = LeasedMediator(config, MockAMIEClient(), None,
+                                  lease_manager=b)
+        with self.assertRaises(LeaseLost):
+            mediator._check_leases()
+        a.acquire(POLLER_LEASE)
+        a.release(POLLER_LEASE)
+        mediator._wait_for_lease(POLLER_LEASE)
+        mediator._check_leases()
+        self.assertIsNone(a.acquire(POLLER_LEASE))
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
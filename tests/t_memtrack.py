@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import os
+import time
+from pathlib import Path
+from memtrack import (MemoryTracker, count_objects, get_rss, REPORT_PREFIX,
+                      TRACKED_OBJECTS, CONTAINER_SIZE)
+from taskstatus import TaskStatus
+
+tempdir = tempfile.TemporaryDirectory()
+
+LEAK = list()
+
+def leaky_alloc(n):
+    LEAK.extend([bytearray(1024) for i in range(n)])
+
+def _task_status(job_id):
+    return TaskStatus(amie_transaction_id='TGCDB:NCAR:TGCDB:100',
+                      amie_packet_id='1',
+                      amie_packet_type='request_project_create',
+                      job_id=job_id,
+                      task_name='create_project',
+                      task_state='queued',
+                      timestamp=1000,
+                      products=[])
+
+class TestMemoryTracker(unittest.TestCase):
+    def tearDown(self):
+        LEAK.clear()
+
+    def _tracker(self, name, **kwargs):
+        report_dir = str(Path(tempdir.name, name))
+        tracker = MemoryTracker(report_dir, **kwargs)
+        self.addCleanup(tracker.stop)
+        return (tracker, report_dir)
+
+    def test_periodic_report(self):
+        (tracker, report_dir) = self._tracker('periodic', interval=0.05)
+        held = dict()
+        tracker.add_container('held', lambda: len(held))
+        self.assertIsNone(tracker.check())
+
+        time.sleep(0.06)
+        first = tracker.check()
+        self.assertIsNotNone(first)
+        self.assertIsNone(tracker.check(), msg="report before interval")
+
+        held.update((str(i), _task_status(str(i))) for i in range(5))
+        leaky_alloc(200)
+        time.sleep(0.06)
+        path = tracker.check()
+        with open(path) as f:
+            report = f.read()
+        self.assertIn("reason: periodic", report)
+        self.assertRegex(report, r"held +5\n")
+        self.assertRegex(report, r"TaskStatus +\d+ +\+5\n")
+        growth = report.split("since previous report:")[1]
+        self.assertIn("t_memtrack.py:", growth.split("\n\n")[0])
+        self.assertEqual(CONTAINER_SIZE.get(container='held'), 5)
+        self.assertGreaterEqual(TRACKED_OBJECTS.get(type='TaskStatus'), 5)
+
+    def test_rss_ceiling(self):
+        (tracker, report_dir) = self._tracker('ceiling', rss_max=1)
+        path = tracker.check()
+        self.assertIsNotNone(path)
+        with open(path) as f:
+            report = f.read()
+        self.assertIn("exceeds ceiling 1", report)
+        self.assertIn("Largest allocations by traceback:", report)
+        # no new dump until the RSS grows another 10%
+        self.assertIsNone(tracker.check())
+
+    def test_keep(self):
+        (tracker, report_dir) = self._tracker('keep', keep=2)
+        paths = [tracker.report("test") for i in range(4)]
+        names = sorted(os.listdir(report_dir))
+        self.assertEqual(names, [os.path.basename(p) for p in paths[2:]])
+        self.assertTrue(all(n.startswith(REPORT_PREFIX) for n in names))
+
+    def test_helpers(self):
+        self.assertGreater(get_rss(), 0)
+        tasks = [_task_status(str(i)) for i in range(3)]
+        self.assertGreaterEqual(count_objects(('TaskStatus',))['TaskStatus'],
+                                3)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import urllib.request
+from pathlib import Path
+from metrics import (Registry, MetricsServer, MetricsError, timed)
+from retryingproxy import (RetryingServiceProxy, CALL_SECONDS, RETRIES)
+from misctypes import TimeUtil
+from requests.exceptions import ConnectionError
+
+tempdir = tempfile.TemporaryDirectory()
+
+class MockTimeUtil(TimeUtil):
+    def sleep(self, secs):
+        pass
+
+class MockService(object):
+    def dotest(self, exc=None):
+        if exc is not None:
+            raise exc()
+        return 'done'
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        counter = registry.counter('t_total', 'A counter', ('kind',))
+        counter.inc(kind='a')
+        counter.inc(2, kind='a')
+        self.assertEqual(counter.get(kind='a'), 3)
+        self.assertIs(registry.counter('t_total', 'A counter', ('kind',)),
+                      counter)
+        with self.assertRaises(MetricsError):
+            registry.gauge('t_total', 'A gauge')
+        with self.assertRaises(MetricsError):
+            counter.inc(other='a')
+        gauge = registry.gauge('t_depth', 'A gauge')
+        gauge.set(5)
+        text = registry.expose()
+        self.assertIn('# TYPE t_total counter\n', text)
+        self.assertIn('t_total{kind="a"} 3\n', text)
+        self.assertIn('t_depth 5\n', text)
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('t_seconds', 'A histogram',
+                                       ('method',), buckets=(1, 10))
+        histogram.observe(0.5, method='m')
+        histogram.observe(5, method='m')
+        histogram.observe(50, method='m')
+        self.assertEqual(histogram.get(method='m'), (3, 55.5))
+        text = registry.expose()
+        self.assertIn('t_seconds_bucket{method="m",le="1"} 1\n', text)
+        self.assertIn('t_seconds_bucket{method="m",le="10"} 2\n', text)
+        self.assertIn('t_seconds_bucket{method="m",le="+Inf"} 3\n', text)
+        self.assertIn('t_seconds_count{method="m"} 3\n', text)
+
+        @timed(histogram, method='f')
+        def f():
+            return 1
+        f()
+        self.assertEqual(histogram.get(method='f')[0], 1)
+
+    def test_const_labels(self):
+        registry = Registry()
+        registry.counter('t_total', 'A counter', ('kind',)).inc(kind='a')
+        registry.histogram('t_seconds', 'A histogram',
+                           buckets=(1,)).observe(0.5)
+        registry.set_const_labels(shard='2')
+        text = registry.expose()
+        self.assertIn('t_total{shard="2",kind="a"} 1\n', text)
+        self.assertIn('t_seconds_bucket{shard="2",le="1"} 1\n', text)
+        self.assertIn('t_seconds_count{shard="2"} 1\n', text)
+
+    def test_textfile_and_server(self):
+        registry = Registry()
+        registry.counter('t_total', 'A counter').inc()
+        path = str(Path(tempdir.name, 'metrics.prom'))
+        registry.write_textfile(path)
+        self.assertIn('t_total 1\n', Path(path).read_text())
+
+        server = MetricsServer('localhost:0', registry)
+        server.start()
+        try:
+            url = 'http://localhost:' + str(server.address[1]) + '/metrics'
+            with urllib.request.urlopen(url) as response:
+                self.assertIn(b't_total 1\n', response.read())
+        finally:
+            server.stop()
+
+    def test_session_metrics(self):
+        class MeteredSession(RetryingServiceProxy):
+            pass
+        MeteredSession.configure(MockService(), 1, 30, 90, MockTimeUtil())
+        with MeteredSession() as svc:
+            self.assertEqual(svc.dotest(), 'done')
+        self.assertEqual(CALL_SECONDS.get(session='MeteredSession',
+                                          method='dotest')[0], 1)
+        with self.assertRaises(ConnectionError):
+            with MeteredSession() as svc:
+                svc.dotest(ConnectionError)
+        self.assertEqual(RETRIES.get(session='MeteredSession'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
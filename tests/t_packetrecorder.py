@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import json
+from datetime import datetime
+from pathlib import Path
+from amieclient.packet.base import Packet
+from packetrecorder import (PacketRecorder, read_recording, RECORD_VERSION)
+
+tempdir = tempfile.TemporaryDirectory()
+
+ITC_DICT = {
+    'type': 'inform_transaction_complete',
+    'header': {
+        'packet_rec_id': 7,
+        'packet_id': 1,
+        'transaction_id': 5,
+        'trans_rec_id': 5,
+        'remote_site_name': 'NCAR',
+        'local_site_name': 'TGCDB',
+        'originating_site_name': 'TGCDB',
+        'outgoing_flag': 1,
+        'transaction_state': 'in-progress',
+        'packet_state': 'in-progress',
+        },
+    'body': {
+        'StatusCode': 'Success',
+        'DetailCode': 1,
+        'Message': 'OK',
+        },
+    }
+
+class TestPacketRecorder(unittest.TestCase):
+    def test_record_and_read(self):
+        path = str(Path(tempdir.name, 'packets.jsonl'))
+        packet = Packet.from_dict(ITC_DICT)
+        t1 = datetime(2023, 8, 3, 12, 0, 0)
+        t2 = datetime(2023, 8, 3, 12, 0, 5)
+
+        recorder = PacketRecorder(path)
+        recorder.record('received', packet, t1)
+        recorder.close()
+        # records are appended by later runs
+        recorder = PacketRecorder(path)
+        recorder.record('sent', packet, t2)
+        recorder.close()
+
+        records = list(read_recording(path))
+        self.assertEqual([r['direction'] for r in records],
+                         ['received', 'sent'])
+        self.assertEqual(records[0]['v'], RECORD_VERSION)
+        self.assertEqual(records[0]['time'], t1.isoformat())
+        self.assertEqual(records[1]['time'], t2.isoformat())
+        pdict = records[0]['packet']
+        self.assertEqual(pdict['type'], 'inform_transaction_complete')
+        self.assertEqual(pdict['header']['transaction_id'], 5)
+        self.assertEqual(pdict['body']['StatusCode'], 'Success')
+
+    def test_bad_record(self):
+        path = str(Path(tempdir.name, 'bad.jsonl'))
+        with open(path, 'w') as f:
+            f.write(json.dumps({'v': RECORD_VERSION, 'direction': 'sent',
+                                'time': '2023-08-03T12:00:00',
+                                'packet': ITC_DICT}) + "\n\n")
+            f.write(json.dumps({'something': 'else'}) + "\n")
+        records = read_recording(path)
+        self.assertEqual(next(records)['direction'], 'sent')
+        with self.assertRaises(ValueError):
+            next(records)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
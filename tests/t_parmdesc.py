@@ -3,6 +3,7 @@ import unittest
 import json
 from misctypes import DateTime
 from amieparms import (AMIEParmDescAware, process_parms)
+from parmdesc import build_docstrings
 
 def upper(str):
     return str.upper()
@@ -75,6 +76,11 @@ class TestParmDesc(unittest.TestCase):
         self.assertFalse('extra' in kwargs,
                          msg='extra parm passed in')
 
+        # docstrings are only supplemented on request (or under Sphinx)
+        self.assertTrue(Target.__init__.__doc__.startswith("Test Target\n"))
+        self.assertNotIn(":param name:", Target.__init__.__doc__)
+        build_docstrings()
+        build_docstrings()
         init_doc = Target.__init__.__doc__
 
         expected_doc = "Test Target\n" + \
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import os
+import time
+import pstats
+from pathlib import Path
+from profiling import (LoopProfiler, LOOP_LABEL)
+
+tempdir = tempfile.TemporaryDirectory()
+
+def busy_loop_work(secs):
+    end = time.monotonic() + secs
+    n = 0
+    while time.monotonic() < end:
+        n += 1
+    return n
+
+def busy_handler_work(secs):
+    return busy_loop_work(secs)
+
+class TestLoopProfiler(unittest.TestCase):
+    def _profiler(self, name, **kwargs):
+        output_dir = str(Path(tempdir.name, name))
+        profiler = LoopProfiler()
+        profiler.configure(output_dir, **kwargs)
+        return (profiler, output_dir)
+
+    def test_cprofile(self):
+        (profiler, output_dir) = self._profiler('cprofile', iterations=2)
+        profiler.start()
+        busy_loop_work(0.01)
+        with profiler.packet_type('request_project_create'):
+            busy_handler_work(0.01)
+        profiler.iteration()
+        self.assertTrue(profiler.running)
+        profiler.iteration()
+        self.assertFalse(profiler.running, msg="iteration limit ignored")
+
+        names = sorted(os.listdir(output_dir))
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].endswith('-' + LOOP_LABEL + '.pstats'))
+        self.assertTrue(names[1].endswith('-request_project_create.pstats'))
+        funcs = lambda name: [func[2] for func in pstats.Stats(
+            str(Path(output_dir, name))).stats]
+        self.assertIn('busy_loop_work', funcs(names[0]))
+        self.assertNotIn('busy_handler_work', funcs(names[0]))
+        self.assertIn('busy_handler_work', funcs(names[1]))
+
+    def test_sample(self):
+        (profiler, output_dir) = self._profiler('sample', mode='sample',
+                                                interval=0.001)
+        profiler.start()
+        busy_loop_work(0.1)
+        with profiler.packet_type('data_project_create'):
+            busy_handler_work(0.1)
+        paths = profiler.stop()
+
+        self.assertEqual(len(paths), 1)
+        self.assertTrue(paths[0].endswith('.collapsed'))
+        counts = dict()
+        with open(paths[0]) as f:
+            for line in f:
+                (stack, count) = line.rsplit(' ', 1)
+                frames = stack.split(';')
+                if 'busy_handler_work' in stack:
+                    self.assertEqual(frames[0], 'data_project_create')
+                counts[frames[0]] = counts.get(frames[0], 0) + int(count)
+        self.assertGreater(counts.get(LOOP_LABEL, 0), 0)
+        self.assertGreater(counts.get('data_project_create', 0), 0)
+
+    def test_toggle(self):
+        (profiler, output_dir) = self._profiler('toggle', seconds=60)
+        profiler.toggle()
+        self.assertFalse(profiler.running, msg="toggled mid-iteration")
+        profiler.iteration()
+        self.assertTrue(profiler.running)
+        profiler.iteration()
+        self.assertTrue(profiler.running, msg="stopped before time limit")
+        profiler.toggle()
+        profiler.iteration()
+        self.assertFalse(profiler.running)
+        self.assertEqual(len(os.listdir(output_dir)), 1)
+        self.assertEqual(profiler.packet_type('x').__class__.__name__,
+                         '_NullContext')
+
+    def test_bad_mode(self):
+        profiler = LoopProfiler()
+        with self.assertRaises(ValueError):
+            profiler.configure(mode='statistical')
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
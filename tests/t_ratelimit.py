@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import unittest
+import time
+from datetime import (datetime, timedelta)
+from requests.exceptions import ConnectionError
+from retryingproxy import RetryingServiceProxy
+from misctypes import TimeUtil
+import deadline
+from ratelimit import (parse_rate_limits, make_call_limiter, TokenBucket,
+                       AdaptiveLimit, CallLimiter)
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = list()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.now += secs
+
+class MockTimeUtil(object):
+    def __init__(self):
+        self.time = datetime(2024, 1, 1)
+        self.sleeps = list()
+
+    def now(self):
+        return self.time
+
+    def sleep(self, secs):
+        self.sleeps.append(secs)
+        self.time += timedelta(seconds=secs)
+
+class MockService(object):
+    def __init__(self):
+        self.calls = 0
+
+    def lookup(self, exc=None):
+        self.calls += 1
+        if exc is not None:
+            raise exc()
+        return self.calls
+
+class LimitedSession(RetryingServiceProxy):
+    pass
+
+class TestRateLimit(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_rate_limits(''), {})
+        self.assertEqual(parse_rate_limits('lookup_person=5:10, send_packet=0.5,'
+                                           ' *=20'),
+                         {'lookup_person': (5.0, 10.0),
+                          'send_packet': (0.5, 1.0),
+                          '*': (20.0, 20.0)})
+        for bad in ('lookup_person', 'x=fast', 'x=0', '=5', 'x=1:0'):
+            with self.assertRaises(ValueError, msg=bad):
+                parse_rate_limits(bad)
+        self.assertIsNone(make_call_limiter('SPSession', '', 0))
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, 3, clock)
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+        clock.now += 10
+        # the bucket refills, but only up to its capacity
+        self.assertEqual([bucket.reserve() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+
+    def test_adaptive_limit(self):
+        clock = FakeClock()
+        limit = AdaptiveLimit(4, latency_target=1, clock=clock)
+        self.assertEqual(limit.limit, 1)
+        for i in range(20):
+            limit.release(limit.acquire(), 0.1)
+        self.assertEqual(limit.limit, 4)
+
+        # two slow calls that started together cut the limit once
+        starts = [limit.acquire(), limit.acquire()]
+        clock.now += 1
+        limit.release(starts[0], 5)
+        self.assertEqual(limit.limit, 2)
+        limit.release(starts[1], 5)
+        self.assertEqual(limit.limit, 2)
+
+        clock.now += 1
+        limit.release(limit.acquire(), 0.1, failed=True)
+        self.assertEqual(limit.limit, 1)
+        clock.now += 1
+        limit.release(limit.acquire(), 0.1, failed=True)
+        self.assertEqual(limit.limit, 1)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_adaptive_limit_deadline(self):
+        limit = AdaptiveLimit(4)
+        start = limit.acquire()
+        before = time.monotonic()
+        with deadline.budget(0.05, 'loop'):
+            with self.assertRaises(deadline.DeadlineExceeded):
+                limit.acquire('LimitedSession.lookup')
+        self.assertLess(time.monotonic() - before, 5)
+        limit.release(start, 0)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_session(self):
+        clock = FakeClock()
+        svc = MockService()
+        LimitedSession.configure(svc, 1, 2, 10)
+        limiter = CallLimiter('LimitedSession', parse_rate_limits('*=1'),
+                              concurrency_max=3, clock=clock,
+                              sleep=clock.sleep)
+        LimitedSession.set_call_limiter(limiter)
+        self.addCleanup(LimitedSession.set_call_limiter, None)
+        with LimitedSession() as session:
+            session.lookup()
+            session.lookup()
+            with self.assertRaises(ConnectionError):
+                session.lookup(ConnectionError)
+        self.assertEqual(svc.calls, 3)
+        self.assertEqual(clock.sleeps, [1.0, 1.0])
+        limit = limiter.limits['lookup']
+        self.assertEqual(limit.in_flight, 0)
+        # two successes (1 -> 2 -> 2.5), then a temporary error
+        self.assertEqual(limit.limit, 1.25)
+
+    def test_time_util(self):
+        time_util = MockTimeUtil()
+        limiter = make_call_limiter('LimitedSession', '*=4', 0,
+                                    time_util=time_util)
+        for i in range(6):
+            limiter.release('lookup', limiter.acquire('lookup'), 0)
+        self.assertEqual(time_util.sleeps, [0.25, 0.25])
+        self.assertEqual(time_util.time, datetime(2024, 1, 1, 0, 0, 0, 500000))
+
+        # the real TimeUtil sleeps for fractions of a second too
+        limiter = make_call_limiter('LimitedSession', '*=10:1', 0,
+                                    time_util=TimeUtil())
+        before = time.monotonic()
+        for i in range(3):
+            limiter.release('lookup', limiter.acquire('lookup'), 0)
+        self.assertGreaterEqual(time.monotonic() - before, 0.15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+from pathlib import Path
+from amieclient.packet.base import Packet
+from taskstatus import TaskStatus
+from spexception import ServiceProviderTemporaryError
+from sharding import (shard_for, shard_path, encode_task, decode_task,
+                      encode_packet, decode_packet, encode_message,
+                      decode_message, worker_config, ForwardingSnapshots,
+                      ShardCoordinator)
+from mediatorstubs import MockAMIEClient
+
+tempdir = tempfile.TemporaryDirectory()
+
+ITC_DICT = {
+    'type': 'inform_transaction_complete',
+    'header': {
+        'packet_rec_id': 7,
+        'packet_id': 1,
+        'transaction_id': 5,
+        'trans_rec_id': 5,
+        'remote_site_name': 'NCAR',
+        'local_site_name': 'TGCDB',
+        'originating_site_name': 'TGCDB',
+        'outgoing_flag': 1,
+        'transaction_state': 'in-progress',
+        'packet_state': 'in-progress',
+        },
+    'body': {
+        'StatusCode': 'Success',
+        'DetailCode': 1,
+        'Message': 'OK',
+        },
+    }
+
+class MockWorker(object):
+    def __init__(self, status):
+        self.status = status
+        self.messages = list()
+
+    def send(self, message):
+        self.messages.append(decode_message(encode_message(message)))
+
+    def receive(self):
+        return dict(self.status)
+
+    def stop(self):
+        pass
+
+def _task_status(**kwargs):
+    parms = {
+        'amie_transaction_id': 'TGCDB:NCAR:TGCDB:100',
+        'amie_packet_id': '1',
+        'amie_packet_type': 'request_project_create',
+        'job_id': '1-create',
+        'task_name': 'create_project',
+        'task_state': 'successful',
+        'timestamp': 1000,
+        }
+    parms.update(kwargs)
+    return TaskStatus(parms)
+
+class TestSharding(unittest.TestCase):
+    def test_shard_for(self):
+        atrids = ['TGCDB:NCAR:TGCDB:' + str(i) for i in range(100)]
+        shards = [shard_for(atrid, 4) for atrid in atrids]
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+        self.assertEqual(shards, [shard_for(atrid, 4) for atrid in atrids])
+        self.assertEqual(shard_for('TGCDB:NCAR:TGCDB:100', 1), 0)
+
+    def test_shard_path(self):
+        self.assertEqual(shard_path('/tmp/amie-sp.jsonl.gz', 1),
+                         '/tmp/amie-sp.shard1.jsonl.gz')
+        self.assertEqual(shard_path('trace', 0), 'trace.shard0')
+
+    def test_encode_task(self):
+        task = _task_status()
+        decoded = decode_task(encode_task(task))
+        self.assertEqual(decoded['job_id'], '1-create')
+        self.assertEqual(decoded['timestamp'], 1000)
+        self.assertFalse(decoded.get('products', None))
+
+        task = _task_status(products=[{'name': 'person_id', 'value': 'p1'}])
+        data = encode_message({'tasks': [encode_task(task)]})
+        decoded = decode_task(decode_message(data)['tasks'][0])
+        self.assertEqual(decoded['products'][0]['name'], 'person_id')
+        self.assertEqual(decoded['products'][0]['value'], 'p1')
+
+    def test_encode_packet(self):
+        packet = Packet.from_dict(ITC_DICT)
+        packet.packet_timestamp = '2024-01-02 03:04:05'
+        data = encode_message({'packets': [encode_packet(packet)]})
+        decoded = decode_packet(decode_message(data)['packets'][0])
+        self.assertEqual(decoded.packet_type, 'inform_transaction_complete')
+        self.assertEqual(decoded.transaction_id, 5)
+        self.assertEqual(str(decoded.packet_timestamp), '2024-01-02 03:04:05')
+
+    def test_worker_config(self):
+        config = {
+            'snapshot_dir': '/tmp/amie',
+            'trace_file': '/tmp/trace.json',
+            'sp_record_file': '',
+            'metrics_address': 'localhost:9100',
+            'profile_dir': '/var/log',
+            }
+        wconfig = worker_config(config, 2)
+        self.assertEqual(wconfig['snapshot_dir'], '/tmp/amie/.shard2')
+        self.assertEqual(wconfig['trace_file'], '/tmp/trace.shard2.json')
+        self.assertEqual(wconfig['sp_record_file'], '')
+        self.assertEqual(wconfig['metrics_address'], '')
+        self.assertEqual(wconfig['profile_dir'], '/var/log/shard2')
+        self.assertEqual(config['snapshot_dir'], '/tmp/amie')
+
+    def test_forwarding_snapshots(self):
+        snapshots = ForwardingSnapshots()
+        snapshots.update('a', {'x': 1})
+        snapshots.update('a', {'x': 2})
+        snapshots.update('b', {'x': 1})
+        self.assertEqual(snapshots.take_changes(),
+                         [['a', {'x': 2}], ['b', {'x': 1}]])
+        snapshots.update('b', {'x': 1})
+        snapshots.delete('a')
+        snapshots.delete('c')
+        self.assertEqual(snapshots.take_changes(), [['a', None]])
+        self.assertEqual(snapshots.take_changes(), [])
+
+    def test_dispatch(self):
+        snapshot_dir = str(Path(tempdir.name, 'dispatch'))
+        workers = [
+            MockWorker({'wait': 60, 'actionable': True,
+                        'depths': {'transactions': 2},
+                        'snapshots': [['k1', {'x': 1}]]}),
+            MockWorker({'error': 'ServiceProviderTimeout',
+                        'message': 'timed out',
+                        'snapshots': [['k2', {'x': 2}]]}),
+            ]
+        coordinator = ShardCoordinator({'snapshot_dir': snapshot_dir},
+                                       MockAMIEClient(), None, workers)
+        task = _task_status()
+        with self.assertRaises(ServiceProviderTemporaryError):
+            coordinator._dispatch([], [task])
+        shard = shard_for(task['amie_transaction_id'], 2)
+        self.assertEqual(len(workers[shard].messages[0]['tasks']), 1)
+        self.assertEqual(len(workers[1 - shard].messages[0]['tasks']), 0)
+        self.assertEqual(sorted(p.name for p in Path(snapshot_dir).iterdir()),
+                         ['k1', 'k2'])
+        self.assertEqual(coordinator._get_queue_depths(), {'transactions': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+import unittest
+import threading
+from singleflight import (SingleFlight, make_key, COALESCED_CALLS)
+
+class TestSingleFlight(unittest.TestCase):
+    def test_make_key(self):
+        self.assertEqual(make_key('lookup_person', {'PersonID': 'p1',
+                                                    'GlobalID': ['1', '2']}),
+                         make_key('lookup_person', {'GlobalID': ['1', '2'],
+                                                    'PersonID': 'p1'}))
+        self.assertNotEqual(make_key('lookup_person', {'PersonID': 'p1'}),
+                            make_key('lookup_org', {'PersonID': 'p1'}))
+
+    def test_same_pass(self):
+        group = SingleFlight()
+        calls = list()
+
+        def lookup():
+            calls.append(1)
+            return {'OrgCode': '0012345'}
+
+        key = make_key('lookup_org', {'OrgCode': '0012345'})
+        first = group.do(key, lookup)
+        self.assertIs(group.do(key, lookup), first)
+        self.assertEqual(len(calls), 1)
+        group.do(make_key('lookup_org', {'OrgCode': '0099999'}), lookup)
+        self.assertEqual(len(calls), 2)
+        group.invalidate()
+        group.do(key, lookup)
+        self.assertEqual(len(calls), 3)
+
+    def test_errors_not_kept(self):
+        group = SingleFlight()
+        calls = list()
+
+        def lookup():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError("temporary")
+            return 'found'
+
+        key = make_key('lookup_person', {'PersonID': 'p1'})
+        with self.assertRaises(ValueError):
+            group.do(key, lookup)
+        self.assertEqual(group.do(key, lookup), 'found')
+        self.assertEqual(len(calls), 2)
+
+    def test_concurrent(self):
+        group = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = list()
+
+        def slow_lookup():
+            calls.append(1)
+            started.set()
+            release.wait(10)
+            return 'p1'
+
+        key = make_key('lookup_person', {'PersonID': 'p1'})
+        before = COALESCED_CALLS.get(method='lookup_person')
+        results = list()
+
+        def run():
+            results.append(group.do(key, slow_lookup))
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        threads[0].start()
+        started.wait(10)
+        for thread in threads[1:]:
+            thread.start()
+        while COALESCED_CALLS.get(method='lookup_person') < before + 3:
+            release.wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results, ['p1'] * 4)
+        self.assertEqual(len(calls), 1)
+
+    def test_invalidate_while_running(self):
+        group = SingleFlight()
+        release = threading.Event()
+        started = threading.Event()
+        calls = list()
+
+        def lookup():
+            calls.append(1)
+            if len(calls) == 1:
+                started.set()
+                release.wait(10)
+            return len(calls)
+
+        key = make_key('lookup_person', {'PersonID': 'p1'})
+        thread = threading.Thread(target=group.do, args=(key, lookup))
+        thread.start()
+        started.wait(10)
+        # a change is made while the first lookup is running
+        group.invalidate()
+        release.set()
+        thread.join(10)
+        self.assertEqual(group.do(key, lookup), 2)
+        self.assertEqual(group.do(key, lookup), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
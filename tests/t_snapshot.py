@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import os
+import time
+from pathlib import Path
+from snapshot import Snapshots
+
+tempdir = tempfile.TemporaryDirectory()
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.dir = str(Path(tempdir.name, self.id().split('.')[-1]))
+
+    def test_update_and_list(self):
+        writer = Snapshots(self.dir, 'w')
+        reader = Snapshots(self.dir, 'r')
+        writer.update('b', {'n': 2})
+        writer.update('a', {'n': 1})
+        self.assertEqual(reader.list(), [{'n': 1}, {'n': 2}])
+        self.assertEqual(writer.list(), [{'n': 1}, {'n': 2}])
+        self.assertEqual(reader.get('a'), {'n': 1})
+
+        writer.update('a', {'n': 30})
+        writer.delete('b')
+        self.assertEqual(reader.list(), [{'n': 30}])
+        self.assertEqual(reader.get('b'), None)
+
+    def test_list_reuses_unchanged(self):
+        writer = Snapshots(self.dir, 'w')
+        reader = Snapshots(self.dir, 'r')
+        writer.update('a', {'n': 1})
+        writer.update('b', {'n': 2})
+        first = reader.list()
+        writer.update('b', {'n': 3})
+        second = reader.list()
+        self.assertIs(first[0], second[0], msg="unchanged snapshot re-read")
+        self.assertEqual(second[1], {'n': 3})
+        self.assertIs(reader.get('a'), first[0])
+
+    def test_partial_write(self):
+        writer = Snapshots(self.dir, 'w')
+        reader = Snapshots(self.dir, 'r')
+        writer.update('a', {'n': 1})
+        self.assertEqual(reader.list(), [{'n': 1}])
+        Path(self.dir, 'a').write_text('{"n":')
+        self.assertEqual(reader.list(), [{'n': 1}])
+        Path(self.dir, 'b').write_text('{"n":')
+        self.assertEqual(reader.list(), [{'n': 1}])
+
+    def test_get_when_updated(self):
+        writer = Snapshots(self.dir, 'w')
+        reader = Snapshots(self.dir, 'r')
+        writer.update('a', {'n': 1})
+        (data, token) = reader.get_when_updated('a')
+        self.assertEqual(data, {'n': 1})
+        writer.update('b', {'n': 1})
+        starttime = time.time()
+        (data, token2) = reader.get_when_updated('a', 1, token)
+        self.assertEqual(data, None, msg="unchanged key reported as updated")
+        self.assertEqual(token, token2)
+        self.assertTrue(time.time() - starttime > 0.5)
+        writer.update('a', {'n': 2})
+        (data, token3) = reader.get_when_updated('a', 1, token)
+        self.assertEqual(data, {'n': 2})
+        self.assertNotEqual(token, token3)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import os
+from pathlib import Path
+from snapshotjournal import (SnapshotJournal, open_snapshots)
+
+tempdir = tempfile.TemporaryDirectory()
+
+class TestSnapshotJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = str(Path(tempdir.name, self.id().split('.')[-1]))
+
+    def test_update_and_list(self):
+        writer = SnapshotJournal(self.dir, 'w')
+        reader = SnapshotJournal(self.dir, 'r')
+        writer.update('b', {'n': 2})
+        writer.update('a', {'n': 1})
+        self.assertEqual(reader.list(), [{'n': 1}, {'n': 2}])
+        self.assertEqual(writer.list(), [{'n': 1}, {'n': 2}])
+
+        writer.update('a', {'n': 3})
+        writer.delete('b')
+        self.assertEqual(reader.list(), [{'n': 3}])
+        self.assertEqual(reader.get('a'), {'n': 3})
+        self.assertEqual(reader.get('b'), None)
+        files = [f for f in os.listdir(self.dir) if not f.startswith('.')]
+        self.assertEqual(files, [], msg="journal wrote visible files")
+
+    def test_history_survives_delete(self):
+        writer = SnapshotJournal(self.dir, 'w')
+        writer.update('a', {'state': 'queued'})
+        writer.update('a', {'state': 'queued'})
+        writer.update('a', {'state': 'successful'})
+        writer.delete('a')
+        reader = SnapshotJournal(self.dir, 'r')
+        history = reader.history('a')
+        ops = [(r['op'], r.get('data', None)) for r in history]
+        self.assertEqual(ops, [('update', {'state': 'queued'}),
+                               ('update', {'state': 'successful'}),
+                               ('delete', None)])
+
+    def test_compaction(self):
+        writer = SnapshotJournal(self.dir, 'w', max_journal_size=200,
+                                 keep_journals=1)
+        reader = SnapshotJournal(self.dir, 'r')
+        for i in range(50):
+            writer.update('k' + str(i % 5), {'i': i})
+            if i % 7 == 0:
+                self.assertEqual(len(reader.list()), min(i + 1, 5))
+        self.assertTrue(writer.generation > 2, msg="journal not rotated")
+        journals = [f for f in os.listdir(self.dir)
+                    if f.startswith('.journal.')]
+        self.assertTrue(len(journals) <= 2, msg="old journals not removed")
+        expected = [{'i': i} for i in range(45, 50)]
+        self.assertEqual(reader.list(), expected)
+        self.assertEqual(SnapshotJournal(self.dir, 'r').list(), expected)
+
+    def test_tail(self):
+        writer = SnapshotJournal(self.dir, 'w')
+        reader = SnapshotJournal(self.dir, 'r')
+        writer.update('a', {'n': 1})
+        (records, position) = reader.tail()
+        self.assertEqual([r['seq'] for r in records], [1])
+        writer.update('a', {'n': 2})
+        writer.update('b', {'n': 1})
+        (records, position) = reader.tail(position)
+        self.assertEqual([r['seq'] for r in records], [2, 3])
+        (records, position) = reader.tail(position)
+        self.assertEqual(records, [])
+
+    def test_get_when_updated(self):
+        writer = SnapshotJournal(self.dir, 'w')
+        reader = SnapshotJournal(self.dir, 'r')
+        writer.update('a', {'n': 1})
+        (data, token) = reader.get_when_updated('a')
+        self.assertEqual(data, {'n': 1})
+        writer.compact()
+        writer.update('b', {'n': 1})
+        (data, token2) = reader.get_when_updated('a', 0, token)
+        self.assertEqual(data, None, msg="unchanged key reported as updated")
+        self.assertEqual(token, token2)
+        writer.update('a', {'n': 2})
+        (data, token3) = reader.get_when_updated('a', 0, token)
+        self.assertEqual(data, {'n': 2})
+
+    def test_restart_without_purge(self):
+        writer = SnapshotJournal(self.dir, 'w')
+        writer.update('a', {'n': 1})
+        writer.update('b', {'n': 2})
+        writer = SnapshotJournal(self.dir, 'w', purge_writeable=False)
+        writer.update('c', {'n': 3})
+        reader = SnapshotJournal(self.dir, 'r')
+        self.assertEqual(reader.list(), [{'n': 1}, {'n': 2}, {'n': 3}])
+
+        writer = SnapshotJournal(self.dir, 'w')
+        self.assertEqual(SnapshotJournal(self.dir, 'r').list(), [])
+
+    def test_open_snapshots(self):
+        snapshots = open_snapshots(self.dir, 'w', 'journal')
+        self.assertTrue(isinstance(snapshots, SnapshotJournal))
+        with self.assertRaises(ValueError):
+            open_snapshots(self.dir, 'r', 'nosuch')
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+import os
+import unittest
+import tempfile
+import threading
+import time
+from pathlib import Path
+from snapshot import Snapshots
+from snapshotjournal import SnapshotJournal
+from snapshotserver import (SnapshotServer, SnapshotClient, parse_address)
+
+tempdir = tempfile.TemporaryDirectory()
+
+def tearDownModule():
+    tempdir.cleanup()
+
+class TestSnapshotServer(unittest.TestCase):
+    def setUp(self):
+        name = self.id().split('.')[-1]
+        self.dir = str(Path(tempdir.name, name))
+        self.address = str(Path(tempdir.name, name + '.sock'))
+
+    def start(self, snapshots, address=None):
+        self.addCleanup(snapshots.close)
+        server = SnapshotServer(snapshots, address or self.address)
+        server.start()
+        self.addCleanup(server.stop)
+        client = SnapshotClient(server.address)
+        self.addCleanup(client.close)
+        return client
+
+    def later(self, secs, function, *args):
+        timer = threading.Timer(secs, function, args)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def test_parse_address(self):
+        self.assertEqual(parse_address('/run/amie.sock')[1], '/run/amie.sock')
+        self.assertEqual(parse_address('8123')[1], ('localhost', 8123))
+        self.assertEqual(parse_address('127.0.0.1:8123', True)[1],
+                         ('127.0.0.1', 8123))
+        self.assertEqual(parse_address('8123', True)[1], ('localhost', 8123))
+        for address in ('0.0.0.0:8123', 'example.com:8123'):
+            with self.assertRaises(ValueError, msg=address):
+                parse_address(address, loopback_only=True)
+        with self.assertRaises(ValueError):
+            SnapshotServer(Snapshots(self.dir, 'w'), '0.0.0.0:8123').start()
+        with self.assertRaises(ValueError):
+            SnapshotClient('0.0.0.0:8123')
+
+    def test_list_and_get(self):
+        writer = Snapshots(self.dir, 'w')
+        client = self.start(writer)
+        self.assertEqual(os.stat(self.address).st_mode & 0o777, 0o600)
+        self.assertEqual(client.list(), [])
+        writer.update('b', {'n': 2})
+        writer.update('a', {'n': 1})
+        self.assertEqual(client.list(), [{'n': 1}, {'n': 2}])
+        self.assertEqual(client.get('a'), {'n': 1})
+        self.assertEqual(client.get('nosuch'), None)
+        writer.delete('a')
+        self.assertEqual(client.get('a'), None)
+        self.assertEqual(client.list(), [{'n': 2}])
+
+    def test_get_when_updated(self):
+        writer = Snapshots(self.dir, 'w')
+        client = self.start(writer)
+        writer.update('a', {'n': 1})
+        (data, token) = client.get_when_updated('a')
+        self.assertEqual(data, {'n': 1})
+
+        writer.update('b', {'n': 1})
+        starttime = time.time()
+        (data, token2) = client.get_when_updated('a', 1, token)
+        self.assertEqual(data, None, msg="unchanged key reported as updated")
+        self.assertEqual(token, token2)
+        self.assertTrue(time.time() - starttime > 0.5)
+
+        self.later(0.2, writer.update, 'a', {'n': 2})
+        starttime = time.time()
+        (data, token3) = client.get_when_updated('a', 5, token)
+        self.assertEqual(data, {'n': 2})
+        self.assertTrue(time.time() - starttime < 3, msg="long poll missed")
+
+        writer.delete('a')
+        self.assertEqual(client.get_when_updated('a', 1, token3), (None, None))
+
+    def test_list_when_updated(self):
+        writer = SnapshotJournal(self.dir, 'w')
+        client = self.start(writer, 'localhost:0')
+        writer.update('a', {'n': 1})
+        self.assertEqual(client.list_when_updated(5), [{'n': 1}])
+        self.later(0.2, writer.update, 'b', {'n': 2})
+        starttime = time.time()
+        self.assertEqual(client.list_when_updated(5), [{'n': 1}, {'n': 2}])
+        self.assertTrue(time.time() - starttime < 3, msg="long poll missed")
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+import unittest
+import threading
+import time
+from spexception import (ServiceProviderTemporaryError,
+                         ServiceProviderRequestFailed)
+from serviceprovider import ServiceProvider
+from sppool import ServiceProviderPool
+from organization import AMIEOrg
+from deadline import (DeadlineExceeded, budget)
+
+CONFIG = {
+    'package': '',
+    'module': 'serviceproviderslow',
+    }
+
+class TestServiceProviderPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = ServiceProviderPool(CONFIG, 2, timeout=5)
+        self.addCleanup(self.pool.close)
+
+    def test_calls(self):
+        self.assertEqual(self.pool.get_tasks(active=True), [])
+        org = self.pool.lookup_org(OrgCode='0032425')
+        self.assertIsInstance(org, AMIEOrg)
+        self.assertEqual(org['OrgCode'], '0032425')
+
+    def test_errors(self):
+        with self.assertRaises(ServiceProviderTemporaryError):
+            self.pool.lookup_org(behavior='temporary')
+        with self.assertRaises(ServiceProviderRequestFailed):
+            self.pool.lookup_org(behavior='failed')
+        self.assertIsNotNone(self.pool.lookup_org())
+
+    def test_parallel(self):
+        start = time.monotonic()
+        calls = [self.pool.submit('lookup_org', (),
+                                  {'behavior': 'sleep', 'secs': 0.5})
+                 for i in range(2)]
+        for call in calls:
+            call.result(5)
+        self.assertLess(time.monotonic() - start, 0.9)
+        pids = set()
+        threads = [threading.Thread(
+            target=lambda: pids.add(self.pool.lookup_org(behavior='pid')))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(pids)
+
+    def test_timeout_and_crash(self):
+        self.pool.timeout = 0.2
+        with self.assertRaises(ServiceProviderTemporaryError):
+            self.pool.lookup_org(behavior='sleep', secs=5)
+        self.pool.timeout = 5
+        self.assertIsNotNone(self.pool.lookup_org())
+
+        with self.assertRaises(ServiceProviderTemporaryError):
+            self.pool.lookup_org(behavior='crash')
+        pid = self.pool.lookup_org(behavior='pid')
+        self.assertIsInstance(pid, int)
+
+    def test_deadline(self):
+        start = time.monotonic()
+        with budget(0.2, 'packet'):
+            with self.assertRaises(DeadlineExceeded):
+                self.pool.lookup_org(behavior='sleep', secs=1)
+        self.assertLess(time.monotonic() - start, 0.9)
+        # the worker is not restarted; it finishes the abandoned call
+        self.assertIsNotNone(self.pool.lookup_org())
+
+    def test_facade(self):
+        sp = ServiceProvider()
+        sp.apply_config(dict(CONFIG, sp_pool_size='1'))
+        self.addCleanup(sp.implem.close)
+        self.assertIsInstance(sp.implem, ServiceProviderPool)
+        self.assertEqual(sp.get_tasks(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import json
+from datetime import (datetime, timedelta)
+from pathlib import Path
+from misctypes import TimeUtil
+from spexception import (ServiceProviderError, ServiceProviderTimeout)
+from taskstatus import TaskStatus
+from organization import AMIEOrg
+from sprecorder import (RecordingServiceProvider, open_recording,
+                        RECORD_VERSION)
+from spreplay import ServiceProvider as ReplayServiceProvider
+
+tempdir = tempfile.TemporaryDirectory()
+
+TRID = 'TGCDB:NCAR:TGCDB:100'
+
+def _task_status(task_state, job_id='1', atrid=TRID, timestamp=1000):
+    return TaskStatus(amie_transaction_id=atrid,
+                      amie_packet_id='1',
+                      amie_packet_type='request_project_create',
+                      job_id=job_id,
+                      task_name='create_project',
+                      task_state=task_state,
+                      timestamp=timestamp,
+                      products=[])
+
+def _task_kwargs(job_id='1', atrid=TRID):
+    return {'amie_transaction_id': atrid,
+            'amie_packet_id': '1',
+            'amie_packet_type': 'request_project_create',
+            'job_id': job_id,
+            'task_name': 'create_project',
+            'timestamp': 1000}
+
+class LocalSP(object):
+    def __init__(self):
+        self.config = None
+
+    def apply_config(self, config):
+        self.config = config
+
+    def lookup_org(self, *args, **kwargs):
+        return AMIEOrg(OrgCode='0012345', Organization='Some University')
+
+    def lookup_local_fos(self, *args, **kwargs):
+        raise ServiceProviderTimeout("timed out")
+
+    def create_project(self, *args, **kwargs):
+        return _task_status('queued', job_id=kwargs['job_id'])
+
+    def get_tasks(self, active=True, wait=None, since=None):
+        return [_task_status('queued')]
+
+    def iter_tasks(self, active=True, wait=None, since=None, page_size=None):
+        raise AssertionError("task streams are not read while recording")
+
+
+class MockTimeUtil(TimeUtil):
+    def __init__(self):
+        self.time = datetime(2023, 8, 3, 12, 0, 0)
+
+    def now(self):
+        return self.time
+
+
+class TestSPRecorder(unittest.TestCase):
+    def _replayer(self, path, **config):
+        timeutil = MockTimeUtil()
+        sp = ReplayServiceProvider()
+        config.setdefault('latency_scale', 0)
+        config.update(replay_file=path, timeutil=timeutil)
+        sp.apply_config(config)
+        return (sp, timeutil)
+
+    def test_record_and_replay(self):
+        path = str(Path(tempdir.name, 'sp.jsonl.gz'))
+        apacket = {'amie_transaction_id': TRID, 'body': 'not recorded'}
+        rsp = RecordingServiceProvider(LocalSP(), path)
+        rsp.apply_config({'x': 1})
+        org = rsp.lookup_org(apacket, OrgCode='0012345')
+        with self.assertRaises(ServiceProviderTimeout):
+            rsp.lookup_local_fos(FieldOfScience='Physics')
+        rsp.create_project(**_task_kwargs())
+        rsp.close()
+
+        with open_recording(path, 'r') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]['v'], RECORD_VERSION)
+        self.assertEqual([r['m'] for r in records[1:]],
+                         ['lookup_org', 'lookup_local_fos', 'create_project'])
+        self.assertEqual(records[1]['a'], [])
+        self.assertEqual(records[2]['e'], 'ServiceProviderTimeout')
+
+        (sp, timeutil) = self._replayer(path)
+        self.assertEqual(sp.lookup_org(apacket, OrgCode='0012345'), org)
+        with self.assertRaises(ServiceProviderTimeout):
+            sp.lookup_local_fos(FieldOfScience='Physics')
+        # the job ID differs from the recording, so it is not matched exactly
+        ts = sp.create_project(**_task_kwargs(job_id='7'))
+        self.assertIsInstance(ts, TaskStatus)
+        self.assertEqual(ts['job_id'], '7')
+        self.assertEqual(sp.mismatches, 0)
+        with self.assertRaises(ServiceProviderError):
+            sp.lookup_org(apacket, OrgCode='0012345')
+
+    def test_mismatch(self):
+        path = str(Path(tempdir.name, 'mismatch.jsonl'))
+        rsp = RecordingServiceProvider(LocalSP(), path)
+        rsp.lookup_org(OrgCode='0012345')
+        rsp.close()
+
+        (sp, timeutil) = self._replayer(path, strict=True)
+        with self.assertRaises(ServiceProviderError):
+            sp.lookup_org(OrgCode='0099999')
+
+        (sp, timeutil) = self._replayer(path)
+        org = sp.lookup_org(OrgCode='0099999')
+        self.assertEqual(org['OrgCode'], '0012345')
+        self.assertEqual(sp.mismatches, 1)
+
+    def test_iter_tasks(self):
+        path = str(Path(tempdir.name, 'iter_tasks.jsonl'))
+        rsp = RecordingServiceProvider(LocalSP(), path)
+        tasks = rsp.iter_tasks(wait=5, page_size=10)
+        self.assertEqual(next(tasks)['task_state'], 'queued')
+        # the stream is abandoned part way through; the call is recorded anyway
+        tasks.close()
+        rsp.close()
+
+        with open_recording(path, 'r') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[1]['m'], 'get_tasks')
+        self.assertEqual(records[1]['k'],
+                         {'active': True, 'wait': 5, 'since': None})
+        self.assertEqual(records[1]['r'][0], 'list')
+
+        (sp, timeutil) = self._replayer(path)
+        self.assertEqual(len(sp.get_tasks_calls), 1)
+        tasks = sp.get_tasks()
+        self.assertEqual([t['task_state'] for t in tasks], ['queued'])
+
+    def test_task_timeline(self):
+        path = str(Path(tempdir.name, 'timeline.jsonl'))
+        queued = ['TaskStatus', dict(_task_status('queued'))]
+        done = ['TaskStatus', dict(_task_status('successful'))]
+        records = [
+            {'v': RECORD_VERSION, 'start': 0},
+            {'m': 'create_project', 'a': [], 'k': _task_kwargs(),
+             'r': queued, 't': 10.0, 'd': 0.5},
+            {'m': 'get_tasks', 'a': [], 'k': {}, 'r': ['list', [queued]],
+             't': 11.0, 'd': 0.0},
+            {'m': 'get_tasks', 'a': [], 'k': {}, 'r': ['list', [done]],
+             't': 30.5, 'd': 0.0},
+            {'m': 'clear_transaction', 'a': [TRID], 'k': {}, 'r': [None, None],
+             't': 31.0, 'd': 0.0},
+            ]
+        with open(path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+        (sp, timeutil) = self._replayer(path, latency_scale=0.5)
+        sp._delay = lambda secs: None
+        self.assertEqual(sp.get_tasks(), [])
+
+        atrid = 'TGCDB:NCAR:TGCDB:200'
+        ts = sp.create_project(**_task_kwargs(job_id='9', atrid=atrid))
+        self.assertEqual(ts['amie_transaction_id'], atrid)
+        self.assertEqual(sp.mismatches, 1)
+
+        # the task completed 20 seconds after it was submitted; at half scale
+        # that is 10 seconds into the replay
+        timeutil.time += timedelta(seconds=9)
+        tasks = sp.get_tasks()
+        self.assertEqual([t['task_state'] for t in tasks], ['queued'])
+        self.assertEqual(tasks[0]['amie_transaction_id'], atrid)
+        self.assertEqual(tasks[0]['job_id'], '9')
+
+        timeutil.time += timedelta(seconds=2)
+        tasks = sp.get_tasks()
+        self.assertEqual([t['task_state'] for t in tasks], ['successful'])
+        since = tasks[0]['timestamp']
+        self.assertEqual(sp.get_tasks(since=since), [])
+
+        sp.clear_transaction(atrid)
+        self.assertEqual(sp.get_tasks(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import threading
+import time
+from pathlib import Path
+from control import LoopControl
+from taskpush import (TaskDropDirectory, post_task_updates, REJECTED_DIR,
+                      PUSHED_TASKS)
+from mediatorstubs import IdleMediator
+
+tempdir = tempfile.TemporaryDirectory()
+
+ATRID = 'TGCDB:NCAR:TGCDB:100'
+
+def _task(task_name='create_project', task_state='queued', timestamp=1000):
+    return {
+        'amie_transaction_id': ATRID,
+        'amie_packet_id': '1',
+        'amie_packet_type': 'request_project_create',
+        'job_id': '1',
+        'task_name': task_name,
+        'task_state': task_state,
+        'timestamp': timestamp,
+        'products': [],
+        }
+
+class TestTaskPush(unittest.TestCase):
+    def test_take_updates(self):
+        drop_dir = str(Path(tempdir.name, 'take'))
+        drop = TaskDropDirectory(drop_dir)
+        self.assertEqual(drop.take_updates(), [])
+        post_task_updates(drop_dir, _task())
+        post_task_updates(drop_dir, [_task('activate', 'in-progress', 1001),
+                                     _task('notify', 'queued', 1002)])
+        Path(drop_dir, '.partial').write_text('[')
+        Path(drop_dir, 'bad.json').write_text('{"task_name": "x"}')
+        before = PUSHED_TASKS.get(result='rejected')
+
+        tasks = drop.take_updates()
+        self.assertEqual([task['task_name'] for task in tasks],
+                         ['create_project', 'activate', 'notify'])
+        self.assertEqual(tasks[1]['task_state'], 'in-progress')
+        self.assertEqual(PUSHED_TASKS.get(result='rejected'), before + 1)
+        self.assertTrue(Path(drop_dir, REJECTED_DIR, 'bad.json').exists())
+        self.assertFalse(drop.pending())
+        self.assertEqual(drop.take_updates(), [])
+
+    def test_wake(self):
+        drop_dir = str(Path(tempdir.name, 'wake'))
+        control = LoopControl()
+        drop = TaskDropDirectory(drop_dir, control.kick)
+        drop.start()
+        self.addCleanup(drop.stop)
+        timer = threading.Timer(0.2, post_task_updates,
+                                (drop_dir, _task()))
+        timer.start()
+        start = time.monotonic()
+        self.assertTrue(control.sleep(30))
+        self.assertLess(time.monotonic() - start, 10)
+        timer.join()
+        self.assertEqual(len(drop.take_updates()), 1)
+
+    def test_mediator(self):
+        drop_dir = str(Path(tempdir.name, 'mediator'))
+        config = {
+            'snapshot_dir': str(Path(tempdir.name, 'snapshots')),
+            'task_push_dir': drop_dir,
+            'idle_loop_delay': 3600,
+            'pause_max': 3600,
+            }
+        mediator = IdleMediator(config)
+        tm = mediator.transaction_manager
+        thread = threading.Thread(target=mediator.run_loop, daemon=True)
+        thread.start()
+        # leave the loop blocked when the test is done
+        self.addCleanup(mediator.task_drop.stop)
+        self.addCleanup(mediator.loop_control.pause)
+
+        # tasks of transactions with no packets are purged by the first load
+        deadline = time.monotonic() + 10
+        while mediator.amie_packet_update_time is None:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        post_task_updates(drop_dir, _task())
+        while not tm.get_queue_depths()['dangling_tasks']:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertIn(ATRID, tm.get_transaction_ids())
+        # the ServiceProvider is never asked to wait
+        self.assertEqual(set(mediator.waits), {None})
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
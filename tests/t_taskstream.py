@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+from pathlib import Path
+from loopdelay import WaitParms
+from taskstatus import (TaskStatus, encode_task, decode_task)
+from transactionmanager import TransactionManager
+from serviceprovider import (ServiceProvider, ServiceProviderIF)
+from mediator import AMIEMediator
+from mediatorstubs import MockAMIEClient
+
+tempdir = tempfile.TemporaryDirectory()
+
+ATRID = 'TGCDB:NCAR:TGCDB:100'
+
+def _task(atrid=ATRID, task_name='create_project', task_state='queued',
+          timestamp=1000):
+    return {
+        'amie_transaction_id': atrid,
+        'amie_packet_id': '1',
+        'amie_packet_type': 'request_project_create',
+        'job_id': '1',
+        'task_name': task_name,
+        'task_state': task_state,
+        'timestamp': timestamp,
+        'products': [],
+        }
+
+class StreamingServiceProvider(ServiceProviderIF):
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.page_sizes = list()
+
+    def iter_tasks(self, active=True, wait=None, since=None,
+                   page_size=None):
+        self.page_sizes.append(page_size)
+        for task in self.tasks:
+            if since is None or task['timestamp'] > since:
+                yield dict(task)
+
+    def apply_config(self, config): pass
+    def get_local_task_name(self, method_name, kwargs): pass
+    def get_tasks(self, active=True, wait=None, since=None): pass
+    def clear_transaction(self, amie_transaction_id): pass
+    def lookup_org(self, *args, **kwargs): pass
+    def choose_or_add_org(self, *args, **kwargs): pass
+    def lookup_person(self, *args, **kwargs): pass
+    def choose_or_add_person(self, *args, **kwargs): pass
+    def update_person_DNs(self, *args, **kwargs): pass
+    def activate_person(self, *args, **kwargs): pass
+    def lookup_project_by_grant_number(self, *args, **kwargs): pass
+    def lookup_local_fos(self, *args, **kwargs): pass
+    def choose_or_add_local_fos(self, *args, **kwargs): pass
+    def choose_or_add_contract_number(self, *args, **kwargs): pass
+    def lookup_project_name_base(self, *args, **kwargs): pass
+    def choose_or_add_project_name_base(self, *args, **kwargs): pass
+    def create_project(self, *args, **kwargs): pass
+    def lookup_project_task(self, *args, **kwargs): pass
+    def inactivate_project(self, *args, **kwargs): pass
+    def reactivate_project(self, *args, **kwargs): pass
+    def create_account(self, *args, **kwargs): pass
+    def inactivate_account(self, *args, **kwargs): pass
+    def reactivate_account(self, *args, **kwargs): pass
+    def update_allocation(self, *args, **kwargs): pass
+    def modify_user(self, *args, **kwargs): pass
+    def merge_person(self, *args, **kwargs): pass
+    def notify_user(self, *args, **kwargs): pass
+
+class TestTaskStream(unittest.TestCase):
+    def test_encode_task(self):
+        task = _task(task_state='failed', timestamp=2000)
+        task['products'] = [{'name': 'FAILED', 'value': 'no such person'}]
+        decoded = decode_task(encode_task(task))
+        self.assertIsInstance(decoded, TaskStatus)
+        self.assertEqual(decoded['task_state'], 'failed')
+        self.assertEqual(decoded.get_product_value('FAILED'),
+                         'no such person')
+
+    def test_stash_and_hydrate(self):
+        tm = TransactionManager(WaitParms(10, 60, 3600))
+        other = 'TGCDB:NCAR:TGCDB:200'
+        n = tm.stream_task_updates(iter([
+            _task(timestamp=1000),
+            _task(task_state='in-progress', timestamp=2000),
+            _task(task_name='notify', timestamp=1500),
+            _task(atrid=other),
+            ]))
+        self.assertEqual(n, 4)
+        self.assertEqual(tm.transactions, {})
+        self.assertEqual(tm.get_transaction_ids(), {ATRID, other})
+        self.assertEqual(tm.get_queue_depths()['stashed_tasks'], 3)
+
+        # the transaction becomes known, and its stashed tasks are hydrated
+        tm.add_or_update_task(TaskStatus(_task(task_name='activate',
+                                               timestamp=3000)))
+        tslist = tm.get_tasks(ATRID, '1')
+        self.assertEqual(set(tslist.get_name_map()),
+                         {'create_project', 'notify', 'activate'})
+        self.assertEqual(tslist.get('create_project')['task_state'],
+                         'in-progress')
+        self.assertIsInstance(tslist.get('notify'), TaskStatus)
+
+        # tasks of known transactions are buffered directly
+        tm.stream_task_updates([_task(task_state='successful',
+                                      timestamp=4000)])
+        self.assertEqual(tslist.get('create_project')['task_state'],
+                         'successful')
+
+        tm.purge(other)
+        self.assertEqual(tm.get_transaction_ids(), {ATRID})
+        self.assertEqual(tm.get_queue_depths()['stashed_tasks'], 0)
+
+    def test_mediator_stream(self):
+        implem = StreamingServiceProvider([_task(timestamp=1000),
+                                           _task(task_name='notify',
+                                                 timestamp=3000),
+                                           _task(atrid='TGCDB:NCAR:TGCDB:2',
+                                                 timestamp=2000)])
+        sp = ServiceProvider()
+        sp.implem = implem
+        config = {
+            'snapshot_dir': str(Path(tempdir.name, 'snapshots')),
+            'task_page_size': 2,
+            }
+        mediator = AMIEMediator(config, MockAMIEClient(), sp)
+        self.assertEqual(mediator._load_tasks(), 3)
+        self.assertEqual(implem.page_sizes, [2])
+        self.assertEqual(mediator.task_query_time, 3000)
+        self.assertEqual(mediator.transaction_manager.get_queue_depths()[
+            'stashed_tasks'], 3)
+        self.assertEqual(mediator._load_tasks(), 0)
+        self.assertEqual(mediator.task_query_time, 3000)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import unittest
+import tempfile
+import json
+from pathlib import Path
+import tracing
+from tracing import (Tracer, MemoryExporter, ChromeTraceExporter, traced,
+                     trace_methods)
+from retryingproxy import RetryingServiceProxy
+
+tempdir = tempfile.TemporaryDirectory()
+
+class MockService(object):
+    def dotest(self):
+        return 'done'
+
+class Adapter(object):
+    def lookup(self):
+        with tracing.span('inner'):
+            return 1
+
+    def _private(self):
+        return 2
+
+trace_methods(Adapter, 'sp_adapter')
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.exporter = MemoryExporter()
+        tracing.configure(self.exporter)
+
+    def tearDown(self):
+        tracing.configure(None)
+
+    def spans(self):
+        return [e for e in self.exporter.events if e['ph'] == 'X']
+
+    def test_disabled(self):
+        tracer = Tracer()
+        self.assertFalse(tracer.enabled)
+        with tracer.span('x') as span:
+            span.set(a=1)
+        with tracer.transaction('t1'):
+            tracer.begin_transaction('t1')
+            tracer.end_transaction('t1')
+
+    def test_transaction_lanes(self):
+        tracer = tracing.TRACER
+        tracer.begin_transaction('t1')
+        tracer.begin_transaction('t2')
+        with tracer.transaction('t1'):
+            with tracer.span('work1', 'handler'):
+                Adapter().lookup()
+        with tracer.transaction('t2'):
+            with tracer.span('work2', 'handler'):
+                pass
+        with tracer.span('loop'):
+            pass
+        tracer.annotate_transaction('t1', packet_type='request_project_create')
+        tracer.end_transaction('t1')
+
+        spans = {e['name']: e for e in self.spans()}
+        self.assertEqual(spans['work1']['tid'], spans['Adapter.lookup']['tid'])
+        self.assertEqual(spans['work1']['tid'], spans['inner']['tid'])
+        self.assertEqual(spans['work1']['tid'], spans['t1']['tid'])
+        self.assertNotEqual(spans['work1']['tid'], spans['work2']['tid'])
+        self.assertEqual(spans['loop']['tid'], 0)
+        self.assertEqual(spans['Adapter.lookup']['cat'], 'sp_adapter')
+        self.assertEqual(spans['t1']['args'],
+                         {'packet_type': 'request_project_create'})
+        self.assertNotIn('t2', spans, msg="unfinished transaction exported")
+        root = spans['t1']
+        inner = spans['inner']
+        self.assertTrue(root['ts'] <= inner['ts'] and
+                        inner['ts'] + inner['dur'] <= root['ts'] + root['dur'])
+        self.assertEqual(Adapter()._private(), 2)
+
+    def test_error_and_decorator(self):
+        @traced('failing', 'test')
+        def failing():
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            failing()
+        self.assertEqual(self.spans()[0]['args'], {'error': 'ValueError'})
+
+    def test_session_spans(self):
+        class TracedSession(RetryingServiceProxy):
+            pass
+        TracedSession.configure(MockService(), 1, 30, 90)
+        with tracing.TRACER.transaction('t1'):
+            with TracedSession() as svc:
+                svc.dotest()
+        self.assertEqual([e['name'] for e in self.spans()],
+                         ['TracedSession.dotest'])
+
+    def test_chrome_trace_file(self):
+        path = str(Path(tempdir.name, 'trace.json'))
+        tracing.configure(ChromeTraceExporter(path))
+        with tracing.TRACER.transaction('t1'):
+            with tracing.span('work'):
+                pass
+        tracing.TRACER.flush()
+        tracing.configure(None)
+        events = json.loads(Path(path).read_text())
+        names = [e.get('name', None) for e in events]
+        self.assertIn('thread_name', names)
+        self.assertIn('work', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
+    tempdir.cleanup()
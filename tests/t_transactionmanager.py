@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import unittest
+from datetime import (datetime, timedelta)
+from amieclient.packet.base import Packet
+from fixtures.request_project_create import RPC_PKT_1
+from loopdelay import WaitParms
+from transactionmanager import TransactionManager
+
+class MockTimeUtil(object):
+    def __init__(self):
+        self.time = datetime(2024, 1, 1)
+
+    def now(self):
+        return self.time
+
+    def future_time(self, seconds, basetime=None):
+        return (basetime or self.time) + timedelta(seconds=seconds)
+
+def _packet(transaction_id, packet_id=2):
+    packet = Packet.from_dict(RPC_PKT_1)
+    packet.transaction_id = transaction_id
+    packet.packet_id = packet_id
+    packet.packet_rec_id = transaction_id * 10 + packet_id
+    packet.packet_timestamp = '2024-01-01 00:00:00'
+    return packet
+
+class TestTransactionManager(unittest.TestCase):
+    def test_loop_delay_waiting_on_tasks(self):
+        time_util = MockTimeUtil()
+        tm = TransactionManager(WaitParms(10, 60, 3600, time_util))
+        start = time_util.now()
+        tm.buffer_incoming_amie_packet(start, _packet(100))
+        self.assertTrue(tm.have_actionable_packets())
+        loop_delay = tm.get_loop_delay()
+        self.assertEqual(loop_delay.get_target_time(),
+                         start + timedelta(seconds=60))
+        self.assertEqual(loop_delay.wait_secs(), 60)
+
+        # AMIE does not list the packet again while the ServiceProvider works
+        # on it, so the transaction's target time is moved forward instead of
+        # leaving the loop to poll without pausing
+        time_util.time += timedelta(seconds=61)
+        loop_delay = tm.get_loop_delay()
+        self.assertEqual(loop_delay.get_target_time(),
+                         time_util.time + timedelta(seconds=60))
+        self.assertEqual(loop_delay.wait_secs(), 60)
+        time_util.time += timedelta(seconds=30)
+        self.assertEqual(tm.get_loop_delay().wait_secs(), 30)
+
+    def test_requeue_outgoing(self):
+        time_util = MockTimeUtil()
+        tm = TransactionManager(WaitParms(10, 60, 3600, time_util))
+        packets = list()
+        for transaction_id in (100, 101):
+            tm.buffer_incoming_amie_packet(time_util.now(),
+                                           _packet(transaction_id))
+            packets.append(_packet(transaction_id, 3))
+            tm.buffer_outgoing_amie_packet(packets[-1])
+        self.assertEqual(len(tm.get_outgoing_amie_packets()), 2)
+        # not resent until reply_delay passes
+        self.assertEqual(tm.get_outgoing_amie_packets(), [])
+        tm.requeue_outgoing_amie_packet(packets[1])
+        self.assertEqual(tm.get_outgoing_amie_packets(), [packets[1]])
+        time_util.time += timedelta(seconds=10)
+        self.assertEqual(len(tm.get_outgoing_amie_packets()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()